@@ -9,11 +9,9 @@ if sys.platform == 'win32':
 
 from flask import Flask, render_template, redirect, url_for, session, g, flash, request
 from flask_login import LoginManager, current_user
-from sqlalchemy import inspect, text
-from sqlalchemy.pool import NullPool
 import os
 from config import Config
-from models.models import db, User, Settings, backfill_invoice_identifiers, assign_random_birth_dates_to_old_customers
+from models.models import db, User
 from models.master_models import MasterUser, CafeModule, CafeTenant  # noqa: F401 (register master tables)
 from services.master_service import MODULE_CODES, ensure_master_admin, module_for_endpoint
 from utils.helpers import register_jinja_filters
@@ -24,7 +22,21 @@ from routes.master_portal import master_bp
 from routes.tenant_auth import tenant_auth_bp
 from routes.tenant import tenant_bp
 from routes.tenant_dashboard import tenant_dashboard_bp
-from services.schema_migrations import migrate_operational_schema
+from services.background_jobs import configure_background_jobs
+from services.compiled_recipes import register_compiled_recipe_events
+from services.customer_directory import register_customer_directory_events
+from services.fleet_metrics import configure_fleet_metrics, register_fleet_metrics_events
+from services.fleet_query import configure_fleet_queries
+from services.live_events import register_live_events
+from services.menu_availability import register_menu_availability_events
+from services.menu_stats import register_menu_stats_events
+from services.sales_rollup import register_sales_rollup_events
+from services.schema_migrations import migrate_master_schema, migrate_operational_schema, migrate_tenant_schema_once
+from services.settings_cache import current_settings, register_settings_cache_events
+from services.stock_ledger import register_stock_ledger_events
+from services.tenant_context import resolve_tenant_context
+from services.tenant_engines import configure_tenant_engines, get_tenant_engine, tenant_sessionmaker
+from services.unit_factors import register_unit_factor_events
 from routes.menu import menu_bp
 from routes.order import order_bp
 from routes.dashboard import dashboard_bp
@@ -44,19 +56,15 @@ def load_user(user_id):
     """Load user from database. If tenant session exists, load from tenant DB."""
     try:
         from flask import session, has_request_context
-        from sqlalchemy import create_engine
         
         # Only check tenant session if we're in a request context
         if has_request_context():
             tenant_slug = session.get('tenant_slug')
             if tenant_slug:
                 # Load user from tenant database
-                from models.master_models import CafeTenant
-                cafe = CafeTenant.query.filter_by(slug=tenant_slug).first()
+                cafe = resolve_tenant_context(tenant_slug)
                 if cafe and os.path.exists(cafe.db_path):
-                    tenant_engine = create_engine(f"sqlite:///{cafe.db_path}", poolclass=NullPool)
-                    from sqlalchemy.orm import sessionmaker
-                    Session = sessionmaker(bind=tenant_engine)
+                    Session = tenant_sessionmaker(cafe.db_path)
                     with Session() as s:
                         user = s.query(User).get(int(user_id))
                         if user:
@@ -79,156 +87,28 @@ def create_app(config_class=Config):
     # Initialize extensions
     db.init_app(app)
     login_manager.init_app(app)
+    configure_tenant_engines(app.config)
+    configure_fleet_queries(app.config)
+    configure_fleet_metrics(app)
+    configure_background_jobs(app)
+    register_unit_factor_events()
+    register_customer_directory_events()
+    register_stock_ledger_events()
+    register_menu_availability_events()
+    register_compiled_recipe_events()
+    register_menu_stats_events()
+    register_sales_rollup_events()
+    register_fleet_metrics_events()
+    register_settings_cache_events()
+    register_live_events()
     
-    # Apply lightweight schema migrations (e.g., missing columns on SQLite)
+    # Apply schema migrations (missing columns, tables and indexes on SQLite)
     with app.app_context():
-        engine = db.get_engine()
-        migrate_operational_schema(engine)
-        inspector = inspect(engine)
-        existing_tables = inspector.get_table_names()
-        if 'customer' in existing_tables:
-            customer_columns = {col['name'] for col in inspector.get_columns('customer')}
-            if 'birth_date' not in customer_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE customer ADD COLUMN birth_date DATE'))
-        if 'table' in existing_tables:
-            table_columns = {col['name'] for col in inspector.get_columns('table')}
-            if 'is_reserved' not in table_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "table" ADD COLUMN is_reserved BOOLEAN DEFAULT 0'))
-        if 'menu_item_material' in existing_tables:
-            material_columns = {col['name'] for col in inspector.get_columns('menu_item_material')}
-            if 'raw_material_id' not in material_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "menu_item_material" ADD COLUMN raw_material_id INTEGER REFERENCES raw_material(id)'))
-        # Create warehouse_material_min_stock table if it doesn't exist
-        if 'warehouse_material_min_stock' not in existing_tables:
-            with engine.begin() as conn:
-                conn.execute(text('''
-                    CREATE TABLE warehouse_material_min_stock (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        raw_material_id INTEGER NOT NULL,
-                        warehouse_id INTEGER NOT NULL,
-                        min_stock REAL NOT NULL DEFAULT 0.0,
-                        created_at DATETIME,
-                        updated_at DATETIME,
-                        FOREIGN KEY (raw_material_id) REFERENCES raw_material(id),
-                        FOREIGN KEY (warehouse_id) REFERENCES warehouse(id),
-                        UNIQUE(raw_material_id, warehouse_id)
-                    )
-                '''))
-        # Migrate pre_production_stock table to add warehouse_id
-        if 'pre_production_stock' in existing_tables:
-            pre_production_stock_columns = {col['name'] for col in inspector.get_columns('pre_production_stock')}
-            if 'warehouse_id' not in pre_production_stock_columns:
-                # Get pre_production warehouse ID
-                with engine.begin() as conn:
-                    # First, add the warehouse_id column (nullable initially)
-                    conn.execute(text('ALTER TABLE pre_production_stock ADD COLUMN warehouse_id INTEGER'))
-                    # Get pre_production warehouse ID
-                    result = conn.execute(text('SELECT id FROM warehouse WHERE code = :code'), {'code': 'pre_production'})
-                    pre_prod_wh_row = result.fetchone()
-                    if pre_prod_wh_row:
-                        pre_prod_wh_id = pre_prod_wh_row[0]
-                        # Update all existing records to point to pre_production warehouse
-                        conn.execute(text('UPDATE pre_production_stock SET warehouse_id = :wh_id WHERE warehouse_id IS NULL'), {'wh_id': pre_prod_wh_id})
-                    # Make warehouse_id NOT NULL and add foreign key
-                    # SQLite doesn't support ALTER COLUMN, so we need to recreate the table
-                    conn.execute(text('''
-                        CREATE TABLE pre_production_stock_new (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            pre_production_item_id INTEGER NOT NULL,
-                            warehouse_id INTEGER NOT NULL,
-                            quantity REAL NOT NULL DEFAULT 0.0,
-                            unit VARCHAR(32) NOT NULL DEFAULT 'عدد',
-                            created_at DATETIME,
-                            updated_at DATETIME,
-                            FOREIGN KEY (pre_production_item_id) REFERENCES pre_production_item(id),
-                            FOREIGN KEY (warehouse_id) REFERENCES warehouse(id),
-                            UNIQUE(pre_production_item_id, warehouse_id)
-                        )
-                    '''))
-                    # Copy data
-                    conn.execute(text('''
-                        INSERT INTO pre_production_stock_new 
-                        (id, pre_production_item_id, warehouse_id, quantity, unit, created_at, updated_at)
-                        SELECT id, pre_production_item_id, warehouse_id, quantity, unit, created_at, updated_at
-                        FROM pre_production_stock
-                    '''))
-                    # Drop old table and rename new one
-                    conn.execute(text('DROP TABLE pre_production_stock'))
-                    conn.execute(text('ALTER TABLE pre_production_stock_new RENAME TO pre_production_stock'))
-        if 'order' in existing_tables:
-            order_columns = {col['name'] for col in inspector.get_columns('order')}
-            if 'daily_sequence' not in order_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "order" ADD COLUMN daily_sequence INTEGER'))
-            if 'invoice_uid' not in order_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "order" ADD COLUMN invoice_uid VARCHAR(64)'))
-        if 'order_item' in existing_tables:
-            order_item_columns = {col['name'] for col in inspector.get_columns('order_item')}
-            if 'is_deleted' not in order_item_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE order_item ADD COLUMN is_deleted BOOLEAN DEFAULT 0'))
-            if 'removal_reason' not in order_item_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE order_item ADD COLUMN removal_reason VARCHAR(256)'))
-        db.create_all()
-        inspector = inspect(engine)
-        if 'menu_item_material' in inspector.get_table_names():
-            material_columns = {col['name'] for col in inspector.get_columns('menu_item_material')}
-            if 'unit' not in material_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "menu_item_material" ADD COLUMN unit VARCHAR(32) DEFAULT \'عدد\''))
-            if 'pre_production_item_id' not in material_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "menu_item_material" ADD COLUMN pre_production_item_id INTEGER REFERENCES pre_production_item(id)'))
-        if 'raw_material' in inspector.get_table_names():
-            raw_material_columns = {col['name'] for col in inspector.get_columns('raw_material')}
-            if 'min_stock' not in raw_material_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "raw_material" ADD COLUMN min_stock REAL'))
-        if 'table' in inspector.get_table_names():
-            table_columns = {col['name'] for col in inspector.get_columns('table')}
-            if 'area_id' not in table_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE "table" ADD COLUMN area_id INTEGER REFERENCES table_area(id)'))
-        if 'settings' in inspector.get_table_names():
-            settings_columns = {col['name'] for col in inspector.get_columns('settings')}
-            if 'service_charge' not in settings_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE settings ADD COLUMN service_charge FLOAT DEFAULT 0'))
-            if 'currency' not in settings_columns:
-                with engine.begin() as conn:
-                    conn.execute(text("ALTER TABLE settings ADD COLUMN currency VARCHAR(16) DEFAULT ''"))
-            if 'card_number' not in settings_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE settings ADD COLUMN card_number VARCHAR(64)'))
-            if 'instagram' not in settings_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE settings ADD COLUMN instagram VARCHAR(256)'))
-            if 'telegram' not in settings_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE settings ADD COLUMN telegram VARCHAR(256)'))
-            if 'website' not in settings_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE settings ADD COLUMN website VARCHAR(256)'))
-
-        # Lightweight migration for cost_formula_settings.personnel column (JSON stored as TEXT)
-        if 'cost_formula_settings' in inspector.get_table_names():
-            cfs_columns = {col['name'] for col in inspector.get_columns('cost_formula_settings')}
-            if 'personnel' not in cfs_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE cost_formula_settings ADD COLUMN personnel TEXT'))
-            if 'cost_control_percent' not in cfs_columns:
-                with engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE cost_formula_settings ADD COLUMN cost_control_percent INTEGER DEFAULT 0'))
+        # Versioned: a current file costs one lookup (services.schema_migrations)
+        migrate_operational_schema(db.engine)
+        migrate_master_schema(db.engines['master'])
 
-        backfill_invoice_identifiers()
-        
-        # اختصاص تاریخ تولد تصادفی به مشتریان قدیمی
-        assign_random_birth_dates_to_old_customers()
+        # بک‌فیل داده‌های قدیمی به‌صورت کار پس‌زمینه اجرا می‌شود (services.background_jobs)
 
         # Create the first central administrator once. Existing credentials are
         # never overwritten on subsequent startups.
@@ -256,7 +136,6 @@ def create_app(config_class=Config):
     from flask import session, request, g
     import os
     from models.master_models import CafeTenant
-    from sqlalchemy import create_engine
     from services.access_control import effective_role, is_master_sso
     from services.tenant_session import clear_tenant_session
 
@@ -282,7 +161,7 @@ def create_app(config_class=Config):
             g.enabled_cafe_modules = set(MODULE_CODES)
             return None
 
-        cafe = CafeTenant.query.filter_by(slug=tenant_slug).first()
+        cafe = resolve_tenant_context(tenant_slug)
         if not cafe:
             return None
 
@@ -293,11 +172,10 @@ def create_app(config_class=Config):
             g.tenant_access_mode = 'master_sso'
             return None
 
-        module_rows = CafeModule.query.filter_by(cafe_id=cafe.id).all()
-        enabled = {row.module_code for row in module_rows if row.is_enabled}
+        enabled = set(cafe.enabled_modules)
         # Cafes created by older versions had no CafeModule rows. Preserve
         # access until the master explicitly saves their access profile.
-        if not module_rows:
+        if not cafe.has_module_rows:
             enabled = set(MODULE_CODES)
         g.enabled_cafe_modules = enabled
         g.tenant_access_mode = 'tenant_user'
@@ -327,8 +205,7 @@ def create_app(config_class=Config):
         tenant_slug = session.get('tenant_slug')
         if tenant_slug:
             # Get tenant database path
-            with app.app_context():
-                cafe = CafeTenant.query.filter_by(slug=tenant_slug).first()
+            cafe = resolve_tenant_context(tenant_slug)
             
             # Check if cafe exists and is active
             if not cafe:
@@ -346,12 +223,9 @@ def create_app(config_class=Config):
                 session.pop('tenant_username', None)
                 g.original_db_bind = None
             elif cafe and os.path.exists(cafe.db_path):
-                # Create engine for tenant database
-                tenant_engine = create_engine(f"sqlite:///{cafe.db_path}", poolclass=NullPool)
-                migrated_paths = app.extensions.setdefault('operational_schema_migrated', set())
-                if cafe.db_path not in migrated_paths:
-                    migrate_operational_schema(tenant_engine)
-                    migrated_paths.add(cafe.db_path)
+                # Shared pooled engine; see services.tenant_engines
+                tenant_engine = get_tenant_engine(cafe.db_path)
+                migrate_tenant_schema_once(cafe.db_path, tenant_engine)
                 # The request-local TenantRoutingSession picks this engine for
                 # operational (non-master) models without mutating global binds.
                 g.tenant_engine = tenant_engine
@@ -363,10 +237,9 @@ def create_app(config_class=Config):
         """Restore default database after request."""
         tenant_engine = getattr(g, 'tenant_engine', None)
         if tenant_engine is not None:
-            try:
-                db.session.remove()
-            finally:
-                tenant_engine.dispose()
+            # The engine is shared across requests; only release the session
+            # so its connection returns to the tenant pool.
+            db.session.remove()
         elif hasattr(g, 'original_db_bind'):
             db.session.bind = g.original_db_bind
         return response
@@ -451,17 +324,22 @@ def create_app(config_class=Config):
         if current_user.is_authenticated and hasattr(current_user, 'role') and current_user.role == 'waiter':
             allowed_routes = [
                 'dashboard.waiter_dashboard',  # Special dashboard for waiters
+                'dashboard.live_events',  # Live table/order/stock updates (SSE)
+                'dashboard.table_card',  # Refreshed table card after a live event
+                'dashboard.takeaway_card',  # Refreshed takeaway card after a live event
                 'table.get_table',  # Allow getting table info
                 'table.submit_table_order',  # Allow submitting table orders
                 'table.add_item_to_table',  # Allow adding items to table
                 'table.remove_item_from_table',  # Allow removing items from table
                 'table.update_item_quantity',  # Allow updating item quantity
                 'table.update_table_customer',  # Allow updating table customer
+                'table.update_table_cart',  # Allow batched cart changes (add/remove/quantity)
                 'takeaway.create_takeaway',  # Allow creating takeaway orders
                 'takeaway.get_takeaway',  # Allow getting takeaway order
                 'takeaway.add_item_to_takeaway',  # Allow adding items to takeaway
                 'takeaway.remove_item_from_takeaway',  # Allow removing items from takeaway
                 'takeaway.update_takeaway',  # Allow updating takeaway
+                'takeaway.update_takeaway_cart',  # Allow batched takeaway cart changes
                 'takeaway.submit_takeaway',  # Allow submitting takeaway
             ]
             route_name = request.endpoint
@@ -493,7 +371,7 @@ def create_app(config_class=Config):
     def inject_business_settings():
         settings = None
         try:
-            settings = Settings.query.first()
+            settings = current_settings()
         except Exception:
             settings = None
         cafe_name = (settings.cafe_name if settings and settings.cafe_name else None) or 'Madeline cafe'
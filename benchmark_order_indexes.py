@@ -0,0 +1,215 @@
+"""
+مقایسه طرح اجرای کوئری‌های گزارش قبل و بعد از ایندکس‌های services.schema_migrations
+
+یک دیتابیس موقت کافه با تعداد زیادی سفارش (پیش‌فرض ۵۰۰ هزار) ساخته می‌شود، ایندکس‌های
+طرح حذف می‌شوند، EXPLAIN QUERY PLAN و زمان هر کوئری چاپ می‌شود، سپس apply_index_plan
+اجرا و همان کوئری‌ها دوباره اندازه‌گیری می‌شوند.
+
+استفاده:
+    python benchmark_order_indexes.py                   # ۵۰۰٬۰۰۰ سفارش
+    python benchmark_order_indexes.py --orders 50000    # اجرای سریع‌تر
+    python benchmark_order_indexes.py --keep bench.db   # نگه داشتن فایل دیتابیس
+"""
+import argparse
+from datetime import date, datetime, timedelta
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, text
+
+from models.models import (
+    Customer, MaterialPurchase, MenuItem, Order, OrderItem, RawMaterial, RawMaterialUsage,
+    Warehouse, WarehouseTransfer, db,
+)
+from services.schema_migrations import apply_index_plan, operational_indexes
+
+CHUNK = 20_000
+UNPAID = 'پرداخت نشده'
+PAID = 'پرداخت شده'
+TAKEAWAY = 'بیرون‌بر'
+DINE_IN = 'حضوری'
+
+QUERIES = [
+    ('unpaid orders (dashboard)',
+     'SELECT id FROM "order" WHERE status = :unpaid ORDER BY created_at DESC LIMIT 10'),
+    ('unpaid takeaway orders',
+     'SELECT id FROM "order" WHERE type = :takeaway AND status = :unpaid ORDER BY created_at DESC'),
+    ('customer history',
+     'SELECT id FROM "order" WHERE customer_id = :customer_id ORDER BY created_at DESC LIMIT 20'),
+    ('financial line stats (one day)',
+     'SELECT o.id, count(oi.id), sum(oi.total_price) FROM "order" o '
+     'LEFT JOIN order_item oi ON oi.order_id = o.id AND oi.is_deleted = 0 '
+     'WHERE o.created_at >= :day_start AND o.created_at < :day_end GROUP BY o.id'),
+    ('menu item sales',
+     'SELECT sum(quantity) FROM order_item WHERE menu_item_id = :menu_item_id'),
+    ('material usage in range',
+     'SELECT sum(quantity) FROM raw_material_usage '
+     'WHERE raw_material_id = :material_id AND created_at >= :day_start AND created_at < :day_end'),
+    ('usages of an order item',
+     'SELECT id FROM raw_material_usage WHERE order_item_id = :order_item_id'),
+    ('latest purchase of a material',
+     'SELECT id FROM material_purchase WHERE raw_material_id = :material_id ORDER BY purchase_date DESC LIMIT 1'),
+    ('transfers into a warehouse',
+     'SELECT raw_material_id, sum(base_quantity) FROM warehouse_transfer '
+     'WHERE to_warehouse_id = :warehouse_id AND transfer_date <= :as_of GROUP BY raw_material_id'),
+]
+
+TABLES = [
+    Customer.__table__, MenuItem.__table__, RawMaterial.__table__, Warehouse.__table__,
+    Order.__table__, OrderItem.__table__, RawMaterialUsage.__table__,
+    MaterialPurchase.__table__, WarehouseTransfer.__table__,
+]
+
+
+def _insert_chunked(connection, table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= CHUNK:
+            connection.execute(insert(table), batch)
+            batch = []
+    if batch:
+        connection.execute(insert(table), batch)
+
+
+def seed(engine, orders_count, seed_value=1):
+    rng = random.Random(seed_value)
+    customers, menu_items, materials, warehouses = 2_000, 60, 80, 4
+    start = datetime.now() - timedelta(days=365)
+    with engine.begin() as connection:
+        _insert_chunked(connection, Customer.__table__, (
+            {'id': i, 'name': f'مشتری {i}', 'phone': f'0912{i:07d}'} for i in range(1, customers + 1)
+        ))
+        _insert_chunked(connection, MenuItem.__table__, (
+            {'id': i, 'name': f'آیتم {i}', 'price': 100_000 + i * 1_000, 'category_id': 1} for i in range(1, menu_items + 1)
+        ))
+        _insert_chunked(connection, RawMaterial.__table__, (
+            {'id': i, 'name': f'ماده {i}', 'default_unit': 'gr'} for i in range(1, materials + 1)
+        ))
+        _insert_chunked(connection, Warehouse.__table__, (
+            {'id': i, 'code': f'wh{i}', 'name': f'انبار {i}'} for i in range(1, warehouses + 1)
+        ))
+
+        def orders():
+            for i in range(1, orders_count + 1):
+                created = start + timedelta(seconds=i * 365 * 86400 // orders_count)
+                status = UNPAID if rng.random() < 0.01 else PAID
+                yield {
+                    'id': i, 'invoice_number': i, 'created_at': created,
+                    'customer_id': rng.randint(1, customers),
+                    'total_amount': 250_000, 'discount': 0, 'tax_amount': 0, 'final_amount': 250_000,
+                    'status': status, 'type': TAKEAWAY if rng.random() < 0.2 else DINE_IN,
+                    'payment_method': 'کارتخوان', 'payment_bucket': 'pos',
+                }
+
+        _insert_chunked(connection, Order.__table__, orders())
+
+        def order_items():
+            item_id = 0
+            for order_id in range(1, orders_count + 1):
+                for _ in range(2):
+                    item_id += 1
+                    yield {
+                        'id': item_id, 'order_id': order_id, 'menu_item_id': rng.randint(1, menu_items),
+                        'quantity': 1, 'unit_price': 125_000, 'total_price': 125_000,
+                        'is_deleted': rng.random() < 0.02,
+                    }
+
+        _insert_chunked(connection, OrderItem.__table__, order_items())
+
+        def usages():
+            for item_id in range(1, orders_count * 2 + 1):
+                order_id = (item_id + 1) // 2
+                yield {
+                    'raw_material_id': rng.randint(1, materials), 'order_id': order_id,
+                    'order_item_id': item_id, 'menu_item_id': None, 'quantity': 18.0, 'unit': 'gr',
+                    'created_at': start + timedelta(seconds=order_id * 365 * 86400 // orders_count),
+                }
+
+        _insert_chunked(connection, RawMaterialUsage.__table__, usages())
+        _insert_chunked(connection, MaterialPurchase.__table__, (
+            {
+                'raw_material_id': rng.randint(1, materials), 'purchase_date': start.date() + timedelta(days=i % 365),
+                'quantity': 5, 'unit': 'kg', 'total_price': 1_000_000, 'warehouse_id': 1,
+            }
+            for i in range(max(orders_count // 50, 100))
+        ))
+        _insert_chunked(connection, WarehouseTransfer.__table__, (
+            {
+                'raw_material_id': rng.randint(1, materials), 'from_warehouse_id': 1,
+                'to_warehouse_id': rng.randint(2, warehouses), 'quantity': 1, 'unit': 'kg',
+                'base_quantity': 1000.0, 'transfer_date': start.date() + timedelta(days=i % 365),
+            }
+            for i in range(max(orders_count // 50, 100))
+        ))
+
+
+def drop_plan_indexes(engine):
+    with engine.begin() as connection:
+        for index in operational_indexes():
+            connection.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+        connection.execute(text('DROP TABLE IF EXISTS schema_meta'))
+        connection.execute(text('DROP TABLE IF EXISTS sqlite_stat1'))
+
+
+def measure(engine, params, repeat):
+    results = {}
+    with engine.connect() as connection:
+        for label, sql in QUERIES:
+            plan = [row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql), params)]
+            started = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(text(sql), params).all()
+            results[label] = (plan, (time.perf_counter() - started) * 1000 / repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=500_000, help='تعداد سفارش‌های ساختگی')
+    parser.add_argument('--repeat', type=int, default=5, help='تعداد تکرار هر کوئری')
+    parser.add_argument('--keep', metavar='PATH', help='مسیر فایل دیتابیس (حذف نمی‌شود)')
+    args = parser.parse_args()
+
+    tmp = None
+    if args.keep:
+        path = args.keep
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix='cafe-index-bench-')
+        path = os.path.join(tmp.name, 'tenant.db')
+    engine = create_engine(f'sqlite:///{path}')
+    try:
+        db.metadata.create_all(engine, tables=TABLES)
+        started = time.perf_counter()
+        seed(engine, args.orders)
+        print(f'seeded {args.orders:,} orders in {time.perf_counter() - started:.1f}s -> {path}')
+
+        middle = (datetime.now() - timedelta(days=180)).replace(hour=0, minute=0, second=0, microsecond=0)
+        params = {
+            'unpaid': UNPAID, 'takeaway': TAKEAWAY, 'customer_id': 42, 'menu_item_id': 7,
+            'material_id': 11, 'order_item_id': args.orders, 'warehouse_id': 2, 'as_of': date.today(),
+            'day_start': middle, 'day_end': middle + timedelta(days=1),
+        }
+
+        drop_plan_indexes(engine)
+        before = measure(engine, params, args.repeat)
+        started = time.perf_counter()
+        apply_index_plan(engine)
+        print(f'apply_index_plan took {time.perf_counter() - started:.1f}s')
+        after = measure(engine, params, args.repeat)
+
+        for label, _ in QUERIES:
+            (plan_before, ms_before), (plan_after, ms_after) = before[label], after[label]
+            print(f'\n{label}: {ms_before:.2f} ms -> {ms_after:.2f} ms')
+            print('  before: ' + ' | '.join(plan_before))
+            print('  after:  ' + ' | '.join(plan_after))
+    finally:
+        engine.dispose()
+        if tmp is not None:
+            tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+مقایسه سرعت ثبت سفارش (سفارش در ثانیه برای یک کافه) قبل و بعد از services.order_writer
+
+یک دیتابیس موقت کافه با منو، رسپی (مستقیم و پیش‌تولید) و خرید مواد ساخته می‌شود و همان
+سفارش‌های تصادفی دو بار ثبت می‌شوند:
+  - legacy: مسیر قبلی روت‌ها (MenuItem.query.get برای هر آیتم، افزودن تک‌تک OrderItem،
+    پیمایش رسپی و درج تک‌تک RawMaterialUsage)
+  - bulk:   place_order (یک کوئری IN، درج دسته‌ای آیتم‌ها و مصرف مواد، یک UPDATE موجودی)
+هر سفارش در تراکنش خودش commit می‌شود، مثل درخواست‌های واقعی.
+
+استفاده:
+    python benchmark_order_writes.py                        # ۵۰۰ سفارش ۴ قلمی
+    python benchmark_order_writes.py --orders 2000 --items 8
+"""
+import argparse
+from datetime import date, datetime
+import os
+import random
+import tempfile
+import time
+
+from config import Config
+from app import create_app
+from models.models import (
+    Category, Customer, MaterialPurchase, MenuItem, MenuItemMaterial, Order, OrderItem,
+    PreProductionItem, PreProductionItemMaterial, RawMaterial, RawMaterialUsage,
+    calculate_order_amount, convert_unit, db, generate_invoice_number, iran_tz,
+)
+from services.order_writer import OrderLine, place_order
+from services.stock_ledger import verify_stock_ledger
+
+
+def seed(menu_items, materials, rng):
+    category = Category(name='بنچمارک', is_active=True)
+    customer = Customer(name='مشتری بنچمارک', phone='09120000000')
+    raw = [RawMaterial(name=f'ماده {i}', default_unit='gr') for i in range(materials)]
+    syrups = [PreProductionItem(name=f'سیروپ {i}', unit='kg') for i in range(5)]
+    db.session.add_all([category, customer, *raw, *syrups])
+    db.session.flush()
+    for syrup in syrups:
+        for material in rng.sample(raw, 3):
+            db.session.add(PreProductionItemMaterial(pre_production_item_id=syrup.id, raw_material_id=material.id, quantity=300, unit='gr'))
+    for material in raw:
+        db.session.add(MaterialPurchase(raw_material_id=material.id, purchase_date=date.today(), quantity=1_000, unit='kg', total_price=1))
+    for i in range(menu_items):
+        item = MenuItem(name=f'آیتم {i}', price=100_000 + i * 1_000, stock=1_000_000, is_active=True, category_id=category.id)
+        db.session.add(item)
+        db.session.flush()
+        for material in rng.sample(raw, 3):
+            db.session.add(MenuItemMaterial(menu_item_id=item.id, raw_material_id=material.id, name=material.name, quantity='20', unit='gr'))
+        syrup = rng.choice(syrups)
+        db.session.add(MenuItemMaterial(menu_item_id=item.id, pre_production_item_id=syrup.id, name=syrup.name, quantity='30', unit='gr'))
+    db.session.commit()
+    return customer.id, [item_id for (item_id,) in db.session.query(MenuItem.id)]
+
+
+def legacy_order(lines, customer_id):
+    """مسیر ثبت سفارش پیش از order_writer، همان‌طور که در روت‌ها بود."""
+    invoice_identifiers = generate_invoice_number()
+    order_items_data = []
+    for line in lines:
+        menu_item = MenuItem.query.get(line.menu_item_id)
+        if menu_item.stock is not None:
+            menu_item.stock = max(0, menu_item.stock - line.quantity)
+        order_items_data.append({
+            'menu_item_id': menu_item.id, 'quantity': line.quantity,
+            'unit_price': int(menu_item.price), 'total_price': int(menu_item.price * line.quantity),
+        })
+    total, tax, final = calculate_order_amount(order_items_data)
+    order = Order(
+        invoice_number=invoice_identifiers.unique_number, daily_sequence=invoice_identifiers.daily_sequence,
+        invoice_uid=invoice_identifiers.invoice_uid, customer_id=customer_id, total_amount=total,
+        tax_amount=tax, final_amount=final, status='پرداخت نشده', type='حضوری', created_at=datetime.now(iran_tz),
+    )
+    db.session.add(order)
+    db.session.flush()
+    for data in order_items_data:
+        db.session.add(OrderItem(order_id=order.id, **data))
+    db.session.flush()
+    for order_item in order.order_items:
+        RawMaterialUsage.query.filter_by(order_item_id=order_item.id).delete()
+        for material in order_item.menu_item.materials:
+            components = []
+            if material.raw_material:
+                components.append((material.raw_material, material.quantity_value, material.unit))
+            elif material.pre_production_item:
+                pre_item = material.pre_production_item
+                multiplier = convert_unit(material.quantity_value, material.unit, pre_item.unit)
+                components.extend(
+                    (component.raw_material, float(component.quantity or 0) * multiplier, component.unit)
+                    for component in pre_item.materials if component.raw_material
+                )
+            for raw_material, quantity, unit in components:
+                db.session.add(RawMaterialUsage(
+                    raw_material_id=raw_material.id, order_id=order.id, order_item_id=order_item.id,
+                    menu_item_id=order_item.menu_item_id, quantity=quantity * order_item.quantity,
+                    unit=unit or raw_material.default_unit,
+                ))
+    db.session.commit()
+
+
+def bulk_order(lines, customer_id):
+    place_order(lines, customer_id=customer_id)
+    db.session.commit()
+
+
+def run(label, write, orders, customer_id):
+    started = time.perf_counter()
+    for lines in orders:
+        write(lines, customer_id)
+        db.session.expire_all()  # هر درخواست با نشست تازه شروع می‌شود
+    elapsed = time.perf_counter() - started
+    print(f'{label:>6}: {len(orders):,} orders in {elapsed:.2f}s -> {len(orders) / elapsed:,.1f} orders/s')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=500, help='تعداد سفارش در هر دور')
+    parser.add_argument('--items', type=int, default=4, help='تعداد قلم هر سفارش')
+    parser.add_argument('--menu', type=int, default=60, help='تعداد آیتم منو')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='cafe-order-bench-') as tmp:
+        class BenchmarkConfig(Config):
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(tmp, 'tenant.db')}"
+            SQLALCHEMY_BINDS = {'master': f"sqlite:///{os.path.join(tmp, 'master.db')}"}
+            TENANTS_DIR = os.path.join(tmp, 'tenants')
+            CACHE_STAMP_DIR = os.path.join(tmp, 'stamps')
+
+        app = create_app(BenchmarkConfig)
+        with app.app_context():
+            rng = random.Random(args.seed)
+            customer_id, menu_ids = seed(args.menu, 80, rng)
+            orders = [
+                [OrderLine(menu_item_id, rng.randint(1, 3)) for menu_item_id in rng.sample(menu_ids, args.items)]
+                for _ in range(args.orders)
+            ]
+            legacy = run('legacy', legacy_order, orders, customer_id)
+            bulk = run('bulk', bulk_order, orders, customer_id)
+            print(f'speedup: {legacy / bulk:.1f}x')
+            drift = verify_stock_ledger(db.session.connection())
+            print('stock ledger: ' + ('consistent' if not drift else f'{len(drift)} drifted rows'))
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -54,3 +54,36 @@ class Config:
         'master': MASTER_DB_URI
     }
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Shared, pooled engines for tenant databases (see services.tenant_engines)
+    TENANT_ENGINE_CACHE_SIZE = int(os.environ.get('CAFE_TENANT_ENGINE_CACHE_SIZE', 64))
+    TENANT_ENGINE_IDLE_SECONDS = int(os.environ.get('CAFE_TENANT_ENGINE_IDLE_SECONDS', 900))
+    TENANT_ENGINE_POOL_SIZE = int(os.environ.get('CAFE_TENANT_ENGINE_POOL_SIZE', 5))
+    TENANT_ENGINE_MAX_OVERFLOW = int(os.environ.get('CAFE_TENANT_ENGINE_MAX_OVERFLOW', 10))
+    TENANT_DB_BUSY_TIMEOUT_MS = int(os.environ.get('CAFE_TENANT_DB_BUSY_TIMEOUT_MS', 5000))
+
+    # Master portal cross-tenant reports (see services.fleet_query)
+    FLEET_QUERY_WORKERS = int(os.environ.get('CAFE_FLEET_QUERY_WORKERS', 8))
+    FLEET_QUERY_TIMEOUT_SECONDS = float(os.environ.get('CAFE_FLEET_QUERY_TIMEOUT_SECONDS', 5))
+    FLEET_QUERY_TTL_SECONDS = float(os.environ.get('CAFE_FLEET_QUERY_TTL_SECONDS', 30))
+
+    # Master dashboard metrics snapshots, refreshed in the background (see services.fleet_metrics)
+    FLEET_METRICS_BACKGROUND = os.environ.get('CAFE_FLEET_METRICS_BACKGROUND', '1').lower() not in ('0', 'false', 'no')
+    FLEET_METRICS_REFRESH_DELAY_SECONDS = float(os.environ.get('CAFE_FLEET_METRICS_REFRESH_DELAY_SECONDS', 2))
+    FLEET_METRICS_FULL_REFRESH_SECONDS = float(os.environ.get('CAFE_FLEET_METRICS_FULL_REFRESH_SECONDS', 900))
+
+    # Resumable batch jobs tracked in the master database (see services.background_jobs)
+    BACKGROUND_JOBS_ENABLED = os.environ.get('CAFE_BACKGROUND_JOBS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+    BACKGROUND_JOB_CHUNK_SIZE = int(os.environ.get('CAFE_BACKGROUND_JOB_CHUNK_SIZE', 1000))
+    BACKGROUND_JOB_POLL_SECONDS = float(os.environ.get('CAFE_BACKGROUND_JOB_POLL_SECONDS', 60))
+
+    # Global invoice numbers reserved per worker at once (1 = gapless; see services.invoice_sequence)
+    INVOICE_NUMBER_BLOCK_SIZE = int(os.environ.get('CAFE_INVOICE_NUMBER_BLOCK_SIZE', 1))
+
+    # Open /dashboard/events streams per worker (see services.live_events). Each one holds a
+    # gunicorn thread, so keep it below `threads` in gunicorn_config.py: the rest serve requests.
+    LIVE_STREAMS_PER_WORKER = int(os.environ.get('CAFE_LIVE_STREAMS_PER_WORKER', 12))
+
+    # Cross-worker invalidation stamps for in-process caches
+    CACHE_STAMP_DIR = os.environ.get('CAFE_CACHE_STAMP_DIR') or os.path.join(INSTANCE_DIR, 'cache_stamps')
+    TENANT_CONTEXT_TTL_SECONDS = int(os.environ.get('CAFE_TENANT_CONTEXT_TTL_SECONDS', 30))
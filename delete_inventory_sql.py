@@ -74,6 +74,12 @@ try:
     # 5. حذف مواد اولیه
     cursor.execute("DELETE FROM raw_material")
     print(f"  ✓ مواد اولیه حذف شد ({cursor.rowcount} رکورد)")
+
+    # 6. حذف موجودی تجمیعی (جدول material_stock_balance)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='material_stock_balance'")
+    if cursor.fetchone():
+        cursor.execute("DELETE FROM material_stock_balance")
+        print(f"  ✓ موجودی تجمیعی حذف شد ({cursor.rowcount} رکورد)")
     
     # Commit تغییرات
     conn.commit()
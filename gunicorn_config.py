@@ -1,7 +1,13 @@
 # تنظیمات Gunicorn برای production
 bind = "127.0.0.1:5000"
 workers = 4
-worker_class = "sync"
+# gthread: اتصال‌های باز /dashboard/events (SSE) هر کدام فقط یک thread را نگه می‌دارند، نه کل worker
+# ظرفیت: هر worker حداکثر LIVE_STREAMS_PER_WORKER (پیش‌فرض 12) جریان باز نگه می‌دارد و بقیه
+# threadها (16 - 12 = 4) همیشه برای درخواست‌های عادی آزادند؛ یعنی 4 × 12 = 48 صفحه زنده هم‌زمان.
+# بیش از آن پاسخ 503 می‌گیرد و صفحه 10 تا 20 ثانیه بعد دوباره وصل می‌شود. برای صفحه‌های بیشتر
+# threads و CAFE_LIVE_STREAMS_PER_WORKER را با هم بالا ببرید.
+worker_class = "gthread"
+threads = 16
 worker_connections = 1000
 timeout = 30
 keepalive = 2
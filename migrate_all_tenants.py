@@ -0,0 +1,70 @@
+"""
+ارتقای شِمای دیتابیس مادر، دیتابیس پیش‌فرض و همه کافه‌ها به آخرین نسخه (services.schema_migrations)
+
+فایل‌هایی که نسخه‌شان به‌روز است فقط با یک کوئری رد می‌شوند؛ بقیه به‌صورت موازی ارتقا پیدا می‌کنند.
+بهتر است قبل از راه‌اندازی مجدد سرویس بعد از هر استقرار اجرا شود تا هیچ درخواستی هزینه ارتقا را ندهد.
+
+استفاده:
+    python migrate_all_tenants.py               # ارتقای همه فایل‌ها
+    python migrate_all_tenants.py --workers 8   # تعداد کافه‌هایی که هم‌زمان ارتقا می‌یابند
+    python migrate_all_tenants.py --status      # فقط نمایش نسخه هر فایل
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import sys
+import time
+
+from app import create_app
+from models.master_models import CafeTenant
+from models.models import db
+from services.schema_migrations import (
+    MASTER_SCHEMA_VERSION, SCHEMA_VERSION, migrate_master_schema, migrate_operational_schema, read_schema_version,
+)
+from services.tenant_engines import get_tenant_engine
+
+
+def _migrate(label, engine, status_only):
+    started = time.perf_counter()
+    before = read_schema_version(engine)
+    upgraded = False if status_only else migrate_operational_schema(engine)
+    return label, before, upgraded, time.perf_counter() - started
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Upgrade the master, default and every tenant database')
+    parser.add_argument('--workers', type=int, default=min(8, (os.cpu_count() or 1) * 2), help='parallel tenant upgrades')
+    parser.add_argument('--status', action='store_true', help='only print the recorded schema versions')
+    args = parser.parse_args()
+
+    # create_app already upgrades the master and default databases.
+    app = create_app()
+    failures = 0
+    with app.app_context():
+        print(f"master: نسخه {read_schema_version(db.engines['master'])}/{MASTER_SCHEMA_VERSION}")
+        if not args.status:
+            migrate_master_schema(db.engines['master'])
+
+        targets = [('default', db.engine)]
+        for cafe in CafeTenant.query.order_by(CafeTenant.id).all():
+            if os.path.exists(cafe.db_path):
+                targets.append((cafe.slug, get_tenant_engine(cafe.db_path)))
+            else:
+                print(f"{cafe.slug}: دیتابیس یافت نشد ({cafe.db_path})")
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(_migrate, label, engine, args.status): label for label, engine in targets}
+        for future in as_completed(futures):
+            try:
+                label, before, upgraded, elapsed = future.result()
+            except Exception as exc:  # noqa: BLE001 - report every tenant, then fail
+                failures += 1
+                print(f"{futures[future]}: خطا در ارتقا - {exc}")
+                continue
+            state = f"{before} -> {SCHEMA_VERSION} ارتقا یافت" if upgraded else f"نسخه {before}/{SCHEMA_VERSION}"
+            print(f"{label}: {state} ({elapsed:.2f}s)")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -103,6 +103,75 @@ class CafeEventLog(db.Model):
         return f"<CafeEventLog cafe_id={self.cafe_id} event_type={self.event_type}>"
 
 
+class CafeMetricsSnapshot(db.Model):
+    """آمار روزانه هر کافه برای داشبورد مادر (services.fleet_metrics)
+
+    هر کافه در هر روز یک ردیف دارد که با هر بازخوانی به‌روز می‌شود؛ ردیف‌های روزهای قبل
+    تاریخچه روند را بدون باز کردن فایل کافه‌ها نگه می‌دارند.
+    """
+    __bind_key__ = 'master'
+    __tablename__ = 'cafe_metrics_snapshot'
+    __table_args__ = (
+        db.UniqueConstraint('cafe_id', 'snapshot_date', name='uq_cafe_metrics_snapshot_cafe_id_snapshot_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    cafe_id = db.Column(db.Integer, db.ForeignKey('cafe_tenant.id'), nullable=False)
+    snapshot_date = db.Column(db.Date, nullable=False, index=True)  # روز محلی (تهران)
+    orders_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Integer, nullable=False, default=0)  # جمع سفارش‌های پرداخت‌شده
+    users_count = db.Column(db.Integer, nullable=False, default=0)
+    menu_items_count = db.Column(db.Integer, nullable=False, default=0)
+    customers_count = db.Column(db.Integer, nullable=False, default=0)
+    day_orders_count = db.Column(db.Integer, nullable=False, default=0)  # سفارش‌های همان روز
+    day_revenue = db.Column(db.Integer, nullable=False, default=0)  # فروش پرداخت‌شده همان روز
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return f"<CafeMetricsSnapshot cafe_id={self.cafe_id} {self.snapshot_date}>"
+
+
+class BackgroundJob(db.Model):
+    """کار پس‌زمینه یک دیتابیس (services.background_jobs)
+
+    هر کار برای هر دیتابیس یک بار اجرا می‌شود؛ پیشرفت و checkpoint بعد از هر دسته
+    ذخیره می‌شود تا بعد از توقف یا ری‌استارت از همان‌جا ادامه پیدا کند.
+    """
+    __bind_key__ = 'master'
+    __tablename__ = 'background_job'
+    __table_args__ = (
+        db.UniqueConstraint('name', 'target', name='uq_background_job_name_target'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    target = db.Column(db.String(512), nullable=False)  # کلید فایل دیتابیس
+    db_path = db.Column(db.String(512), nullable=False)
+    cafe_id = db.Column(db.Integer, db.ForeignKey('cafe_tenant.id'), nullable=True, index=True)  # None = دیتابیس پیش‌فرض
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)  # pending, running, done, failed
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    checkpoint_json = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker = db.Column(db.String(128), nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def progress(self) -> int:
+        if self.status == 'done':
+            return 100
+        if not self.total:
+            return 0
+        return min(99, int(self.processed * 100 / self.total))
+
+    def __repr__(self) -> str:
+        return f"<BackgroundJob {self.name} {self.target} ({self.status})>"
+
+
 class OTPCode(db.Model):
     __bind_key__ = 'master'
     __tablename__ = 'otp_code'
@@ -1,9 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import repeat
 from typing import Optional
 import pytz
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 from dataclasses import dataclass
 
 iran_tz = pytz.timezone("Asia/Tehran")
@@ -44,30 +47,51 @@ def normalize_unit(unit: Optional[str]) -> Optional[str]:
     return UNIT_SYNONYMS.get(key, key)
 
 
+# ضریب هر واحد استاندارد نسبت به واحد پایه بُعد خودش؛ تبدیل فقط بین واحدهای هم‌بُعد انجام می‌شود
+UNIT_SCALES = {
+    'g': ('mass', 1.0),
+    'kg': ('mass', 1000.0),
+    'ml': ('volume', 1.0),
+    'l': ('volume', 1000.0),
+    'count': ('count', 1.0),
+    'pack': ('pack', 1.0),
+    'm': ('length', 1.0),
+}
+
+
+@lru_cache(maxsize=1024)
+def unit_factor(from_unit: Optional[str], to_unit: Optional[str]) -> float:
+    """
+    ضریب تبدیل از from_unit به to_unit (مقدار * ضریب = مقدار در to_unit)
+    واحدهای ناشناخته یا غیرهم‌بُعد بدون تبدیل (ضریب ۱) می‌مانند.
+    """
+    from_norm = normalize_unit(from_unit) or normalize_unit(to_unit)
+    to_norm = normalize_unit(to_unit) or from_norm
+    if not from_norm or from_norm == to_norm:
+        return 1.0
+    source, target = UNIT_SCALES.get(from_norm), UNIT_SCALES.get(to_norm)
+    if source is None or target is None or source[0] != target[0]:
+        return 1.0
+    return source[1] / target[1]
+
+
 def convert_unit(quantity: Optional[float], from_unit: Optional[str], to_unit: Optional[str]) -> float:
     if quantity is None:
         return 0.0
-    from_norm = normalize_unit(from_unit) or normalize_unit(to_unit)
-    to_norm = normalize_unit(to_unit) or normalize_unit(from_unit)
-    if not from_norm or not to_norm or from_norm == to_norm:
-        return float(quantity)
-
-    if from_norm == 'kg' and to_norm == 'g':
-        return float(quantity) * 1000
-    if from_norm == 'g' and to_norm == 'kg':
-        return float(quantity) / 1000
-    if from_norm == 'l' and to_norm == 'ml':
-        return float(quantity) * 1000
-    if from_norm == 'ml' and to_norm == 'l':
-        return float(quantity) / 1000
-    if from_norm == 'count' and to_norm == 'count':
-        return float(quantity)
-    if from_norm == 'pack' and to_norm == 'pack':
-        return float(quantity)
-    if from_norm == 'm' and to_norm == 'm':
-        return float(quantity)
-
-    return float(quantity)
+    return float(quantity) * unit_factor(from_unit, to_unit)
+
+
+def convert_units(quantities, from_units, to_units) -> list:
+    """
+    نسخه دسته‌ای convert_unit روی آرایه‌ها
+    to_units می‌تواند یک واحد برای همه مقادیر یا آرایه‌ای هم‌طول باشد.
+    """
+    if to_units is None or isinstance(to_units, str):
+        to_units = repeat(to_units)
+    return [
+        float(quantity) * unit_factor(from_unit, to_unit) if quantity is not None else 0.0
+        for quantity, from_unit, to_unit in zip(quantities, from_units, to_units)
+    ]
 
 class TenantRoutingSession(FlaskSQLAlchemySession):
     """Route unbound operational models to the request's tenant engine.
@@ -151,6 +175,9 @@ class Customer(db.Model):
     created_at = db.Column(db.DateTime)
     last_visit = db.Column(db.DateTime, nullable=True)
     note = db.Column(db.String(256), nullable=True)  # توضیحات اضافی (مثلاً مشتری ویژه)
+    # کلیدهای نرمال‌شده جستجو (services.customer_directory) که هنگام ذخیره پر می‌شوند
+    name_key = db.Column(db.String(128), nullable=True, index=True)
+    phone_key = db.Column(db.String(20), nullable=True, index=True)
 
     orders = db.relationship('Order', backref='customer', lazy=True)
 
@@ -164,7 +191,7 @@ class Order(db.Model):
     invoice_number = db.Column(db.Integer, unique=True, nullable=False)
     daily_sequence = db.Column(db.Integer, nullable=True)
     invoice_uid = db.Column(db.String(64), unique=True, nullable=True)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz), index=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
     total_amount = db.Column(db.Integer, nullable=False)
     discount = db.Column(db.Integer, default=0)
@@ -175,8 +202,10 @@ class Order(db.Model):
     note = db.Column(db.String(256), nullable=True)
     paid_at = db.Column(db.DateTime, nullable=True)
     payment_method = db.Column(db.String(32), nullable=True)  # کارتخوان، کارت به کارت و ...
+    payment_bucket = db.Column(db.String(16), nullable=True, default='pos')  # categorize_payment_method(payment_method)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # اضافه کردن فیلد user_id
     table_id = db.Column(db.Integer, db.ForeignKey('table.id'), nullable=True)  # میز مرتبط با این سفارش
+    cart_revision = db.Column(db.Integer, default=0)  # شماره نسخه سبد بیرون‌بر (services.cart_operations)
 
     order_items = db.relationship(
     'OrderItem',
@@ -189,11 +218,94 @@ class Order(db.Model):
     # از foreign_keys استفاده می‌کنیم تا مشخص کنیم از table_id استفاده شود نه order_id
     table = db.relationship('Table', foreign_keys=[table_id], lazy=True)
 
+    # ایندکس‌های ترکیبی مطابق شرط‌های گزارش‌ها (لیست پرداخت‌نشده‌ها، بیرون‌برها، سابقه مشتری)؛
+    # روی دیتابیس‌های قدیمی services.schema_migrations.apply_index_plan آن‌ها را می‌سازد
+    __table_args__ = (
+        db.Index('ix_order_status_created_at', 'status', 'created_at'),
+        db.Index('ix_order_type_status_created_at', 'type', 'status', 'created_at'),
+        db.Index('ix_order_customer_id_created_at', 'customer_id', 'created_at'),
+    )
+
+    @validates('payment_method')
+    def _sync_payment_bucket(self, key, value):
+        """باکت پرداخت داشبورد همراه با روش پرداخت ذخیره می‌شود تا گزارش‌ها با GROUP BY محاسبه شوند"""
+        from utils.helpers import categorize_payment_method
+        self.payment_bucket = categorize_payment_method(value)
+        return value
 
     def __repr__(self):
         human_code = self.invoice_uid or self.invoice_number
         return f"<Order #{human_code} - {self.status}>"
 
+class DailySalesRollup(db.Model):
+    """
+    خلاصه روزانه فروش به تفکیک وضعیت، باکت پرداخت و نوع سفارش.
+
+    services.sales_rollup هم‌زمان با ثبت، پرداخت، ویرایش و حذف سفارش این جدول را
+    به‌روزرسانی می‌کند تا گزارش‌ها به‌جای اسکن سفارش‌ها بازه‌ای از ردیف‌های روزانه را بخوانند.
+    مقدار خالی ('') به‌جای NULL برای وضعیت/نوع نامشخص ذخیره می‌شود.
+    """
+    __tablename__ = 'daily_sales_rollup'
+    id = db.Column(db.Integer, primary_key=True)
+    sales_date = db.Column(db.Date, nullable=False, index=True)  # تاریخ میلادی (به وقت تهران)
+    jalali_date = db.Column(db.String(10), nullable=False, index=True)  # YYYY-MM-DD شمسی
+    status = db.Column(db.String(32), nullable=False, default='')
+    payment_bucket = db.Column(db.String(16), nullable=False, default='')
+    order_type = db.Column(db.String(32), nullable=False, default='')
+    orders_count = db.Column(db.Integer, nullable=False, default=0)
+    final_total = db.Column(db.Integer, nullable=False, default=0)
+    tax_total = db.Column(db.Integer, nullable=False, default=0)
+    discount_total = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz), onupdate=lambda: datetime.now(iran_tz))
+
+    __table_args__ = (
+        db.UniqueConstraint('sales_date', 'status', 'payment_bucket', 'order_type', name='uq_daily_sales_rollup'),
+    )
+
+    def __repr__(self):
+        return f"<DailySalesRollup {self.sales_date} {self.status} {self.payment_bucket} {self.order_type}>"
+
+
+class MenuItemStats(db.Model):
+    """
+    snapshot تحلیلی هر آیتم منو: محبوبیت و بهای تمام‌شده مواد.
+
+    services.menu_stats شمارنده‌های محبوبیت (تعداد سفارش پرداخت‌شده و تعداد فروش) را هم‌زمان
+    با پرداخت، ویرایش و حذف سفارش به‌روزرسانی می‌کند. بهای رسپی فقط وقتی خرید، رسپی یا واحد
+    مواد تغییر کند کهنه علامت می‌خورد (cost_version بالا می‌رود) و در اولین خواندن بعدی دوباره
+    محاسبه می‌شود.
+    """
+    __tablename__ = 'menu_item_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    menu_item_id = db.Column(db.Integer, nullable=False, unique=True)
+    orders_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity_sold = db.Column(db.Integer, nullable=False, default=0)
+    cost_price = db.Column(db.Float, nullable=True)
+    cost_breakdown = db.Column(db.Text, nullable=True)  # JSON ریز مواد و هزینه هر کدام
+    cost_stale = db.Column(db.Boolean, nullable=False, default=True)
+    cost_version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz), onupdate=lambda: datetime.now(iran_tz))
+
+    def __repr__(self):
+        return f"<MenuItemStats item={self.menu_item_id} orders={self.orders_count}>"
+
+
+class InvoiceSequence(db.Model):
+    """
+    شمارنده‌های شماره فاکتور هر کافه.
+
+    ردیف 'invoice' آخرین شماره یکتای تخصیص‌یافته و ردیف‌های 'daily:YYYYMMDD' آخرین شماره روزانه
+    را نگه می‌دارند. services.invoice_sequence با UPDATE ... RETURNING اتمیک از آن‌ها شماره می‌گیرد
+    تا ثبت هم‌زمان سفارش در چند worker شماره تکراری تولید نکند.
+    """
+    __tablename__ = 'invoice_sequence'
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz), onupdate=lambda: datetime.now(iran_tz))
+
+    def __repr__(self):
+        return f"<InvoiceSequence {self.name}={self.value}>"
+
 # --- مدل آیتم سفارش ---
 class OrderItem(db.Model):
     """آیتم‌های هر سفارش (هر آیتم به یک سفارش و یک آیتم منو متصل است)"""
@@ -207,6 +319,11 @@ class OrderItem(db.Model):
     removal_reason = db.Column(db.String(256), nullable=True)  # دلیل حذف آیتم
     is_deleted = db.Column(db.Boolean, default=False)  # نشان می‌دهد که آیا آیتم حذف شده است یا نه
 
+    __table_args__ = (
+        db.Index('ix_order_item_order_id_is_deleted', 'order_id', 'is_deleted'),
+        db.Index('ix_order_item_menu_item_id', 'menu_item_id'),
+    )
+
     material_usages = db.relationship(
         'RawMaterialUsage',
         backref='order_item',
@@ -311,6 +428,7 @@ class Table(db.Model):
     final_amount = db.Column(db.Integer, default=0)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=True)  # سفارش مرتبط
     area_id = db.Column(db.Integer, db.ForeignKey('table_area.id'), nullable=True)
+    cart_revision = db.Column(db.Integer, default=0)  # با هر تغییر سبد میز یکی زیاد می‌شود (services.cart_operations)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz), onupdate=lambda: datetime.now(iran_tz))
     
@@ -356,6 +474,23 @@ class ActionLog(db.Model):
         return f"<ActionLog {self.action} on {self.target_type}:{self.target_id}>"
 
 
+class LiveEvent(db.Model):
+    """
+    رویدادهای زنده هر کافه برای صفحه‌های باز (وضعیت میز، ثبت و پرداخت سفارش، موجودی منو).
+
+    services.live_events این ردیف‌ها را در همان تراکنش تغییر اصلی درج می‌کند و از طریق
+    /dashboard/events (SSE) به همه workerها و صفحه‌ها می‌رساند؛ ردیف‌های قدیمی حذف می‌شوند.
+    """
+    __tablename__ = 'live_event'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)  # table | order | stock
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz))
+
+    def __repr__(self):
+        return f"<LiveEvent {self.id} {self.kind}>"
+
+
 class SnapSettlement(db.Model):
     """
     ثبت تسویه‌های اسنپ به صورت دستی.
@@ -485,15 +620,13 @@ class RawMaterial(db.Model):
     @property
     def weighted_average_unit_price(self):
         """Moving weighted purchase cost in the material's base unit."""
-        total_quantity = 0.0
-        total_value = 0.0
-        for purchase in self.purchases:
-            quantity = convert_unit(purchase.quantity, purchase.unit, self.default_unit)
-            if quantity <= 0:
-                continue
-            total_quantity += quantity
-            total_value += float(purchase.total_price or 0)
-        return (total_value / total_quantity) if total_quantity > 0 else None
+        if self.id is None:
+            return None
+        base_quantity = MaterialPurchase.quantity * MaterialPurchase.unit_factor
+        total_quantity, total_value = db.session.query(
+            db.func.sum(base_quantity), db.func.sum(MaterialPurchase.total_price)
+        ).filter(MaterialPurchase.raw_material_id == self.id, base_quantity > 0).one()
+        return (float(total_value or 0) / total_quantity) if total_quantity else None
 
     @property
     def total_purchase_value(self):
@@ -501,17 +634,12 @@ class RawMaterial(db.Model):
     
     @property
     def current_stock(self):
-        """محاسبه موجودی فعلی از خریدها"""
-        base_unit = self.default_unit
-        total = 0.0
-        for purchase in self.purchases:
-            total += convert_unit(purchase.quantity, purchase.unit, base_unit)
-
-        usage_total = 0.0
-        for usage in self.usages:
-            usage_total += convert_unit(usage.quantity, usage.unit, base_unit)
-
-        remaining = total - usage_total
+        """موجودی فعلی (خرید منهای مصرف) از جدول تجمیعی MaterialStockBalance"""
+        if self.id is None:
+            return 0.0
+        remaining = db.session.query(
+            db.func.sum(MaterialStockBalance.purchased - MaterialStockBalance.consumed)
+        ).filter(MaterialStockBalance.raw_material_id == self.id).scalar() or 0.0
         return remaining if remaining > 0 else 0.0
 
     def __repr__(self):
@@ -529,10 +657,18 @@ class MaterialPurchase(db.Model):
     vendor_phone = db.Column(db.String(32), nullable=True)
     note = db.Column(db.String(256), nullable=True)
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouse.id'), nullable=True, index=True)
+    # واحد استاندارد و ضریب تبدیل به واحد پایه ماده؛ هنگام ثبت توسط services.unit_factors پر می‌شوند
+    unit_code = db.Column(db.String(16), nullable=True)
+    unit_factor = db.Column(db.Float, nullable=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz))
 
     warehouse = db.relationship('Warehouse', backref=db.backref('material_purchases', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_material_purchase_raw_material_id_purchase_date', 'raw_material_id', 'purchase_date'),
+        db.Index('ix_material_purchase_purchase_date', 'purchase_date'),
+    )
+
     @property
     def unit_price(self):
         if not self.quantity:
@@ -541,6 +677,8 @@ class MaterialPurchase(db.Model):
 
     @property
     def base_quantity(self):
+        if self.unit_factor is not None:
+            return float(self.quantity or 0) * self.unit_factor
         if not self.raw_material:
             return float(self.quantity or 0)
         return convert_unit(self.quantity, self.unit, self.raw_material.default_unit)
@@ -562,12 +700,21 @@ class RawMaterialUsage(db.Model):
     menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=True)
     quantity = db.Column(db.Float, nullable=False)
     unit = db.Column(db.String(32), nullable=False)
+    unit_code = db.Column(db.String(16), nullable=True)
+    unit_factor = db.Column(db.Float, nullable=True)  # ضریب تبدیل به واحد پایه ماده
     note = db.Column(db.String(256), nullable=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz))
 
     menu_item = db.relationship('MenuItem', backref='material_usages', lazy=True)
     order = db.relationship('Order', backref='material_usages', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_raw_material_usage_raw_material_id_created_at', 'raw_material_id', 'created_at'),
+        db.Index('ix_raw_material_usage_order_id', 'order_id'),
+        db.Index('ix_raw_material_usage_order_item_id', 'order_item_id'),
+        db.Index('ix_raw_material_usage_created_at', 'created_at'),
+    )
+
     def __repr__(self):
         return f"<RawMaterialUsage material={self.raw_material_id} qty={self.quantity} {self.unit}>"
 
@@ -622,10 +769,38 @@ class WarehouseTransfer(db.Model):
     to_warehouse = db.relationship('Warehouse', foreign_keys=[to_warehouse_id], lazy=True)
     user = db.relationship('User', backref='warehouse_transfers', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_warehouse_transfer_from_warehouse_id_transfer_date', 'from_warehouse_id', 'transfer_date'),
+        db.Index('ix_warehouse_transfer_to_warehouse_id_transfer_date', 'to_warehouse_id', 'transfer_date'),
+    )
+
     def __repr__(self):
         return f"<WarehouseTransfer rm={self.raw_material_id} {self.from_warehouse_id}->{self.to_warehouse_id} qty={self.quantity} {self.unit}>"
 
 
+class MaterialStockBalance(db.Model):
+    """
+    موجودی تجمیعی هر ماده اولیه در هر انبار (به واحد پایه ماده اولیه).
+
+    این جدول توسط services.stock_ledger هم‌زمان با ثبت خرید، مصرف و انتقال
+    به‌روزرسانی می‌شود. warehouse_id = 0 سطل خریدهای بدون انبار و مصرف سفارش‌هاست
+    که همیشه به انبار مرکزی نسبت داده می‌شود.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    raw_material_id = db.Column(db.Integer, nullable=False, index=True)
+    warehouse_id = db.Column(db.Integer, nullable=False, default=0)
+    purchased = db.Column(db.Float, nullable=False, default=0.0)
+    consumed = db.Column(db.Float, nullable=False, default=0.0)
+    transferred_in = db.Column(db.Float, nullable=False, default=0.0)
+    transferred_out = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(iran_tz), onupdate=lambda: datetime.now(iran_tz))
+
+    __table_args__ = (db.UniqueConstraint('raw_material_id', 'warehouse_id', name='uq_material_stock_balance'),)
+
+    def __repr__(self):
+        return f"<MaterialStockBalance rm={self.raw_material_id} wh={self.warehouse_id}>"
+
+
 class WarehouseMaterialMinStock(db.Model):
     """حداقل موجودی هر ماده اولیه در هر انبار"""
     id = db.Column(db.Integer, primary_key=True)
@@ -739,26 +914,6 @@ class PreProductionTransfer(db.Model):
     def __repr__(self):
         return f"<PreProductionTransfer item={self.pre_production_item_id} {self.from_warehouse_id}->{self.to_warehouse_id} qty={self.quantity} {self.unit}>"
 
-# --- توابع کمکی برای جستجو و ثبت مشتری ---
-def find_or_create_customer(name: str, phone: str = None, email: str = None, birth_date = None) -> Customer:
-    """
-    جستجو بر اساس نام یا شماره موبایل؛ اگر پیدا نشد، مشتری جدید ثبت می‌شود.
-    """
-    customer = None
-    if phone:
-        customer = Customer.query.filter_by(phone=phone).first()
-    if not customer and name:
-        customer = Customer.query.filter_by(name=name).first()
-    if not customer:
-        customer = Customer(name=name, phone=phone, email=email, birth_date=birth_date)
-        db.session.add(customer)
-        db.session.commit()
-    elif birth_date and not customer.birth_date:
-        # اگر مشتری قدیمی است و تاریخ تولد ندارد، آن را اضافه کن
-        customer.birth_date = birth_date
-        db.session.commit()
-    return customer
-
 @dataclass
 class InvoiceIdentifiers:
     """شناسه‌های مورد نیاز برای ثبت فاکتور"""
@@ -773,29 +928,14 @@ def generate_invoice_number(now: Optional[datetime] = None) -> InvoiceIdentifier
     - unique_number: ادامه توالی قبلی (برای یکتا بودن در سیستم)
     - daily_sequence: ریست‌شونده روزانه که از 100 شروع می‌شود
     - invoice_uid: شناسه متنی ترکیبی از تاریخ + شماره روزانه (برای استفاده‌های آتی)
-    """
-    current_dt = now or datetime.now(iran_tz)
-
-    last_order = Order.query.order_by(Order.invoice_number.desc()).first()
-    if last_order and last_order.invoice_number:
-        next_unique = last_order.invoice_number + 1
-    else:
-        next_unique = 1001
 
-    start_of_day = current_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-    end_of_day = start_of_day + timedelta(days=1)
-
-    last_today = (
-        Order.query
-        .filter(Order.created_at >= start_of_day, Order.created_at < end_of_day)
-        .order_by(Order.daily_sequence.desc())
-        .first()
-    )
-
-    next_daily = 100
-    if last_today and last_today.daily_sequence:
-        next_daily = last_today.daily_sequence + 1
+    شماره‌ها از جدول invoice_sequence به‌صورت اتمیک گرفته می‌شوند (services.invoice_sequence).
+    """
+    from services.invoice_sequence import allocate_daily_sequence, allocate_invoice_number
 
+    current_dt = now or datetime.now(iran_tz)
+    next_unique = allocate_invoice_number()
+    next_daily = allocate_daily_sequence(current_dt.date())
     invoice_uid = f"{current_dt.strftime('%Y%m%d')}-{next_daily:04d}"
 
     return InvoiceIdentifiers(
@@ -813,144 +953,3 @@ def calculate_order_amount(order_items, discount=0, tax_percent=9.0):
     tax = int(total * tax_percent / 100)
     final = total + tax - discount
     return total, tax, final
-
-
-def sync_order_item_material_usage(order_item):
-    """همگام‌سازی مصرف مواد اولیه برای یک آیتم سفارش"""
-    if not order_item:
-        return
-
-    if order_item.id is None:
-        db.session.flush()
-
-    RawMaterialUsage.query.filter_by(order_item_id=order_item.id).delete()
-
-    if getattr(order_item, 'is_deleted', False):
-        return
-
-    menu_item = order_item.menu_item or MenuItem.query.get(order_item.menu_item_id)
-    if not menu_item:
-        return
-
-    for material in menu_item.materials:
-        qty_per_unit = material.quantity_value
-        if qty_per_unit is None:
-            continue
-
-        components = []
-        if material.raw_material:
-            components.append((material.raw_material, qty_per_unit, material.unit))
-        elif material.pre_production_item:
-            pre_item = material.pre_production_item
-            pre_multiplier = convert_unit(qty_per_unit, material.unit, pre_item.unit)
-            for component in pre_item.materials:
-                if component.raw_material:
-                    components.append((
-                        component.raw_material,
-                        float(component.quantity or 0) * pre_multiplier,
-                        component.unit,
-                    ))
-
-        for raw_material, component_quantity, component_unit in components:
-            db.session.add(RawMaterialUsage(
-                raw_material_id=raw_material.id,
-                order_id=order_item.order_id,
-                order_item_id=order_item.id,
-                menu_item_id=menu_item.id,
-                quantity=component_quantity * order_item.quantity,
-                unit=component_unit or raw_material.default_unit,
-                note='مصرف مستقیم BOM' if material.raw_material else f'مصرف از پیش‌تولید: {material.name}',
-            ))
-
-
-def record_order_material_usage(order, replace_existing=False):
-    """ثبت/به‌روزرسانی مصرف مواد اولیه برای کل سفارش"""
-    if not order:
-        return
-
-    if replace_existing and order.id is not None:
-        RawMaterialUsage.query.filter_by(order_id=order.id).delete()
-
-    for order_item in order.order_items:
-        sync_order_item_material_usage(order_item)
-
-
-def _normalize_created_at(created_at: Optional[datetime]) -> Optional[datetime]:
-    if not created_at:
-        return None
-    if created_at.tzinfo is None:
-        try:
-            return iran_tz.localize(created_at)
-        except ValueError:
-            return created_at.replace(tzinfo=iran_tz)
-    return created_at.astimezone(iran_tz)
-
-
-def backfill_invoice_identifiers():
-    """
-    برای سفارش‌های قدیمی که daily_sequence یا invoice_uid ندارند،
-    مقادیر مناسب را محاسبه و ذخیره می‌کند.
-    """
-    from collections import defaultdict
-
-    orders = Order.query.order_by(Order.created_at.asc(), Order.id.asc()).all()
-    if not orders:
-        return
-
-    daily_track = defaultdict(lambda: 99)
-    changes = False
-
-    for order in orders:
-        localized_dt = _normalize_created_at(order.created_at)
-        order_date = localized_dt.date() if localized_dt else None
-
-        if order_date:
-            if not order.daily_sequence or order.daily_sequence < 100:
-                daily_track[order_date] += 1
-                order.daily_sequence = daily_track[order_date]
-                changes = True
-            else:
-                daily_track[order_date] = max(daily_track[order_date], order.daily_sequence)
-
-            if not order.invoice_uid:
-                order.invoice_uid = f"{order_date.strftime('%Y%m%d')}-{order.daily_sequence:04d}"
-                changes = True
-        else:
-            if not order.invoice_uid:
-                order.invoice_uid = f"LEGACY-{order.invoice_number}"
-                changes = True
-
-    if changes:
-        db.session.commit()
-
-
-def assign_random_birth_dates_to_old_customers():
-    """
-    اختصاص تاریخ تولد تصادفی به مشتریان قدیمی که تاریخ تولد ندارند
-    """
-    from random import randint
-    from datetime import date, timedelta
-    
-    # پیدا کردن مشتریانی که سفارش دارند اما تاریخ تولد ندارند
-    customers_with_orders = (
-        db.session.query(Customer)
-        .join(Order, Order.customer_id == Customer.id)
-        .filter(Customer.birth_date.is_(None))
-        .distinct()
-        .all()
-    )
-    
-    changes = False
-    for customer in customers_with_orders:
-        # تولید تاریخ تولد تصادفی بین 18 تا 80 سال پیش
-        years_ago = randint(18, 80)
-        days_ago = randint(0, 365)
-        birth_date = date.today() - timedelta(days=years_ago * 365 + days_ago)
-        customer.birth_date = birth_date
-        changes = True
-    
-    if changes:
-        db.session.commit()
-        print(f"تاریخ تولد تصادفی به {len(customers_with_orders)} مشتری قدیمی اختصاص داده شد")
-    
-    return len(customers_with_orders)
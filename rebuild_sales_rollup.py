@@ -0,0 +1,62 @@
+"""
+بازسازی / بررسی جدول خلاصه روزانه فروش (daily_sales_rollup)
+
+استفاده:
+    python rebuild_sales_rollup.py                     # بازسازی برای دیتابیس پیش‌فرض و همه کافه‌ها
+    python rebuild_sales_rollup.py --verify            # فقط گزارش اختلاف، بدون تغییر
+    python rebuild_sales_rollup.py --cafe SLUG         # فقط یک کافه
+    python rebuild_sales_rollup.py --since 2025-01-01  # فقط روزهای بعد از تاریخ داده‌شده
+"""
+import argparse
+from datetime import date
+import os
+import sys
+
+from app import create_app
+from models.master_models import CafeTenant
+from models.models import db
+from services.schema_migrations import migrate_operational_schema
+from services.sales_rollup import rebuild_sales_rollup, verify_sales_rollup
+from services.tenant_engines import get_tenant_engine
+
+
+def _targets(cafe_slug=None):
+    if not cafe_slug:
+        yield 'default', db.get_engine()
+    query = CafeTenant.query.order_by(CafeTenant.id)
+    if cafe_slug:
+        query = query.filter_by(slug=cafe_slug)
+    for cafe in query.all():
+        if os.path.exists(cafe.db_path):
+            yield cafe.slug, get_tenant_engine(cafe.db_path)
+        else:
+            print(f"{cafe.slug}: دیتابیس یافت نشد ({cafe.db_path})")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Rebuild or verify daily_sales_rollup')
+    parser.add_argument('--verify', action='store_true', help='only report drift')
+    parser.add_argument('--cafe', help='limit to one cafe slug')
+    parser.add_argument('--since', type=date.fromisoformat, help='only rebuild days from this date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    app = create_app()
+    drifted = 0
+    with app.app_context():
+        for label, engine in _targets(args.cafe):
+            migrate_operational_schema(engine)
+            with engine.begin() as connection:
+                if args.verify:
+                    drift = verify_sales_rollup(connection)
+                    drifted += len(drift)
+                    print(f"{label}: {len(drift)} اختلاف")
+                    for row in drift[:20]:
+                        print(f"  {row.key} expected={row.expected} actual={row.actual}")
+                else:
+                    count = rebuild_sales_rollup(connection, start_date=args.since)
+                    print(f"{label}: {count} ردیف بازسازی شد")
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+بازسازی / بررسی جدول موجودی تجمیعی (material_stock_balance)
+
+استفاده:
+    python rebuild_stock_ledger.py              # بازسازی برای دیتابیس پیش‌فرض و همه کافه‌ها
+    python rebuild_stock_ledger.py --verify     # فقط گزارش اختلاف، بدون تغییر
+    python rebuild_stock_ledger.py --cafe SLUG  # فقط یک کافه
+"""
+import argparse
+import os
+import sys
+
+from app import create_app
+from models.master_models import CafeTenant
+from models.models import db
+from services.schema_migrations import migrate_operational_schema
+from services.stock_ledger import rebuild_stock_ledger, verify_stock_ledger
+from services.tenant_engines import get_tenant_engine
+
+
+def _targets(cafe_slug=None):
+    if not cafe_slug:
+        yield 'default', db.get_engine()
+    query = CafeTenant.query.order_by(CafeTenant.id)
+    if cafe_slug:
+        query = query.filter_by(slug=cafe_slug)
+    for cafe in query.all():
+        if os.path.exists(cafe.db_path):
+            yield cafe.slug, get_tenant_engine(cafe.db_path)
+        else:
+            print(f"{cafe.slug}: دیتابیس یافت نشد ({cafe.db_path})")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Rebuild or verify material_stock_balance')
+    parser.add_argument('--verify', action='store_true', help='only report drift')
+    parser.add_argument('--cafe', help='limit to one cafe slug')
+    args = parser.parse_args()
+
+    app = create_app()
+    drifted = 0
+    with app.app_context():
+        for label, engine in _targets(args.cafe):
+            migrate_operational_schema(engine)
+            with engine.begin() as connection:
+                if args.verify:
+                    drift = verify_stock_ledger(connection)
+                    drifted += len(drift)
+                    print(f"{label}: {len(drift)} اختلاف")
+                    for row in drift[:20]:
+                        print(f"  rm={row.raw_material_id} wh={row.warehouse_id} expected={row.expected} actual={row.actual}")
+                else:
+                    count = rebuild_stock_ledger(connection)
+                    print(f"{label}: {count} ردیف بازسازی شد")
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
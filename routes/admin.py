@@ -4,7 +4,15 @@ from sqlalchemy import create_engine
 from models.models import db, Settings, Order, OrderItem, Customer, User, RawMaterial, MaterialPurchase, Table, TableArea, TableItem, SnapSettlement, Warehouse, InventoryConfiguration, WarehouseTransfer, RawMaterialUsage, MenuItemMaterial, PreProductionItem, PreProductionItemMaterial, PreProductionStock, PreProductionProduction, PreProductionTransfer, WarehouseMaterialMinStock, calculate_order_amount, convert_unit
 from utils.helpers import to_jalali, categorize_payment_method, PAYMENT_BUCKET_LABELS, restrict_cashier_access
 from sqlalchemy import func, extract, or_, text
-from services.inventory_service import calculate_material_stock_for_period, weighted_average_unit_price
+from services.inventory_service import calculate_material_stock_for_period, weighted_average_unit_prices
+from services.menu_availability import invalidate_menu_availability
+from services.order_pages import OrderFilter, order_summary, orders_page, page_size, parse_date
+from services.financial_report import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, financial_orders_page, financial_range_totals, order_range_filters,
+)
+from services.sales_rollup import daily_paid_totals, sales_summary
+from services.settings_cache import current_tax_percent
+from services.stock_ledger import warehouse_stock_matrix
 from collections import defaultdict
 from datetime import datetime, timedelta, date
 import pytz
@@ -85,29 +93,8 @@ def warehouse_transfer_sums(warehouse_id: int, direction: str, end_date: date |
 
 def compute_warehouse_stock_for_material(raw_material: RawMaterial, warehouse: Warehouse, end_date: date | None = None) -> float:
     """Compute warehouse stock in base unit (raw_material.default_unit)."""
-    incoming = warehouse_transfer_sums(warehouse.id, 'in', end_date=end_date).get(raw_material.id, 0.0)
-    outgoing = warehouse_transfer_sums(warehouse.id, 'out', end_date=end_date).get(raw_material.id, 0.0)
-    central = get_central_warehouse()
-    purchases_query = MaterialPurchase.query.filter(MaterialPurchase.raw_material_id == raw_material.id)
-    if end_date:
-        purchases_query = purchases_query.filter(MaterialPurchase.purchase_date <= end_date)
-    purchases = purchases_query.all()
-    base = sum(
-        convert_unit(purchase.quantity, purchase.unit, raw_material.default_unit)
-        for purchase in purchases
-        if purchase.warehouse_id == warehouse.id
-        or (purchase.warehouse_id is None and central and warehouse.id == central.id)
-    )
-    # Existing order consumption is global and is charged to the central warehouse.
-    if central and warehouse.id == central.id:
-        usages_query = RawMaterialUsage.query.filter_by(raw_material_id=raw_material.id)
-        if end_date:
-            usages_query = usages_query.filter(func.date(RawMaterialUsage.created_at) <= end_date)
-        base -= sum(
-            convert_unit(usage.quantity, usage.unit, raw_material.default_unit)
-            for usage in usages_query.all()
-        )
-    return max(0.0, base + incoming - outgoing)
+    return warehouse_stock_matrix([raw_material.id], [warehouse.id], as_of=end_date).get((raw_material.id, warehouse.id), 0.0)
+
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -207,20 +194,15 @@ def ui_kit():
 def dashboard():
     seed_inventory_if_needed()
     today = datetime.now().date()
-    orders_today = Order.query.filter(func.date(Order.created_at) == today).all()
-    total_orders = len(orders_today)
-    total_sales = sum(o.final_amount for o in orders_today)
-    unpaid_orders = [o for o in orders_today if o.status == 'پرداخت نشده']
-    paid_orders = [o for o in orders_today if o.status == 'پرداخت شده']
-    takeaway_orders = [o for o in orders_today if o.type == 'بیرون‌بر']
+    today_sales = sales_summary(today, today)
 
     # کارت‌های خلاصه
     summary = {
-        'total_orders': total_orders,
-        'total_sales': total_sales,
-        'unpaid_orders': len(unpaid_orders),
-        'paid_orders': len(paid_orders),
-        'takeaway_orders': len(takeaway_orders),
+        'total_orders': today_sales['orders_count'],
+        'total_sales': today_sales['total_sales'],
+        'unpaid_orders': today_sales['unpaid_count'],
+        'paid_orders': today_sales['paid_count'],
+        'takeaway_orders': today_sales['order_types'].get('بیرون‌بر', 0),
     }
     # آخرین سفارش‌ها برای نمایش کارت‌ها
     recent_orders = Order.query.order_by(Order.created_at.desc()).limit(20).all()
@@ -395,48 +377,19 @@ def settings():
         tables=tables
     )
 
-# --- گزارش سفارش‌ها با جستجو و فیلتر ---
+# --- گزارش سفارش‌ها با جستجو و فیلتر (صفحه‌بندی keyset) ---
 @admin_bp.route('/orders')
 @login_required
 def orders_report():
     # فیلتر بر اساس تاریخ، وضعیت، شماره فاکتور یا نام مشتری
-    status = request.args.get('status')
-    q = request.args.get('q')
-    date_from = request.args.get('from')
-    date_to = request.args.get('to')
-    orders_query = Order.query
-
-    if status:
-        orders_query = orders_query.filter_by(status=status)
-    if q:
-        try:
-            q_int = int(q)
-        except (TypeError, ValueError):
-            q_int = None
-        filters = [
-            (Order.invoice_number == q),
-            (Order.invoice_uid == q),
-            (Customer.name.ilike(f'%{q}%')),
-            (Customer.phone.ilike(f'%{q}%'))
-        ]
-        if q_int is not None:
-            filters.append(Order.daily_sequence == q_int)
-        orders_query = orders_query.join(Customer).filter(or_(*filters))
-    if date_from:
-        try:
-            date_from_dt = datetime.strptime(date_from, '%Y-%m-%d')
-            orders_query = orders_query.filter(Order.created_at >= date_from_dt)
-        except:
-            pass
-    if date_to:
-        try:
-            date_to_dt = datetime.strptime(date_to, '%Y-%m-%d')
-            orders_query = orders_query.filter(Order.created_at <= date_to_dt)
-        except:
-            pass
-
-    orders = orders_query.order_by(Order.created_at.desc()).all()
-    return render_template('admin/orders_report.html', orders=orders)
+    order_filter = OrderFilter(
+        q=(request.args.get('q') or '').strip() or None,
+        status=request.args.get('status') or None,
+        start_date=parse_date(request.args.get('from')),
+        end_date=parse_date(request.args.get('to')),
+    )
+    page = orders_page(order_filter, request.args.get('cursor'), page_size(request.args.get('per_page')))
+    return render_template('admin/orders_report.html', page=page, orders=page.orders)
 
 
 @admin_bp.route('/customers/leaderboard')
@@ -545,24 +498,9 @@ def inventory_dashboard():
 
     all_purchases = purchases_query.all()
 
+    unit_prices = weighted_average_unit_prices([material.id for material in raw_material_records])
     materials = []
     for material in raw_material_records:
-        # Latest unit price converted to base unit (e.g. price per gr / ml)
-        base_unit_price = None
-        try:
-            latest_purchase = (
-                MaterialPurchase.query
-                .filter_by(raw_material_id=material.id)
-                .order_by(MaterialPurchase.purchase_date.desc(), MaterialPurchase.created_at.desc())
-                .first()
-            )
-            if latest_purchase and latest_purchase.quantity:
-                qty_in_base = convert_unit(latest_purchase.quantity, latest_purchase.unit, material.default_unit)
-                if qty_in_base and qty_in_base > 0:
-                    base_unit_price = int((latest_purchase.total_price or 0) / qty_in_base)
-        except Exception:
-            base_unit_price = None
-
         materials.append({
             'id': material.id,
             'code': material.id,  # استفاده از ID به عنوان کد
@@ -570,14 +508,13 @@ def inventory_dashboard():
             'unit': material.default_unit,
             'current_stock': material.current_stock,  # موجودی فعلی
             'min_stock': material.min_stock or 0,  # حداقل موجودی
-            'base_unit_price': weighted_average_unit_price(material),
+            'base_unit_price': unit_prices.get(material.id),
             'created_at': material.created_at
         })
 
     # محاسبه موجودی بر اساس بازه زمانی
     material_stock_by_id = calculate_material_stock_for_period(
         raw_materials=raw_material_records,
-        purchases=all_purchases,
         start_date=start_date,
         end_date=end_date,
     )
@@ -639,8 +576,11 @@ def warehouses_management():
     show_all = (request.args.get('show_all') or '').strip() in {'1', 'true', 'yes', 'on'}
 
     raw_materials = RawMaterial.query.order_by(RawMaterial.name.asc()).all()
-    in_sums = warehouse_transfer_sums(selected_wh.id, 'in')
-    out_sums = warehouse_transfer_sums(selected_wh.id, 'out')
+    # موجودی همه مواد این انبار با یک کوئری (services.stock_ledger)
+    stock_by_material = {
+        material_id: stock
+        for (material_id, _), stock in warehouse_stock_matrix(warehouse_ids=[selected_wh.id]).items()
+    }
 
     # Get min_stock for each material in this warehouse
     warehouse_min_stocks = {}
@@ -649,7 +589,7 @@ def warehouses_management():
 
     rows = []
     for rm in raw_materials:
-        stock = compute_warehouse_stock_for_material(rm, selected_wh)
+        stock = stock_by_material.get(rm.id, 0.0)
         
         # Get min_stock for this warehouse, fallback to global min_stock if not set
         min_stock = warehouse_min_stocks.get(rm.id)
@@ -805,6 +745,8 @@ def create_warehouse():
             db.session.add(CafeWarehouseDefinition(
                 cafe_id=cafe.id, code=code, name=name, position=position, is_active=True
             ))
+            from services.tenant_context import invalidate_tenant_context
+            invalidate_tenant_context(cafe.slug)
 
     db.session.commit()
     flash(f'انبار «{name}» ساخته شد و در دفتر مادر هم ثبت شد.', 'success')
@@ -884,6 +826,9 @@ def create_warehouse_transfer():
             transfers_to_create = []
             
             # First, check all materials before creating any transfers
+            available_stock = warehouse_stock_matrix(
+                [m.raw_material_id for m in item.materials], [from_wh.id], as_of=transfer_date
+            )
             for item_material in item.materials:
                 raw_material = item_material.raw_material
                 if not raw_material:
@@ -897,7 +842,7 @@ def create_warehouse_transfer():
                 required_base_qty = convert_unit(required_qty, required_unit, raw_material.default_unit)
 
                 # بررسی موجودی در انبار منبع
-                available = compute_warehouse_stock_for_material(raw_material, from_wh, end_date=transfer_date)
+                available = available_stock.get((raw_material.id, from_wh.id), 0.0)
                 
                 if required_base_qty > (available + 1e-9):
                     insufficient_materials.append({
@@ -1231,112 +1176,39 @@ def financial_report():
     start_datetime = iran_tz.localize(datetime.combine(start_date, datetime.min.time()))
     end_datetime = iran_tz.localize(datetime.combine(end_date, datetime.max.time()))
     
-    # استفاده از datetime با timezone برای فیلتر کردن (مطمئن‌ترین روش)
-    orders = (
-        Order.query
-        .filter(Order.created_at >= start_datetime)
-        .filter(Order.created_at <= end_datetime)
-        .order_by(Order.created_at.desc())
-        .all()
-    )
-    
-    # دیباگ: چاپ اطلاعات برای بررسی
-    
-    # محاسبه اطلاعات آیتم‌های حذف شده برای هر سفارش
-    orders_with_deleted_info = []
-    total_deleted_items_count = 0
-    total_deleted_items_amount = 0
-    orders_with_deleted = 0
-    
     # دریافت تنظیمات برای محاسبه مالیات
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
-    
-    for order in orders:
-        deleted_items = OrderItem.query.filter_by(order_id=order.id, is_deleted=True).all()
-        deleted_count = len(deleted_items)
-        deleted_total = sum(item.total_price for item in deleted_items)
-        orders_with_deleted_info.append({
-            'order': order,
-            'deleted_items_count': deleted_count,
-            'deleted_items_total': deleted_total
-        })
-        
-        # محاسبه مجموع برای باکس خلاصه
-        if deleted_count > 0:
-            total_deleted_items_count += deleted_count
-            total_deleted_items_amount += deleted_total
-            orders_with_deleted += 1
-    
-        # همیشه مالیات را دوباره محاسبه می‌کنیم (برای اطمینان از صحت محاسبات)
-        order_items = OrderItem.query.filter_by(order_id=order.id, is_deleted=False).all()
-        if order_items:
-            order_items_data = [{
-                'quantity': item.quantity,
-                'unit_price': item.unit_price
-            } for item in order_items]
-            _, calculated_tax, _ = calculate_order_amount(order_items_data, order.discount or 0, tax_percent)
-            # ذخیره در متغیر order برای استفاده در محاسبات (بدون commit به دیتابیس)
-            order.tax_amount = calculated_tax
-    
-    # محاسبه مجموع‌ها
-    total_sales = sum(o.final_amount or 0 for o in orders)
-    total_discount = sum(o.discount or 0 for o in orders)
-    total_tax = sum(o.tax_amount or 0 for o in orders)
-    paid_orders = [o for o in orders if o.status == 'پرداخت شده']
-    unpaid_orders = [o for o in orders if o.status == 'پرداخت نشده']
-    average_ticket = int(total_sales / len(orders)) if orders else 0
-
-    # دیباگ: چاپ محاسبات با جزئیات بیشتر
-
-    # استفاده از datetime با timezone برای فیلتر کردن payment_rows
-    payment_rows = (
-        db.session.query(
-            Order.payment_method.label('method'),
-            func.count(Order.id).label('count'),
-            func.coalesce(func.sum(Order.final_amount), 0).label('amount')
-        )
-        .filter(Order.created_at >= start_datetime)
-        .filter(Order.created_at <= end_datetime)
-        .filter(Order.status == 'پرداخت شده')
-        .group_by(Order.payment_method)
-        .all()
-    )
-
-    payment_breakdown = []
-    payment_buckets = {key: 0 for key in PAYMENT_BUCKET_LABELS.keys()}
-    payment_bucket_counts = {key: 0 for key in PAYMENT_BUCKET_LABELS.keys()}
-    for row in payment_rows:
-        method_label = row.method or 'نامشخص'
-        method_amount = int(row.amount or 0)
-        method_count = int(row.count or 0)
-        payment_breakdown.append({
-            'method': method_label,
-            'amount': method_amount,
-            'count': method_count
-        })
-        bucket = categorize_payment_method(method_label)
-        payment_buckets[bucket] += method_amount
-        payment_bucket_counts[bucket] += method_count
+    tax_percent = current_tax_percent()
+
+    # آمار آیتم‌های حذف‌شده و مالیات بازنگری‌شده با یک کوئری گروه‌بندی‌شده روی order_item
+    order_filters = order_range_filters(start_datetime, end_datetime)
+    range_totals = financial_range_totals(order_filters, tax_percent)
+    total_deleted_items_count = range_totals['total_deleted_items_count']
+    total_deleted_items_amount = range_totals['total_deleted_items_amount']
+    orders_with_deleted = range_totals['orders_with_deleted']
+
+    # جدول سفارش‌ها صفحه‌بندی می‌شود تا بازه‌های طولانی حافظه محدودی مصرف کنند
+    per_page = min(max(request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int) or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    total_pages = max(1, -(-range_totals['orders_count'] // per_page))
+    page = min(max(request.args.get('page', 1, type=int) or 1, 1), total_pages)
+    orders_with_deleted_info = financial_orders_page(order_filters, tax_percent, page, per_page)
+
+    # محاسبه مجموع‌ها از جدول خلاصه روزانه (services.sales_rollup)
+    summary = sales_summary(start_date, end_date)
+    total_sales = summary['total_sales']
+    total_discount = summary['discount_total']
+    total_tax = range_totals['total_tax']
+    paid_count = summary['paid_count']
+    unpaid_count = summary['unpaid_count']
+    orders_count = summary['orders_count']
+    average_ticket = int(total_sales / orders_count) if orders_count else 0
+
+    payment_buckets = {key: summary['payment'].get(key, 0) for key in PAYMENT_BUCKET_LABELS.keys()}
+    payment_bucket_counts = {key: summary['payment_counts'].get(key, 0) for key in PAYMENT_BUCKET_LABELS.keys()}
 
     # --- Snap settlement logic (manual settlements) ---
-    def _order_local_date(dt_value: datetime | None) -> date | None:
-        if not dt_value:
-            return None
-        try:
-            # created_at is usually stored with Iran tz; keep it robust for naive datetimes too.
-            if dt_value.tzinfo is None:
-                return dt_value.date()
-            return dt_value.astimezone(iran_tz).date()
-        except Exception:
-            return dt_value.date()
-
-    snap_orders = [
-        o for o in paid_orders
-        if categorize_payment_method(o.payment_method) == 'snap'
-    ]
-    snap_total = sum(o.final_amount or 0 for o in snap_orders)
-    snap_count = len(snap_orders)
+    snap_daily = daily_paid_totals('snap', start_date, end_date)
+    snap_total = sum(amount for _, amount in snap_daily.values())
+    snap_count = sum(count for count, _ in snap_daily.values())
 
     # Settled periods that overlap the current report range
     settled_periods = (
@@ -1348,17 +1220,11 @@ def financial_report():
     )
     settled_ranges = [(s.start_date, s.end_date) for s in settled_periods]
 
-    def _is_snap_order_settled(order: Order) -> bool:
-        od = _order_local_date(order.created_at)
-        if not od:
-            return False
-        for s_start, s_end in settled_ranges:
-            if s_start <= od <= s_end:
-                return True
-        return False
-
-    snap_settled_total = sum((o.final_amount or 0) for o in snap_orders if _is_snap_order_settled(o))
-    snap_settled_count = sum(1 for o in snap_orders if _is_snap_order_settled(o))
+    def _is_snap_day_settled(sales_date: date) -> bool:
+        return any(s_start <= sales_date <= s_end for s_start, s_end in settled_ranges)
+
+    snap_settled_total = sum(amount for day, (_, amount) in snap_daily.items() if _is_snap_day_settled(day))
+    snap_settled_count = sum(count for day, (count, _) in snap_daily.items() if _is_snap_day_settled(day))
     snap_pending_total = max(0, snap_total - snap_settled_total)
     snap_pending_count = max(0, snap_count - snap_settled_count)
 
@@ -1376,8 +1242,8 @@ def financial_report():
         'pos_count': payment_bucket_counts.get('pos', 0),
         'transfer_total': payment_buckets.get('card_to_card', 0),
         'transfer_count': payment_bucket_counts.get('card_to_card', 0),
-        'paid_total': sum(o.final_amount or 0 for o in paid_orders),
-        'pending_total': sum(o.final_amount or 0 for o in unpaid_orders)
+        'paid_total': summary['paid_total'],
+        'pending_total': summary['unpaid_total']
     }
     closing_summary['drawer_expected'] = closing_summary['pos_total']
     closing_summary['snap_total'] = snap_total
@@ -1399,10 +1265,10 @@ def financial_report():
     ]
 
     channel_totals = defaultdict(lambda: {'amount': 0, 'count': 0})
-    for order in paid_orders:
-        channel_key = order.type or 'حضوری'
-        channel_totals[channel_key]['amount'] += order.final_amount or 0
-        channel_totals[channel_key]['count'] += 1
+    for order_type, stats in summary['paid_channels'].items():
+        channel_key = order_type or 'حضوری'
+        channel_totals[channel_key]['amount'] += stats['amount']
+        channel_totals[channel_key]['count'] += stats['count']
     channel_breakdown = [
         {'label': label, 'amount': stats['amount'], 'count': stats['count']}
         for label, stats in channel_totals.items()
@@ -1416,13 +1282,17 @@ def financial_report():
     ]
 
     return render_template('admin/financial_report.html',
-                           orders=orders,
                            orders_with_deleted_info=orders_with_deleted_info,
+                           page=page,
+                           per_page=per_page,
+                           total_pages=total_pages,
+                           page_offset=(page - 1) * per_page,
                            total_sales=total_sales,
                            total_discount=total_discount,
                            total_tax=total_tax,
-                           paid_orders=paid_orders,
-                           unpaid_orders=unpaid_orders,
+                           orders_count=orders_count,
+                           paid_count=paid_count,
+                           unpaid_count=unpaid_count,
                            payment_breakdown=payment_breakdown_display,
                            closing_summary=closing_summary,
                            channel_breakdown=channel_breakdown,
@@ -1489,25 +1359,16 @@ def users_list():
     # Force fresh query - use a completely new session to avoid any cache
     import os
     from sqlalchemy import create_engine
-    from sqlalchemy.orm import sessionmaker
     
     tenant_slug = session.get('tenant_slug')
     if tenant_slug:
-        from models.master_models import CafeTenant
-        # Query cafe from master DB
-        original_bind = db.session.bind
-        try:
-            from config import Config
-            master_engine = create_engine(Config.MASTER_DB_URI)
-            db.session.bind = master_engine
-            cafe = CafeTenant.query.filter_by(slug=tenant_slug).first()
-        finally:
-            db.session.bind = original_bind
+        from services.tenant_context import resolve_tenant_context
+        cafe = resolve_tenant_context(tenant_slug)
         
         if cafe and os.path.exists(cafe.db_path):
             # Create a completely fresh session for this query
-            tenant_engine = create_engine(f"sqlite:///{cafe.db_path}")
-            TenantSession = sessionmaker(bind=tenant_engine)
+            from services.tenant_engines import tenant_sessionmaker
+            TenantSession = tenant_sessionmaker(cafe.db_path)
             with TenantSession() as tenant_session:
                 # Query directly from tenant DB with fresh session
                 users_raw = tenant_session.query(User).order_by(User.created_at.desc()).all()
@@ -1563,15 +1424,8 @@ def request_user_creation():
         return redirect(url_for('admin.users_list'))
     
     # Get cafe from master database
-    from config import Config
-    original_bind_for_cafe = db.session.bind
-    try:
-        # Switch to master database to query CafeTenant
-        master_engine = create_engine(Config.MASTER_DB_URI)
-        db.session.bind = master_engine
-        cafe = CafeTenant.query.filter_by(slug=tenant_slug).first()
-    finally:
-        db.session.bind = original_bind_for_cafe
+    from services.tenant_context import resolve_tenant_context
+    cafe = resolve_tenant_context(tenant_slug)
     
     if not cafe:
         if request.form.get('modal') == '1':
@@ -1619,7 +1473,7 @@ def request_user_creation():
         
         # Check if request already exists for this username in this cafe
         existing_request = UserCreationRequest.query.filter_by(
-            cafe_id=cafe.id,
+            cafe_id=cafe.cafe_id,
             username=username,
             status='pending'
         ).first()
@@ -1640,7 +1494,7 @@ def request_user_creation():
         
         # Create request in master database
         request_obj = UserCreationRequest(
-            cafe_id=cafe.id,
+            cafe_id=cafe.cafe_id,
             requested_by=requested_by,
             username=username,
             name=name,
@@ -1819,40 +1673,20 @@ def delete_user(user_id):
     return redirect(url_for('admin.users_list'))
 
 # --- جستجوی سریع سفارش بر اساس شماره فاکتور یا نام مشتری (AJAX) ---
+# فقط یک صفحه برمی‌گردد؛ مکان‌نمای صفحه بعد در هدر X-Next-Cursor است
 @admin_bp.route('/orders/search')
 @login_required
 def search_orders():
-    q = request.args.get('q')
+    q = (request.args.get('q') or '').strip()
     if not q:
         return jsonify([])
-    try:
-        q_int = int(q)
-    except (TypeError, ValueError):
-        q_int = None
-
-    filters = [
-        (Order.invoice_number == q),
-        (Order.invoice_uid == q),
-        (Customer.name.ilike(f'%{q}%')),
-        (Customer.phone.ilike(f'%{q}%'))
-    ]
-    if q_int is not None:
-        filters.append(Order.daily_sequence == q_int)
-
-    orders = Order.query.join(Customer).filter(or_(*filters)).all()
-    results = []
-    for o in orders:
-        results.append({
-            'id': o.id,
-            'invoice_uid': o.invoice_uid,
-            'invoice_number': o.invoice_number,
-            'daily_invoice_number': o.daily_sequence,
-            'customer': o.customer.name,
-            'status': o.status,
-            'final_amount': o.final_amount,
-            'created_at': o.created_at.strftime('%Y-%m-%d %H:%M')
-        })
-    return jsonify(results)
+    page = orders_page(
+        OrderFilter(q=q), request.args.get('cursor'), page_size(request.args.get('per_page')), with_count=False,
+    )
+    response = jsonify([order_summary(order) for order in page.orders])
+    if page.next_cursor:
+        response.headers['X-Next-Cursor'] = page.next_cursor
+    return response
 
 # --- پروفایل کاربر ---
 @admin_bp.route('/profile')
@@ -2222,6 +2056,8 @@ def clear_all_inventory_data():
             conn.execute(text('DELETE FROM material_purchase'))
             conn.execute(text('DELETE FROM menu_item_material'))
             conn.execute(text('DELETE FROM raw_material'))
+            conn.execute(text('DELETE FROM material_stock_balance'))
+        invalidate_menu_availability(engine)
         
         # Commit تغییرات
         db.session.commit()
@@ -2503,6 +2339,9 @@ def produce_pre_production_item():
     
     insufficient_materials = []
     transfers_to_create = []
+    available_stock = warehouse_stock_matrix(
+        [m.raw_material_id for m in item.materials], [source_warehouse.id], as_of=production_date
+    )
 
     for item_material in item.materials:
         raw_material = item_material.raw_material
@@ -2517,7 +2356,7 @@ def produce_pre_production_item():
         required_base_qty = convert_unit(required_qty, required_unit, raw_material.default_unit)
 
         # بررسی موجودی در انبار منبع
-        available = compute_warehouse_stock_for_material(raw_material, source_warehouse, end_date=production_date)
+        available = available_stock.get((raw_material.id, source_warehouse.id), 0.0)
         
         if required_base_qty > (available + 1e-9):
             insufficient_materials.append({
@@ -1,13 +1,21 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
-from models.models import Order, Category, MenuItem, Customer, Table, RawMaterial, MaterialPurchase, Warehouse, PreProductionItem, db
+from flask import Blueprint, Response, current_app, render_template, request, redirect, url_for, flash, jsonify
+from models.models import Order, Category, MenuItem, Table, RawMaterial, MaterialPurchase, Warehouse, PreProductionItem, db
 from flask_login import login_required
 from sqlalchemy import text, func, extract
 from datetime import datetime, timedelta
 from collections import defaultdict
 import pytz
 import jdatetime
-from utils.helpers import categorize_payment_method, PAYMENT_BUCKET_LABELS, restrict_cashier_access
+from utils.helpers import restrict_cashier_access
 from services.inventory_service import menu_stock_map
+from services.dashboard_summary import dashboard_periods
+from services.live_events import (
+    BUSY_RETRY_SECONDS,
+    close_stream_slot,
+    live_events_engine,
+    open_stream_slot,
+    stream_live_events,
+)
 
 dashboard_bp = Blueprint('dashboard', __name__, url_prefix='/dashboard')
 
@@ -29,9 +37,6 @@ def waiter_dashboard():
     # Get all categories for menu grouping
     categories = Category.query.filter_by(is_active=True).order_by(Category.order, Category.name).all()
     
-    # Get all customers for the datalist
-    customers = Customer.query.all()
-    
     # Get all tables, if no tables exist, create 4 default tables
     tables = Table.query.order_by(Table.number).all()
     if not tables:
@@ -79,7 +84,6 @@ def waiter_dashboard():
                           menu_items=menu_items,
                           menu_stocks=menu_stocks,
                           categories=categories,
-                          customers=customers,
                           tables=tables,
                           table_groups=table_groups,
                           financial=financial_data,
@@ -97,9 +101,6 @@ def dashboard():
     # Get all categories for menu grouping
     categories = Category.query.filter_by(is_active=True).order_by(Category.order, Category.name).all()
     
-    # Get all customers for the datalist
-    customers = Customer.query.all()
-    
     # Get all tables, if no tables exist, create 4 default tables
     tables = Table.query.order_by(Table.number).all()
     if not tables:
@@ -121,78 +122,8 @@ def dashboard():
     
     # دیگر نیازی به table_orders نیست چون فقط سفارش فعلی (order_id) را نمایش می‌دهیم
     
-    # محاسبه اطلاعات مالی
-    iran_tz = pytz.timezone('Asia/Tehran')
-    now = datetime.now(iran_tz)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # محاسبه شروع ماه شمسی جاری
-    # تبدیل به naive datetime برای jdatetime (SQLite معمولاً naive datetime ذخیره می‌کند)
-    now_naive = now.replace(tzinfo=None) if now.tzinfo else now
-    jalali_now = jdatetime.datetime.fromgregorian(datetime=now_naive)
-    jalali_month_start = jdatetime.datetime(jalali_now.year, jalali_now.month, 1, 0, 0, 0)
-    # تبدیل به میلادی برای فیلتر کردن در دیتابیس (به صورت naive چون SQLite naive ذخیره می‌کند)
-    month_start_naive = jalali_month_start.togregorian().replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # محاسبه پایان ماه شمسی جاری
-    if jalali_now.month == 12:
-        # آخرین ماه سال - 29 یا 30 روز بسته به سال کبیسه
-        last_day = 29 if jdatetime.date.isleap(jalali_now.year) else 30
-    elif jalali_now.month <= 6:
-        last_day = 31
-    else:
-        last_day = 30
-    jalali_month_end = jdatetime.datetime(jalali_now.year, jalali_now.month, last_day, 23, 59, 59)
-    month_end_naive = jalali_month_end.togregorian().replace(hour=23, minute=59, second=59, microsecond=999999)
-    
-    def summarize_period(key, label, start_dt, end_dt=None):
-        query = Order.query.filter(Order.created_at >= start_dt)
-        if end_dt:
-            query = query.filter(Order.created_at <= end_dt)
-        orders = query.all()
-        
-        total_sales = sum(o.final_amount or 0 for o in orders)
-        orders_count = len(orders)
-        paid_orders = [o for o in orders if o.status == 'پرداخت شده']
-        paid_count = len(paid_orders)
-        paid_total = sum(o.final_amount or 0 for o in paid_orders)
-        unpaid_total = sum(o.final_amount or 0 for o in orders if o.status != 'پرداخت شده')
-        payment_stats = {bucket: 0 for bucket in PAYMENT_BUCKET_LABELS.keys()}
-        payment_counts = {bucket: 0 for bucket in PAYMENT_BUCKET_LABELS.keys()}
-        order_type_stats = {'حضوری': 0, 'بیرون‌بر': 0, 'سایر': 0}
-        for order in orders:
-            order_type = order.type or 'سایر'
-            if order_type not in order_type_stats:
-                order_type_stats[order_type] = 0
-            order_type_stats[order_type] += 1
-        for order in paid_orders:
-            bucket = categorize_payment_method(order.payment_method)
-            payment_stats[bucket] += order.final_amount or 0
-            payment_counts[bucket] += 1
-        tax_total = sum(o.tax_amount or 0 for o in orders)
-        discount_total = sum(o.discount or 0 for o in orders)
-        
-        return {
-            'key': key,
-            'label': label,
-            'total_sales': total_sales,
-            'orders_count': orders_count,
-            'paid_count': paid_count,
-            'paid_total': paid_total,
-            'unpaid_total': unpaid_total,
-            'payment': payment_stats,
-            'payment_counts': payment_counts,
-            'tax_total': tax_total,
-            'discount_total': discount_total,
-            'order_types': order_type_stats
-        }
-    
-    today_start_naive = today_start.replace(tzinfo=None) if today_start.tzinfo else today_start
-    periods = [
-        summarize_period('day', 'امروز', today_start_naive),
-        summarize_period('week', 'هفته جاری (۷ روز)', (today_start_naive - timedelta(days=7))),
-        summarize_period('month', 'ماه جاری', month_start_naive, month_end_naive)
-    ]
+    # محاسبه اطلاعات مالی از ردیف‌های روزانه daily_sales_rollup (services.dashboard_summary)
+    periods = dashboard_periods()
     active_period_key = 'month'
     period_lookup = {p['key']: p for p in periods}
     active_period = period_lookup[active_period_key]
@@ -264,11 +195,9 @@ def dashboard():
     # table_orders = {}  # حذف شده - دیگر استفاده نمی‌شود
     
     return render_template('dashboard.html', 
-                          orders=Order.query.all(),
                           menu_items=menu_items,
                           menu_stocks=menu_stocks,
                           categories=categories,
-                          customers=customers,
                           tables=tables,
                           table_groups=table_groups,
                           financial=financial_data,
@@ -311,3 +240,50 @@ def mark_all_unpaid_as_paid():
         flash(f'خطا در تغییر وضعیت سفارش‌ها: {str(e)}', 'danger')
         print(f"خطا: {str(e)}")
         return redirect(url_for('dashboard.dashboard'))
+
+
+# --- به‌روزرسانی زنده داشبورد (به جای location.reload) ---
+@dashboard_bp.route('/events')
+@login_required
+def live_events():
+    """جریان SSE رویدادهای میز، سفارش و موجودی منوی کافه جاری (services.live_events)"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    # هر جریان باز یک thread از worker را نگه می‌دارد؛ بیش از سقف، صفحه کمی بعد دوباره تلاش می‌کند
+    if not open_stream_slot(current_app.config['LIVE_STREAMS_PER_WORKER']):
+        response = Response(f'retry: {BUSY_RETRY_SECONDS * 1000}\n\n', status=503, mimetype='text/event-stream')
+        response.headers['Retry-After'] = str(BUSY_RETRY_SECONDS)
+        return response
+    try:
+        events = stream_live_events(live_events_engine(), last_event_id)
+    except Exception:
+        close_stream_slot()
+        raise
+    # اتصال نشست تا پایان جریان نگه داشته نشود؛ جریان فقط از engine می‌خواند
+    db.session.close()
+    response = Response(events, mimetype='text/event-stream')
+    response.call_on_close(close_stream_slot)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@dashboard_bp.route('/cards/table/<int:table_id>')
+@login_required
+def table_card(table_id):
+    """HTML کارت یک میز برای جایگزینی در داشبورد"""
+    table = Table.query.get_or_404(table_id)
+    return render_template('dashboard/table_card.html', table=table)
+
+
+@dashboard_bp.route('/cards/takeaway/<int:order_id>')
+@login_required
+def takeaway_card(order_id):
+    """HTML کارت سفارش بیرون‌بر؛ اگر دیگر در داشبورد نمایش داده نمی‌شود 204"""
+    order = db.session.get(Order, order_id)
+    if order is None or order.type != 'بیرون‌بر' or order.status != 'پرداخت نشده':
+        return '', 204
+    return render_template('dashboard/takeaway_card.html', order=order)
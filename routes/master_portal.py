@@ -4,25 +4,30 @@ from datetime import datetime
 import pytz
 
 import os
-from flask import Blueprint, current_app, flash, redirect, render_template, request, session, url_for
+from flask import Blueprint, current_app, flash, jsonify, redirect, render_template, request, session, url_for
 from werkzeug.security import check_password_hash
 
 from models.models import db
-from models.master_models import CafeModule, CafeTenant, MasterUser, UserCreationRequest
+from models.master_models import BackgroundJob, CafeMetricsSnapshot, CafeModule, CafeTenant, MasterUser, UserCreationRequest
 import shutil
+from services.background_jobs import JOBS, list_jobs, retry_job
+from services.fleet_metrics import fleet_metrics_trend, latest_cafe_metrics, refresh_cafe_metrics
+from services.fleet_query import invalidate_fleet_results, run_fleet_query
+from services.fleet_reports import cafe_report_details
 from services.master_service import (
     MODULE_CATALOG,
     create_managed_cafe,
     ensure_cafe_warehouse_profile,
     enabled_module_codes,
+    fleet_master_data,
     log_cafe_event,
     set_cafe_modules,
     warehouse_profile_for_cafe,
 )
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
 from models.models import User as TenantUser
+from services.tenant_context import invalidate_tenant_context
+from services.tenant_engines import invalidate_tenant_engine, tenant_sessionmaker
 from services.tenant_session import clear_tenant_session, establish_tenant_session
 
 master_bp = Blueprint('master', __name__, url_prefix='/master')
@@ -101,51 +106,52 @@ def dashboard():
     user = _master_user()
     cafes = CafeTenant.query.order_by(CafeTenant.created_at.desc()).all()
     
-    # Collect summary statistics for each cafe
+    # آمار هر کافه از آخرین snapshot دیتابیس مادر (services.fleet_metrics)؛
+    # فقط کافه‌هایی که هنوز snapshot ندارند همین‌جا یک بار خوانده می‌شوند.
+    enabled_modules, warehouse_profiles = fleet_master_data(cafes)
+    active = [cafe for cafe in cafes if cafe.is_active]
+    snapshots = latest_cafe_metrics([cafe.id for cafe in active])
+    missing = [cafe for cafe in active if cafe.id not in snapshots]
+    refresh_errors = {}
+    if missing:
+        results = refresh_cafe_metrics(missing)
+        refresh_errors = {slug: result.error for slug, result in results.items() if not result.ok}
+        snapshots.update(latest_cafe_metrics([cafe.id for cafe in missing]))
+
     cafe_stats = []
     total_orders = 0
     total_revenue = 0
     active_cafes = 0
-    
+
     for cafe in cafes:
-        warehouse_profile = ensure_cafe_warehouse_profile(cafe)
         stats = {
             'cafe': cafe,
-            'enabled_modules': enabled_module_codes(cafe.id),
+            'enabled_modules': enabled_modules[cafe.id],
             'orders_count': 0,
             'revenue': 0,
             'users_count': 0,
             'menu_items_count': 0,
             'customers_count': 0,
             'has_data': False,
-            'warehouse_profile': warehouse_profile,
+            'warehouse_profile': warehouse_profiles[cafe.id],
         }
-        
-        if cafe.is_active and os.path.exists(cafe.db_path):
-            try:
-                engine = create_engine(f"sqlite:///{cafe.db_path}")
-                Session = sessionmaker(bind=engine)
-                with Session() as s:
-                    from models.models import Order, User, MenuItem, Customer
-                    from sqlalchemy import func
-                    
-                    stats['orders_count'] = s.query(func.count(Order.id)).scalar() or 0
-                    stats['revenue'] = s.query(func.coalesce(func.sum(Order.final_amount), 0)).filter(Order.status == 'پرداخت شده').scalar() or 0
-                    stats['users_count'] = s.query(func.count(User.id)).scalar() or 0
-                    stats['menu_items_count'] = s.query(func.count(MenuItem.id)).scalar() or 0
-                    stats['customers_count'] = s.query(func.count(Customer.id)).scalar() or 0
-                    stats['has_data'] = True
-                    
-                    total_orders += stats['orders_count']
-                    total_revenue += stats['revenue']
-            except Exception as e:
-                stats['error'] = str(e)
-        
+
+        snapshot = snapshots.get(cafe.id) if cafe.is_active else None
+        if snapshot is not None:
+            for field in ('orders_count', 'revenue', 'users_count', 'menu_items_count', 'customers_count'):
+                stats[field] = getattr(snapshot, field)
+            stats['refreshed_at'] = snapshot.refreshed_at
+            stats['has_data'] = True
+            total_orders += stats['orders_count']
+            total_revenue += stats['revenue']
+        elif cafe.slug in refresh_errors and os.path.exists(cafe.db_path):
+            stats['error'] = refresh_errors[cafe.slug]
+
         if cafe.is_active:
             active_cafes += 1
-        
+
         cafe_stats.append(stats)
-    
+
     summary = {
         'total_cafes': len(cafes),
         'active_cafes': active_cafes,
@@ -161,7 +167,7 @@ def dashboard():
         req.cafe = CafeTenant.query.get(req.cafe_id)
     
     module_access_by_cafe = {stat['cafe'].id: stat['enabled_modules'] for stat in cafe_stats}
-    warehouse_profiles = {stat['cafe'].id: stat['warehouse_profile'] for stat in cafe_stats}
+    cafe_names = {cafe.id: cafe.name for cafe in cafes}
     return render_template(
         'master/dashboard.html',
         master_user=user,
@@ -172,9 +178,35 @@ def dashboard():
         user_requests=user_requests,
         module_access_by_cafe=module_access_by_cafe,
         warehouse_profiles=warehouse_profiles,
+        background_jobs=list_jobs(),
+        job_titles={name: job.title for name, job in JOBS.items()},
+        cafe_names=cafe_names,
     )
 
 
+@master_bp.route('/jobs/<int:job_id>/retry', methods=['POST'])
+@master_login_required
+def retry_background_job(job_id):
+    """اجرای دوباره کار پس‌زمینه ناموفق از آخرین checkpoint"""
+    if retry_job(job_id):
+        flash('کار پس‌زمینه دوباره در صف اجرا قرار گرفت.', 'success')
+    else:
+        flash('فقط کارهای ناموفق را می‌توان دوباره اجرا کرد.', 'warning')
+    return redirect(url_for('master.dashboard') + '#jobs')
+
+
+@master_bp.route('/metrics/trend')
+@master_login_required
+def metrics_trend():
+    """روند روزانه سفارش و فروش کل کافه‌ها (یا یک کافه) از snapshotهای دیتابیس مادر"""
+    days = min(max(request.args.get('days', 30, type=int) or 30, 1), 366)
+    cafe_id = None
+    slug = request.args.get('cafe')
+    if slug:
+        cafe_id = CafeTenant.query.filter_by(slug=slug).first_or_404().id
+    return jsonify({'days': days, 'cafe': slug, 'points': fleet_metrics_trend(days, cafe_id=cafe_id)})
+
+
 @master_bp.route('/cafes/create', methods=['POST'])
 @master_login_required
 def create_cafe():
@@ -230,6 +262,10 @@ def cafe_access(slug):
             {'is_active': cafe.is_active, 'modules': sorted(selected)},
         )
         db.session.commit()
+        invalidate_tenant_context(cafe.slug)
+        invalidate_fleet_results(cafe.db_path)
+        if not cafe.is_active:
+            invalidate_tenant_engine(cafe.db_path)
         flash('دسترسی‌ها و وضعیت کافه ذخیره شد.', 'success')
         return redirect(url_for('master.cafe_access', slug=slug))
 
@@ -257,31 +293,27 @@ def enter_cafe(slug):
         return redirect(url_for('master.dashboard'))
     
     master_user = _master_user()
-    engine = create_engine(f"sqlite:///{cafe.db_path}", poolclass=NullPool)
-    Session = sessionmaker(bind=engine)
-    try:
-        with Session.begin() as tenant_session:
-            tenant_user = (
-                tenant_session.query(TenantUser)
-                .filter(TenantUser.is_active.is_(True))
-                .order_by((TenantUser.role != 'admin').asc(), TenantUser.id.asc())
-                .first()
-            )
-            if tenant_user is None:
-                flash('این کافه کاربر فعال برای ورود مدیریتی ندارد.', 'danger')
-                return redirect(url_for('master.dashboard'))
-
-            tenant_user.last_login = datetime.now(pytz.timezone('Asia/Tehran'))
-            establish_tenant_session(
-                cafe=cafe,
-                user=tenant_user,
-                remember=False,
-                master_user_id=master_user.id,
-            )
-            tenant_user_id = int(tenant_user.id)
-            tenant_username = tenant_user.username
-    finally:
-        engine.dispose()
+    Session = tenant_sessionmaker(cafe.db_path)
+    with Session.begin() as tenant_session:
+        tenant_user = (
+            tenant_session.query(TenantUser)
+            .filter(TenantUser.is_active.is_(True))
+            .order_by((TenantUser.role != 'admin').asc(), TenantUser.id.asc())
+            .first()
+        )
+        if tenant_user is None:
+            flash('این کافه کاربر فعال برای ورود مدیریتی ندارد.', 'danger')
+            return redirect(url_for('master.dashboard'))
+
+        tenant_user.last_login = datetime.now(pytz.timezone('Asia/Tehran'))
+        establish_tenant_session(
+            cafe=cafe,
+            user=tenant_user,
+            remember=False,
+            master_user_id=master_user.id,
+        )
+        tenant_user_id = int(tenant_user.id)
+        tenant_username = tenant_user.username
 
     log_cafe_event(
         cafe,
@@ -316,8 +348,7 @@ def cafe_users(slug):
         return redirect(url_for('master.dashboard'))
     
     # Connect to tenant DB
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     with Session() as s:
         users = s.query(TenantUser).order_by(TenantUser.created_at.desc()).all()
@@ -343,8 +374,7 @@ def delete_all_users_except_admin(slug):
         return redirect(url_for('master.dashboard'))
     
     # Connect to tenant DB
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     try:
         with Session() as s:
@@ -375,8 +405,7 @@ def delete_cafe_user(slug, user_id):
         return redirect(url_for('master.dashboard'))
     
     # Connect to tenant DB
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     try:
         with Session() as s:
@@ -411,8 +440,7 @@ def user_report(slug, user_id):
         return redirect(url_for('master.dashboard'))
     
     # Connect to tenant DB
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     with Session() as s:
         from models.models import ActionLog, Order
@@ -486,6 +514,10 @@ def toggle_cafe_active(slug):
     
     cafe.is_active = not cafe.is_active
     db.session.commit()
+    invalidate_tenant_context(cafe.slug)
+    invalidate_fleet_results(cafe.db_path)
+    if not cafe.is_active:
+        invalidate_tenant_engine(cafe.db_path)
     
     status = 'فعال' if cafe.is_active else 'غیرفعال'
     flash(f'کافه «{cafe.name}» {status} شد.', 'success')
@@ -518,57 +550,13 @@ def cafe_report(slug):
     }
     
     if os.path.exists(cafe.db_path):
-        try:
-            engine = create_engine(f"sqlite:///{cafe.db_path}")
-            Session = sessionmaker(bind=engine)
-            with Session() as s:
-                from models.models import (
-                    Order, User, MenuItem, Category, Customer, Table, TableArea,
-                    RawMaterial, Warehouse
-                )
-                from sqlalchemy import func
-                
-                stats['orders_count'] = s.query(func.count(Order.id)).scalar() or 0
-                stats['revenue'] = s.query(func.coalesce(func.sum(Order.final_amount), 0)).scalar() or 0
-                stats['paid_revenue'] = s.query(func.coalesce(func.sum(Order.final_amount), 0)).filter(Order.status == 'پرداخت شده').scalar() or 0
-                stats['unpaid_revenue'] = s.query(func.coalesce(func.sum(Order.final_amount), 0)).filter(Order.status == 'پرداخت نشده').scalar() or 0
-                stats['users_count'] = s.query(func.count(User.id)).scalar() or 0
-                stats['menu_items_count'] = s.query(func.count(MenuItem.id)).scalar() or 0
-                stats['categories_count'] = s.query(func.count(Category.id)).scalar() or 0
-                stats['customers_count'] = s.query(func.count(Customer.id)).scalar() or 0
-                stats['tables_count'] = s.query(func.count(Table.id)).scalar() or 0
-                stats['table_areas_count'] = s.query(func.count(TableArea.id)).scalar() or 0
-                stats['raw_materials_count'] = s.query(func.count(RawMaterial.id)).scalar() or 0
-                stats['warehouses_count'] = s.query(func.count(Warehouse.id)).scalar() or 0
-                stats['has_data'] = True
-                
-                # Get recent orders
-                recent_orders = s.query(Order).order_by(Order.created_at.desc()).limit(10).all()
-                stats['recent_orders'] = [
-                    {
-                        'id': o.id,
-                        'invoice_number': str(o.invoice_number) if o.invoice_number else '-',
-                        'final_amount': o.final_amount or 0,
-                        'status': o.status,
-                        'created_at': o.created_at
-                    } for o in recent_orders
-                ]
-                
-                # Get active users
-                active_users = s.query(User).filter(User.is_active == True).all()
-                stats['active_users'] = [
-                    {
-                        'id': u.id,
-                        'username': u.username,
-                        'name': u.name,
-                        'role': u.role
-                    } for u in active_users
-                ]
-                
-        except Exception as e:
-            stats['error'] = str(e)
-            stats['has_data'] = False
-    
+        result = run_fleet_query('cafe_report', [cafe], cafe_report_details)[cafe.slug]
+        if result.ok:
+            stats.update(result.value)
+            stats['has_data'] = True
+        else:
+            stats['error'] = result.error
+
     return render_template('master/cafe_report.html', stats=stats)
 
 
@@ -614,8 +602,7 @@ def approve_user_request(request_id):
     generated_password = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(8))
     
     # Connect to tenant DB and create user
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     try:
         with Session() as s:
@@ -735,8 +722,7 @@ def reject_user_request(request_id):
         cafe = CafeTenant.query.get(req.cafe_id)
         if cafe and os.path.exists(cafe.db_path):
             # Connect to tenant DB and delete temp user
-            engine = create_engine(f"sqlite:///{cafe.db_path}")
-            Session = sessionmaker(bind=engine)
+            Session = tenant_sessionmaker(cafe.db_path)
             try:
                 with Session() as s:
                     temp_user = s.query(TenantUser).get(temp_user_id)
@@ -789,11 +775,18 @@ def delete_cafe(slug):
     try:
         # Delete all CafeModule records
         CafeModule.query.filter_by(cafe_id=cafe.id).delete()
+        CafeMetricsSnapshot.query.filter_by(cafe_id=cafe.id).delete()
+        BackgroundJob.query.filter_by(cafe_id=cafe.id).delete()
         
         # Delete cafe from master DB
         db.session.delete(cafe)
         db.session.commit()
         
+        # Release pooled connections before the files disappear
+        invalidate_tenant_context(cafe.slug)
+        invalidate_fleet_results(cafe.db_path)
+        invalidate_tenant_engine(cafe.db_path)
+
         # Delete tenant directory and database
         import shutil
         if os.path.exists(cafe.root_dir):
@@ -823,8 +816,7 @@ def delete_user(request_id):
         return redirect(url_for('master.dashboard') + '#requests')
     
     # Connect to tenant DB and delete user
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     user_deleted = False
     try:
@@ -880,8 +872,7 @@ def deactivate_user(request_id):
         return redirect(url_for('master.dashboard') + '#requests')
     
     # Connect to tenant DB and deactivate user
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     try:
         with Session() as s:
@@ -940,8 +931,7 @@ def reactivate_user(request_id):
     new_password = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(8))
     
     # Connect to tenant DB and reactivate user
-    engine = create_engine(f"sqlite:///{cafe.db_path}")
-    Session = sessionmaker(bind=engine)
+    Session = tenant_sessionmaker(cafe.db_path)
     
     try:
         with Session() as s:
@@ -1,9 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort
-from models.models import db, Category, MenuItem, MenuItemMaterial, RawMaterial, MaterialPurchase, Order, OrderItem, CostFormulaSettings, PreProductionItem
+from models.models import db, Category, MenuItem, MenuItemMaterial, RawMaterial, MaterialPurchase, Order, CostFormulaSettings, PreProductionItem
 from flask_login import login_required
-from sqlalchemy import func, or_
 from datetime import datetime, timedelta
 import math
+from services.menu_stats import menu_item_costs, menu_popularity
+from services.sales_rollup import sales_summary
+from services.search_index import ranked_matches
+from services.settings_cache import cost_formula_settings
 
 menu_bp = Blueprint('menu', __name__)
 MATERIAL_UNITS = ['عدد', 'گرم', 'میلی‌لیتر', 'کیلوگرم', 'لیتر', 'بسته', 'متر']
@@ -51,29 +54,9 @@ def show_menu():
     menu_items = MenuItem.query.filter_by(is_active=True).order_by(MenuItem.name).all()
 
     # --- Popularity (محبوبیت) بر اساس تعداد سفارش‌های پرداخت‌شده ---
-    # معیار: تعداد سفارش‌هایی که آیتم در آنها بوده (count distinct orders)
-    # tie-breaker: مجموع تعداد فروش (sum quantity)
-    # استفاده از == 0 برای SQLite به جای is_(False)
-    popularity_rows = (
-        db.session.query(
-            OrderItem.menu_item_id.label('menu_item_id'),
-            func.count(func.distinct(OrderItem.order_id)).label('orders_count'),
-            func.coalesce(func.sum(OrderItem.quantity), 0).label('quantity_sold')
-        )
-        .join(Order, Order.id == OrderItem.order_id)
-        .filter(Order.status == 'پرداخت شده')
-        .filter(or_(OrderItem.is_deleted == False, OrderItem.is_deleted == None))
-        .group_by(OrderItem.menu_item_id)
-        .all()
-    )
-    popularity = {
-        int(row.menu_item_id): {
-            'orders_count': int(row.orders_count or 0),
-            'quantity_sold': int(row.quantity_sold or 0),
-        }
-        for row in popularity_rows
-        if row and row.menu_item_id is not None
-    }
+    # معیار: تعداد سفارش‌هایی که آیتم در آنها بوده؛ tie-breaker: مجموع تعداد فروش
+    # شمارنده‌ها هنگام پرداخت به‌روز می‌شوند (services.menu_stats) و اینجا فقط خوانده می‌شوند
+    popularity = menu_popularity()
     
     # گروه‌بندی آیتم‌ها بر اساس دسته‌بندی
     items_by_category = {}
@@ -180,30 +163,13 @@ def menu_price_management():
     category_total_cost = 0
     items_data = []
     
+    # بهای رسپی از snapshot خوانده می‌شود و فقط پس از تغییر خرید یا رسپی دوباره محاسبه می‌شود
+    recipe_costs = menu_item_costs([item.id for item in menu_items])
+
     for item in menu_items:
-        item_total_cost = 0
-        materials_data = []
-        
-        # دریافت مواد اولیه مصرفی این آیتم
-        item_materials = MenuItemMaterial.query.filter_by(menu_item_id=item.id).all()
-        
-        for item_material in item_materials:
-            quantity_value = item_material.quantity_value
-            if quantity_value is None:
-                quantity_value = 0
-
-            avg_unit_price = item_material.latest_unit_price or 0
-            material_cost = item_material.estimated_cost or 0
-            item_total_cost += material_cost
-
-            materials_data.append({
-                'name': item_material.name,
-                'quantity': quantity_value,
-                'unit': item_material.unit,
-                'avg_unit_price': avg_unit_price,
-                'total_cost': material_cost,
-                'source_type': 'پیش‌تولید' if item_material.pre_production_item_id else 'ماده اولیه',
-            })
+        recipe_cost = recipe_costs[item.id]
+        item_total_cost = recipe_cost.cost_price
+        materials_data = recipe_cost.materials
         
         category_total_cost += item_total_cost
         
@@ -229,7 +195,7 @@ def menu_price_management():
 
     # محاسبه میانگین تعداد سفارشات و میانگین مبلغ هر سفارش در حدود یک ماه اخیر
     # بارگذاری تنظیمات قبلی فرمول، اگر وجود داشته باشد
-    formula = CostFormulaSettings.query.first()
+    formula = cost_formula_settings()
 
     # محاسبه میانگین تعداد سفارشات و میانگین مبلغ هر سفارش در حدود یک ماه اخیر (فقط برای پیشنهاد اولیه)
     monthly_orders_avg = formula.monthly_orders_avg if formula else 0
@@ -238,14 +204,11 @@ def menu_price_management():
 
     if monthly_orders_avg == 0 or avg_order_price == 0:
         try:
-            last_30_days = datetime.utcnow() - timedelta(days=30)
-            recent_orders = Order.query.filter(
-                Order.created_at >= last_30_days,
-                Order.status == 'پرداخت شده'
-            ).all()
-
-            orders_count = len(recent_orders)
-            total_final = sum(o.final_amount for o in recent_orders) if recent_orders else 0
+            last_30_days = (datetime.utcnow() - timedelta(days=30)).date()
+            recent_sales = sales_summary(last_30_days)
+
+            orders_count = recent_sales['paid_count']
+            total_final = recent_sales['paid_total']
             if orders_count > 0:
                 monthly_orders_avg = monthly_orders_avg or orders_count
                 avg_order_price = avg_order_price or int(total_final / orders_count)
@@ -471,10 +434,7 @@ def search_menu():
     if len(query) < 2:
         return jsonify([])
     
-    items = MenuItem.query.filter(
-        MenuItem.name.contains(query),
-        MenuItem.is_active == True
-    ).limit(10).all()
+    items = ranked_matches(MenuItem, query, 10, MenuItem.is_active == True)
     
     results = [{'id': item.id, 'name': item.name, 'price': item.price} for item in items]
     return jsonify(results)
@@ -6,17 +6,17 @@ from models.models import (
     Order,
     OrderItem,
     Customer,
-    Settings,
     Table,
     TableItem,
-    find_or_create_customer,
-    generate_invoice_number,
     calculate_order_amount,
-    sync_order_item_material_usage,
-    record_order_material_usage,
     RawMaterialUsage,
 )
-from sqlalchemy import func, or_
+from sqlalchemy import func
+from services.compiled_recipes import sync_order_item_material_usage
+from services.customer_directory import customer_typeahead, find_customer, find_or_create_customer
+from services.order_pages import OrderFilter, order_summary, orders_page, page_size, parse_date
+from services.order_writer import InvalidOrderLines, OrderLine, place_order
+from services.settings_cache import current_settings, current_tax_percent
 from datetime import datetime
 import pytz
 import sys
@@ -35,42 +35,47 @@ else:
 
 order_bp = Blueprint('order', __name__)
 
-# --- لیست سفارش‌ها با فیلتر و جستجو ---
+# --- لیست سفارش‌ها با فیلتر و جستجو (صفحه‌بندی keyset روی created_at و id) ---
+def _order_filter_from_request():
+    return OrderFilter(
+        q=(request.args.get('q') or '').strip() or None,
+        status=request.args.get('status') or None,
+        customer_id=request.args.get('customer_id', type=int),
+        start_date=parse_date(request.args.get('from')),
+        end_date=parse_date(request.args.get('to')),
+    )
+
+
 @order_bp.route('/orders')
 @login_required
 def orders_list():
-    q = request.args.get('q')
-    status = request.args.get('status')
-    customer_id = request.args.get('customer_id', type=int)
-    orders_query = Order.query
-    if status:
-        orders_query = orders_query.filter_by(status=status)
-    if customer_id:
-        orders_query = orders_query.filter_by(customer_id=customer_id)
-    if q:
-        try:
-            q_int = int(q)
-        except (TypeError, ValueError):
-            q_int = None
-        filters = [
-            (Order.invoice_number == q),
-            (Order.invoice_uid == q),
-            (Customer.name.ilike(f'%{q}%')),
-            (Customer.phone.ilike(f'%{q}%'))
-        ]
-        if q_int is not None:
-            filters.append(Order.daily_sequence == q_int)
-        orders_query = orders_query.join(Customer).filter(or_(*filters))
-    orders = orders_query.order_by(Order.created_at.desc()).all()
-    return render_template('orders/orders_list.html', orders=orders, q=q, status=status)
+    order_filter = _order_filter_from_request()
+    page = orders_page(order_filter, request.args.get('cursor'), page_size(request.args.get('per_page')))
+    return render_template('orders/orders_list.html', page=page, orders=page.orders,
+                           q=order_filter.q, status=order_filter.status)
+
+
+@order_bp.route('/api/orders/page')
+@login_required
+def api_orders_page():
+    order_filter = _order_filter_from_request()
+    page = orders_page(order_filter, request.args.get('cursor'), page_size(request.args.get('per_page')))
+    return jsonify({
+        'orders': [
+            {**order_summary(order), 'deleted_items_count': page.deleted_items.get(order.id, 0)}
+            for order in page.orders
+        ],
+        'next_cursor': page.next_cursor,
+        'total': page.total,
+        'total_is_exact': page.total_is_exact,
+    })
 
 # --- ثبت سفارش جدید (فرم) ---
 @order_bp.route('/order/new')
 @login_required # Added login_required as it's likely needed for creating orders
 def new_order_form():
     menu_items = MenuItem.query.filter_by(is_active=True).order_by(MenuItem.name).all()
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
 
     return render_template('orders/create_order.html', menu_items=menu_items, tax_percent=tax_percent)
 
@@ -96,71 +101,37 @@ def create_order():
         flash('لطفاً حداقل یک آیتم برای سفارش انتخاب کنید.', 'danger')
         return redirect(url_for('order.new_order_form')) # Redirect back to form on error
 
-    customer = find_or_create_customer(customer_name, customer_phone)
-    invoice_identifiers = generate_invoice_number()
-    settings = Settings.query.first() # Fetch settings again
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
 
-    order_items_data = []
+    lines = []
     for item_id, qty in zip(items, quantities):
-        menu_item = MenuItem.query.get(int(item_id))
-        qty = int(qty)
-        if menu_item and qty > 0: # Ensure item exists and quantity is positive
-            # کاهش موجودی آیتم
-            if menu_item.stock is not None:
-                menu_item.stock = max(0, menu_item.stock - qty)
-            
-            order_items_data.append({
-                'menu_item_id': menu_item.id,
-                'quantity': qty,
-                'unit_price': int(menu_item.price),
-                'total_price': int(menu_item.price * qty)
-            })
-        else:
+        try:
+            lines.append(OrderLine(int(item_id), int(qty)))
+        except (TypeError, ValueError):
             flash(f'آیتم با شناسه {item_id} نامعتبر است یا تعداد آن صفر است.', 'warning')
-            # Optionally, you might want to break or handle this more strictly
-
-    if not order_items_data: # Check if any valid items were added
-        flash('هیچ آیتم معتبری برای ثبت سفارش وجود ندارد.', 'danger')
-        return redirect(url_for('order.new_order_form'))
-
-    total, tax, final = calculate_order_amount(order_items_data, discount, tax_percent)
 
+    customer = find_or_create_customer(customer_name, customer_phone)
     iran_tz = pytz.timezone('Asia/Tehran')
-    created_at = datetime.now(iran_tz)
-
-    order = Order(
-        invoice_number=invoice_identifiers.unique_number,
-        daily_sequence=invoice_identifiers.daily_sequence,
-        invoice_uid=invoice_identifiers.invoice_uid,
-        customer_id=customer.id,
-        total_amount=total,
-        discount=discount,
-        tax_amount=tax,
-        final_amount=final,
-        created_at=created_at,  # زمان با تایم‌زون ایران
-        status=order_status,    # اگر هست
-        type=order_type,        # اگر هست
-        user_id=current_user.id
-    )
-
-    db.session.add(order)
-    db.session.flush()  # تا بتونیم id سفارش رو بگیریم
-
-    order_items = []
-    for oi in order_items_data:
-        order_item = OrderItem(
-            order_id=order.id,
-            menu_item_id=oi['menu_item_id'],
-            quantity=oi['quantity'],
-            unit_price=oi['unit_price'],
-            total_price=oi['total_price']
+    try:
+        # اعتبارسنجی همه آیتم‌ها با یک کوئری و درج دسته‌ای آیتم‌ها و مصرف مواد
+        placed = place_order(
+            lines,
+            customer_id=customer.id,
+            user_id=current_user.id,
+            discount=discount,
+            tax_percent=tax_percent,
+            status=order_status,
+            order_type=order_type,
+            created_at=datetime.now(iran_tz),  # زمان با تایم‌زون ایران
+            skip_invalid=True,
         )
-        db.session.add(order_item)
-        order_items.append(order_item)
-
-    db.session.flush()
-    record_order_material_usage(order)
+    except InvalidOrderLines:
+        db.session.rollback()
+        flash('هیچ آیتم معتبری برای ثبت سفارش وجود ندارد.', 'danger')
+        return redirect(url_for('order.new_order_form'))
+    for line in placed.rejected:
+        flash(f'آیتم با شناسه {line.menu_item_id} نامعتبر است یا تعداد آن صفر است.', 'warning')
+    order = placed.order
 
     db.session.commit()
     print_invoice(order)
@@ -172,8 +143,7 @@ def create_order():
 def order_detail(order_id):
     order = Order.query.get_or_404(order_id)
     menu_items = MenuItem.query.filter_by(is_active=True).order_by(MenuItem.name).all()
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     return render_template('orders/order_detail.html', order=order, menu_items=menu_items, tax_percent=tax_percent)
 
 # --- پرداخت سفارش ---
@@ -243,8 +213,7 @@ def update_order_item(item_id):
     sync_order_item_material_usage(order_item)
     
     # محاسبه مجدد مجموع سفارش
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     # فقط آیتم‌های حذف نشده را در نظر بگیر
     order_items_data = [{
         'menu_item_id': item.menu_item_id,
@@ -291,8 +260,7 @@ def update_order(order_id):
         order.type = data['type']
     
     # محاسبه مجدد
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     order_items_data = [{
         'menu_item_id': item.menu_item_id,
         'quantity': item.quantity,
@@ -358,8 +326,7 @@ def merge_duplicate_order_items():
         if order_merged:
             orders_processed += 1
             # محاسبه مجدد مجموع سفارش
-            settings = Settings.query.first()
-            tax_percent = settings.tax_percent if settings else 9.0
+            tax_percent = current_tax_percent()
             # فقط آیتم‌های حذف نشده را در نظر بگیر
             order_items_data = [{
                 'menu_item_id': item.menu_item_id,
@@ -416,8 +383,7 @@ def add_order_item(order_id):
         db.session.add(menu_item)
     
     # Recalculate order totals after adding item
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     # فقط آیتم‌های حذف نشده را در نظر بگیر
     order_items_data = [{
         'menu_item_id': item.menu_item_id,
@@ -496,8 +462,7 @@ def delete_order_item(item_id):
         flash('تمام آیتم‌ها لغو شد؛ میز آزاد و موجودی مواد برگردانده شد.', 'success')
         return redirect(url_for('order.orders_list'))
 
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     # فقط آیتم‌های حذف نشده را در نظر بگیر
     order_items_data = [{
         'menu_item_id': item.menu_item_id,
@@ -516,28 +481,20 @@ def delete_order_item(item_id):
     flash('آیتم از سفارش حذف شد.', 'success')
     return redirect(url_for('order.order_detail', order_id=order_id))
 
-# --- جستجوی سریع مشتری (AJAX) ---
+# --- جستجوی سریع مشتری (AJAX) با ایندکس FTS5 و رتبه‌بندی پیشوندی ---
 @order_bp.route('/customer/search')
 @login_required
 def search_customer():
     q = request.args.get('q')
     if not q:
         return jsonify([])
-    customers = Customer.query.filter(
-        (Customer.name.ilike(f'%{q}%')) | (Customer.phone.ilike(f'%{q}%'))
-    ).all()
-    results = []
-    for c in customers:
-        # بررسی اینکه آیا مشتری سفارش قبلی دارد یا نه
-        has_orders = Order.query.filter_by(customer_id=c.id).count() > 0
-        results.append({
-            'id': c.id,
-            'name': c.name,
-            'phone': c.phone,
-            'has_orders': has_orders,
-            'birth_date': c.birth_date.isoformat() if c.birth_date else None
-        })
-    return jsonify(results)
+    return jsonify(customer_typeahead(q, page_size(request.args.get('limit'), default=20)))
+
+# --- typeahead مشتری: N نتیجه برتر؛ بدون q، مشتری‌های اخیر همین کافه (services.customer_directory) ---
+@order_bp.route('/api/customers/typeahead')
+@login_required
+def customer_typeahead_api():
+    return jsonify(customer_typeahead(request.args.get('q'), page_size(request.args.get('limit'), default=10)))
 
 # --- ثبت مشتری جدید ---
 @order_bp.route('/customer/register', methods=['POST'])
@@ -554,11 +511,7 @@ def register_customer():
             return jsonify({'success': False, 'message': 'نام مشتری الزامی است'}), 400
         
         # بررسی اینکه آیا مشتری با این نام یا شماره تماس وجود دارد
-        existing_customer = None
-        if phone:
-            existing_customer = Customer.query.filter_by(phone=phone).first()
-        if not existing_customer and name:
-            existing_customer = Customer.query.filter_by(name=name).first()
+        existing_customer = find_customer(name, phone)
         
         if existing_customer:
             return jsonify({
@@ -666,67 +619,26 @@ def create_order_api():
         if not items:
             return jsonify({'success': False, 'message': 'هیچ آیتمی انتخاب نشده است.'}), 400
             
+        lines = [OrderLine(int(item.get('id')), int(item.get('quantity'))) for item in items]
         customer = find_or_create_customer(customer_name, customer_phone)
-        invoice_identifiers = generate_invoice_number()
-        
-        order_items_data = []
-        print("📦 Items received from client:", items)
-        for item in items:
-            print("🧪 Processing item:", item)
-            item_id = int(item.get('id'))
-            qty = int(item.get('quantity'))
-            menu_item = MenuItem.query.filter_by(id=item_id, is_active=True).first()
-            if not menu_item or qty <= 0:
-                return jsonify({'success': False, 'message': f'آیتم نامعتبر: {item_id}'}), 400
-                
-            # کم کردن موجودی همان لحظه
-            menu_item.stock = max(menu_item.stock - qty, 0)
-                
-            order_items_data.append({
-                'menu_item_id': item_id,
-                'quantity': qty,
-                'unit_price': int(menu_item.price),
-                'total_price': int(menu_item.price * qty)
-            })
-            
-        total, tax, final = calculate_order_amount(order_items_data, discount, tax_percent)
-        
-        order = Order(
-            invoice_number=invoice_identifiers.unique_number,
-            daily_sequence=invoice_identifiers.daily_sequence,
-            invoice_uid=invoice_identifiers.invoice_uid,
-            customer_id=customer.id,
-            total_amount=total,
-            discount=discount,
-            tax_amount=tax,
-            final_amount=final,
-            status='پرداخت نشده',
-            type='حضوری',
-            user_id=current_user.id
-        )
-        
-        db.session.add(order)
-        db.session.flush()
-        
-        order_items = []
-        for oi in order_items_data:
-            order_item = OrderItem(
-                order_id=order.id,
-                menu_item_id=oi['menu_item_id'],
-                quantity=oi['quantity'],
-                unit_price=oi['unit_price'],
-                total_price=oi['total_price']
+        try:
+            # یک کوئری برای اعتبارسنجی، درج دسته‌ای آیتم‌ها و مصرف مواد، یک UPDATE برای موجودی
+            placed = place_order(
+                lines,
+                customer_id=customer.id,
+                user_id=current_user.id,
+                discount=discount,
+                tax_percent=tax_percent,
+                active_only=True,
             )
-            db.session.add(order_item)
-            order_items.append(order_item)
-
-            
+        except InvalidOrderLines as e:
+            db.session.rollback()
+            item_id = e.lines[0].menu_item_id if e.lines else ''
+            return jsonify({'success': False, 'message': f'آیتم نامعتبر: {item_id}'}), 400
+        order = placed.order
         db.session.commit()
-        
-        # Get updated stock information
-        updated_stocks = [{'id': MenuItem.query.get(oi['menu_item_id']).id, 
-                          'stock': MenuItem.query.get(oi['menu_item_id']).stock} 
-                         for oi in order_items_data]
+
+        updated_stocks = [{'id': item_id, 'stock': stock} for item_id, stock in placed.stocks.items()]
         
         return jsonify({
             'success': True,
@@ -767,12 +679,11 @@ def print_invoice(order_id):
 @login_required
 def get_invoice_text(order_id):
     """دریافت محتوای فاکتور به صورت متن برای کپی"""
-    from models.models import Settings
     from utils.helpers import to_jalali
     import jdatetime
     
     order = Order.query.get_or_404(order_id)
-    settings = Settings.query.first()
+    settings = current_settings()
     
     # ساخت متن فاکتور
     invoice_text = ""
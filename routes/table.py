@@ -7,24 +7,21 @@ from models.models import (
     MenuItem,
     Order,
     OrderItem,
-    Customer,
-    Settings,
-    find_or_create_customer,
-    generate_invoice_number,
     calculate_order_amount,
-    sync_order_item_material_usage
 )
+from services.cart_operations import CartError, apply_table_operations, bump_cart_revision, parse_cart_request
+from services.compiled_recipes import record_order_material_usage, sync_order_item_material_usage
+from services.customer_directory import find_customer, find_or_create_customer
+from services.order_writer import InvalidOrderLines, OrderLine, place_order
+from services.settings_cache import current_tax_percent
 from datetime import datetime
 import pytz
 
 table_bp = Blueprint('table', __name__, url_prefix='/table')
 
-# --- دریافت اطلاعات میز ---
-@table_bp.route('/<int:table_id>', methods=['GET'])
-@login_required
-def get_table(table_id):
-    table = Table.query.get_or_404(table_id)
-    
+# --- وضعیت سبد میز (برای GET و پاسخ /cart) ---
+def table_cart_state(table):
+    """آیتم‌ها و مبالغ فعلی میز؛ قبل از ثبت سفارش از TableItem و بعد از آن از OrderItem"""
     items_data = []
     order_status = None
     
@@ -48,7 +45,7 @@ def get_table(table_id):
                 })
     else:
         # اگر سفارش ثبت نشده باشد، TableItem ها را برگردان
-        table_items = TableItem.query.filter_by(table_id=table_id).all()
+        table_items = TableItem.query.filter_by(table_id=table.id).all()
         for item in table_items:
             items_data.append({
                 'id': item.id,  # TableItem.id
@@ -66,7 +63,7 @@ def get_table(table_id):
     tax_amount = order.tax_amount if order else table.tax_amount
     discount = order.discount if order else table.discount
     
-    return jsonify({
+    return {
         'id': table.id,
         'number': table.number,
         'status': table.status,
@@ -78,8 +75,47 @@ def get_table(table_id):
         'final_amount': final_amount,
         'order_id': table.order_id,
         'order_status': order_status,  # وضعیت سفارش
+        'cart_revision': table.cart_revision or 0,
         'items': items_data
-    })
+    }
+
+# --- دریافت اطلاعات میز ---
+@table_bp.route('/<int:table_id>', methods=['GET'])
+@login_required
+def get_table(table_id):
+    table = Table.query.get_or_404(table_id)
+    return jsonify(table_cart_state(table))
+
+# --- اعمال دسته‌ای تغییرات سبد میز (افزودن/تغییر تعداد/حذف در یک تراکنش) ---
+@table_bp.route('/<int:table_id>/cart', methods=['POST'])
+@login_required
+def update_table_cart(table_id):
+    """
+    بدنه: {"revision": n, "operations": [{"op": "add", "menu_item_id": 3, "quantity": 1},
+    {"op": "update", "item_id": 7, "quantity": 2}, {"op": "remove", "item_id": 8, "removal_reason": "..."}]}
+    همه عملیات به ترتیب و با یک commit اعمال می‌شوند؛ اگر revision کهنه باشد (409) یا عملیاتی
+    نامعتبر باشد هیچ تغییری ذخیره نمی‌شود و وضعیت فعلی سبد برگردانده می‌شود.
+    """
+    table = Table.query.get_or_404(table_id)
+    try:
+        revision, operations = parse_cart_request(request.get_json(silent=True))
+        apply_table_operations(table, operations, revision)
+        db.session.commit()
+    except CartError as error:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': error.message,
+            'index': error.index,
+            **error.details,
+            'cart': table_cart_state(table),
+        }), error.status
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'خطا: {str(e)}'}), 500
+    
+    cart = table_cart_state(table)
+    return jsonify({'success': True, 'revision': cart['cart_revision'], 'cart': cart})
 
 # --- افزودن آیتم به میز ---
 @table_bp.route('/<int:table_id>/add_item', methods=['POST'])
@@ -123,7 +159,7 @@ def add_item_to_table(table_id):
                 menu_item.stock = max(menu_item.stock - quantity, 0)
             
             # به‌روزرسانی مبلغ سفارش
-            update_order_totals(order)
+            update_order_totals(order, table)
             
             db.session.commit()
             return jsonify({'success': True, 'message': 'آیتم اضافه شد'})
@@ -216,8 +252,7 @@ def remove_item_from_table(table_id, item_id):
                     order_item.removal_reason = removal_reason
                     order_item.is_deleted = True
                 # به‌روزرسانی مبلغ سفارش
-                settings = Settings.query.first()
-                tax_percent = settings.tax_percent if settings else 9.0
+                tax_percent = current_tax_percent()
                 # فقط آیتم‌های حذف نشده را در نظر بگیر
                 order_items_data = [{
                     'menu_item_id': item.menu_item_id,
@@ -229,6 +264,7 @@ def remove_item_from_table(table_id, item_id):
                 order.total_amount = total
                 order.tax_amount = tax
                 order.final_amount = final
+                bump_cart_revision(table)
                 
                 # اگر همه آیتم‌ها حذف شده‌اند، سفارش را حذف کن
                 remaining_order_items = OrderItem.query.filter_by(order_id=order.id, is_deleted=False).count()
@@ -318,11 +354,7 @@ def update_table_customer(table_id):
         try:
             birth_date = dt.strptime(birth_date_str, '%Y-%m-%d').date()
             # بررسی اینکه آیا مشتری موجود است یا نه
-            customer = None
-            if table.customer_phone:
-                customer = Customer.query.filter_by(phone=table.customer_phone).first()
-            if not customer and table.customer_name:
-                customer = Customer.query.filter_by(name=table.customer_name).first()
+            customer = find_customer(table.customer_name, table.customer_phone)
             
             # اگر مشتری پیدا شد و سفارش قبلی ندارد، تاریخ تولد را اضافه کن
             if customer:
@@ -346,16 +378,8 @@ def update_existing_order(table, order):
         # دریافت TableItem های فعلی
         table_items = TableItem.query.filter_by(table_id=table.id).all()
         
-        # ایجاد یا پیدا کردن مشتری
-        # بررسی اینکه آیا مشتری موجود است
-        customer = None
+        # تاریخ تولد (در صورت ارسال) برای مشتری جدید یا مشتری بدون تاریخ تولد ثبت می‌شود
         birth_date = None
-        if table.customer_phone:
-            customer = Customer.query.filter_by(phone=table.customer_phone).first()
-        if not customer and table.customer_name:
-            customer = Customer.query.filter_by(name=table.customer_name).first()
-        
-        # اگر مشتری پیدا نشد، باید تاریخ تولد را از درخواست بگیریم
         data = request.get_json() or {}
         birth_date_str = data.get('birth_date')
         if birth_date_str:
@@ -375,7 +399,7 @@ def update_existing_order(table, order):
         if not table_items:
             # اگر هیچ TableItem وجود ندارد، فقط مبلغ سفارش را به‌روزرسانی کن
             # (آیتم‌ها از OrderItem هستند و قبلاً حذف شده‌اند)
-            update_order_totals(order)
+            update_order_totals(order, table)
             db.session.commit()
             return jsonify({
                 'success': True,
@@ -441,8 +465,6 @@ def update_existing_order(table, order):
                     total_price=table_item.total_price
                 )
                 db.session.add(new_order_item)
-                db.session.flush()
-                sync_order_item_material_usage(new_order_item)
             
             # کاهش موجودی
             menu_item = MenuItem.query.get(table_item.menu_item_id)
@@ -452,8 +474,11 @@ def update_existing_order(table, order):
                 if not existing:
                     menu_item.stock = max(0, menu_item.stock - table_item.quantity)
         
+        # مصرف مواد همه آیتم‌ها (جدید، تغییر تعداد یا حذف‌شده) یک‌جا همگام می‌شود
+        record_order_material_usage(order)
+
         # به‌روزرسانی مبلغ سفارش
-        update_order_totals(order)
+        update_order_totals(order, table)
         
         # حذف TableItem ها بعد از به‌روزرسانی
         TableItem.query.filter_by(table_id=table.id).delete()
@@ -493,16 +518,8 @@ def submit_table_order(table_id):
         if not table_items:
             return jsonify({'success': False, 'message': 'هیچ آیتمی برای ثبت وجود ندارد'}), 400
         
-        # ایجاد یا پیدا کردن مشتری
-        # بررسی اینکه آیا مشتری موجود است و تاریخ تولد دارد یا نه
-        customer = None
+        # تاریخ تولد (در صورت ارسال) برای مشتری جدید یا مشتری بدون تاریخ تولد ثبت می‌شود
         birth_date = None
-        if table.customer_phone:
-            customer = Customer.query.filter_by(phone=table.customer_phone).first()
-        if not customer and table.customer_name:
-            customer = Customer.query.filter_by(name=table.customer_name).first()
-        
-        # اگر مشتری پیدا نشد، باید تاریخ تولد را از درخواست بگیریم
         data = request.get_json() or {}
         birth_date_str = data.get('birth_date')
         if birth_date_str:
@@ -517,66 +534,28 @@ def submit_table_order(table_id):
             birth_date=birth_date
         )
         
-        # ایجاد سفارش
-        invoice_identifiers = generate_invoice_number()
-        settings = Settings.query.first()
-        tax_percent = settings.tax_percent if settings else 9.0
-        
-        order_items_data = []
-        for item in table_items:
-            order_items_data.append({
-                'menu_item_id': item.menu_item_id,
-                'quantity': item.quantity,
-                'unit_price': item.unit_price,
-                'total_price': item.total_price
-            })
-            # کاهش موجودی
-            menu_item = MenuItem.query.get(item.menu_item_id)
-            if menu_item and menu_item.stock is not None:
-                menu_item.stock = max(0, menu_item.stock - item.quantity)
-        
-        total, tax, final = calculate_order_amount(order_items_data, table.discount, tax_percent)
-        
-        iran_tz = pytz.timezone('Asia/Tehran')
-        order = Order(
-            invoice_number=invoice_identifiers.unique_number,
-            daily_sequence=invoice_identifiers.daily_sequence,
-            invoice_uid=invoice_identifiers.invoice_uid,
-            customer_id=customer.id,
-            total_amount=total,
-            discount=table.discount,
-            tax_amount=tax,
-            final_amount=final,
-            status='پرداخت نشده',
-            type='حضوری',
-            user_id=current_user.id,
-            created_at=datetime.now(iran_tz)
-        )
-        
-        db.session.add(order)
-        db.session.flush()
-        
-        # افزودن آیتم‌های سفارش
-        for item_data in order_items_data:
-            order_item = OrderItem(
-                order_id=order.id,
-                menu_item_id=item_data['menu_item_id'],
-                quantity=item_data['quantity'],
-                unit_price=item_data['unit_price'],
-                total_price=item_data['total_price']
+        # ایجاد سفارش: اعتبارسنجی آیتم‌ها با یک کوئری و درج دسته‌ای آیتم‌ها و مصرف مواد
+        tax_percent = current_tax_percent()
+        try:
+            placed = place_order(
+                [OrderLine(item.menu_item_id, item.quantity, item.unit_price) for item in table_items],
+                customer_id=customer.id,
+                user_id=current_user.id,
+                discount=table.discount,
+                tax_percent=tax_percent,
+                table_id=table_id,
             )
-            db.session.add(order_item)
-
-        db.session.flush()
-        for order_item in order.order_items:
-            sync_order_item_material_usage(order_item)
+        except InvalidOrderLines:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'آیتم نامعتبر در سفارش میز'}), 400
+        order = placed.order
         
         # اتصال سفارش به میز
         table.order_id = order.id
-        order.table_id = table_id
         
         # حذف TableItem ها بعد از ثبت سفارش
         TableItem.query.filter_by(table_id=table_id).delete()
+        bump_cart_revision(table)
         
         db.session.commit()
         
@@ -623,6 +602,7 @@ def checkout_table(table_id):
     table.tax_amount = 0
     table.final_amount = 0
     table.started_at = None
+    bump_cart_revision(table)
     
     db.session.commit()
     
@@ -742,6 +722,9 @@ def transfer_table(table_id):
                 source_table.tax_amount = 0
                 source_table.final_amount = 0
         
+        # سبد هر دو میز عوض شده است
+        bump_cart_revision(source_table)
+        bump_cart_revision(target_table)
         db.session.commit()
         
         return jsonify({
@@ -756,8 +739,7 @@ def transfer_table(table_id):
 
 def update_table_totals(table):
     table_items = TableItem.query.filter_by(table_id=table.id).all()
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     
     order_items_data = [{
         'quantity': item.quantity,
@@ -770,12 +752,12 @@ def update_table_totals(table):
     table.tax_amount = tax
     table.final_amount = final
     table.updated_at = datetime.now(pytz.timezone('Asia/Tehran'))
+    bump_cart_revision(table)
 
-def update_order_totals(order):
+def update_order_totals(order, table=None):
     # فقط آیتم‌های حذف نشده را در نظر بگیر
     order_items = OrderItem.query.filter_by(order_id=order.id, is_deleted=False).all()
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     
     order_items_data = [{
         'quantity': item.quantity,
@@ -787,4 +769,5 @@ def update_order_totals(order):
     order.total_amount = total
     order.tax_amount = tax
     order.final_amount = final
+    bump_cart_revision(table)
 
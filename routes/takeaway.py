@@ -6,13 +6,14 @@ from models.models import (
     OrderItem,
     MenuItem,
     Customer,
-    Settings,
-    find_or_create_customer,
     generate_invoice_number,
     calculate_order_amount,
-    record_order_material_usage,
-    sync_order_item_material_usage
 )
+from services.cart_operations import CartError, apply_order_operations, bump_cart_revision, parse_cart_request
+from services.compiled_recipes import record_order_material_usage, sync_order_item_material_usage
+from services.customer_directory import find_customer, find_or_create_customer
+from services.order_writer import decrement_menu_stock
+from services.settings_cache import current_tax_percent
 from datetime import datetime
 import pytz
 
@@ -34,7 +35,7 @@ def create_takeaway():
             # اگر شماره تماس هم خالی است، از مشتری عمومی استفاده کن
             if not customer_phone:
                 # پیدا کردن یا ایجاد مشتری عمومی
-                customer = Customer.query.filter_by(name='عمومی').first()
+                customer = find_customer('عمومی')
                 if not customer:
                     customer = Customer(name='عمومی', phone=None)
                     db.session.add(customer)
@@ -47,8 +48,7 @@ def create_takeaway():
         else:
             customer = find_or_create_customer(customer_name, customer_phone)
         invoice_identifiers = generate_invoice_number()
-        settings = Settings.query.first()
-        tax_percent = settings.tax_percent if settings else 9.0
+        tax_percent = current_tax_percent()
         
         # ایجاد سفارش موقت (پرداخت نشده)
         iran_tz = pytz.timezone('Asia/Tehran')
@@ -307,12 +307,11 @@ def submit_takeaway(order_id):
         # این کار فقط یک بار انجام می‌شود - اگر سفارش قبلاً ثبت شده باشد، موجودی قبلاً کاهش یافته است
         # برای تشخیص اینکه آیا سفارش قبلاً ثبت شده است، می‌توانیم چک کنیم که آیا موجودی کاهش یافته است یا نه
         # اما برای سادگی، همیشه موجودی را کاهش می‌دهیم (اگر قبلاً کاهش یافته باشد، مشکلی ایجاد نمی‌کند)
+        sold = {}
         for item in order_items:
-            menu_item = MenuItem.query.get(item.menu_item_id)
-            if menu_item and menu_item.stock is not None:
-                menu_item.stock = max(0, menu_item.stock - item.quantity)
+            sold[item.menu_item_id] = sold.get(item.menu_item_id, 0) + item.quantity
+        decrement_menu_stock(sold)
         
-        db.session.flush()
         record_order_material_usage(order, replace_existing=True)
 
         db.session.commit()
@@ -361,45 +360,79 @@ def checkout_takeaway(order_id):
         db.session.rollback()
         return jsonify({'success': False, 'message': f'خطا: {str(e)}'}), 500
 
+# --- وضعیت سبد بیرون‌بر (برای GET و پاسخ /cart) ---
+def takeaway_cart_state(order):
+    """اطلاعات سفارش بیرون‌بر با آیتم‌های حذف نشده و مبالغ فعلی"""
+    # فقط آیتم‌های حذف نشده را برگردان
+    order_items = OrderItem.query.filter_by(order_id=order.id, is_deleted=False).all()
+    
+    items_data = []
+    for item in order_items:
+        items_data.append({
+            'id': item.id,
+            'menu_item_id': item.menu_item_id,
+            'menu_item_name': item.menu_item.name,
+            'quantity': item.quantity,
+            'unit_price': item.unit_price,
+            'total_price': item.total_price
+        })
+    
+    return {
+        'id': order.id,
+        'invoice_number': order.invoice_number,
+        'daily_invoice_number': order.daily_sequence,
+        'invoice_uid': order.invoice_uid,
+        'customer_name': order.customer.name,
+        'customer_phone': order.customer.phone or '',
+        'total_amount': order.total_amount,
+        'discount': order.discount,
+        'tax_amount': order.tax_amount,
+        'final_amount': order.final_amount,
+        'status': order.status,
+        'cart_revision': order.cart_revision or 0,
+        'items': items_data
+    }
+
 # --- دریافت اطلاعات سفارش بیرون‌بر ---
 @takeaway_bp.route('/<int:order_id>', methods=['GET'])
 @login_required
 def get_takeaway(order_id):
     try:
         order = Order.query.get_or_404(order_id)
-        # فقط آیتم‌های حذف نشده را برگردان
-        order_items = OrderItem.query.filter_by(order_id=order_id, is_deleted=False).all()
-        
-        items_data = []
-        for item in order_items:
-            items_data.append({
-                'id': item.id,
-                'menu_item_id': item.menu_item_id,
-                'menu_item_name': item.menu_item.name,
-                'quantity': item.quantity,
-                'unit_price': item.unit_price,
-                'total_price': item.total_price
-            })
-        
-        return jsonify({
-            'id': order.id,
-            'invoice_number': order.invoice_number,
-            'daily_invoice_number': order.daily_sequence,
-            'invoice_uid': order.invoice_uid,
-            'customer_name': order.customer.name,
-            'customer_phone': order.customer.phone or '',
-            'total_amount': order.total_amount,
-            'discount': order.discount,
-            'tax_amount': order.tax_amount,
-            'final_amount': order.final_amount,
-            'status': order.status,
-            'items': items_data
-        })
+        return jsonify(takeaway_cart_state(order))
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'خطا: {str(e)}'}), 500
 
+# --- اعمال دسته‌ای تغییرات سبد بیرون‌بر (افزودن/تغییر تعداد/حذف در یک تراکنش) ---
+@takeaway_bp.route('/<int:order_id>/cart', methods=['POST'])
+@login_required
+def update_takeaway_cart(order_id):
+    """همان قرارداد /table/<id>/cart؛ حذف آیتم بدون removal_reason کل درخواست را رد می‌کند"""
+    order = Order.query.get_or_404(order_id)
+    if order.type != 'بیرون‌بر':
+        return jsonify({'success': False, 'message': 'سفارش نامعتبر است'}), 400
+    try:
+        revision, operations = parse_cart_request(request.get_json(silent=True))
+        apply_order_operations(order, operations, revision)
+        db.session.commit()
+    except CartError as error:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': error.message,
+            'index': error.index,
+            **error.details,
+            'cart': takeaway_cart_state(order),
+        }), error.status
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'خطا: {str(e)}'}), 500
+    
+    cart = takeaway_cart_state(order)
+    return jsonify({'success': True, 'revision': cart['cart_revision'], 'cart': cart})
+
 # --- حذف سفارش بیرون‌بر ---
 @takeaway_bp.route('/<int:order_id>/delete', methods=['DELETE', 'POST'])
 @login_required
@@ -441,8 +474,7 @@ def delete_takeaway(order_id):
 def update_order_totals(order):
     # فقط آیتم‌های حذف نشده را در نظر بگیر
     order_items = OrderItem.query.filter_by(order_id=order.id, is_deleted=False).all()
-    settings = Settings.query.first()
-    tax_percent = settings.tax_percent if settings else 9.0
+    tax_percent = current_tax_percent()
     
     order_items_data = [{
         'quantity': item.quantity,
@@ -454,4 +486,5 @@ def update_order_totals(order):
     order.total_amount = total
     order.tax_amount = tax
     order.final_amount = final
+    bump_cart_revision(order)
 
@@ -4,7 +4,7 @@ from functools import wraps
 
 from flask import Blueprint, flash, redirect, render_template, session, url_for
 
-from models.master_models import CafeTenant
+from services.tenant_context import resolve_tenant_context
 
 
 tenant_bp = Blueprint('tenant', __name__, url_prefix='/cafe/<slug>')
@@ -14,7 +14,7 @@ def require_tenant_session(view_func):
     """Require an active cafe and a session scoped to the URL tenant."""
     @wraps(view_func)
     def wrapper(slug, *args, **kwargs):
-        cafe = CafeTenant.query.filter_by(slug=slug).first()
+        cafe = resolve_tenant_context(slug)
         if not cafe:
             flash('کافه یافت نشد.', 'danger')
             session.pop('tenant_slug', None)
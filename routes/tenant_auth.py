@@ -5,13 +5,12 @@ from datetime import datetime
 
 from flask import Blueprint, current_app, flash, redirect, render_template, request, session, url_for
 from werkzeug.security import check_password_hash
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
 import pytz
 
 from models.master_models import CafeTenant
 from models.models import User
+from services.tenant_context import resolve_tenant_context
+from services.tenant_engines import tenant_sessionmaker
 from services.tenant_session import establish_tenant_session
 
 iran_tz = pytz.timezone("Asia/Tehran")
@@ -21,15 +20,11 @@ tenant_auth_bp = Blueprint('tenant_auth', __name__, url_prefix='/cafe/<slug>')
 
 def get_tenant_db_session(slug: str):
     """Get a session connected to tenant database"""
-    from flask import current_app
-    with current_app.app_context():
-        cafe = CafeTenant.query.filter_by(slug=slug).first()
+    cafe = resolve_tenant_context(slug)
     if not cafe or not os.path.exists(cafe.db_path):
         return None, None
     
-    engine = create_engine(f"sqlite:///{cafe.db_path}", poolclass=NullPool)
-    Session = sessionmaker(bind=engine)
-    return Session, cafe
+    return tenant_sessionmaker(cafe.db_path), cafe
 
 
 @tenant_auth_bp.route('/login', methods=['GET', 'POST'])
@@ -0,0 +1,65 @@
+"""
+اجرای کارهای پس‌زمینه (services.background_jobs) از خط فرمان
+
+کارها به‌طور معمول در پس‌زمینه هر worker اجرا می‌شوند؛ این اسکریپت برای اجرای فوری
+بعد از استقرار، یا روی سروری که BACKGROUND_JOBS_ENABLED خاموش است، به کار می‌رود.
+کارهای نیمه‌تمام از آخرین checkpoint ادامه پیدا می‌کنند.
+
+استفاده:
+    python run_background_jobs.py                              # اجرای همه کارهای باقی‌مانده
+    python run_background_jobs.py --job invoice_identifiers    # فقط یک کار
+    python run_background_jobs.py --status                     # فقط نمایش وضعیت
+    python run_background_jobs.py --retry-failed               # برگرداندن کارهای ناموفق به صف
+"""
+import argparse
+import sys
+import time
+
+from app import create_app
+from models.master_models import BackgroundJob
+from services.background_jobs import (
+    FAILED, JOBS, claim_next_job, enqueue_jobs, list_jobs, retry_job, run_job, worker_name,
+)
+
+
+def _describe(job):
+    where = f"cafe#{job.cafe_id}" if job.cafe_id else 'default'
+    total = f"/{job.total:,}" if job.total is not None else ''
+    line = f"{where:>10}  {job.name:<22} {job.status:<8} {job.processed:,}{total} ({job.progress}%)"
+    if job.error:
+        line += f"  خطا: {job.error}"
+    return line
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Run resumable background jobs')
+    parser.add_argument('--job', action='append', choices=sorted(JOBS), help='only this job (repeatable)')
+    parser.add_argument('--chunk-size', type=int, help='rows per chunk (default: BACKGROUND_JOB_CHUNK_SIZE)')
+    parser.add_argument('--status', action='store_true', help='only print job status')
+    parser.add_argument('--retry-failed', action='store_true', help='requeue failed jobs before running')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if not args.status:
+            enqueue_jobs(args.job)
+            if args.retry_failed:
+                for job in BackgroundJob.query.filter_by(status=FAILED).all():
+                    retry_job(job.id)
+
+            chunk_size = args.chunk_size or app.config['BACKGROUND_JOB_CHUNK_SIZE']
+            worker = worker_name()
+            while (job := claim_next_job(worker, args.job)) is not None:
+                started = time.perf_counter()
+                job = run_job(job, chunk_size)
+                print(f"{_describe(job)}  {time.perf_counter() - started:.1f}s")
+
+        jobs = list_jobs()
+        if args.status:
+            for job in jobs:
+                print(_describe(job))
+        return 1 if any(job.status == FAILED for job in jobs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Chunked data backfills run as background jobs (see ``services.background_jobs``).
+
+Every backfill is a ``run_chunk(connection, checkpoint, limit)`` function that
+processes at most ``limit`` rows after ``checkpoint`` using keyset pagination
+and returns ``(next_checkpoint, rows_seen)``; ``next_checkpoint`` is ``None``
+once the table is exhausted. Checkpoints are small JSON-serialisable dicts.
+A chunk only fills values that are still missing, so re-running a chunk whose
+checkpoint was not saved yet is harmless.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+from random import randint
+
+from sqlalchemy import and_, bindparam, exists, func, or_, select, update
+
+from models.models import Customer, Order, iran_tz
+
+
+order_table = Order.__table__
+customer_table = Customer.__table__
+
+# Daily sequences of legacy orders start after this value, as in generate_invoice_number.
+LEGACY_DAILY_SEQUENCE_BASE = 99
+
+
+def _normalize_created_at(created_at: datetime | None) -> datetime | None:
+    if not created_at:
+        return None
+    if created_at.tzinfo is None:
+        try:
+            return iran_tz.localize(created_at)
+        except ValueError:
+            return created_at.replace(tzinfo=iran_tz)
+    return created_at.astimezone(iran_tz)
+
+
+# --- invoice identifiers ---------------------------------------------------------
+
+def count_invoice_identifier_rows(connection) -> int:
+    return connection.execute(select(func.count()).select_from(order_table)).scalar() or 0
+
+
+def backfill_invoice_identifiers(connection, checkpoint: dict | None, limit: int) -> tuple[dict | None, int]:
+    """Fill ``daily_sequence`` / ``invoice_uid`` of legacy orders.
+
+    Dated orders are walked in ``(created_at, id)`` order so daily sequences
+    keep following each other within a day (the checkpoint carries the current
+    day and its highest sequence); orders without ``created_at`` get a
+    ``LEGACY-<invoice number>`` uid in a second pass.
+    """
+    o = order_table.c
+    checkpoint = dict(checkpoint or {'phase': 'dated'})
+    columns = (o.id, o.created_at, o.daily_sequence, o.invoice_uid, o.invoice_number)
+    if checkpoint['phase'] == 'dated':
+        stmt = select(*columns).where(o.created_at.isnot(None)).order_by(o.created_at, o.id)
+        if 'created_at' in checkpoint:
+            last = datetime.fromisoformat(checkpoint['created_at'])
+            stmt = stmt.where(or_(o.created_at > last, and_(o.created_at == last, o.id > checkpoint['id'])))
+    else:
+        stmt = select(*columns).where(o.created_at.is_(None), o.id > checkpoint.get('id', 0)).order_by(o.id)
+    rows = connection.execute(stmt.limit(limit)).all()
+
+    day = checkpoint.get('day')
+    day_max = checkpoint.get('day_max', LEGACY_DAILY_SEQUENCE_BASE)
+    changes = []
+    for row in rows:
+        localized = _normalize_created_at(row.created_at)
+        sequence, uid = row.daily_sequence, row.invoice_uid
+        if localized:
+            order_date = localized.date()
+            if order_date.isoformat() != day:
+                day, day_max = order_date.isoformat(), LEGACY_DAILY_SEQUENCE_BASE
+            if not sequence or sequence < 100:
+                day_max += 1
+                sequence = day_max
+            else:
+                day_max = max(day_max, sequence)
+            uid = uid or f"{order_date.strftime('%Y%m%d')}-{sequence:04d}"
+        else:
+            uid = uid or f"LEGACY-{row.invoice_number}"
+        if (sequence, uid) != (row.daily_sequence, row.invoice_uid):
+            changes.append({'order_id': row.id, 'sequence': sequence, 'uid': uid})
+
+    if changes:
+        connection.execute(
+            update(order_table)
+            .where(o.id == bindparam('order_id'))
+            .values(daily_sequence=bindparam('sequence'), invoice_uid=bindparam('uid')),
+            changes,
+        )
+
+    if len(rows) < limit:
+        return ({'phase': 'undated'} if checkpoint['phase'] == 'dated' else None), len(rows)
+    last_row = rows[-1]
+    if checkpoint['phase'] == 'dated':
+        return {
+            'phase': 'dated', 'created_at': last_row.created_at.isoformat(), 'id': last_row.id,
+            'day': day, 'day_max': day_max,
+        }, len(rows)
+    return {'phase': 'undated', 'id': last_row.id}, len(rows)
+
+
+# --- customer birth dates --------------------------------------------------------
+
+def _customers_without_birth_date():
+    c = customer_table.c
+    return select(c.id).where(c.birth_date.is_(None), exists().where(order_table.c.customer_id == c.id))
+
+
+def count_customers_without_birth_date(connection) -> int:
+    return connection.execute(
+        select(func.count()).select_from(_customers_without_birth_date().subquery())
+    ).scalar() or 0
+
+
+def assign_random_birth_dates(connection, checkpoint: dict | None, limit: int) -> tuple[dict | None, int]:
+    """Give customers who have orders but no birth date a random one (18-80 years ago)."""
+    c = customer_table.c
+    last_id = (checkpoint or {}).get('id', 0)
+    ids = connection.execute(
+        _customers_without_birth_date().where(c.id > last_id).order_by(c.id).limit(limit)
+    ).scalars().all()
+    if ids:
+        today = date.today()
+        connection.execute(
+            update(customer_table).where(c.id == bindparam('customer_id')).values(birth_date=bindparam('birth_date')),
+            [
+                {
+                    'customer_id': customer_id,
+                    'birth_date': today - timedelta(days=randint(18, 80) * 365 + randint(0, 365)),
+                }
+                for customer_id in ids
+            ],
+        )
+    if len(ids) < limit:
+        return None, len(ids)
+    return {'id': ids[-1]}, len(ids)
@@ -0,0 +1,267 @@
+"""Resumable batch jobs tracked in the master database.
+
+A job is a named :class:`JobDefinition` run once per database (the default
+database and every active cafe). ``BackgroundJob`` rows in the master
+database record its status, progress and checkpoint:
+
+* a worker claims a ``pending`` job (or a ``running`` one whose heartbeat is
+  older than ``STALE_AFTER``) with a conditional ``UPDATE``, so exactly one
+  process runs it;
+* the job runs in chunks of ``BACKGROUND_JOB_CHUNK_SIZE`` rows, each in its
+  own short transaction on the target database, and the checkpoint, progress
+  and heartbeat are saved after every chunk;
+* an interrupted job resumes from its last checkpoint; a failed one keeps the
+  error and can be retried from the master portal.
+
+:class:`JobRunner` runs jobs in a background thread of each worker, started
+lazily from the first request (see ``services.fleet_metrics`` for why).
+``run_background_jobs.py`` runs them from the command line.
+"""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, NamedTuple
+
+from sqlalchemy import inspect, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from models.master_models import BackgroundJob, CafeTenant
+from models.models import db
+from services.backfills import (
+    assign_random_birth_dates, backfill_invoice_identifiers,
+    count_customers_without_birth_date, count_invoice_identifier_rows,
+)
+from services.menu_availability import database_key
+from services.schema_migrations import migrate_tenant_schema_once
+from services.tenant_engines import get_tenant_engine, tenant_registry_key
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_POLL_SECONDS = 60.0
+# A running job whose heartbeat is older than this is considered abandoned.
+STALE_AFTER = timedelta(minutes=2)
+
+job_table = BackgroundJob.__table__
+
+
+class JobDefinition(NamedTuple):
+    name: str
+    title: str
+    run_chunk: Callable  # (connection, checkpoint, limit) -> (next_checkpoint | None, rows)
+    count: Callable  # (connection) -> int
+
+
+JOBS: dict[str, JobDefinition] = {
+    job.name: job
+    for job in (
+        JobDefinition(
+            'invoice_identifiers', 'شناسه فاکتور سفارش‌های قدیمی',
+            backfill_invoice_identifiers, count_invoice_identifier_rows,
+        ),
+        JobDefinition(
+            'customer_birth_dates', 'تاریخ تولد مشتریان قدیمی',
+            assign_random_birth_dates, count_customers_without_birth_date,
+        ),
+    )
+}
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _master_bind() -> dict:
+    return {'mapper': inspect(BackgroundJob)}
+
+
+# --- queue -----------------------------------------------------------------------
+
+def job_targets() -> list[dict]:
+    """The default database and every active cafe database."""
+    default_path = db.engine.url.database
+    targets = [{'target': database_key(db.engine), 'db_path': default_path, 'cafe_id': None}]
+    for cafe in CafeTenant.query.filter(CafeTenant.is_active == True).order_by(CafeTenant.id):  # noqa: E712
+        if os.path.exists(cafe.db_path):
+            targets.append({'target': tenant_registry_key(cafe.db_path), 'db_path': cafe.db_path, 'cafe_id': cafe.id})
+    return targets
+
+
+def enqueue_jobs(names=None) -> None:
+    """Create the missing ``(job, database)`` rows; existing rows are left alone."""
+    names = list(names or JOBS)
+    now = datetime.utcnow()
+    rows = [
+        {**target, 'name': name, 'status': PENDING, 'processed': 0, 'attempts': 0, 'created_at': now}
+        for target in job_targets()
+        for name in names
+    ]
+    db.session.execute(insert(job_table).on_conflict_do_nothing(), rows, bind_arguments=_master_bind())
+    db.session.commit()
+
+
+def _claimable(now: datetime):
+    c = job_table.c
+    return or_(c.status == PENDING, (c.status == RUNNING) & (c.heartbeat_at < now - STALE_AFTER))
+
+
+def claim_next_job(worker: str, names=None) -> BackgroundJob | None:
+    """Atomically take the oldest runnable job, or ``None`` when there is none."""
+    c = job_table.c
+    now = datetime.utcnow()
+    candidates = select(c.id).where(_claimable(now)).order_by(c.id)
+    if names:
+        candidates = candidates.where(c.name.in_(list(names)))
+    for job_id in db.session.execute(candidates, bind_arguments=_master_bind()).scalars().all():
+        claimed = db.session.execute(
+            update(job_table)
+            .where(c.id == job_id, _claimable(now))
+            .values(status=RUNNING, worker=worker, heartbeat_at=now, attempts=c.attempts + 1,
+                    started_at=now, error=None),
+            bind_arguments=_master_bind(),
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(BackgroundJob, job_id)
+    return None
+
+
+# --- execution -------------------------------------------------------------------
+
+def _job_engine(job: BackgroundJob):
+    if job.cafe_id is None:
+        return db.engine
+    engine = get_tenant_engine(job.db_path)
+    migrate_tenant_schema_once(job.db_path, engine)
+    return engine
+
+
+def run_job(job: BackgroundJob, chunk_size: int = DEFAULT_CHUNK_SIZE) -> BackgroundJob:
+    """Run a claimed job to the end, saving its checkpoint after every chunk."""
+    definition = JOBS[job.name]
+    try:
+        engine = _job_engine(job)
+        if job.total is None:
+            with engine.connect() as connection:
+                job.total = definition.count(connection)
+            db.session.commit()
+        checkpoint = json.loads(job.checkpoint_json) if job.checkpoint_json else None
+        while True:
+            with engine.begin() as connection:
+                checkpoint, rows = definition.run_chunk(connection, checkpoint, chunk_size)
+            job.processed += rows
+            job.checkpoint_json = json.dumps(checkpoint) if checkpoint is not None else None
+            job.heartbeat_at = datetime.utcnow()
+            if checkpoint is None:
+                job.status = DONE
+                job.finished_at = job.heartbeat_at
+            db.session.commit()
+            if checkpoint is None:
+                return job
+    except Exception as exc:  # noqa: BLE001 - recorded on the job, retried on demand
+        db.session.rollback()
+        job.status = FAILED
+        job.error = str(exc) or exc.__class__.__name__
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return job
+
+
+def run_pending_jobs(names=None, chunk_size: int = DEFAULT_CHUNK_SIZE, worker: str | None = None) -> list[BackgroundJob]:
+    """Enqueue and run every runnable job in this thread; returns the jobs that ran."""
+    enqueue_jobs(names)
+    worker = worker or worker_name()
+    finished = []
+    while (job := claim_next_job(worker, names)) is not None:
+        finished.append(run_job(job, chunk_size))
+    return finished
+
+
+def retry_job(job_id: int) -> bool:
+    """Put a failed job back in the queue; it resumes from its last checkpoint."""
+    updated = db.session.execute(
+        update(job_table)
+        .where(job_table.c.id == job_id, job_table.c.status == FAILED)
+        .values(status=PENDING, error=None),
+        bind_arguments=_master_bind(),
+    ).rowcount
+    db.session.commit()
+    if updated:
+        job_runner.wake()
+    return bool(updated)
+
+
+def list_jobs() -> list[BackgroundJob]:
+    return BackgroundJob.query.order_by(BackgroundJob.cafe_id, BackgroundJob.name).all()
+
+
+# --- background runner -----------------------------------------------------------
+
+class JobRunner:
+    """Per-process thread that drains the job queue."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._woken = False
+        self.app = None
+        self.enabled = False
+        self.poll_seconds = DEFAULT_POLL_SECONDS
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+
+    def configure(self, app) -> None:
+        config = app.config
+        self.app = app
+        self.enabled = bool(config.get('BACKGROUND_JOBS_ENABLED', True)) and not config.get('TESTING')
+        self.poll_seconds = max(1.0, float(config.get('BACKGROUND_JOB_POLL_SECONDS', DEFAULT_POLL_SECONDS)))
+        self.chunk_size = max(1, int(config.get('BACKGROUND_JOB_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)))
+
+    def ensure_running(self) -> None:
+        """Start the thread in this process if it is not running yet."""
+        if not self.enabled or self.app is None:
+            return
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='background-jobs', daemon=True)
+            self._thread.start()
+
+    def wake(self) -> None:
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def _run(self) -> None:
+        worker = worker_name()
+        while True:
+            try:
+                with self.app.app_context():
+                    run_pending_jobs(chunk_size=self.chunk_size, worker=worker)
+            except Exception:  # noqa: BLE001 - keep the thread alive, retry on the next round
+                self.app.logger.exception('background job runner failed')
+            with self._cond:
+                if not self._woken:
+                    self._cond.wait(self.poll_seconds)
+                self._woken = False
+
+
+job_runner = JobRunner()
+
+
+def configure_background_jobs(app) -> None:
+    """Apply ``BACKGROUND_JOB*`` settings; the thread itself starts with the first request."""
+    job_runner.configure(app)
+    app.before_request(job_runner.ensure_running)
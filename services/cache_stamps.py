@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+
+
+def read_stamp(path: str) -> int:
+    """Return the version stamp stored at ``path`` (0 when it was never bumped).
+
+    Stamps are plain files whose modification time is the version. A single
+    ``stat`` call is cheap enough to run on every request and is shared by all
+    gunicorn workers on the host, so one worker can invalidate the in-process
+    caches of the others.
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def bump_stamp(path: str) -> int:
+    """Advance the stamp at ``path`` and return the new version."""
+    previous = read_stamp(path)
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a', encoding='utf-8'):
+            pass
+        version = max(time.time_ns(), previous + 1)
+        os.utime(path, ns=(version, version))
+    except OSError:
+        return previous
+    return read_stamp(path)
+
+
+def stamp_path(stamp_dir: str | None, namespace: str, key: str) -> str | None:
+    """Stamp file of one cached ``namespace`` for one database ``key``."""
+    if not stamp_dir:
+        return None
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(stamp_dir, namespace, f'{digest}.stamp')
@@ -0,0 +1,315 @@
+"""Batched cart mutations for tables and takeaway orders.
+
+A waiter's burst of taps (add, change quantity, remove) arrives as one ordered
+list of :class:`CartOperation` together with the cart revision the client last
+saw. The whole batch is applied in the caller's transaction:
+
+* the revision is claimed with one conditional ``UPDATE`` on the table (or
+  takeaway order) row, so a client holding a stale cart gets
+  :class:`StaleCartRevision` and nothing is written;
+* the menu items being added are priced with one ``IN`` query and the tax
+  rate comes from the settings cache;
+* for a submitted order, material usage of the touched items is synced and
+  legacy menu stock lowered once for the batch, and totals are recomputed once.
+
+Any invalid operation raises :class:`CartError` before anything is committed;
+the route rolls back and returns the current cart.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import func, inspect, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models.models import (
+    MenuItem,
+    Order,
+    OrderItem,
+    TableItem,
+    calculate_order_amount,
+    db,
+    iran_tz,
+)
+from services.compiled_recipes import sync_order_material_usage
+from services.order_writer import decrement_menu_stock
+from services.settings_cache import current_tax_percent
+
+
+MAX_OPERATIONS = 100
+OPERATIONS = ('add', 'update', 'remove')
+PAID_STATUS = 'پرداخت شده'
+
+
+class CartOperation(NamedTuple):
+    op: str  # add | update | remove
+    item_id: int | None = None  # TableItem / OrderItem id (update, remove)
+    menu_item_id: int | None = None  # add
+    quantity: int = 1  # add: units to add; update: new quantity (<= 0 removes)
+    removal_reason: str | None = None
+
+
+class CartError(ValueError):
+    """A batch that cannot be applied; ``index`` is the offending operation."""
+
+    status = 400
+
+    def __init__(self, message: str, index: int | None = None, status: int | None = None, **details) -> None:
+        super().__init__(message)
+        self.message = message
+        self.index = index
+        if status is not None:
+            self.status = status
+        self.details = details
+
+
+class StaleCartRevision(CartError):
+    """The cart changed since the client's revision."""
+
+    status = 409
+
+
+# --- request parsing -------------------------------------------------------------
+
+def _int(value, index, field):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise CartError(f'مقدار {field} نامعتبر است', index)
+
+
+def parse_cart_request(payload) -> tuple[int | None, list[CartOperation]]:
+    """``(revision, operations)`` of a cart request body.
+
+    The body is ``{"revision": n, "operations": [{"op": ..., ...}, ...]}``;
+    a missing revision skips the staleness check.
+    """
+    if not isinstance(payload, dict):
+        raise CartError('درخواست نامعتبر است')
+    raw_operations = payload.get('operations')
+    if not isinstance(raw_operations, list) or not raw_operations:
+        raise CartError('هیچ عملیاتی ارسال نشده است')
+    if len(raw_operations) > MAX_OPERATIONS:
+        raise CartError(f'حداکثر {MAX_OPERATIONS} عملیات در هر درخواست مجاز است')
+
+    operations = []
+    for index, raw in enumerate(raw_operations):
+        if not isinstance(raw, dict) or raw.get('op') not in OPERATIONS:
+            raise CartError('عملیات نامعتبر است', index)
+        op = raw['op']
+        operation = CartOperation(
+            op=op,
+            item_id=_int(raw.get('item_id'), index, 'item_id'),
+            menu_item_id=_int(raw.get('menu_item_id'), index, 'menu_item_id'),
+            quantity=_int(raw.get('quantity', 1), index, 'quantity'),
+            removal_reason=(raw.get('removal_reason') or '').strip() or None,
+        )
+        if op == 'add' and (operation.menu_item_id is None or operation.quantity is None or operation.quantity <= 0):
+            raise CartError('آیتم منو یا تعداد نامعتبر است', index)
+        if op in ('update', 'remove') and operation.item_id is None:
+            raise CartError('شناسه آیتم ارسال نشده است', index)
+        if op == 'update' and operation.quantity is None:
+            raise CartError('تعداد نامعتبر است', index)
+        operations.append(operation)
+    return _int(payload.get('revision'), None, 'revision'), operations
+
+
+# --- revisions -------------------------------------------------------------------
+
+def bump_cart_revision(target) -> None:
+    """Advance the revision of a table / order changed outside a batch."""
+    if target is not None:
+        target.cart_revision = (target.cart_revision or 0) + 1
+
+
+def claim_revision(target, expected: int | None) -> int:
+    """Advance ``target``'s revision if it is still ``expected`` (any, if ``None``).
+
+    One conditional ``UPDATE … RETURNING`` on the row: two batches built on the
+    same revision cannot both pass, whichever worker gets there second fails.
+    """
+    model = type(target)
+    column = func.coalesce(model.__table__.c.cart_revision, 0)
+    statement = (
+        update(model.__table__)
+        .where(model.__table__.c.id == target.id)
+        .values(cart_revision=column + 1)
+        .returning(model.__table__.c.cart_revision)
+    )
+    if expected is not None:
+        statement = statement.where(column == expected)
+    connection = db.session.connection(bind_arguments={'mapper': inspect(model)})
+    revision = connection.execute(statement).scalar()
+    if revision is None:
+        raise StaleCartRevision('سبد در این فاصله تغییر کرده است؛ آخرین وضعیت بارگذاری شد')
+    set_committed_value(target, 'cart_revision', revision)
+    return revision
+
+
+# --- applying operations ---------------------------------------------------------
+
+def _menu_prices(operations) -> dict[int, int]:
+    ids = {operation.menu_item_id for operation in operations if operation.op == 'add'}
+    if not ids:
+        return {}
+    prices = dict(db.session.execute(select(MenuItem.id, MenuItem.price).where(MenuItem.id.in_(ids))).all())
+    for index, operation in enumerate(operations):
+        if operation.op == 'add' and operation.menu_item_id not in prices:
+            raise CartError('آیتم منو یافت نشد', index, status=404)
+    return prices
+
+
+def _totals(items, discount, tax_percent) -> tuple[int, int, int]:
+    return calculate_order_amount(
+        [{'quantity': item.quantity, 'unit_price': item.unit_price} for item in items],
+        discount or 0,
+        tax_percent,
+    )
+
+
+def _reset_table(table) -> None:
+    table.status = 'خالی'
+    table.customer_name = None
+    table.customer_phone = None
+    table.discount = 0
+    table.total_amount = 0
+    table.tax_amount = 0
+    table.final_amount = 0
+    table.started_at = None
+
+
+def _apply_table_items(table, operations, tax_percent) -> None:
+    """Operations on a table whose order has not been submitted yet."""
+    prices = _menu_prices(operations)
+    items = {item.id: item for item in TableItem.query.filter_by(table_id=table.id).order_by(TableItem.id)}
+    by_menu_item = {item.menu_item_id: item for item in items.values()}
+
+    for index, operation in enumerate(operations):
+        if operation.op == 'add':
+            item = by_menu_item.get(operation.menu_item_id)
+            if item is None:
+                item = TableItem(
+                    table_id=table.id,
+                    menu_item_id=operation.menu_item_id,
+                    quantity=0,
+                    unit_price=prices[operation.menu_item_id],
+                )
+                db.session.add(item)
+                by_menu_item[item.menu_item_id] = item
+            item.quantity += operation.quantity
+            item.total_price = item.quantity * item.unit_price
+            continue
+
+        item = items.get(operation.item_id)
+        if item is None:
+            raise CartError('آیتم یافت نشد', index, status=404)
+        if operation.op == 'update' and operation.quantity > 0:
+            item.quantity = operation.quantity
+            item.total_price = item.quantity * item.unit_price
+        else:
+            db.session.delete(item)
+            del items[item.id]
+            by_menu_item.pop(item.menu_item_id, None)
+
+    remaining = list(by_menu_item.values())
+    if not remaining:
+        _reset_table(table)
+        return
+    if table.status == 'خالی':
+        table.status = 'اشغال شده'
+        table.started_at = datetime.now(iran_tz)
+    table.total_amount, table.tax_amount, table.final_amount = _totals(remaining, table.discount, tax_percent)
+    table.updated_at = datetime.now(iran_tz)
+
+
+def _apply_order_items(order, operations, tax_percent) -> int:
+    """Operations on a submitted (unpaid) order; returns the items left in it."""
+    if order.status == PAID_STATUS:
+        raise CartError('سفارش قبلاً تسویه شده است')
+    prices = _menu_prices(operations)
+    items = {
+        item.id: item
+        for item in OrderItem.query.filter_by(order_id=order.id, is_deleted=False).order_by(OrderItem.id)
+    }
+    by_menu_item = {item.menu_item_id: item for item in items.values()}
+    touched, sold = [], defaultdict(int)
+
+    for index, operation in enumerate(operations):
+        if operation.op == 'add':
+            item = by_menu_item.get(operation.menu_item_id)
+            if item is None:
+                item = OrderItem(
+                    order_id=order.id,
+                    menu_item_id=operation.menu_item_id,
+                    quantity=0,
+                    unit_price=int(prices[operation.menu_item_id]),
+                    is_deleted=False,
+                )
+                db.session.add(item)
+                by_menu_item[item.menu_item_id] = item
+            item.quantity += operation.quantity
+            item.total_price = item.quantity * item.unit_price
+            sold[item.menu_item_id] += operation.quantity
+            touched.append(item)
+            continue
+
+        item = items.get(operation.item_id)
+        if item is None:
+            raise CartError('آیتم یافت نشد', index, status=404)
+        if operation.op == 'update' and operation.quantity > 0:
+            item.quantity = operation.quantity
+            item.total_price = item.quantity * item.unit_price
+        else:
+            if not operation.removal_reason:
+                raise CartError(
+                    'برای حذف آیتم از سفارش ثبت شده، باید دلیل حذف را وارد کنید',
+                    index,
+                    requires_reason=True,
+                    item_id=item.id,
+                )
+            item.removal_reason = operation.removal_reason
+            item.is_deleted = True
+            del items[item.id]
+            by_menu_item.pop(item.menu_item_id, None)
+        touched.append(item)
+
+    db.session.flush()
+    sync_order_material_usage({id(item): item for item in touched}.values())
+    decrement_menu_stock(sold)
+
+    remaining = list(by_menu_item.values())
+    order.total_amount, order.tax_amount, order.final_amount = _totals(remaining, order.discount, tax_percent)
+    return len(remaining)
+
+
+def apply_table_operations(table, operations, revision: int | None = None) -> int:
+    """Apply ``operations`` to a table's cart; returns the new revision.
+
+    Before submission the cart is the table's ``TableItem`` rows; afterwards it
+    is the items of its order. A submitted order left without items is deleted
+    and the table freed, as the single-item routes do.
+    """
+    new_revision = claim_revision(table, revision)
+    tax_percent = current_tax_percent()
+    order = db.session.get(Order, table.order_id) if table.order_id else None
+    if order is None:
+        _apply_table_items(table, operations, tax_percent)
+        return new_revision
+
+    if not _apply_order_items(order, operations, tax_percent):
+        db.session.delete(order)
+        table.order_id = None
+        _reset_table(table)
+    table.updated_at = datetime.now(iran_tz)
+    return new_revision
+
+
+def apply_order_operations(order, operations, revision: int | None = None) -> int:
+    """Apply ``operations`` to a takeaway order's cart; returns the new revision."""
+    new_revision = claim_revision(order, revision)
+    _apply_order_items(order, operations, current_tax_percent())
+    return new_revision
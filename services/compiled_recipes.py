@@ -0,0 +1,231 @@
+"""Compiled recipes and bulk material-usage recording.
+
+A menu item's recipe (``MenuItemMaterial`` → ``RawMaterial``, or →
+``PreProductionItem`` → ``PreProductionItemMaterial``) is flattened once into
+a tuple of :class:`RecipeLine` — raw material, quantity per sold unit, the
+unit it is recorded in and that unit's stored factor — using four column-only
+queries for the whole menu. The compiled menu is cached per tenant database
+and recompiled only after a commit that changes recipes, pre-production units
+or a material's default unit, in every worker, through a stamp under
+``CACHE_STAMP_DIR``.
+
+Usage rows are written per order, not per item: the current rows of all the
+given items are read in one query, items whose rows already match their recipe
+are left alone, and the rest are replaced with one ``DELETE`` and a single
+executemany ``INSERT`` that carries ``unit_code`` / ``unit_factor``. The stock
+ledger hooks follow both statements.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import NamedTuple
+
+from sqlalchemy import delete, insert, inspect, or_, select
+
+from models.models import (
+    MenuItemMaterial,
+    OrderItem,
+    PreProductionItem,
+    PreProductionItemMaterial,
+    RawMaterial,
+    RawMaterialUsage,
+    db,
+    normalize_unit,
+    unit_factor,
+)
+from services.tenant_cache import StampedTenantCache
+
+
+# Writes to any of these can change a compiled recipe.
+RECIPE_MODELS = (MenuItemMaterial, PreProductionItem, PreProductionItemMaterial, RawMaterial)
+
+DIRECT_NOTE = 'مصرف مستقیم BOM'
+PRE_PRODUCTION_NOTE = 'مصرف از پیش‌تولید: {name}'
+
+class RecipeLine(NamedTuple):
+    raw_material_id: int
+    quantity: float  # per sold unit, in ``unit``
+    unit: str
+    unit_code: str | None
+    unit_factor: float  # ``unit`` → material base unit
+    note: str
+
+    @property
+    def base_quantity(self) -> float:
+        return self.quantity * self.unit_factor
+
+
+# --- compilation -----------------------------------------------------------------
+
+def compile_recipes(menu_item_ids=None) -> dict[int, tuple[RecipeLine, ...]]:
+    """Flattened recipe of every menu item (or of ``menu_item_ids``) with a recipe."""
+    ids = list(menu_item_ids) if menu_item_ids is not None else None
+    material_units = dict(db.session.query(RawMaterial.id, RawMaterial.default_unit))
+    pre_units = dict(db.session.query(PreProductionItem.id, PreProductionItem.unit))
+
+    materials = db.session.query(
+        MenuItemMaterial.menu_item_id,
+        MenuItemMaterial.raw_material_id,
+        MenuItemMaterial.pre_production_item_id,
+        MenuItemMaterial.name,
+        MenuItemMaterial.quantity,
+        MenuItemMaterial.unit,
+    ).order_by(MenuItemMaterial.id)
+    if ids is not None:
+        materials = materials.filter(MenuItemMaterial.menu_item_id.in_(ids))
+    materials = materials.all()
+
+    used_pre_ids = {row.pre_production_item_id for row in materials if row.pre_production_item_id in pre_units}
+    pre_components: dict[int, list[tuple[int, float, str]]] = defaultdict(list)
+    if used_pre_ids:
+        for pre_id, material_id, quantity, unit in db.session.query(
+            PreProductionItemMaterial.pre_production_item_id,
+            PreProductionItemMaterial.raw_material_id,
+            PreProductionItemMaterial.quantity,
+            PreProductionItemMaterial.unit,
+        ).filter(PreProductionItemMaterial.pre_production_item_id.in_(used_pre_ids)).order_by(PreProductionItemMaterial.id):
+            if material_id in material_units:
+                pre_components[pre_id].append((material_id, float(quantity or 0), unit))
+
+    def line(material_id, quantity, unit, note):
+        default_unit = material_units[material_id]
+        unit = unit or default_unit
+        return RecipeLine(material_id, quantity, unit, normalize_unit(unit), unit_factor(unit, default_unit), note)
+
+    recipes: dict[int, list[RecipeLine]] = defaultdict(list)
+    for item_id, material_id, pre_id, name, raw_quantity, unit in materials:
+        try:
+            quantity = float(raw_quantity)
+        except (TypeError, ValueError):
+            continue
+        if material_id in material_units:
+            recipes[item_id].append(line(material_id, quantity, unit, DIRECT_NOTE))
+        elif pre_id in pre_units:
+            multiplier = unit_factor(unit, pre_units[pre_id]) * quantity
+            note = PRE_PRODUCTION_NOTE.format(name=name)
+            for component_id, component_quantity, component_unit in pre_components.get(pre_id, ()):
+                recipes[item_id].append(line(component_id, component_quantity * multiplier, component_unit, note))
+    return {item_id: tuple(lines) for item_id, lines in recipes.items()}
+
+
+def _is_recipe_change(session, obj) -> bool:
+    # Only a material's default unit feeds its recipe lines.
+    return not isinstance(obj, RawMaterial) or obj in session.deleted or (
+        inspect(obj).attrs.default_unit.history.has_changes()
+    )
+
+
+_recipes: StampedTenantCache[dict[int, tuple[RecipeLine, ...]]] = StampedTenantCache(
+    'compiled_recipes', compile_recipes, RECIPE_MODELS, is_change=_is_recipe_change,
+)
+
+
+def compiled_recipes(menu_item_ids) -> dict[int, tuple[RecipeLine, ...]]:
+    """Compiled recipes of ``menu_item_ids`` from this tenant's cached menu."""
+    ids = set(menu_item_ids)
+    if not _recipes.enabled():
+        return compile_recipes(ids) if ids else {}
+    recipes = _recipes.get()
+    return {item_id: recipes[item_id] for item_id in ids if item_id in recipes}
+
+
+def invalidate_compiled_recipes(engine=None) -> None:
+    """Drop the compiled recipes of one database (default: current tenant)."""
+    _recipes.invalidate(engine)
+
+
+# --- usage recording -------------------------------------------------------------
+
+_USAGE_FIELDS = ('order_id', 'menu_item_id', 'raw_material_id', 'quantity', 'unit', 'note')
+
+
+def usage_rows(recipe, order_id, order_item_id, menu_item_id, quantity) -> list[dict]:
+    """``RawMaterialUsage`` insert parameters for ``quantity`` units sold of ``recipe``."""
+    return [
+        {
+            'raw_material_id': line.raw_material_id,
+            'order_id': order_id,
+            'order_item_id': order_item_id,
+            'menu_item_id': menu_item_id,
+            'quantity': line.quantity * quantity,
+            'unit': line.unit,
+            'unit_code': line.unit_code,
+            'unit_factor': line.unit_factor,
+            'note': line.note,
+        }
+        for line in recipe
+    ]
+
+
+def _usage_rows(order_item, recipe) -> list[dict]:
+    return usage_rows(recipe, order_item.order_id, order_item.id, order_item.menu_item_id, order_item.quantity)
+
+
+def _signature(rows) -> list[tuple]:
+    return sorted(tuple(row[name] for name in _USAGE_FIELDS) for row in rows)
+
+
+def sync_order_material_usage(order_items, order_id: int | None = None) -> int:
+    """Make the usage rows of ``order_items`` match their compiled recipes.
+
+    With ``order_id``, usage rows of that order not belonging to any of the
+    items are removed as well. Returns the number of items whose rows changed.
+    """
+    items = [item for item in order_items if item is not None]
+    if not items and order_id is None:
+        return 0
+    if any(item.id is None or item.order_id is None for item in items):
+        db.session.flush()
+
+    recipes = compiled_recipes({item.menu_item_id for item in items if not item.is_deleted})
+    item_ids = {item.id for item in items}
+    U = RawMaterialUsage
+    scope = U.order_item_id.in_(item_ids)
+    if order_id is not None:
+        scope = or_(scope, U.order_id == order_id)
+
+    current: dict[int, list[dict]] = defaultdict(list)
+    stray_ids = []
+    for row in db.session.execute(
+        select(U.id, U.order_item_id, *(getattr(U, name) for name in _USAGE_FIELDS)).where(scope)
+    ).mappings():
+        if row['order_item_id'] in item_ids:
+            current[row['order_item_id']].append(row)
+        else:
+            stray_ids.append(row['id'])
+
+    changed, rows = [], []
+    for item in items:
+        wanted = [] if item.is_deleted else _usage_rows(item, recipes.get(item.menu_item_id, ()))
+        if _signature(wanted) != _signature(current.get(item.id, ())):
+            changed.append(item.id)
+            rows.extend(wanted)
+
+    if changed or stray_ids:
+        db.session.execute(delete(U).where(or_(U.order_item_id.in_(changed), U.id.in_(stray_ids))))
+    if rows:
+        db.session.execute(insert(U), rows)
+    return len(changed)
+
+
+def sync_order_item_material_usage(order_item) -> int:
+    """Usage rows of a single order item (see :func:`sync_order_material_usage`)."""
+    return sync_order_material_usage([order_item])
+
+
+def record_order_material_usage(order, replace_existing: bool = False) -> int:
+    """Usage rows of every item of ``order``.
+
+    ``replace_existing`` also drops rows of the order that no item accounts for.
+    """
+    if order is None:
+        return 0
+    if order.id is None:
+        db.session.flush()
+    items = OrderItem.query.filter_by(order_id=order.id).all()
+    return sync_order_material_usage(items, order.id if replace_existing else None)
+
+
+def register_compiled_recipe_events() -> None:
+    """Attach the invalidation hooks once per process."""
+    _recipes.register()
@@ -0,0 +1,245 @@
+"""Customer lookup by normalized phone and name, with a per-tenant LRU.
+
+Every ``Customer`` row stores ``phone_key`` and ``name_key`` next to the raw
+values, filled when the row is written and indexed:
+
+* ``phone_key`` keeps only digits (Persian/Arabic digits folded) and writes
+  Iranian numbers in their local ``09…`` form, so ``+98 912 …``, ``0912…``
+  and ``۰۹۱۲…`` are the same customer;
+* ``name_key`` is the name folded by ``search_index.normalize_search_text``.
+
+:func:`find_customer` resolves phone first, then name, through those indexes.
+Recently served customers are remembered in an in-process LRU per tenant
+database, so the order, table and takeaway flows that look the same customer
+up several times per request do not repeat the query, and the typeahead can
+offer them before anything is typed. Updating or deleting a customer drops
+the tenant's LRU in every worker through a stamp under ``CACHE_STAMP_DIR``;
+new customers cannot change an existing lookup and leave it alone.
+"""
+from __future__ import annotations
+
+import re
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from sqlalchemy import bindparam, event, inspect, select, update
+
+from models.models import Customer, Order, db
+from services.search_index import normalize_search_text, ranked_matches
+from services.tenant_cache import StampedTenantCache
+
+
+DEFAULT_TYPEAHEAD_LIMIT = 10
+MAX_TYPEAHEAD_LIMIT = 50
+MAX_RECENT_CUSTOMERS = 256
+BACKFILL_CHUNK_SIZE = 1000
+
+customer_table = Customer.__table__
+
+_NON_DIGIT = re.compile(r'\D+')
+
+
+# --- keys ------------------------------------------------------------------------
+
+def normalize_phone(value) -> str | None:
+    """Digits of ``value`` with Iranian numbers in local ``0…`` form; ``None`` when empty."""
+    digits = _NON_DIGIT.sub('', normalize_search_text(value))
+    if digits.startswith('0098'):
+        digits = '0' + digits[4:]
+    elif digits.startswith('98') and len(digits) == 12:
+        digits = '0' + digits[2:]
+    elif digits.startswith('9') and len(digits) == 10:
+        digits = '0' + digits
+    return digits or None
+
+
+def normalize_name(value) -> str | None:
+    return normalize_search_text(value) or None
+
+
+def _set_keys(target) -> None:
+    target.phone_key = normalize_phone(target.phone)
+    target.name_key = normalize_name(target.name)
+
+
+def backfill_customer_keys(connection, chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    """Fill ``phone_key`` / ``name_key`` of rows written before they existed."""
+    c = customer_table.c
+    statement = (
+        update(customer_table)
+        .where(c.id == bindparam('row_id'))
+        .values(phone_key=bindparam('phone_key_value'), name_key=bindparam('name_key_value'))
+    )
+    last_id, updated = 0, 0
+    while True:
+        rows = connection.execute(
+            select(c.id, c.name, c.phone)
+            .where(c.id > last_id, c.name_key.is_(None))
+            .order_by(c.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return updated
+        connection.execute(statement, [
+            {'row_id': row.id, 'phone_key_value': normalize_phone(row.phone), 'name_key_value': normalize_name(row.name)}
+            for row in rows
+        ])
+        last_id, updated = rows[-1].id, updated + len(rows)
+
+
+# --- recently served customers ---------------------------------------------------
+
+class CustomerEntry(NamedTuple):
+    id: int
+    name: str
+    phone: str | None
+    birth_date: str | None  # ISO date
+
+    @classmethod
+    def of(cls, customer: Customer) -> 'CustomerEntry':
+        birth_date = customer.birth_date.isoformat() if customer.birth_date else None
+        return cls(customer.id, customer.name, customer.phone, birth_date)
+
+
+class RecentCustomers:
+    """LRU of the customers one tenant served recently, addressable by key."""
+
+    def __init__(self) -> None:
+        self.entries: OrderedDict[int, CustomerEntry] = OrderedDict()
+        self.by_phone: dict[str, int] = {}
+        self.by_name: dict[str, int] = {}
+
+    def get(self, phone_key: str | None, name_key: str | None) -> CustomerEntry | None:
+        # An unknown phone may still belong to someone in the database, so the
+        # name is only consulted when no phone was given.
+        customer_id = self.by_phone.get(phone_key) if phone_key else self.by_name.get(name_key)
+        entry = self.entries.get(customer_id) if customer_id else None
+        if entry is not None:
+            self.entries.move_to_end(customer_id)
+        return entry
+
+    def put(self, entry: CustomerEntry, phone_key: str | None = None, name_key: str | None = None) -> None:
+        """Remember ``entry``; pass a key only when the database resolved it to this customer."""
+        self.entries[entry.id] = entry
+        self.entries.move_to_end(entry.id)
+        if phone_key:
+            self.by_phone[phone_key] = entry.id
+        if name_key:
+            self.by_name[name_key] = entry.id
+        while len(self.entries) > MAX_RECENT_CUSTOMERS:
+            evicted, _ = self.entries.popitem(last=False)
+            self.by_phone = {key: value for key, value in self.by_phone.items() if value != evicted}
+            self.by_name = {key: value for key, value in self.by_name.items() if value != evicted}
+
+    def recent(self, limit: int) -> list[CustomerEntry]:
+        return list(reversed(self.entries.values()))[:limit]
+
+
+# A changed or deleted customer resets the tenant's LRU in every worker; new
+# customers are remembered explicitly.
+_directories: StampedTenantCache[RecentCustomers] = StampedTenantCache(
+    'customer_directory', RecentCustomers, (Customer,), watch_inserts=False,
+)
+_lock = threading.Lock()
+
+
+def _recent_customers() -> RecentCustomers | None:
+    """This tenant's LRU, reset when another worker changed a customer; ``None`` when stamps are off."""
+    return _directories.get() if _directories.enabled() else None
+
+
+def _remember(directory: RecentCustomers | None, customer: Customer, phone_key=None, name_key=None) -> None:
+    if directory is None or customer.id is None:
+        return
+    with _lock:
+        directory.put(CustomerEntry.of(customer), phone_key, name_key)
+
+
+# --- lookups ---------------------------------------------------------------------
+
+def find_customer(name: str | None = None, phone: str | None = None) -> Customer | None:
+    """Customer with this phone, else the oldest one with this name (both normalized)."""
+    phone_key, name_key = normalize_phone(phone), normalize_name(name)
+    if not phone_key and not name_key:
+        return None
+    directory = _recent_customers()
+    if directory is not None:
+        with _lock:
+            entry = directory.get(phone_key, name_key)
+        customer = db.session.get(Customer, entry.id) if entry is not None else None
+        if customer is not None:
+            return customer
+    if phone_key:
+        customer = Customer.query.filter(Customer.phone_key == phone_key).order_by(Customer.id).first()
+        if customer is not None:
+            _remember(directory, customer, phone_key=phone_key)
+            return customer
+    if name_key:
+        customer = Customer.query.filter(Customer.name_key == name_key).order_by(Customer.id).first()
+        if customer is not None:
+            _remember(directory, customer, name_key=name_key)
+            return customer
+    return None
+
+
+def find_or_create_customer(name: str, phone: str = None, email: str = None, birth_date=None) -> Customer:
+    """Customer found by phone or name; a new one is registered when there is none."""
+    customer = find_customer(name, phone)
+    if customer is None:
+        customer = Customer(name=name, phone=phone, email=email, birth_date=birth_date)
+        db.session.add(customer)
+        db.session.commit()
+        # Nobody had this phone or name, so the new row is what both resolve to.
+        _remember(_recent_customers(), customer, customer.phone_key, customer.name_key)
+    elif birth_date and not customer.birth_date:
+        # Older customers get the birth date the first time it is given.
+        customer.birth_date = birth_date
+        db.session.commit()
+    return customer
+
+
+def customer_typeahead(q: str | None, limit: int = DEFAULT_TYPEAHEAD_LIMIT) -> list[dict]:
+    """Top ``limit`` customers for a name/phone prefix; recently served ones when ``q`` is empty."""
+    limit = max(1, min(MAX_TYPEAHEAD_LIMIT, limit))
+    directory = _recent_customers()
+    if q and q.strip():
+        customers = ranked_matches(Customer, q, limit)
+        for customer in customers:
+            _remember(directory, customer)
+        entries = [CustomerEntry.of(customer) for customer in customers]
+    elif directory is not None:
+        with _lock:
+            entries = directory.recent(limit)
+    else:
+        entries = []
+    ids = [entry.id for entry in entries]
+    with_orders = set(
+        db.session.execute(select(Order.customer_id).where(Order.customer_id.in_(ids)).distinct()).scalars()
+    ) if ids else set()
+    return [{**entry._asdict(), 'has_orders': entry.id in with_orders} for entry in entries]
+
+
+def invalidate_customer_directory(engine=None) -> None:
+    _directories.invalidate(engine)
+
+
+# --- ORM hooks -------------------------------------------------------------------
+
+def _before_insert(mapper, connection, target):
+    _set_keys(target)
+
+
+def _before_update(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.name.history.has_changes() or state.attrs.phone.history.has_changes():
+        _set_keys(target)
+
+
+def register_customer_directory_events() -> None:
+    """Attach the key and invalidation hooks once per process."""
+    if event.contains(Customer, 'before_insert', _before_insert):
+        return
+    event.listen(Customer, 'before_insert', _before_insert)
+    event.listen(Customer, 'before_update', _before_update)
+    _directories.register()
@@ -0,0 +1,82 @@
+"""Sales summaries for the main dashboard.
+
+All three periods start and end on local day boundaries, so each one is a
+single GROUP BY over a date range of ``daily_sales_rollup`` rows (see
+``services.sales_rollup``); the cost depends on the number of days, not on how
+many orders the cafe has ever taken.
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+import jdatetime
+import pytz
+
+from services.sales_rollup import sales_summary
+from utils.helpers import PAYMENT_BUCKET_LABELS
+
+
+DEFAULT_ORDER_TYPES = ('حضوری', 'بیرون‌بر', 'سایر')
+
+
+def dashboard_period_bounds(now: datetime | None = None) -> list[tuple[str, str, datetime, datetime | None]]:
+    """Return ``(key, label, start, end)`` for today, the last 7 days and the Jalali month.
+
+    Bounds are naive Tehran-local datetimes, matching how ``Order.created_at``
+    is stored in SQLite.
+    """
+    now = now or datetime.now(pytz.timezone('Asia/Tehran'))
+    now_naive = now.replace(tzinfo=None) if now.tzinfo else now
+    today_start = now_naive.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    jalali_now = jdatetime.datetime.fromgregorian(datetime=now_naive)
+    month_start = jdatetime.datetime(jalali_now.year, jalali_now.month, 1, 0, 0, 0).togregorian()
+    if jalali_now.month == 12:
+        last_day = 30 if jdatetime.date.isleap(jalali_now.year) else 29
+    elif jalali_now.month <= 6:
+        last_day = 31
+    else:
+        last_day = 30
+    month_end = jdatetime.datetime(jalali_now.year, jalali_now.month, last_day, 23, 59, 59).togregorian()
+
+    return [
+        ('day', 'امروز', today_start, None),
+        ('week', 'هفته جاری (۷ روز)', today_start - timedelta(days=7), None),
+        ('month', 'ماه جاری', month_start.replace(hour=0, minute=0, second=0, microsecond=0),
+         month_end.replace(microsecond=999999)),
+    ]
+
+
+def summarize_period(key: str, label: str, start_dt: datetime, end_dt: datetime | None = None) -> dict:
+    """Totals, order-type counts and paid amounts per payment bucket for one period."""
+    summary = sales_summary(start_dt.date(), end_dt.date() if end_dt else None)
+
+    order_type_stats = dict.fromkeys(DEFAULT_ORDER_TYPES, 0)
+    for order_type, count in summary['order_types'].items():
+        order_type = order_type or 'سایر'
+        order_type_stats[order_type] = order_type_stats.get(order_type, 0) + count
+
+    payment_stats = dict.fromkeys(PAYMENT_BUCKET_LABELS, 0)
+    payment_counts = dict.fromkeys(PAYMENT_BUCKET_LABELS, 0)
+    for bucket, total in summary['payment'].items():
+        payment_stats[bucket] = payment_stats.get(bucket, 0) + total
+        payment_counts[bucket] = payment_counts.get(bucket, 0) + summary['payment_counts'][bucket]
+
+    return {
+        'key': key,
+        'label': label,
+        'total_sales': summary['total_sales'],
+        'orders_count': summary['orders_count'],
+        'paid_count': summary['paid_count'],
+        'paid_total': summary['paid_total'],
+        'unpaid_total': summary['open_total'],
+        'payment': payment_stats,
+        'payment_counts': payment_counts,
+        'tax_total': summary['tax_total'],
+        'discount_total': summary['discount_total'],
+        'order_types': order_type_stats,
+    }
+
+
+def dashboard_periods(now: datetime | None = None) -> list[dict]:
+    return [summarize_period(*bounds) for bounds in dashboard_period_bounds(now)]
@@ -0,0 +1,107 @@
+"""Per-order line statistics for the financial report.
+
+Deleted-item counts/amounts and the live subtotal of every order come from one
+grouped ``order ⟕ order_item`` query instead of two ``OrderItem`` queries per
+order. Range totals (including the recomputed tax) are aggregated over that
+grouped query inside the database, so their memory use does not depend on the
+length of the range; only the displayed page of orders is loaded as objects.
+"""
+from __future__ import annotations
+
+from typing import NamedTuple
+
+from sqlalchemy import Integer, case, cast, func, select
+from sqlalchemy.orm import joinedload
+
+from models.models import Order, OrderItem, db
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class OrderLineStats(NamedTuple):
+    deleted_count: int
+    deleted_total: int
+    live_count: int
+    live_subtotal: int
+
+
+def recomputed_tax(live_subtotal: int, tax_percent: float) -> int:
+    """Tax for a live subtotal, identical to ``calculate_order_amount``."""
+    return int(live_subtotal * tax_percent / 100)
+
+
+def _line_stats_query(filters):
+    is_deleted = OrderItem.is_deleted == True  # noqa: E712 - NULL must not match
+    is_live = OrderItem.is_deleted == False  # noqa: E712
+    return (
+        select(
+            Order.id.label('order_id'),
+            Order.tax_amount.label('tax_amount'),
+            func.count(case((is_deleted, 1))).label('deleted_count'),
+            func.coalesce(func.sum(case((is_deleted, OrderItem.total_price))), 0).label('deleted_total'),
+            func.count(case((is_live, 1))).label('live_count'),
+            func.coalesce(func.sum(case((is_live, OrderItem.quantity * OrderItem.unit_price))), 0).label('live_subtotal'),
+        )
+        .select_from(Order)
+        .outerjoin(OrderItem, OrderItem.order_id == Order.id)
+        .where(*filters)
+        .group_by(Order.id)
+    )
+
+
+def order_range_filters(start_datetime, end_datetime) -> list:
+    return [Order.created_at >= start_datetime, Order.created_at <= end_datetime]
+
+
+def financial_range_totals(filters, tax_percent: float) -> dict:
+    """Order count, recomputed tax and deleted-item totals for the whole range."""
+    lines = _line_stats_query(filters).subquery()
+    tax = case(
+        (lines.c.live_count > 0, cast(lines.c.live_subtotal * tax_percent / 100.0, Integer)),
+        else_=func.coalesce(lines.c.tax_amount, 0),
+    )
+    orders_count, total_tax, deleted_count, deleted_total, orders_with_deleted = db.session.execute(select(
+        func.count(),
+        func.coalesce(func.sum(tax), 0),
+        func.coalesce(func.sum(lines.c.deleted_count), 0),
+        func.coalesce(func.sum(lines.c.deleted_total), 0),
+        func.coalesce(func.sum(case((lines.c.deleted_count > 0, 1), else_=0)), 0),
+    ).select_from(lines)).one()
+    return {
+        'orders_count': int(orders_count or 0),
+        'total_tax': int(total_tax or 0),
+        'total_deleted_items_count': int(deleted_count or 0),
+        'total_deleted_items_amount': int(deleted_total or 0),
+        'orders_with_deleted': int(orders_with_deleted or 0),
+    }
+
+
+def financial_orders_page(filters, tax_percent: float, page: int, per_page: int) -> list[dict]:
+    """One page of orders (newest first) with their line statistics."""
+    orders = (
+        Order.query
+        .options(joinedload(Order.customer))
+        .filter(*filters)
+        .order_by(Order.created_at.desc(), Order.id.desc())
+        .offset((page - 1) * per_page)
+        .limit(per_page)
+        .all()
+    )
+    if not orders:
+        return []
+    stats = {
+        row.order_id: OrderLineStats(row.deleted_count, row.deleted_total, row.live_count, row.live_subtotal)
+        for row in db.session.execute(_line_stats_query([Order.id.in_([order.id for order in orders])]))
+    }
+    rows = []
+    for order in orders:
+        line = stats.get(order.id, OrderLineStats(0, 0, 0, 0))
+        rows.append({
+            'order': order,
+            'deleted_items_count': line.deleted_count,
+            'deleted_items_total': line.deleted_total,
+            'tax_amount': recomputed_tax(line.live_subtotal, tax_percent) if line.live_count else (order.tax_amount or 0),
+        })
+    return rows
@@ -0,0 +1,278 @@
+"""Fleet-wide metrics snapshots in the master database.
+
+``CafeMetricsSnapshot`` keeps one row per cafe and local day with the counters
+shown on the master dashboard. The dashboard renders from the latest row of
+every cafe with a single query, and older rows form the history for fleet
+trend charts, so neither touches tenant files.
+
+Rows are refreshed by :class:`MetricsRefresher`, a background thread in each
+worker process:
+
+* commits that change orders, users, menu items or customers of a tenant mark
+  that tenant dirty; dirty tenants are refreshed after a short debounce delay,
+  so a burst of orders costs one refresh;
+* every ``FLEET_METRICS_FULL_REFRESH_SECONDS`` the snapshots older than that
+  period are refreshed, which covers cafes written by other workers, scripts
+  or restored backups.
+
+The thread is started lazily from the first request of a worker (gunicorn
+preloads the app in the master process, where threads would not survive the
+fork) and is not started at all when ``FLEET_METRICS_BACKGROUND`` is off.
+"""
+from __future__ import annotations
+
+import functools
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models.master_models import CafeMetricsSnapshot, CafeTenant
+from models.models import Customer, MenuItem, Order, User, db, iran_tz
+from services.fleet_query import run_fleet_query
+from services.fleet_reports import cafe_metrics
+from services.menu_availability import database_key
+from services.tenant_engines import tenant_registry_key
+
+
+DEFAULT_REFRESH_DELAY_SECONDS = 2.0
+DEFAULT_FULL_REFRESH_SECONDS = 900.0
+
+METRIC_FIELDS = (
+    'orders_count', 'revenue', 'users_count', 'menu_items_count', 'customers_count',
+    'day_orders_count', 'day_revenue',
+)
+WATCHED_MODELS = (Order, User, MenuItem, Customer)
+_DIRTY_KEY = 'fleet_metrics_dirty'
+
+snapshot_table = CafeMetricsSnapshot.__table__
+
+
+def _today() -> date:
+    return datetime.now(iran_tz).date()
+
+
+# --- refresh ---------------------------------------------------------------------
+
+def refresh_cafe_metrics(cafes, day: date | None = None) -> dict:
+    """Recompute and upsert the ``day`` snapshot (default: today) of ``cafes``.
+
+    Returns the :class:`~services.fleet_query.TenantResult` of every cafe; a
+    failed cafe keeps its previous snapshot.
+    """
+    cafes = list(cafes)
+    if not cafes:
+        return {}
+    day = day or _today()
+    results = run_fleet_query('cafe_metrics', cafes, functools.partial(cafe_metrics, day=day), ttl=0)
+    now = datetime.utcnow()
+    rows = [
+        {
+            'cafe_id': cafe.id,
+            'snapshot_date': day,
+            **{name: int(results[cafe.slug].value.get(name) or 0) for name in METRIC_FIELDS},
+            'refreshed_at': now,
+        }
+        for cafe in cafes
+        if results[cafe.slug].ok
+    ]
+    if rows:
+        stmt = insert(snapshot_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[snapshot_table.c.cafe_id, snapshot_table.c.snapshot_date],
+            set_={name: stmt.excluded[name] for name in (*METRIC_FIELDS, 'refreshed_at')},
+        )
+        db.session.execute(stmt, rows, bind_arguments={'mapper': inspect(CafeMetricsSnapshot)})
+        db.session.commit()
+    return results
+
+
+def refresh_stale_cafe_metrics(max_age_seconds: float) -> dict:
+    """Refresh active cafes whose today's snapshot is missing or older than ``max_age_seconds``."""
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    fresh = select(CafeMetricsSnapshot.cafe_id).where(
+        CafeMetricsSnapshot.snapshot_date == _today(),
+        CafeMetricsSnapshot.refreshed_at >= cutoff,
+    )
+    stale = CafeTenant.query.filter(CafeTenant.is_active == True, CafeTenant.id.not_in(fresh)).all()  # noqa: E712
+    return refresh_cafe_metrics(stale)
+
+
+def refresh_dirty_cafe_metrics(db_keys) -> dict:
+    """Refresh the active cafes whose database files are in ``db_keys``."""
+    db_keys = set(db_keys)
+    cafes = [
+        cafe for cafe in CafeTenant.query.filter(CafeTenant.is_active == True).all()  # noqa: E712
+        if tenant_registry_key(cafe.db_path) in db_keys
+    ]
+    return refresh_cafe_metrics(cafes)
+
+
+# --- reads -----------------------------------------------------------------------
+
+def latest_cafe_metrics(cafe_ids=None) -> dict[int, CafeMetricsSnapshot]:
+    """``{cafe_id: snapshot}`` with the most recent snapshot of each cafe."""
+    S = CafeMetricsSnapshot
+    latest = select(S.cafe_id, func.max(S.snapshot_date).label('snapshot_date')).group_by(S.cafe_id)
+    if cafe_ids is not None:
+        latest = latest.where(S.cafe_id.in_(list(cafe_ids)))
+    latest = latest.subquery()
+    rows = db.session.execute(
+        select(S).join(latest, (S.cafe_id == latest.c.cafe_id) & (S.snapshot_date == latest.c.snapshot_date))
+    ).scalars()
+    return {row.cafe_id: row for row in rows}
+
+
+def fleet_metrics_trend(days: int = 30, cafe_id: int | None = None) -> list[dict]:
+    """Per-day fleet totals (or one cafe's) of the last ``days`` local days, oldest first."""
+    S = CafeMetricsSnapshot
+    stmt = (
+        select(
+            S.snapshot_date, func.count(S.cafe_id),
+            func.sum(S.day_orders_count), func.sum(S.day_revenue),
+            func.sum(S.orders_count), func.sum(S.revenue),
+        )
+        .where(S.snapshot_date > _today() - timedelta(days=max(1, int(days))))
+        .group_by(S.snapshot_date)
+        .order_by(S.snapshot_date)
+    )
+    if cafe_id is not None:
+        stmt = stmt.where(S.cafe_id == cafe_id)
+    return [
+        {
+            'date': snapshot_date.isoformat(),
+            'cafes': int(cafes or 0),
+            'day_orders_count': int(day_orders or 0),
+            'day_revenue': int(day_revenue or 0),
+            'orders_count': int(orders or 0),
+            'revenue': int(revenue or 0),
+        }
+        for snapshot_date, cafes, day_orders, day_revenue, orders, revenue in db.session.execute(stmt)
+    ]
+
+
+# --- background refresher --------------------------------------------------------
+
+class MetricsRefresher:
+    """Per-process thread that keeps the snapshots of dirty tenants current."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._dirty: set[str] = set()
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self.app = None
+        self.enabled = False
+        self.delay = DEFAULT_REFRESH_DELAY_SECONDS
+        self.full_refresh_seconds = DEFAULT_FULL_REFRESH_SECONDS
+
+    def configure(self, app) -> None:
+        config = app.config
+        self.app = app
+        self.enabled = bool(config.get('FLEET_METRICS_BACKGROUND', True)) and not config.get('TESTING')
+        self.delay = max(0.0, float(config.get('FLEET_METRICS_REFRESH_DELAY_SECONDS', DEFAULT_REFRESH_DELAY_SECONDS)))
+        self.full_refresh_seconds = max(
+            1.0, float(config.get('FLEET_METRICS_FULL_REFRESH_SECONDS', DEFAULT_FULL_REFRESH_SECONDS))
+        )
+
+    def ensure_running(self) -> None:
+        """Start the thread in this process if it is not running yet."""
+        if not self.enabled or self.app is None:
+            return
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # Marks inherited from the preloading parent belong to no one.
+                self._dirty.clear()
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='fleet-metrics', daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self, db_keys) -> None:
+        if not self.enabled:
+            return
+        with self._cond:
+            self._dirty.update(db_keys)
+            self._cond.notify()
+
+    def _run(self) -> None:
+        next_full = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._dirty and time.monotonic() < next_full:
+                    self._cond.wait(max(0.0, next_full - time.monotonic()))
+            # Let a burst of commits collapse into one refresh.
+            time.sleep(self.delay)
+            with self._cond:
+                dirty, self._dirty = self._dirty, set()
+            full = time.monotonic() >= next_full
+            try:
+                with self.app.app_context():
+                    if full:
+                        refresh_stale_cafe_metrics(self.full_refresh_seconds)
+                    if dirty:
+                        refresh_dirty_cafe_metrics(dirty)
+            except Exception:  # noqa: BLE001 - keep the thread alive, retry on the next round
+                self.app.logger.exception('fleet metrics refresh failed')
+                with self._cond:
+                    self._dirty.update(dirty)
+                time.sleep(self.full_refresh_seconds / 10)
+            if full:
+                next_full = time.monotonic() + self.full_refresh_seconds
+
+
+metrics_refresher = MetricsRefresher()
+
+
+def configure_fleet_metrics(app) -> None:
+    """Apply ``FLEET_METRICS_*`` settings; the thread itself starts with the first request."""
+    metrics_refresher.configure(app)
+    app.before_request(metrics_refresher.ensure_running)
+
+
+# --- dirty tracking --------------------------------------------------------------
+
+def _mark(session, mapper) -> None:
+    bind = session.get_bind(mapper=mapper)
+    session.info.setdefault(_DIRTY_KEY, set()).add(database_key(bind.engine))
+
+
+def _after_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, WATCHED_MODELS):
+            _mark(session, inspect(obj).mapper)
+
+
+def _do_orm_execute(orm_execute_state):
+    if orm_execute_state.is_delete or orm_execute_state.is_update or orm_execute_state.is_insert:
+        mapper = orm_execute_state.bind_arguments.get('mapper')
+        if mapper is not None and issubclass(mapper.class_, WATCHED_MODELS):
+            _mark(orm_execute_state.session, mapper)
+
+
+def _after_commit(session):
+    keys = session.info.pop(_DIRTY_KEY, None)
+    if keys:
+        metrics_refresher.mark_dirty(keys)
+
+
+def _after_rollback(session):
+    session.info.pop(_DIRTY_KEY, None)
+
+
+def register_fleet_metrics_events() -> None:
+    """Attach the dirty-tracking hooks once per process."""
+    if event.contains(Session, 'after_commit', _after_commit):
+        return
+    event.listen(Session, 'after_flush', _after_flush)
+    event.listen(Session, 'do_orm_execute', _do_orm_execute)
+    event.listen(Session, 'after_commit', _after_commit)
+    event.listen(Session, 'after_rollback', _after_rollback)
@@ -0,0 +1,200 @@
+"""Cross-tenant query executor for master portal (fleet) reports.
+
+Per-tenant work runs on a bounded thread pool. Each task borrows a connection
+from the tenant's shared pooled engine (``services.tenant_engines``) and
+switches it to ``PRAGMA query_only`` for the duration. A SQLite progress
+handler and ``busy_timeout`` bound every tenant to its own time budget. A
+locked, corrupt or slow database yields a failed :class:`TenantResult` for
+that cafe instead of failing the whole report. Successful results are
+memoized per ``(report key, database file)`` for a short TTL.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, NamedTuple
+
+from flask import current_app
+from sqlalchemy.orm import Session
+
+from services.schema_migrations import migrate_tenant_schema_once
+from services.tenant_engines import get_tenant_engine, tenant_engines, tenant_registry_key
+
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT_SECONDS = 5.0
+DEFAULT_TTL_SECONDS = 30.0
+# SQLite VM instructions between two deadline checks.
+PROGRESS_STEPS = 10_000
+
+
+class TenantTimeout(Exception):
+    pass
+
+
+class TenantResult(NamedTuple):
+    slug: str
+    value: Any = None
+    error: str | None = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _describe_error(exc: Exception, timeout: float) -> str:
+    message = str(exc)
+    if isinstance(exc, TenantTimeout) or 'interrupted' in message:
+        return f'timeout after {timeout:g}s'
+    return message or exc.__class__.__name__
+
+
+def _set_pragmas(dbapi_connection, query_only: bool, busy_timeout_ms: int) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA query_only = {'ON' if query_only else 'OFF'}")
+        cursor.execute(f'PRAGMA busy_timeout = {int(busy_timeout_ms)}')
+    finally:
+        cursor.close()
+
+
+def run_read_only(db_path: str, work: Callable[[Session], Any], timeout: float) -> Any:
+    """Run ``work(session)`` on a read-only pooled connection within ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    engine = get_tenant_engine(db_path)
+    migrate_tenant_schema_once(db_path, engine)
+    with engine.connect() as connection:
+        dbapi_connection = connection.connection.dbapi_connection
+        dbapi_connection.set_progress_handler(lambda: int(time.monotonic() > deadline), PROGRESS_STEPS)
+        _set_pragmas(dbapi_connection, True, max(1, int(timeout * 1000)))
+        try:
+            with Session(bind=connection) as session:
+                return work(session)
+        finally:
+            try:
+                dbapi_connection.set_progress_handler(None, 0)
+                _set_pragmas(dbapi_connection, False, tenant_engines.busy_timeout_ms)
+            except Exception:
+                # Never hand a read-only connection back to the shared pool.
+                connection.invalidate()
+
+
+class FleetQueryExecutor:
+    """Bounded, memoizing fan-out of read-only work over tenant databases."""
+
+    def __init__(
+        self,
+        *,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        timeout: float = DEFAULT_TIMEOUT_SECONDS,
+        ttl: float = DEFAULT_TTL_SECONDS,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._pool: ThreadPoolExecutor | None = None
+        self._memo: dict[tuple[str, str], tuple[float, TenantResult]] = {}
+        self.configure(max_workers=max_workers, timeout=timeout, ttl=ttl)
+
+    def configure(self, *, max_workers: int | None = None, timeout: float | None = None, ttl: float | None = None) -> None:
+        with self._lock:
+            if max_workers is not None and max(1, int(max_workers)) != getattr(self, 'max_workers', None):
+                self.max_workers = max(1, int(max_workers))
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                    self._pool = None
+            if timeout is not None:
+                self.timeout = max(0.1, float(timeout))
+            if ttl is not None:
+                self.ttl = max(0.0, float(ttl))
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fleet-query')
+            return self._pool
+
+    def _task(self, app, slug: str, db_path: str, work, timeout: float) -> TenantResult:
+        started = time.monotonic()
+        with app.app_context():
+            try:
+                value = run_read_only(db_path, work, timeout)
+            except Exception as exc:  # noqa: BLE001 - one broken tenant must not fail the report
+                return TenantResult(slug, error=_describe_error(exc, timeout), elapsed=time.monotonic() - started)
+        return TenantResult(slug, value, elapsed=time.monotonic() - started)
+
+    def run(
+        self,
+        key: str,
+        cafes: Iterable,
+        work: Callable[[Session], Any],
+        *,
+        timeout: float | None = None,
+        ttl: float | None = None,
+    ) -> dict[str, TenantResult]:
+        """Run ``work`` for every cafe; returns ``{slug: TenantResult}`` in input order."""
+        timeout = self.timeout if timeout is None else timeout
+        ttl = self.ttl if ttl is None else ttl
+        app = current_app._get_current_object()
+        now = time.monotonic()
+        results: dict[str, TenantResult | None] = {}
+        pending = {}
+        for cafe in cafes:
+            results[cafe.slug] = None
+            if not os.path.exists(cafe.db_path):
+                results[cafe.slug] = TenantResult(cafe.slug, error='database file not found')
+                continue
+            memo_key = (key, tenant_registry_key(cafe.db_path))
+            with self._lock:
+                cached = self._memo.get(memo_key)
+            if cached and now - cached[0] < ttl:
+                results[cafe.slug] = cached[1]
+                continue
+            future = self._executor().submit(self._task, app, cafe.slug, cafe.db_path, work, timeout)
+            pending[future] = (cafe.slug, memo_key)
+
+        if pending:
+            # Tasks queue behind each other on the pool; every task is already
+            # bounded by its own deadline, this only guards against a stuck thread.
+            rounds = -(-len(pending) // self.max_workers)
+            done, not_done = wait(pending, timeout=timeout * (rounds + 1))
+            for future, (slug, memo_key) in pending.items():
+                if future in not_done:
+                    future.cancel()
+                    results[slug] = TenantResult(slug, error=_describe_error(TenantTimeout(), timeout))
+                    continue
+                result = future.result()
+                results[slug] = result
+                if result.ok and ttl > 0:
+                    with self._lock:
+                        self._memo[memo_key] = (time.monotonic(), result)
+        return results
+
+    def invalidate(self, db_path: str | None = None, key: str | None = None) -> None:
+        """Drop memoized results (for one database file and/or one report key)."""
+        path_key = tenant_registry_key(db_path) if db_path else None
+        with self._lock:
+            for memo_key in list(self._memo):
+                if (key is None or memo_key[0] == key) and (path_key is None or memo_key[1] == path_key):
+                    del self._memo[memo_key]
+
+
+fleet_queries = FleetQueryExecutor()
+
+
+def configure_fleet_queries(config) -> None:
+    """Apply ``FLEET_QUERY_*`` settings from a Flask config mapping."""
+    fleet_queries.configure(
+        max_workers=config.get('FLEET_QUERY_WORKERS'),
+        timeout=config.get('FLEET_QUERY_TIMEOUT_SECONDS'),
+        ttl=config.get('FLEET_QUERY_TTL_SECONDS'),
+    )
+
+
+def run_fleet_query(key: str, cafes: Iterable, work: Callable[[Session], Any], **options) -> dict[str, TenantResult]:
+    return fleet_queries.run(key, cafes, work, **options)
+
+
+def invalidate_fleet_results(db_path: str | None = None, key: str | None = None) -> None:
+    fleet_queries.invalidate(db_path, key)
@@ -0,0 +1,94 @@
+"""Per-tenant work functions for the master portal, run through ``services.fleet_query``.
+
+Each function receives a read-only session on one tenant database and returns
+plain data (no ORM objects), so results can be memoized and shared between
+requests.
+"""
+from __future__ import annotations
+
+from datetime import date, datetime
+
+from sqlalchemy import func, select
+
+from models.models import Category, Customer, MenuItem, Order, RawMaterial, Table, TableArea, User, Warehouse, iran_tz
+from services.sales_rollup import sales_summary
+
+
+OVERVIEW_COUNTS = {
+    'users_count': User,
+    'menu_items_count': MenuItem,
+    'customers_count': Customer,
+}
+REPORT_COUNTS = {
+    **OVERVIEW_COUNTS,
+    'categories_count': Category,
+    'tables_count': Table,
+    'table_areas_count': TableArea,
+    'raw_materials_count': RawMaterial,
+    'warehouses_count': Warehouse,
+}
+
+
+def row_counts(session, models: dict) -> dict[str, int]:
+    """``COUNT(*)`` of several tables in a single statement."""
+    columns = [
+        select(func.count()).select_from(model.__table__).scalar_subquery().label(name)
+        for name, model in models.items()
+    ]
+    row = session.execute(select(*columns)).one()
+    return {name: int(value or 0) for name, value in zip(models, row)}
+
+
+def cafe_overview(session) -> dict:
+    """Order/revenue totals and row counts shown per cafe on the master dashboard."""
+    sales = sales_summary(session=session)
+    return {
+        'orders_count': sales['orders_count'],
+        'revenue': sales['paid_total'],
+        **row_counts(session, OVERVIEW_COUNTS),
+    }
+
+
+def cafe_metrics(session, day: date | None = None) -> dict:
+    """:func:`cafe_overview` plus the sales of one local day (default: today)."""
+    day = day or datetime.now(iran_tz).date()
+    sales = sales_summary(day, day, session=session)
+    return {
+        **cafe_overview(session),
+        'day_orders_count': sales['orders_count'],
+        'day_revenue': sales['paid_total'],
+    }
+
+
+def cafe_report_details(session) -> dict:
+    """Everything the master cafe report needs from one tenant database."""
+    sales = sales_summary(session=session)
+    recent_orders = session.execute(
+        select(Order.id, Order.invoice_number, Order.final_amount, Order.status, Order.created_at)
+        .order_by(Order.created_at.desc())
+        .limit(10)
+    ).all()
+    active_users = session.execute(
+        select(User.id, User.username, User.name, User.role).where(User.is_active == True)  # noqa: E712
+    ).all()
+    return {
+        'orders_count': sales['orders_count'],
+        'revenue': sales['total_sales'],
+        'paid_revenue': sales['paid_total'],
+        'unpaid_revenue': sales['unpaid_total'],
+        **row_counts(session, REPORT_COUNTS),
+        'recent_orders': [
+            {
+                'id': row.id,
+                'invoice_number': str(row.invoice_number) if row.invoice_number else '-',
+                'final_amount': row.final_amount or 0,
+                'status': row.status,
+                'created_at': row.created_at,
+            }
+            for row in recent_orders
+        ],
+        'active_users': [
+            {'id': row.id, 'username': row.username, 'name': row.name, 'role': row.role}
+            for row in active_users
+        ],
+    }
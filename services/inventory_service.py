@@ -1,6 +1,7 @@
-from collections import defaultdict
+import threading
+from collections import OrderedDict
 from datetime import date
-import math
+from typing import NamedTuple
 
 from models.models import (
     db,
@@ -8,29 +9,37 @@ from models.models import (
     MaterialPurchase,
     RawMaterial,
     RawMaterialUsage,
-    convert_unit,
 )
-from sqlalchemy import cast, Date
+from sqlalchemy import func, inspect, select, union_all
+
+from services.menu_availability import database_key, menu_availability, stock_version
 
 
 def purchase_base_quantity(purchase: MaterialPurchase) -> float:
-    material = purchase.raw_material
-    if not material:
-        return float(purchase.quantity or 0)
-    return convert_unit(purchase.quantity, purchase.unit, material.default_unit)
+    return purchase.base_quantity
+
+
+def weighted_average_unit_prices(material_ids=None) -> dict[int, float]:
+    """Weighted average purchase cost in the base unit of every material, in one query.
+
+    Materials without a positive purchased quantity are omitted.
+    """
+    base_quantity = MaterialPurchase.quantity * MaterialPurchase.unit_factor
+    query = db.session.query(
+        MaterialPurchase.raw_material_id, func.sum(base_quantity), func.sum(MaterialPurchase.total_price)
+    ).filter(base_quantity > 0)
+    if material_ids is not None:
+        query = query.filter(MaterialPurchase.raw_material_id.in_(list(material_ids)))
+    return {
+        material_id: float(total_value or 0) / total_quantity
+        for material_id, total_quantity, total_value in query.group_by(MaterialPurchase.raw_material_id)
+        if total_quantity
+    }
 
 
 def weighted_average_unit_price(material: RawMaterial) -> float | None:
     """Return weighted average purchase cost in the material base unit."""
-    total_quantity = 0.0
-    total_value = 0.0
-    for purchase in material.purchases:
-        quantity = purchase_base_quantity(purchase)
-        if quantity <= 0:
-            continue
-        total_quantity += quantity
-        total_value += float(purchase.total_price or 0)
-    return (total_value / total_quantity) if total_quantity > 0 else None
+    return weighted_average_unit_prices([material.id]).get(material.id)
 
 
 def menu_item_available_quantity(item: MenuItem) -> int:
@@ -40,154 +49,122 @@ def menu_item_available_quantity(item: MenuItem) -> int:
     This keeps the order screen aligned with the inventory ledger instead of the
     old, unrelated ``menu_item.stock`` counter.
     """
-    requirements: dict[int, tuple[RawMaterial, float]] = {}
-    for part in item.materials:
-        quantity = part.quantity_value
-        if not quantity or quantity <= 0:
-            continue
-        if part.raw_material:
-            required_base = convert_unit(quantity, part.unit, part.raw_material.default_unit)
-            previous = requirements.get(part.raw_material.id, (part.raw_material, 0.0))[1]
-            requirements[part.raw_material.id] = (part.raw_material, previous + required_base)
-        elif part.pre_production_item:
-            pre_item = part.pre_production_item
-            multiplier = convert_unit(quantity, part.unit, pre_item.unit)
-            for component in pre_item.materials:
-                if not component.raw_material:
-                    continue
-                required_base = convert_unit(
-                    float(component.quantity or 0) * multiplier,
-                    component.unit,
-                    component.raw_material.default_unit,
-                )
-                previous = requirements.get(component.raw_material.id, (component.raw_material, 0.0))[1]
-                requirements[component.raw_material.id] = (component.raw_material, previous + required_base)
-
-    capacities: list[int] = []
-    for raw_material, required_base in requirements.values():
-        if required_base <= 0:
-            continue
-        capacities.append(math.floor(float(raw_material.current_stock or 0) / required_base))
-
-    if capacities:
-        return max(0, min(capacities))
+    availability = menu_availability()
+    if item.id in availability:
+        return availability[item.id]
     return max(0, int(item.stock or 0))
 
 
 def menu_stock_map(items: list[MenuItem] | None = None) -> dict[int, int]:
-    items = items if items is not None else MenuItem.query.filter_by(is_active=True).all()
-    return {item.id: menu_item_available_quantity(item) for item in items}
+    """Sellable quantity per menu item, shared by the dashboard, POS and waiter screens."""
+    availability = menu_availability()
+    if items is None:
+        items = MenuItem.query.filter_by(is_active=True).all()
+    return {
+        item.id: availability[item.id] if item.id in availability else max(0, int(item.stock or 0))
+        for item in items
+    }
+
+
+class PeriodStock(NamedTuple):
+    """Per-material quantities (in the material base unit) of one period."""
+    opening: dict[int, float]
+    purchased: dict[int, float]
+    used: dict[int, float]
+    closing: dict[int, float]
+
+
+MAX_CACHED_PERIODS = 256
+
+_period_cache: OrderedDict[tuple, tuple[int, PeriodStock]] = OrderedDict()
+_period_cache_lock = threading.Lock()
+
+
+def _base_totals(rows, material_ids) -> dict[int, float]:
+    return {material_id: float(quantity or 0) for material_id, quantity in rows if material_id in material_ids}
+
+
+def compute_period_stock(start_date: date | None, end_date: date | None) -> PeriodStock:
+    """Opening balance, purchases, usage and closing stock of every material.
+
+    One grouped statement each for the opening balance (purchases minus usage
+    before ``start_date``), the period's purchases and the period's usage,
+    summing ``quantity * unit_factor`` so every total is already in the
+    material base unit (see ``services.unit_factors``). Without ``start_date``
+    the whole history is the opening balance. Opening and closing balances are
+    floored at 0.
+    """
+    material_ids = set(db.session.execute(select(RawMaterial.id)).scalars())
+    purchase_day = MaterialPurchase.purchase_date
+    usage_day = func.date(RawMaterialUsage.created_at)
+    purchase_quantity = MaterialPurchase.quantity * MaterialPurchase.unit_factor
+    usage_quantity = RawMaterialUsage.quantity * RawMaterialUsage.unit_factor
+
+    purchases_before = select(
+        MaterialPurchase.raw_material_id.label('material_id'), purchase_quantity.label('quantity'),
+    )
+    usages_before = select(RawMaterialUsage.raw_material_id, -usage_quantity)
+    if start_date:
+        purchases_before = purchases_before.where(purchase_day < start_date)
+        usages_before = usages_before.where(usage_day < start_date)
+    movements = union_all(purchases_before, usages_before).subquery()
+    opening = _base_totals(db.session.execute(
+        select(movements.c.material_id, func.sum(movements.c.quantity)).group_by(movements.c.material_id),
+        bind_arguments={'mapper': inspect(RawMaterial)},
+    ), material_ids)
+
+    purchased: dict[int, float] = {}
+    used: dict[int, float] = {}
+    if start_date:
+        purchases = db.session.query(MaterialPurchase.raw_material_id, func.sum(purchase_quantity)).filter(
+            purchase_day >= start_date
+        )
+        usages = db.session.query(RawMaterialUsage.raw_material_id, func.sum(usage_quantity)).filter(
+            usage_day >= start_date
+        )
+        if end_date:
+            purchases = purchases.filter(purchase_day <= end_date)
+            usages = usages.filter(usage_day <= end_date)
+        purchased = _base_totals(purchases.group_by(MaterialPurchase.raw_material_id), material_ids)
+        used = _base_totals(usages.group_by(RawMaterialUsage.raw_material_id), material_ids)
+
+    opening = {material_id: max(0.0, quantity) for material_id, quantity in opening.items()}
+    closing = {
+        material_id: max(0.0, opening.get(material_id, 0.0) + purchased.get(material_id, 0.0) - used.get(material_id, 0.0))
+        for material_id in material_ids
+    }
+    return PeriodStock(opening, purchased, used, closing)
+
+
+def period_stock(start_date: date | None, end_date: date | None) -> PeriodStock:
+    """:func:`compute_period_stock`, cached per (tenant, start, end) until stock changes."""
+    engine = db.session.get_bind(mapper=inspect(RawMaterial))
+    version = stock_version(engine)
+    if version is None:
+        return compute_period_stock(start_date, end_date)
+    key = (database_key(engine), start_date, end_date)
+    with _period_cache_lock:
+        entry = _period_cache.get(key)
+        if entry is not None and entry[0] == version:
+            _period_cache.move_to_end(key)
+            return entry[1]
+    result = compute_period_stock(start_date, end_date)
+    with _period_cache_lock:
+        _period_cache[key] = (version, result)
+        _period_cache.move_to_end(key)
+        while len(_period_cache) > MAX_CACHED_PERIODS:
+            _period_cache.popitem(last=False)
+    return result
 
 
 def calculate_material_stock_for_period(
     raw_materials,
-    purchases,
     start_date: date | None,
     end_date: date | None,
 ) -> dict[int, float]:
     """
-    بر اساس خریدها و مصرف سفارش‌ها، موجودی پایان بازه را برای هر ماده اولیه حساب می‌کند.
+    موجودی پایان بازه هر ماده اولیه بر اساس خریدها و مصرف سفارش‌ها (period_stock)
     خروجی: دیکشنری {raw_material_id: stock}
     """
-    # ۱) موجودی اولیه را از فیلد فعلی مدل (مثلاً current_stock) بگیر
-    # اما برای محاسبه دقیق‌تر، باید خریدها و مصرف‌های قبل از start_date را هم حساب کنیم
-    opening = {}
-    for m in raw_materials:
-        if start_date:
-            # اگر start_date مشخص است، موجودی ابتدای دوره را محاسبه می‌کنیم
-            # تمام خریدها تا قبل از start_date
-            purchases_before = MaterialPurchase.query.filter(
-                MaterialPurchase.raw_material_id == m.id,
-                MaterialPurchase.purchase_date < start_date
-            ).all()
-            
-            # تمام مصرف‌ها تا قبل از start_date
-            usages_before = RawMaterialUsage.query.filter(
-                RawMaterialUsage.raw_material_id == m.id,
-                cast(RawMaterialUsage.created_at, Date) < start_date
-            ).all()
-            
-            # محاسبه موجودی ابتدای دوره
-            base_unit = m.default_unit
-            stock_before = 0.0
-            for p in purchases_before:
-                stock_before += convert_unit(p.quantity, p.unit, base_unit)
-            for u in usages_before:
-                stock_before -= convert_unit(u.quantity, u.unit, base_unit)
-            
-            opening[m.id] = max(0.0, stock_before)
-        else:
-            # اگر start_date مشخص نیست، موجودی را از تمام خریدها و مصرف‌ها محاسبه می‌کنیم
-            # (نه از current_stock که ممکن است به‌روز نباشد)
-            purchases_all = MaterialPurchase.query.filter(
-                MaterialPurchase.raw_material_id == m.id
-            ).all()
-            
-            usages_all = RawMaterialUsage.query.filter(
-                RawMaterialUsage.raw_material_id == m.id
-            ).all()
-            
-            base_unit = m.default_unit
-            stock_calculated = 0.0
-            for p in purchases_all:
-                stock_calculated += convert_unit(p.quantity, p.unit, base_unit)
-            for u in usages_all:
-                stock_calculated -= convert_unit(u.quantity, u.unit, base_unit)
-            
-            opening[m.id] = max(0.0, stock_calculated)
-
-    # ۲) تغییرات موجودی در بازه را بر اساس خریدها حساب کن
-    # فقط اگر start_date مشخص باشد، باید تغییرات را محاسبه کنیم
-    # در غیر این صورت، opening قبلاً شامل تمام خریدهاست
-    delta = defaultdict(float)
-    
-    if start_date:
-        # فقط اگر start_date مشخص باشد، تغییرات در بازه را محاسبه می‌کنیم
-        for p in purchases:
-            rm_id = p.raw_material_id
-            if not rm_id:
-                continue
-            raw_material = next((m for m in raw_materials if m.id == rm_id), None)
-            if not raw_material:
-                continue
-            
-            qty = float(getattr(p, "quantity", 0) or 0)
-            base_unit = raw_material.default_unit
-            converted_qty = convert_unit(qty, p.unit, base_unit)
-            delta[rm_id] += converted_qty
-
-        # ۳) مصرف در سفارش‌ها/رسپی‌ها را هم در همین بازه کم کن
-        usages_query = RawMaterialUsage.query
-        
-        usages_query = usages_query.filter(
-            cast(RawMaterialUsage.created_at, Date) >= start_date
-        )
-        if end_date:
-            usages_query = usages_query.filter(
-                cast(RawMaterialUsage.created_at, Date) <= end_date
-            )
-        
-        usages_in_period = usages_query.all()
-        
-        for usage in usages_in_period:
-            rm_id = usage.raw_material_id
-            if not rm_id:
-                continue
-            raw_material = next((m for m in raw_materials if m.id == rm_id), None)
-            if not raw_material:
-                continue
-            
-            qty = float(getattr(usage, "quantity", 0) or 0)
-            base_unit = raw_material.default_unit
-            converted_qty = convert_unit(qty, usage.unit, base_unit)
-            delta[rm_id] -= converted_qty
-
-    # محاسبه نتیجه نهایی
-    result = {}
-    for m in raw_materials:
-        base = opening.get(m.id, 0.0)
-        change = delta.get(m.id, 0.0)
-        result[m.id] = max(0.0, base + change)
-
-    return result
-
+    closing = period_stock(start_date, end_date).closing
+    return {m.id: closing.get(m.id, 0.0) for m in raw_materials}
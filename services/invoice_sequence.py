@@ -0,0 +1,160 @@
+"""Atomic invoice number allocation.
+
+``invoice_sequence`` holds the last allocated global invoice number (row
+``'invoice'``) and the last daily sequence of each local day (rows
+``'daily:YYYYMMDD'``). A number is taken with a single
+``UPDATE ... SET value = value + n ... RETURNING value``, so concurrent workers
+never see the same value and order creation no longer scans ``order`` for the
+current maxima. A counter row is seeded from those maxima only the first time
+it is used.
+
+By default both numbers are allocated inside the caller's transaction: a
+rolled-back order returns its number and the sequences stay gapless. With
+``INVOICE_NUMBER_BLOCK_SIZE > 1`` each worker reserves a block of global
+numbers in its own short transaction and hands them out from memory, which
+keeps the write lock for the counter short when many orders arrive in
+parallel. Numbers of an unused block are skipped, so the global number may
+then have gaps. Daily sequences are printed on receipts and are always
+allocated one at a time.
+"""
+from __future__ import annotations
+
+import threading
+from datetime import date, datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import delete, func, insert, inspect, select, update
+
+from models.models import InvoiceSequence, Order, db, iran_tz
+from services.menu_availability import database_key
+
+
+INVOICE_SEQUENCE = 'invoice'
+FIRST_INVOICE_NUMBER = 1001
+FIRST_DAILY_SEQUENCE = 100
+# Daily counters older than this are purged when a new day's counter is created.
+DAILY_RETENTION_DAYS = 7
+
+sequence_table = InvoiceSequence.__table__
+order_table = Order.__table__
+
+_blocks: dict[str, list[int]] = {}
+_blocks_lock = threading.Lock()
+
+
+def daily_sequence_name(day: date) -> str:
+    return f"daily:{day.strftime('%Y%m%d')}"
+
+
+def _increment(connection, name: str, count: int) -> int | None:
+    """Add ``count`` to a counter and return its new value (``None`` if missing)."""
+    c = sequence_table.c
+    return connection.execute(
+        update(sequence_table)
+        .where(c.name == name)
+        .values(value=c.value + count, updated_at=datetime.now(iran_tz))
+        .returning(c.value)
+    ).scalar()
+
+
+def _seed(connection, name: str, value: int) -> None:
+    connection.execute(
+        insert(sequence_table).prefix_with('OR IGNORE'),
+        {'name': name, 'value': value, 'updated_at': datetime.now(iran_tz)},
+    )
+
+
+def _last_invoice_number(connection) -> int:
+    last = connection.execute(select(func.max(order_table.c.invoice_number))).scalar()
+    return last or FIRST_INVOICE_NUMBER - 1
+
+
+def _last_daily_sequence(connection, day: date) -> int:
+    start = datetime.combine(day, datetime.min.time())
+    last = connection.execute(
+        select(func.max(order_table.c.daily_sequence))
+        .where(order_table.c.created_at >= start, order_table.c.created_at < start + timedelta(days=1))
+    ).scalar()
+    return max(last or 0, FIRST_DAILY_SEQUENCE - 1)
+
+
+def _purge_daily_counters(connection, day: date) -> None:
+    oldest = daily_sequence_name(day - timedelta(days=DAILY_RETENTION_DAYS))
+    connection.execute(
+        delete(sequence_table).where(sequence_table.c.name.like('daily:%'), sequence_table.c.name < oldest)
+    )
+
+
+def reserve_invoice_numbers(connection, count: int = 1) -> range:
+    """Atomically reserve ``count`` consecutive global invoice numbers."""
+    last = _increment(connection, INVOICE_SEQUENCE, count)
+    if last is None:
+        _seed(connection, INVOICE_SEQUENCE, _last_invoice_number(connection))
+        last = _increment(connection, INVOICE_SEQUENCE, count)
+    return range(last - count + 1, last + 1)
+
+
+def reserve_daily_sequence(connection, day: date) -> int:
+    """Atomically take the next daily sequence of ``day``."""
+    name = daily_sequence_name(day)
+    value = _increment(connection, name, 1)
+    if value is None:
+        _seed(connection, name, _last_daily_sequence(connection, day))
+        _purge_daily_counters(connection, day)
+        value = _increment(connection, name, 1)
+    return value
+
+
+def _session_connection():
+    return db.session.connection(bind_arguments={'mapper': inspect(InvoiceSequence)})
+
+
+def _block_size() -> int:
+    if not has_app_context():
+        return 1
+    return max(1, int(current_app.config.get('INVOICE_NUMBER_BLOCK_SIZE', 1) or 1))
+
+
+def _session_holds_write_lock() -> bool:
+    if not db.session().in_transaction():
+        return False
+    dbapi_connection = _session_connection().connection.dbapi_connection
+    return bool(getattr(dbapi_connection, 'in_transaction', False))
+
+
+def allocate_invoice_number() -> int:
+    """Next global invoice number for the current tenant database."""
+    block_size = _block_size()
+    if block_size == 1:
+        return reserve_invoice_numbers(_session_connection()).start
+
+    engine = db.session.get_bind(mapper=inspect(InvoiceSequence))
+    key = database_key(engine)
+    with _blocks_lock:
+        block = _blocks.get(key)
+        if not block or block[0] >= block[1]:
+            if _session_holds_write_lock():
+                # A second connection would wait on the session's SQLite write
+                # lock, so take a single number inside the caller's transaction.
+                return reserve_invoice_numbers(_session_connection()).start
+            # Own short transaction: the reservation survives a rolled-back order.
+            with engine.begin() as connection:
+                numbers = reserve_invoice_numbers(connection, block_size)
+            block = _blocks[key] = [numbers.start, numbers.stop]
+        number = block[0]
+        block[0] += 1
+    return number
+
+
+def allocate_daily_sequence(day: date) -> int:
+    """Next daily sequence of ``day`` (starting at 100) inside the caller's transaction."""
+    return reserve_daily_sequence(_session_connection(), day)
+
+
+def discard_reserved_blocks(engine=None) -> None:
+    """Forget in-memory blocks (all, or one database's), e.g. after restoring a backup."""
+    with _blocks_lock:
+        if engine is None:
+            _blocks.clear()
+        else:
+            _blocks.pop(database_key(engine), None)
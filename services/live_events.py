@@ -0,0 +1,415 @@
+"""Live dashboard events of one tenant: table status, orders and menu stock.
+
+Screens used to ``location.reload()`` after every submit, checkout or transfer
+to pick up what they or another device had changed. Instead, session hooks
+publish small events that open screens receive over server-sent events
+(``/dashboard/events``) and use to patch only the affected card:
+
+* ``table``  ``{"table_id"}`` when a table's status, order, customer or amount
+  changes;
+* ``order``  ``{"order_id", "action", "type", "table_id"}`` with action
+  ``created``, ``updated``, ``paid`` or ``deleted``;
+* ``stock``  ``{"items": {menu_item_id: sellable}, "full"}`` with the sellable
+  quantities that changed (all of them when there is no previous map to diff).
+
+Events are rows of ``live_event`` in the tenant database. Table and order
+events are inserted by ``after_flush`` in the same transaction as the change,
+so a rolled-back change publishes nothing. The stock delta needs a full
+availability pass, which is too slow to run while the transaction holds
+SQLite's write lock; it is computed right after the commit and written in a
+short transaction of its own. SQLite serializes writers, so ids become visible
+in increasing order and a reader can follow the table with ``id > last_seen``.
+
+Each worker keeps one :class:`LiveEventHub` per tenant database: a bounded
+buffer of recent events plus a condition variable. Of the streams waiting on a
+hub only one polls the table (at most every :data:`POLL_INTERVAL` seconds, or
+right away after a commit in this worker) and wakes the others, so events
+written by any gunicorn worker reach every screen with one query per worker
+rather than one per screen. Streams end after :data:`STREAM_SECONDS` and the
+browser reconnects with ``Last-Event-ID``, so a thread is never held for long
+and no event is lost across reconnects or deploys.
+
+Every open stream still holds a worker thread while it lasts, so a worker
+serves at most ``LIVE_STREAMS_PER_WORKER`` of them (:func:`open_stream_slot`);
+past that the route answers 503 and the screen retries after
+:data:`BUSY_RETRY_SECONDS`, leaving the remaining threads to requests.
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, func, insert, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from models.models import LiveEvent, MenuItem, Order, Table, db, iran_tz
+from services.cache_stamps import bump_stamp, read_stamp, stamp_path
+from services.menu_availability import (
+    WATCHED_MODELS as STOCK_MODELS,
+    cached_menu_availability,
+    compute_menu_availability,
+    database_key,
+    stock_version,
+)
+
+
+MAX_CACHED_TENANTS = 128
+POLL_INTERVAL = 1.0
+STREAM_SECONDS = 25
+RETRY_MILLISECONDS = 1000
+BUSY_RETRY_SECONDS = 10
+BUFFER_SIZE = 500
+KEEP_EVENTS = 2000
+PRUNE_EVERY = 200
+# Stock deltas cost a full availability pass, so they are only computed while
+# some screen of the tenant has opened a stream recently.
+LISTENER_TTL_SECONDS = 2 * STREAM_SECONDS + 10
+
+PAID_STATUS = 'پرداخت شده'
+TABLE_FIELDS = ('status', 'order_id', 'customer_name', 'discount', 'final_amount')
+ORDER_FIELDS = ('status', 'customer_id', 'discount', 'final_amount', 'table_id')
+
+_EVENTS_KEY = 'live_events_published'
+_STOCK_KEY = 'live_events_stock'
+_NOTIFY_KEY = 'live_events_notify'
+_PENDING_STOCK_KEY = 'live_events_stock_maps'
+
+_hubs: OrderedDict[str, 'LiveEventHub'] = OrderedDict()
+_hubs_lock = threading.Lock()
+_streams_lock = threading.Lock()
+_open_streams = 0
+# Last published availability per database, keyed by the stock version it matches.
+_published_stock: dict[str, tuple[int, dict[int, int]]] = {}
+_published_lock = threading.Lock()
+
+
+# --- reading -----------------------------------------------------------------------
+
+def _fetch(engine, after: int, limit: int = BUFFER_SIZE) -> list[tuple[int, str, str]]:
+    table = LiveEvent.__table__
+    with engine.connect() as connection:
+        return [
+            tuple(row)
+            for row in connection.execute(
+                select(table.c.id, table.c.kind, table.c.payload)
+                .where(table.c.id > after)
+                .order_by(table.c.id)
+                .limit(limit)
+            )
+        ]
+
+
+class LiveEventHub:
+    """Recent events of one tenant database, shared by this worker's streams."""
+
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        with engine.connect() as connection:
+            self.last_id = connection.execute(select(func.coalesce(func.max(LiveEvent.__table__.c.id), 0))).scalar()
+        # Every event with floor < id <= last_id is in the buffer.
+        self.floor = self.last_id
+        self._events: deque[tuple[int, str, str]] = deque(maxlen=BUFFER_SIZE)
+        self._condition = threading.Condition()
+        self._polling = False
+        self._poked = False
+        self._polled_at = time.monotonic()
+
+    def poke(self) -> None:
+        """Poll right away instead of waiting for the next interval."""
+        with self._condition:
+            self._poked = True
+            self._condition.notify_all()
+
+    def _append(self, rows) -> None:
+        for row in rows:
+            if len(self._events) == self._events.maxlen:
+                self.floor = self._events[0][0]
+            self._events.append(row)
+            self.last_id = row[0]
+
+    def events_after(self, after: int, timeout: float) -> list[tuple[int, str, str]]:
+        """Events with ``id > after``, waiting up to ``timeout`` seconds for one."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while after >= self.floor:
+                if self.last_id > after:
+                    return [row for row in self._events if row[0] > after]
+                now = time.monotonic()
+                if now >= deadline:
+                    return []
+                if not self._polling and (self._poked or now - self._polled_at >= POLL_INTERVAL):
+                    self._polling, self._poked = True, False
+                    self._condition.release()
+                    try:
+                        rows = _fetch(self.engine, self.last_id)
+                    finally:
+                        self._condition.acquire()
+                        self._polling = False
+                        self._polled_at = time.monotonic()
+                    self._append(rows)
+                    self._poked = self._poked or len(rows) == BUFFER_SIZE
+                    self._condition.notify_all()
+                    continue
+                wait = deadline - now
+                if not self._polling:
+                    wait = min(wait, self._polled_at + POLL_INTERVAL - now)
+                self._condition.wait(max(wait, 0.01))
+        # Older than the buffer (a long-disconnected screen): read it directly.
+        return _fetch(self.engine, after)
+
+
+def live_event_hub(engine) -> LiveEventHub:
+    key = database_key(engine)
+    with _hubs_lock:
+        hub = _hubs.get(key)
+        if hub is not None and hub.engine is engine:
+            _hubs.move_to_end(key)
+            return hub
+    hub = LiveEventHub(engine)
+    with _hubs_lock:
+        _hubs[key] = hub
+        _hubs.move_to_end(key)
+        while len(_hubs) > MAX_CACHED_TENANTS:
+            _hubs.popitem(last=False)
+    return hub
+
+
+def live_events_engine():
+    """Engine of the current tenant's ``live_event`` table."""
+    return db.session.get_bind(mapper=inspect(LiveEvent))
+
+
+def _listeners_stamp(key: str) -> str | None:
+    if not has_app_context():
+        return None
+    return stamp_path(current_app.config.get('CACHE_STAMP_DIR'), 'live_listeners', key)
+
+
+def open_stream_slot(limit: int) -> bool:
+    """Claim one of this worker's ``limit`` stream slots; ``False`` when all are taken."""
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= limit:
+            return False
+        _open_streams += 1
+        return True
+
+
+def close_stream_slot() -> None:
+    global _open_streams
+    with _streams_lock:
+        _open_streams = max(0, _open_streams - 1)
+
+
+def stream_live_events(engine, last_event_id: int | None = None, seconds: float = STREAM_SECONDS):
+    """Server-sent event lines for one screen, for at most ``seconds``.
+
+    Opens within the request (it touches the listener stamp and creates the
+    hub), then only uses ``engine``, so the response can be streamed after the
+    request context is gone.
+    """
+    stamp = _listeners_stamp(database_key(engine))
+    if stamp:
+        bump_stamp(stamp)
+    hub = live_event_hub(engine)
+    after = hub.last_id if last_event_id is None else min(last_event_id, hub.last_id)
+
+    def generate():
+        nonlocal after
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            for event_id, kind, payload in hub.events_after(after, remaining):
+                yield f'id: {event_id}\nevent: {kind}\ndata: {payload}\n\n'
+                after = event_id
+
+    return generate()
+
+
+# --- publishing --------------------------------------------------------------------
+
+def _changed(obj, fields) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+
+def _collect(session) -> tuple[list[tuple[str, dict]], bool]:
+    """Events of the objects in this flush, and whether menu stock may have changed."""
+    published = session.info.setdefault(_EVENTS_KEY, set())
+    events: list[tuple[str, dict]] = []
+    stock = False
+
+    def publish(kind, identity, payload):
+        if identity not in published:
+            published.add(identity)
+            events.append((kind, payload))
+
+    def order_event(order, action):
+        publish('order', ('order', order.id, action), {
+            'order_id': order.id, 'action': action, 'type': order.type, 'table_id': order.table_id,
+        })
+
+    for obj in session.new:
+        if isinstance(obj, Table):
+            publish('table', ('table', obj.id), {'table_id': obj.id})
+        elif isinstance(obj, Order):
+            order_event(obj, 'paid' if obj.status == PAID_STATUS else 'created')
+        stock = stock or isinstance(obj, STOCK_MODELS)
+    for obj in session.dirty:
+        if isinstance(obj, Table) and _changed(obj, TABLE_FIELDS):
+            publish('table', ('table', obj.id), {'table_id': obj.id})
+        elif isinstance(obj, Order) and _changed(obj, ORDER_FIELDS):
+            paid = obj.status == PAID_STATUS and inspect(obj).attrs.status.history.has_changes()
+            order_event(obj, 'paid' if paid else 'updated')
+        stock = stock or (isinstance(obj, STOCK_MODELS) and session.is_modified(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Table):
+            publish('table', ('table', obj.id), {'table_id': obj.id})
+        elif isinstance(obj, Order):
+            order_event(obj, 'deleted')
+        stock = stock or isinstance(obj, STOCK_MODELS)
+    return events, stock
+
+
+def _insert_events(connection, events) -> None:
+    table = LiveEvent.__table__
+    now = datetime.now(iran_tz)
+    ids = connection.execute(
+        insert(table).returning(table.c.id),
+        [{'kind': kind, 'payload': json.dumps(payload, ensure_ascii=False), 'created_at': now} for kind, payload in events],
+    ).scalars().all()
+    if any(event_id % PRUNE_EVERY == 0 for event_id in ids):
+        connection.execute(delete(table).where(table.c.id <= max(ids) - KEEP_EVENTS))
+
+
+def _write(session, events) -> None:
+    connection = session.connection(bind_arguments={'mapper': inspect(LiveEvent)})
+    _insert_events(connection, events)
+    session.info.setdefault(_NOTIFY_KEY, set()).add(database_key(connection.engine))
+
+
+def _poke(key: str) -> None:
+    with _hubs_lock:
+        hub = _hubs.get(key)
+    if hub is not None:
+        hub.poke()
+
+
+def _mark_stock(session, mapper) -> None:
+    session.info.setdefault(_STOCK_KEY, set()).add(database_key(session.get_bind(mapper=mapper)))
+
+
+def _after_flush(session, flush_context):
+    events, stock = _collect(session)
+    if events:
+        _write(session, events)
+    if stock:
+        _mark_stock(session, inspect(MenuItem))
+
+
+def _do_orm_execute(orm_execute_state):
+    if orm_execute_state.is_delete or orm_execute_state.is_update or orm_execute_state.is_insert:
+        mapper = orm_execute_state.bind_arguments.get('mapper')
+        if mapper is not None and issubclass(mapper.class_, STOCK_MODELS):
+            _mark_stock(orm_execute_state.session, mapper)
+
+
+def _has_listeners(key: str) -> bool:
+    stamp = _listeners_stamp(key)
+    if stamp is None:
+        return True
+    return time.time_ns() - read_stamp(stamp) < LISTENER_TTL_SECONDS * 1_000_000_000
+
+
+def _previous_stock(engine) -> dict[int, int] | None:
+    """Availability the screens were last sent, if it is still the current version."""
+    version = stock_version(engine)
+    if version is None:
+        return None
+    with _published_lock:
+        entry = _published_stock.get(database_key(engine))
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    return cached_menu_availability(engine)
+
+
+def _publish_stock(engine, previous: dict[int, int] | None) -> None:
+    """Write the stock delta of a commit that has just landed.
+
+    Runs after the commit, once services.menu_availability has bumped the
+    stock version, so the availability pass reads through its own session
+    without holding SQLite's write lock; only the one-row insert of the event
+    takes it, in a transaction of its own.
+    """
+    key = database_key(engine)
+    version = stock_version(engine)
+    with Session(bind=engine) as session:
+        current = compute_menu_availability(session)
+    if version is not None:
+        with _published_lock:
+            _published_stock[key] = (version, current)
+    items = {
+        item_id: quantity
+        for item_id, quantity in current.items()
+        if previous is None or previous.get(item_id) != quantity
+    }
+    if items:
+        with engine.begin() as connection:
+            _insert_events(connection, [('stock', {'items': items, 'full': previous is None})])
+        _poke(key)
+
+
+def _before_commit(session):
+    """Note which availability map this commit's stock delta is against.
+
+    Only reads this worker's memory and a stamp: the version cannot move
+    before the commit, since this transaction already holds the write lock.
+    """
+    if not has_app_context() or session is not db.session():
+        return
+    if session.new or session.dirty or session.deleted:
+        session.flush()
+    keys = session.info.pop(_STOCK_KEY, None)
+    if not keys:
+        return
+    engine = live_events_engine()
+    if database_key(engine) in keys and _has_listeners(database_key(engine)):
+        session.info[_PENDING_STOCK_KEY] = (engine, _previous_stock(engine))
+
+
+def _after_commit(session):
+    session.info.pop(_EVENTS_KEY, None)
+    session.info.pop(_STOCK_KEY, None)
+    for key in session.info.pop(_NOTIFY_KEY, ()):
+        _poke(key)
+    # services.menu_availability bumps the stock version in its own
+    # after_commit hook, registered earlier, so the delta is computed against
+    # the committed data and remembered under the new version.
+    pending = session.info.pop(_PENDING_STOCK_KEY, None)
+    if pending is not None:
+        try:
+            _publish_stock(*pending)
+        except SQLAlchemyError:
+            # The change itself is committed; screens catch up on the next stock event.
+            current_app.logger.exception('live stock event failed')
+
+
+def _after_rollback(session):
+    for key in (_EVENTS_KEY, _STOCK_KEY, _NOTIFY_KEY, _PENDING_STOCK_KEY):
+        session.info.pop(key, None)
+
+
+def register_live_events() -> None:
+    """Attach the publishing hooks once per process."""
+    if event.contains(Session, 'after_commit', _after_commit):
+        return
+    event.listen(Session, 'after_flush', _after_flush)
+    event.listen(Session, 'do_orm_execute', _do_orm_execute)
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_commit', _after_commit)
+    event.listen(Session, 'after_rollback', _after_rollback)
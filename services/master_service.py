@@ -4,8 +4,6 @@ import json
 import os
 from dataclasses import dataclass
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from werkzeug.security import generate_password_hash
 
 from models.master_models import (
@@ -17,6 +15,9 @@ from models.master_models import (
     MasterUser,
 )
 from models.models import InventoryConfiguration, Warehouse, db
+from services.schema_migrations import migrate_operational_schema
+from services.tenant_context import invalidate_tenant_context
+from services.tenant_engines import get_tenant_engine, tenant_sessionmaker
 from services.tenant_provisioning import normalize_slug, normalize_warehouse_plan, provision_tenant
 
 
@@ -121,6 +122,7 @@ def set_cafe_modules(cafe: CafeTenant, requested_codes: list[str] | tuple[str, .
             db.session.add(CafeModule(cafe_id=cafe.id, module_code=code, is_enabled=code in selected))
         else:
             row.is_enabled = code in selected
+    invalidate_tenant_context(cafe.slug)
     return selected
 
 
@@ -158,6 +160,7 @@ def set_cafe_warehouse_profile(
                 is_active=True,
             )
         )
+    invalidate_tenant_context(cafe.slug)
     return profile
 
 
@@ -185,33 +188,59 @@ def ensure_cafe_warehouse_profile(cafe: CafeTenant) -> dict:
     mode = 'none'
     plan: tuple[tuple[str, str], ...] = ()
     if inventory_enabled and os.path.exists(cafe.db_path):
-        engine = create_engine(f"sqlite:///{cafe.db_path}", future=True)
-        try:
-            db.metadata.create_all(bind=engine)
-            Session = sessionmaker(bind=engine, future=True)
-            with Session.begin() as tenant_session:
-                rows = tenant_session.query(Warehouse).order_by(Warehouse.id.asc()).all()
-                if not rows:
-                    rows = [Warehouse(code='central', name='انبار مرکزی', is_active=True)]
-                    tenant_session.add_all(rows)
-                    tenant_session.flush()
-                plan = tuple((row.code, row.name) for row in rows if row.is_active)
-                mode = 'central' if len(plan) == 1 else 'multi'
-                config = tenant_session.query(InventoryConfiguration).first()
-                if config is None:
-                    config = InventoryConfiguration()
-                    tenant_session.add(config)
-                config.is_enabled = True
-                config.warehouse_mode = mode
-                config.managed_by_master = True
-        finally:
-            engine.dispose()
+        migrate_operational_schema(get_tenant_engine(cafe.db_path))
+        Session = tenant_sessionmaker(cafe.db_path)
+        with Session.begin() as tenant_session:
+            rows = tenant_session.query(Warehouse).order_by(Warehouse.id.asc()).all()
+            if not rows:
+                rows = [Warehouse(code='central', name='انبار مرکزی', is_active=True)]
+                tenant_session.add_all(rows)
+                tenant_session.flush()
+            plan = tuple((row.code, row.name) for row in rows if row.is_active)
+            mode = 'central' if len(plan) == 1 else 'multi'
+            config = tenant_session.query(InventoryConfiguration).first()
+            if config is None:
+                config = InventoryConfiguration()
+                tenant_session.add(config)
+            config.is_enabled = True
+            config.warehouse_mode = mode
+            config.managed_by_master = True
 
     set_cafe_warehouse_profile(cafe, mode, plan)
     db.session.commit()
     return warehouse_profile_for_cafe(cafe.id)
 
 
+def fleet_master_data(cafes: list[CafeTenant]) -> tuple[dict[int, set[str]], dict[int, dict]]:
+    """Enabled modules and warehouse profiles of many cafes with a fixed number of master queries."""
+    cafe_ids = [cafe.id for cafe in cafes]
+    if not cafe_ids:
+        return {}, {}
+    profiled = {
+        cafe_id for (cafe_id,) in
+        db.session.query(CafeWarehouseProfile.cafe_id).filter(CafeWarehouseProfile.cafe_id.in_(cafe_ids))
+    }
+    for cafe in cafes:
+        if cafe.id not in profiled:
+            ensure_cafe_warehouse_profile(cafe)
+
+    modules: dict[int, set[str]] = {cafe_id: set() for cafe_id in cafe_ids}
+    for row in CafeModule.query.filter(CafeModule.cafe_id.in_(cafe_ids), CafeModule.is_enabled.is_(True)):
+        modules[row.cafe_id].add(row.module_code)
+
+    profiles = {cafe_id: {'mode': 'none', 'is_enabled': False, 'warehouses': []} for cafe_id in cafe_ids}
+    for profile in CafeWarehouseProfile.query.filter(CafeWarehouseProfile.cafe_id.in_(cafe_ids)):
+        profiles[profile.cafe_id].update(mode=profile.mode, is_enabled=bool(profile.is_enabled))
+    definitions = (
+        CafeWarehouseDefinition.query
+        .filter(CafeWarehouseDefinition.cafe_id.in_(cafe_ids), CafeWarehouseDefinition.is_active.is_(True))
+        .order_by(CafeWarehouseDefinition.cafe_id, CafeWarehouseDefinition.position.asc())
+    )
+    for row in definitions:
+        profiles[row.cafe_id]['warehouses'].append(row)
+    return modules, profiles
+
+
 def create_managed_cafe(
     *,
     tenants_dir: str,
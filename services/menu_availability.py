@@ -0,0 +1,135 @@
+"""Set-based sellable-quantity engine for the whole menu.
+
+The recipe graph (``MenuItemMaterial`` → ``RawMaterial`` or
+``PreProductionItem`` → ``PreProductionItemMaterial``) and the stock ledger are
+read with a fixed number of column-only queries, and every item's sellable
+quantity is derived in a single pass over those rows. The result is cached per
+tenant database and dropped after any commit that touches stock or recipes, in
+every worker, through a version stamp under ``CACHE_STAMP_DIR``.
+"""
+from __future__ import annotations
+
+import math
+from collections import defaultdict
+
+from models.models import (
+    MaterialPurchase,
+    MaterialStockBalance,
+    MenuItem,
+    MenuItemMaterial,
+    PreProductionItem,
+    PreProductionItemMaterial,
+    RawMaterial,
+    RawMaterialUsage,
+    WarehouseTransfer,
+    convert_unit,
+    db,
+)
+from services.stock_ledger import material_stock_levels
+from services.tenant_cache import StampedTenantCache, database_key  # noqa: F401 (database_key is imported from here)
+
+
+# Writes to any of these can change what the menu can sell.
+WATCHED_MODELS = (
+    MaterialPurchase,
+    MaterialStockBalance,
+    MenuItem,
+    MenuItemMaterial,
+    PreProductionItem,
+    PreProductionItemMaterial,
+    RawMaterial,
+    RawMaterialUsage,
+    WarehouseTransfer,
+)
+
+
+def compute_menu_availability(session=None) -> dict[int, int]:
+    """Sellable quantity of every menu item, from six column-only queries.
+
+    Reads through ``session`` when given (e.g. one opened after a commit),
+    otherwise through ``db.session``.
+    """
+    session = session if session is not None else db.session
+    legacy_stock = dict(session.query(MenuItem.id, MenuItem.stock))
+    material_units = dict(session.query(RawMaterial.id, RawMaterial.default_unit))
+    pre_units = dict(session.query(PreProductionItem.id, PreProductionItem.unit))
+
+    pre_components: dict[int, list[tuple[int, float, str]]] = defaultdict(list)
+    for pre_id, material_id, quantity, unit in session.query(
+        PreProductionItemMaterial.pre_production_item_id,
+        PreProductionItemMaterial.raw_material_id,
+        PreProductionItemMaterial.quantity,
+        PreProductionItemMaterial.unit,
+    ):
+        if material_id in material_units:
+            pre_components[pre_id].append((material_id, float(quantity or 0), unit))
+
+    requirements: dict[int, dict[int, float]] = defaultdict(lambda: defaultdict(float))
+    for item_id, material_id, pre_id, raw_quantity, unit in session.query(
+        MenuItemMaterial.menu_item_id,
+        MenuItemMaterial.raw_material_id,
+        MenuItemMaterial.pre_production_item_id,
+        MenuItemMaterial.quantity,
+        MenuItemMaterial.unit,
+    ):
+        try:
+            quantity = float(raw_quantity)
+        except (TypeError, ValueError):
+            continue
+        if quantity <= 0:
+            continue
+        needs = requirements[item_id]
+        if material_id is not None:
+            if material_id in material_units:
+                needs[material_id] += convert_unit(quantity, unit, material_units[material_id])
+        elif pre_id in pre_units:
+            multiplier = convert_unit(quantity, unit, pre_units[pre_id])
+            for component_id, component_quantity, component_unit in pre_components.get(pre_id, ()):
+                needs[component_id] += convert_unit(
+                    component_quantity * multiplier, component_unit, material_units[component_id]
+                )
+
+    stock_levels = material_stock_levels(session=session)
+    availability: dict[int, int] = {}
+    for item_id, stock in legacy_stock.items():
+        capacities = [
+            math.floor(stock_levels.get(material_id, 0.0) / required)
+            for material_id, required in requirements.get(item_id, {}).items()
+            if required > 0
+        ]
+        availability[item_id] = max(0, min(capacities)) if capacities else max(0, int(stock or 0))
+    return availability
+
+
+_availability: StampedTenantCache[dict[int, int]] = StampedTenantCache(
+    'menu_availability', compute_menu_availability, WATCHED_MODELS,
+)
+
+
+def menu_availability() -> dict[int, int]:
+    """Cached :func:`compute_menu_availability` for the current tenant."""
+    return _availability.get()
+
+
+def stock_version(engine=None) -> int | None:
+    """Version stamp that changes with every commit touching stock or recipes.
+
+    Other per-tenant inventory caches can key on it; ``None`` means stamps are
+    not configured and nothing should be cached.
+    """
+    return _availability.version(engine)
+
+
+def cached_menu_availability(engine=None) -> dict[int, int] | None:
+    """The cached availability if it is still current, without computing it."""
+    return _availability.peek(engine)
+
+
+def invalidate_menu_availability(engine=None) -> None:
+    """Drop the cached availability of one database (default: current tenant)."""
+    _availability.invalidate(engine)
+
+
+def register_menu_availability_events() -> None:
+    """Attach the invalidation hooks once per process."""
+    _availability.register()
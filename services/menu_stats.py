@@ -0,0 +1,477 @@
+"""Menu analytics snapshot: popularity counters and recipe costs per item.
+
+``MenuItemStats`` keeps one row per menu item:
+
+* ``orders_count`` / ``quantity_sold`` count the paid orders containing the
+  item and the quantity sold in them (removed order items excluded). Every
+  flush touching orders or order items, and ``Query.update()`` /
+  ``Query.delete()`` on them, subtracts the affected orders' previous
+  contribution and adds their new one on the same connection, so the counters
+  commit or roll back together with the payment.
+* ``cost_price`` / ``cost_breakdown`` hold the recipe cost shown on the price
+  management page. Writes to purchases, recipes, pre-production recipes or the
+  units they are expressed in bump ``cost_version`` of the affected items;
+  :func:`menu_item_costs` recomputes stale items in one batch on the next read
+  and stores the result unless the item was marked again in the meantime.
+
+The menu page and price management read this table instead of grouping every
+paid order item or walking each recipe on every view.
+"""
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import bindparam, delete, event, func, inspect, insert, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models.models import (
+    MaterialPurchase,
+    MenuItemMaterial,
+    MenuItemStats,
+    Order,
+    OrderItem,
+    PreProductionItem,
+    PreProductionItemMaterial,
+    RawMaterial,
+    convert_unit,
+    db,
+    iran_tz,
+)
+from services.inventory_service import weighted_average_unit_prices
+from services.sales_rollup import PAID_STATUS
+
+
+ORDER_ID_CHUNK = 500
+
+_PENDING_KEY = 'menu_stats_pending'
+_ORDER_FIELDS = ('status',)
+_ITEM_FIELDS = ('order_id', 'menu_item_id', 'quantity', 'is_deleted')
+# Writes to these models change recipe costs; the columns that matter on update.
+_COST_FIELDS = {
+    MaterialPurchase: ('raw_material_id', 'quantity', 'unit', 'unit_factor', 'total_price', 'purchase_date', 'created_at'),
+    MenuItemMaterial: ('menu_item_id', 'raw_material_id', 'pre_production_item_id', 'name', 'quantity', 'unit'),
+    PreProductionItemMaterial: ('pre_production_item_id', 'raw_material_id', 'quantity', 'unit'),
+    RawMaterial: ('default_unit',),
+    PreProductionItem: ('unit',),
+}
+
+stats_table = MenuItemStats.__table__
+order_table = Order.__table__
+item_table = OrderItem.__table__
+
+
+class RecipeCost(NamedTuple):
+    cost_price: float
+    materials: list[dict]  # name, quantity, unit, avg_unit_price, total_cost, source_type
+
+
+class StatsDrift(NamedTuple):
+    menu_item_id: int
+    expected: tuple[int, int]
+    actual: tuple[int, int]
+
+
+def _bind() -> dict:
+    return {'mapper': inspect(MenuItemStats)}
+
+
+# --- popularity ------------------------------------------------------------------
+
+def compute_popularity(connection, order_ids=None) -> dict[int, list[int]]:
+    """``{menu_item_id: [paid orders, quantity sold]}`` over all orders or ``order_ids``."""
+    o, i = order_table.c, item_table.c
+    stmt = (
+        select(i.menu_item_id, func.count(func.distinct(i.order_id)), func.coalesce(func.sum(i.quantity), 0))
+        .join_from(item_table, order_table, o.id == i.order_id)
+        .where(o.status == PAID_STATUS, or_(i.is_deleted == False, i.is_deleted.is_(None)))  # noqa: E712
+        .group_by(i.menu_item_id)
+    )
+    if order_ids is None:
+        return {item_id: [int(count), int(quantity)] for item_id, count, quantity in connection.execute(stmt)}
+    ids = sorted(order_ids)
+    totals: dict[int, list[int]] = {}
+    for start in range(0, len(ids), ORDER_ID_CHUNK):
+        chunk = stmt.where(i.order_id.in_(ids[start:start + ORDER_ID_CHUNK]))
+        for item_id, count, quantity in connection.execute(chunk):
+            total = totals.setdefault(item_id, [0, 0])
+            total[0] += int(count)
+            total[1] += int(quantity)
+    return totals
+
+
+def _apply(connection, before: dict[int, list[int]], after: dict[int, list[int]]) -> None:
+    """Add ``after - before`` to the counters (upsert per menu item)."""
+    rows = []
+    for item_id in set(before) | set(after):
+        old, new = before.get(item_id, (0, 0)), after.get(item_id, (0, 0))
+        if new[0] != old[0] or new[1] != old[1]:
+            rows.append({'menu_item_id': item_id, 'orders_count': new[0] - old[0], 'quantity_sold': new[1] - old[1]})
+    if not rows:
+        return
+    stmt = sqlite_insert(stats_table)
+    c = stats_table.c
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[c.menu_item_id],
+        set_={
+            'orders_count': c.orders_count + stmt.excluded.orders_count,
+            'quantity_sold': c.quantity_sold + stmt.excluded.quantity_sold,
+            'updated_at': datetime.now(iran_tz),
+        },
+    ), rows)
+
+
+def rebuild_menu_item_stats(connection) -> int:
+    """Recompute every popularity counter and mark every recipe cost stale."""
+    popularity = compute_popularity(connection)
+    connection.execute(delete(stats_table))
+    if popularity:
+        connection.execute(insert(stats_table), [
+            {'menu_item_id': item_id, 'orders_count': count, 'quantity_sold': quantity}
+            for item_id, (count, quantity) in popularity.items()
+        ])
+    return len(popularity)
+
+
+def verify_menu_item_stats(connection) -> list[StatsDrift]:
+    expected = compute_popularity(connection)
+    c = stats_table.c
+    actual = {
+        row.menu_item_id: (row.orders_count, row.quantity_sold)
+        for row in connection.execute(select(c.menu_item_id, c.orders_count, c.quantity_sold))
+        if row.orders_count or row.quantity_sold
+    }
+    drift = []
+    for item_id in sorted(set(expected) | set(actual)):
+        want, have = tuple(expected.get(item_id, (0, 0))), tuple(actual.get(item_id, (0, 0)))
+        if want != have:
+            drift.append(StatsDrift(item_id, want, have))
+    return drift
+
+
+def ensure_menu_item_stats(engine) -> bool:
+    """Create and backfill the snapshot on databases that predate it."""
+    tables = set(inspect(engine).get_table_names())
+    if stats_table.name in tables:
+        return False
+    stats_table.create(bind=engine, checkfirst=True)
+    if {order_table.name, item_table.name} <= tables:
+        with engine.begin() as connection:
+            rebuild_menu_item_stats(connection)
+    return True
+
+
+def menu_popularity() -> dict[int, dict[str, int]]:
+    """``{menu_item_id: {'orders_count', 'quantity_sold'}}`` of items sold at least once."""
+    S = MenuItemStats
+    rows = db.session.query(S.menu_item_id, S.orders_count, S.quantity_sold).filter(
+        or_(S.orders_count > 0, S.quantity_sold > 0)
+    )
+    return {
+        item_id: {'orders_count': int(count), 'quantity_sold': int(quantity)}
+        for item_id, count, quantity in rows
+    }
+
+
+# --- recipe costs ----------------------------------------------------------------
+
+def _latest_unit_prices(material_ids) -> dict[int, float]:
+    """Base-unit price of each material's latest purchase (0 when its quantity is 0)."""
+    if not material_ids:
+        return {}
+    P = MaterialPurchase
+    base_quantity = P.quantity * P.unit_factor
+    ranked = (
+        select(
+            P.raw_material_id.label('material_id'),
+            P.total_price.label('total_price'),
+            base_quantity.label('base_quantity'),
+            func.row_number().over(
+                partition_by=P.raw_material_id,
+                order_by=(P.purchase_date.desc(), P.created_at.desc(), P.id.desc()),
+            ).label('position'),
+        )
+        .where(P.raw_material_id.in_(list(material_ids)))
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(ranked.c.material_id, ranked.c.total_price, ranked.c.base_quantity).where(ranked.c.position == 1),
+        bind_arguments={'mapper': inspect(MaterialPurchase)},
+    )
+    return {
+        material_id: (float(total_price or 0) / base) if base and base > 0 else 0
+        for material_id, total_price, base in rows
+    }
+
+
+def compute_recipe_costs(item_ids) -> dict[int, RecipeCost]:
+    """Recipe cost of each menu item from a fixed number of batched queries."""
+    ids = list(item_ids)
+    if not ids:
+        return {}
+    M = MenuItemMaterial
+    lines = db.session.query(
+        M.menu_item_id, M.name, M.quantity, M.unit, M.raw_material_id, M.pre_production_item_id,
+    ).filter(M.menu_item_id.in_(ids)).order_by(M.id).all()
+
+    pre_ids = {line.pre_production_item_id for line in lines if line.pre_production_item_id}
+    pre_units = dict(
+        db.session.query(PreProductionItem.id, PreProductionItem.unit).filter(PreProductionItem.id.in_(pre_ids))
+    ) if pre_ids else {}
+    components = db.session.query(
+        PreProductionItemMaterial.pre_production_item_id, PreProductionItemMaterial.raw_material_id,
+        PreProductionItemMaterial.quantity, PreProductionItemMaterial.unit,
+    ).filter(PreProductionItemMaterial.pre_production_item_id.in_(pre_ids)).order_by(PreProductionItemMaterial.id).all() if pre_ids else []
+
+    direct_ids = {line.raw_material_id for line in lines if line.raw_material_id}
+    component_ids = {component.raw_material_id for component in components}
+    material_units = dict(
+        db.session.query(RawMaterial.id, RawMaterial.default_unit).filter(RawMaterial.id.in_(direct_ids | component_ids))
+    ) if direct_ids or component_ids else {}
+    latest_prices = _latest_unit_prices(direct_ids & set(material_units))
+    average_prices = weighted_average_unit_prices(component_ids & set(material_units)) if component_ids else {}
+
+    # Cost of one unit of each pre-production item from its components' average price.
+    pre_prices: dict[int, float | None] = {}
+    pre_totals: dict[int, float] = {}
+    for pre_id, material_id, quantity, unit in components:
+        unit_price = average_prices.get(material_id)
+        if material_id not in material_units or unit_price is None:
+            continue
+        try:
+            quantity = float(quantity)
+        except (TypeError, ValueError):
+            continue
+        pre_totals[pre_id] = pre_totals.get(pre_id, 0.0) + convert_unit(quantity, unit, material_units[material_id]) * unit_price
+    for pre_id in pre_units:
+        total = pre_totals.get(pre_id, 0.0)
+        pre_prices[pre_id] = int(total) if total > 0 else None
+
+    costs = {item_id: RecipeCost(0, []) for item_id in ids}
+    for line in lines:
+        try:
+            quantity = float(line.quantity)
+        except (TypeError, ValueError):
+            quantity = None
+        unit_price, cost = None, None
+        if line.raw_material_id in material_units:
+            unit_price = latest_prices.get(line.raw_material_id)
+            if quantity is not None and unit_price is not None:
+                cost = convert_unit(quantity, line.unit, material_units[line.raw_material_id]) * unit_price
+        elif line.pre_production_item_id in pre_units:
+            unit_price = pre_prices[line.pre_production_item_id]
+            if quantity is not None and unit_price is not None:
+                cost = convert_unit(quantity, line.unit, pre_units[line.pre_production_item_id]) * unit_price
+        item = costs[line.menu_item_id]
+        item.materials.append({
+            'name': line.name,
+            'quantity': quantity if quantity is not None else 0,
+            'unit': line.unit,
+            'avg_unit_price': unit_price or 0,
+            'total_cost': cost or 0,
+            'source_type': 'پیش‌تولید' if line.pre_production_item_id else 'ماده اولیه',
+        })
+        costs[line.menu_item_id] = item._replace(cost_price=item.cost_price + (cost or 0))
+    return costs
+
+
+def _store_costs(costs: dict[int, RecipeCost], versions: dict[int, int]) -> None:
+    c = stats_table.c
+    now = datetime.now(iran_tz)
+    known = [
+        {'item_id': item_id, 'seen_version': versions[item_id], 'price': cost.cost_price,
+         'breakdown': json.dumps(cost.materials, ensure_ascii=False)}
+        for item_id, cost in costs.items() if item_id in versions
+    ]
+    if known:
+        db.session.execute(
+            update(stats_table)
+            .where(c.menu_item_id == bindparam('item_id'), c.cost_version == bindparam('seen_version'))
+            .values(cost_price=bindparam('price'), cost_breakdown=bindparam('breakdown'), cost_stale=False, updated_at=now),
+            known,
+            bind_arguments=_bind(),
+        )
+    missing = [
+        {'menu_item_id': item_id, 'cost_price': cost.cost_price,
+         'cost_breakdown': json.dumps(cost.materials, ensure_ascii=False), 'cost_stale': False}
+        for item_id, cost in costs.items() if item_id not in versions
+    ]
+    if missing:
+        db.session.execute(sqlite_insert(stats_table).on_conflict_do_nothing(), missing, bind_arguments=_bind())
+
+
+def menu_item_costs(item_ids) -> dict[int, RecipeCost]:
+    """Snapshot recipe cost of each item; stale or missing ones are recomputed and stored."""
+    ids = list(item_ids)
+    if not ids:
+        return {}
+    c = stats_table.c
+    rows = {
+        row.menu_item_id: row
+        for row in db.session.execute(
+            select(c.menu_item_id, c.cost_price, c.cost_breakdown, c.cost_stale, c.cost_version)
+            .where(c.menu_item_id.in_(ids)),
+            bind_arguments=_bind(),
+        )
+    }
+    costs = {
+        item_id: RecipeCost(row.cost_price or 0, json.loads(row.cost_breakdown or '[]'))
+        for item_id, row in rows.items() if not row.cost_stale
+    }
+    stale = [item_id for item_id in ids if item_id not in costs]
+    if stale:
+        fresh = compute_recipe_costs(stale)
+        _store_costs(fresh, {item_id: rows[item_id].cost_version for item_id in stale if item_id in rows})
+        db.session.commit()
+        costs.update(fresh)
+    return costs
+
+
+def _mark_costs_stale(connection, materials=(), pre_items=(), menu_items=(), everything: bool = False) -> None:
+    c = stats_table.c
+    stmt = update(stats_table).values(cost_stale=True, cost_version=c.cost_version + 1)
+    if not everything:
+        m, p = MenuItemMaterial.__table__.c, PreProductionItemMaterial.__table__.c
+        uses = []
+        if materials:
+            uses.append(m.raw_material_id.in_(list(materials)))
+            uses.append(m.pre_production_item_id.in_(
+                select(p.pre_production_item_id).where(p.raw_material_id.in_(list(materials)))
+            ))
+        if pre_items:
+            uses.append(m.pre_production_item_id.in_(list(pre_items)))
+        conditions = [c.menu_item_id.in_(list(menu_items))] if menu_items else []
+        if uses:
+            conditions.append(c.menu_item_id.in_(select(m.menu_item_id).where(or_(*uses))))
+        if not conditions:
+            return
+        stmt = stmt.where(or_(*conditions))
+    connection.execute(stmt)
+
+
+# --- ORM hooks -------------------------------------------------------------------
+
+def _changed(obj, fields) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in fields)
+
+
+def _values(obj, name) -> set:
+    """Current and previous values of one column, without loading anything."""
+    state = inspect(obj)
+    values = set(state.attrs[name].history.deleted)
+    values.add(state.dict.get(name))
+    values.discard(None)
+    return values
+
+
+def _popularity_objects(session) -> list:
+    touched = []
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Order):
+            fields = _ORDER_FIELDS
+        elif isinstance(obj, OrderItem):
+            fields = _ITEM_FIELDS
+        else:
+            continue
+        if obj in session.dirty and not _changed(obj, fields):
+            continue
+        touched.append(obj)
+    return touched
+
+
+def _order_ids(objects) -> set[int]:
+    ids = set()
+    for obj in objects:
+        if isinstance(obj, Order):
+            ids |= _values(obj, 'id')
+        else:
+            ids |= _values(obj, 'order_id')
+            order = inspect(obj).dict.get('order')
+            if order is not None:
+                ids |= _values(order, 'id')
+    return ids
+
+
+def _before_flush(session, flush_context, instances):
+    objects = _popularity_objects(session)
+    if not objects:
+        return
+    connection = session.connection(bind_arguments=_bind())
+    order_ids = _order_ids(objects)
+    before = compute_popularity(connection, order_ids) if order_ids else {}
+    session.info[_PENDING_KEY] = (objects, order_ids, before)
+
+
+def _after_flush(session, flush_context):
+    pending = session.info.pop(_PENDING_KEY, None)
+    connection = None
+    if pending:
+        objects, order_ids, before = pending
+        order_ids = order_ids | _order_ids(objects)
+        connection = session.connection(bind_arguments=_bind())
+        _apply(connection, before, compute_popularity(connection, order_ids))
+
+    materials, pre_items, menu_items = set(), set(), set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        fields = _COST_FIELDS.get(type(obj))
+        if not fields or (obj in session.dirty and not _changed(obj, fields)):
+            continue
+        if isinstance(obj, RawMaterial):
+            materials |= _values(obj, 'id')
+        elif isinstance(obj, PreProductionItem):
+            pre_items |= _values(obj, 'id')
+        else:
+            for name, target in (('raw_material_id', materials), ('pre_production_item_id', pre_items), ('menu_item_id', menu_items)):
+                if name in fields:
+                    target |= _values(obj, name)
+    if materials or pre_items or menu_items:
+        _mark_costs_stale(connection or session.connection(bind_arguments=_bind()), materials, pre_items, menu_items)
+
+
+def _do_orm_execute(orm_execute_state):
+    """Keep the snapshot in step with ``Query.update()`` / ``Query.delete()`` and bulk inserts."""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return None
+    mapper = orm_execute_state.bind_arguments.get('mapper')
+    model = mapper.class_ if mapper is not None else None
+    if model not in (Order, OrderItem) and model not in _COST_FIELDS:
+        return None
+    if orm_execute_state.is_insert and model is Order:
+        return None  # a new order has no items yet
+    session = orm_execute_state.session
+    if session.autoflush:
+        session.flush()
+    connection = session.connection(bind_arguments=orm_execute_state.bind_arguments)
+    if model in _COST_FIELDS:
+        # Bulk edits of purchases and recipes are rare admin operations.
+        result = orm_execute_state.invoke_statement()
+        _mark_costs_stale(connection, everything=True)
+        return result
+    if orm_execute_state.is_insert:
+        rows = orm_execute_state.parameters
+        rows = [rows] if isinstance(rows, dict) else rows or []
+        order_ids = {row.get('order_id') for row in rows} - {None}
+    else:
+        column = order_table.c.id if model is Order else item_table.c.order_id
+        affected = select(column).distinct()
+        if orm_execute_state.statement.whereclause is not None:
+            affected = affected.where(orm_execute_state.statement.whereclause)
+        order_ids = {order_id for (order_id,) in connection.execute(affected) if order_id is not None}
+    if not order_ids:
+        return None
+    before = compute_popularity(connection, order_ids)
+    result = orm_execute_state.invoke_statement()
+    _apply(connection, before, compute_popularity(connection, order_ids))
+    return result
+
+
+def register_menu_stats_events() -> None:
+    """Attach the snapshot hooks once per process."""
+    if event.contains(Session, 'after_flush', _after_flush):
+        return
+    event.listen(Session, 'before_flush', _before_flush)
+    event.listen(Session, 'after_flush', _after_flush)
+    event.listen(Session, 'do_orm_execute', _do_orm_execute)
@@ -0,0 +1,179 @@
+"""Keyset-paginated order browsing for the order list, admin report and search.
+
+Orders are listed newest first on ``(created_at, id)``. A page is fetched with
+``WHERE (created_at, id) < cursor ORDER BY created_at DESC, id DESC LIMIT n``,
+which walks the ``created_at`` index from the cursor, so every page costs the
+same however deep it is. Cursors are opaque URL-safe strings; a malformed
+cursor starts from the first page. Orders without ``created_at`` sort last.
+Text search goes through the FTS5 index of ``services.search_index``.
+
+Totals come from the daily sales rollup when the filters can be answered from
+it (status and date range only) and otherwise from a count capped at
+``COUNT_CAP`` rows, so the page never scans the whole history.
+"""
+from __future__ import annotations
+
+import base64
+import json
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import joinedload
+
+from models.models import DailySalesRollup, Order, OrderItem, db
+from services.search_index import customer_ids_matching, order_ids_matching
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+COUNT_CAP = 1000
+
+
+class OrderFilter(NamedTuple):
+    q: str | None = None
+    status: str | None = None
+    customer_id: int | None = None
+    start_date: date | None = None  # local dates, inclusive
+    end_date: date | None = None
+
+    def conditions(self) -> list:
+        conditions = []
+        if self.status:
+            conditions.append(Order.status == self.status)
+        if self.customer_id:
+            conditions.append(Order.customer_id == self.customer_id)
+        if self.start_date:
+            conditions.append(Order.created_at >= datetime.combine(self.start_date, datetime.min.time()))
+        if self.end_date:
+            conditions.append(Order.created_at < datetime.combine(self.end_date + timedelta(days=1), datetime.min.time()))
+        if self.q:
+            matches = [
+                Order.invoice_uid == self.q,
+                Order.id.in_(order_ids_matching(self.q)),
+                Order.customer_id.in_(customer_ids_matching(self.q)),
+            ]
+            try:
+                number = int(self.q)
+            except (TypeError, ValueError):
+                number = None
+            if number is not None:
+                matches += [Order.invoice_number == number, Order.daily_sequence == number]
+            conditions.append(or_(*matches))
+        return conditions
+
+
+class OrderPage(NamedTuple):
+    orders: list
+    next_cursor: str | None
+    total: int
+    total_is_exact: bool
+    deleted_items: dict[int, int]  # order_id -> number of removed items
+
+
+def page_size(value, default: int = DEFAULT_PAGE_SIZE) -> int:
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(MAX_PAGE_SIZE, value))
+
+
+def parse_date(value: str | None) -> date | None:
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+# --- cursors ---------------------------------------------------------------------
+
+def encode_cursor(order: Order) -> str:
+    created_at = order.created_at.replace(tzinfo=None).isoformat() if order.created_at else None
+    raw = json.dumps([created_at, order.id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str | None) -> tuple[datetime | None, int] | None:
+    if not token:
+        return None
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return (datetime.fromisoformat(created_at) if created_at else None), int(order_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def _after(cursor: tuple[datetime | None, int]):
+    created_at, order_id = cursor
+    if created_at is None:
+        return and_(Order.created_at.is_(None), Order.id < order_id)
+    return or_(
+        Order.created_at < created_at,
+        and_(Order.created_at == created_at, Order.id < order_id),
+        Order.created_at.is_(None),
+    )
+
+
+# --- pages -----------------------------------------------------------------------
+
+def order_count(order_filter: OrderFilter, cap: int = COUNT_CAP) -> tuple[int, bool]:
+    """``(count, exact)``: rollup-based when possible, otherwise capped at ``cap``."""
+    if not order_filter.q and not order_filter.customer_id:
+        R = DailySalesRollup
+        query = db.session.query(func.coalesce(func.sum(R.orders_count), 0))
+        if order_filter.status:
+            query = query.filter(R.status == order_filter.status)
+        if order_filter.start_date:
+            query = query.filter(R.sales_date >= order_filter.start_date)
+        if order_filter.end_date:
+            query = query.filter(R.sales_date <= order_filter.end_date)
+        return int(query.scalar() or 0), True
+    capped = select(Order.id).where(*order_filter.conditions()).limit(cap + 1).subquery()
+    count = db.session.execute(select(func.count()).select_from(capped)).scalar() or 0
+    return min(count, cap), count <= cap
+
+
+def deleted_item_counts(order_ids) -> dict[int, int]:
+    if not order_ids:
+        return {}
+    return dict(
+        db.session.query(OrderItem.order_id, func.count())
+        .filter(OrderItem.order_id.in_(list(order_ids)), OrderItem.is_deleted == True)  # noqa: E712
+        .group_by(OrderItem.order_id)
+    )
+
+
+def orders_page(order_filter: OrderFilter, cursor: str | None = None, limit: int = DEFAULT_PAGE_SIZE,
+                with_count: bool = True) -> OrderPage:
+    """One page of orders (newest first) after ``cursor``, customers preloaded."""
+    query = (
+        Order.query
+        .options(joinedload(Order.customer))
+        .filter(*order_filter.conditions())
+        .order_by(Order.created_at.desc(), Order.id.desc())
+    )
+    position = decode_cursor(cursor)
+    if position is not None:
+        query = query.filter(_after(position))
+    rows = query.limit(limit + 1).all()
+    orders = rows[:limit]
+    next_cursor = encode_cursor(orders[-1]) if len(rows) > limit else None
+    total, exact = order_count(order_filter) if with_count else (0, False)
+    return OrderPage(orders, next_cursor, total, exact, deleted_item_counts([order.id for order in orders]))
+
+
+def order_summary(order: Order) -> dict:
+    """JSON row of an order in list and search responses."""
+    return {
+        'id': order.id,
+        'invoice_uid': order.invoice_uid,
+        'invoice_number': order.invoice_number,
+        'daily_invoice_number': order.daily_sequence,
+        'customer': order.customer.name if order.customer else None,
+        'phone': order.customer.phone if order.customer else None,
+        'status': order.status,
+        'type': order.type,
+        'final_amount': order.final_amount,
+        'created_at': order.created_at.strftime('%Y-%m-%d %H:%M') if order.created_at else None,
+    }
@@ -0,0 +1,153 @@
+"""Set-based order creation.
+
+An order is written with a fixed number of statements however many lines it
+has: the menu items are validated with one ``IN`` query, the order row is
+inserted (so the sales rollup and fleet hooks see it), its items and their
+material usage go in as two executemany inserts (usage from the compiled
+recipes of ``services.compiled_recipes``), and legacy menu stock is lowered by
+one ``UPDATE``. Nothing is committed here; the route commits the order with
+whatever else it changes, in one transaction.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import case, func, insert, select, update
+
+from models.models import (
+    InvoiceIdentifiers,
+    MenuItem,
+    Order,
+    OrderItem,
+    RawMaterialUsage,
+    calculate_order_amount,
+    db,
+    generate_invoice_number,
+    iran_tz,
+)
+from services.compiled_recipes import compiled_recipes, usage_rows
+
+
+class OrderLine(NamedTuple):
+    menu_item_id: int
+    quantity: int
+    unit_price: int | None = None  # None: the menu price
+
+
+class InvalidOrderLines(ValueError):
+    """Lines naming unknown (or inactive) menu items or non-positive quantities."""
+
+    def __init__(self, lines) -> None:
+        self.lines = list(lines)
+        super().__init__(f'invalid order lines: {[line.menu_item_id for line in self.lines]}')
+
+
+class PlacedOrder(NamedTuple):
+    order: Order
+    identifiers: InvoiceIdentifiers
+    order_item_ids: list[int]
+    stocks: dict[int, int | None]  # menu_item_id -> legacy stock after the order
+    rejected: list[OrderLine]
+
+
+def price_lines(lines, active_only: bool = False) -> tuple[list[dict], list[OrderLine]]:
+    """``OrderItem`` values of the valid ``lines`` and the rejected lines, from one query."""
+    lines = [OrderLine(*line) for line in lines]
+    ids = {line.menu_item_id for line in lines}
+    query = select(MenuItem.id, MenuItem.price).where(MenuItem.id.in_(ids))
+    if active_only:
+        query = query.where(MenuItem.is_active == True)  # noqa: E712
+    prices = dict(db.session.execute(query).all()) if ids else {}
+
+    priced, rejected = [], []
+    for line in lines:
+        if line.menu_item_id not in prices or not line.quantity or line.quantity <= 0:
+            rejected.append(line)
+            continue
+        unit_price = int(line.unit_price if line.unit_price is not None else prices[line.menu_item_id])
+        priced.append({
+            'menu_item_id': line.menu_item_id,
+            'quantity': line.quantity,
+            'unit_price': unit_price,
+            'total_price': unit_price * line.quantity,
+        })
+    return priced, rejected
+
+
+def decrement_menu_stock(quantities) -> dict[int, int | None]:
+    """Lower the legacy ``MenuItem.stock`` (floored at 0) with one ``UPDATE``.
+
+    ``quantities`` maps menu item id to sold quantity. Returns the stock of
+    every given item afterwards; items without a stock figure map to ``None``.
+    """
+    quantities = {item_id: quantity for item_id, quantity in quantities.items() if quantity}
+    if not quantities:
+        return {}
+    result = db.session.execute(
+        update(MenuItem)
+        .where(MenuItem.id.in_(quantities), MenuItem.stock.isnot(None))
+        .values(stock=func.max(0, MenuItem.stock - case(quantities, value=MenuItem.id, else_=0)))
+        .returning(MenuItem.id, MenuItem.stock)
+        .execution_options(synchronize_session='fetch')
+    )
+    stocks = dict.fromkeys(quantities)
+    stocks.update({item_id: stock for item_id, stock in result})
+    return stocks
+
+
+def place_order(lines, *, customer_id: int, user_id: int | None = None, discount: int = 0,
+                tax_percent: float = 9.0, status: str = 'پرداخت نشده', order_type: str = 'حضوری',
+                table_id: int | None = None, created_at: datetime | None = None,
+                active_only: bool = False, skip_invalid: bool = False) -> PlacedOrder:
+    """Write an order with its items, material usage and stock change.
+
+    Invalid lines raise :class:`InvalidOrderLines`, unless ``skip_invalid``
+    drops them (reported in ``rejected``); an order left without a valid line
+    always raises. Invoice numbers are allocated only once the lines are valid.
+    """
+    items, rejected = price_lines(lines, active_only)
+    if (rejected and not skip_invalid) or not items:
+        raise InvalidOrderLines(rejected)
+
+    identifiers = generate_invoice_number()
+    total, tax, final = calculate_order_amount(items, discount, tax_percent)
+    order = Order(
+        invoice_number=identifiers.unique_number,
+        daily_sequence=identifiers.daily_sequence,
+        invoice_uid=identifiers.invoice_uid,
+        customer_id=customer_id,
+        total_amount=total,
+        discount=discount,
+        tax_amount=tax,
+        final_amount=final,
+        status=status,
+        type=order_type,
+        user_id=user_id,
+        table_id=table_id,
+        created_at=created_at or datetime.now(iran_tz),
+    )
+    db.session.add(order)
+    db.session.flush()
+
+    db.session.execute(insert(OrderItem), [{**item, 'order_id': order.id} for item in items])
+    # The order is new, so its items are exactly the rows just inserted, in order.
+    item_ids = db.session.execute(
+        select(OrderItem.id).where(OrderItem.order_id == order.id).order_by(OrderItem.id)
+    ).scalars().all()
+
+    recipes = compiled_recipes({item['menu_item_id'] for item in items})
+    usages = []
+    for item_id, item in zip(item_ids, items):
+        recipe = recipes.get(item['menu_item_id'], ())
+        usages.extend(usage_rows(recipe, order.id, item_id, item['menu_item_id'], item['quantity']))
+    if usages:
+        db.session.execute(insert(RawMaterialUsage), usages)
+
+    sold = defaultdict(int)
+    for item in items:
+        sold[item['menu_item_id']] += item['quantity']
+    stocks = decrement_menu_stock(sold)
+    db.session.expire(order, ['order_items'])
+    return PlacedOrder(order, identifiers, list(item_ids), stocks, rejected)
@@ -0,0 +1,316 @@
+"""Incrementally maintained daily sales rollup.
+
+``DailySalesRollup`` keeps one row per local sales day, order status, payment
+bucket and order type with the order count and the final/tax/discount sums.
+Order inserts, edits and deletes (ORM flushes as well as ``Query.update()`` /
+``Query.delete()``) adjust the affected rows on the same connection, so the
+rollup commits or rolls back together with the order itself. Reports read a
+date range of rollup rows instead of scanning ``order``.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+
+import jdatetime
+from sqlalchemy import delete, event, func, inspect, insert, select, update
+from sqlalchemy.orm import Session
+
+from models.models import DailySalesRollup, Order, db, iran_tz
+from utils.helpers import categorize_payment_method
+
+
+PAID_STATUS = 'پرداخت شده'
+UNPAID_STATUS = 'پرداخت نشده'
+
+_ORDER_FIELDS = (
+    'created_at', 'status', 'payment_bucket', 'payment_method', 'type',
+    'final_amount', 'tax_amount', 'discount',
+)
+
+rollup_table = DailySalesRollup.__table__
+order_table = Order.__table__
+
+
+class RollupDrift(NamedTuple):
+    key: tuple
+    expected: tuple[int, int, int, int]
+    actual: tuple[int, int, int, int]
+
+
+def jalali_date_string(value: date) -> str:
+    return jdatetime.date.fromgregorian(date=value).strftime('%Y-%m-%d')
+
+
+def _sales_date(created_at) -> date | None:
+    if created_at is None:
+        return None
+    if isinstance(created_at, str):
+        return date.fromisoformat(created_at[:10])
+    if isinstance(created_at, datetime):
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(iran_tz)
+        return created_at.date()
+    return created_at
+
+
+def _rollup_key(row) -> tuple | None:
+    sales_date = _sales_date(row.created_at)
+    if sales_date is None:
+        return None
+    bucket = row.payment_bucket or categorize_payment_method(row.payment_method)
+    return (sales_date, row.status or '', bucket, row.type or '')
+
+
+def _measures(row) -> list[int]:
+    return [1, int(row.final_amount or 0), int(row.tax_amount or 0), int(row.discount or 0)]
+
+
+def _accumulate(rows, sign: int = 1) -> dict[tuple, list[int]]:
+    totals: dict[tuple, list[int]] = defaultdict(lambda: [0, 0, 0, 0])
+    for row in rows:
+        key = _rollup_key(row)
+        if key is None:
+            continue
+        for index, value in enumerate(_measures(row)):
+            totals[key][index] += sign * value
+    return totals
+
+
+def _apply(connection, deltas: dict[tuple, list[int]]) -> None:
+    """Add signed per-key deltas to the rollup (UPDATE, else INSERT)."""
+    now = datetime.now(iran_tz)
+    c = rollup_table.c
+    for (sales_date, status, bucket, order_type), (count, final, tax, discount) in deltas.items():
+        if not (count or final or tax or discount):
+            continue
+        match = (c.sales_date == sales_date, c.status == status, c.payment_bucket == bucket, c.order_type == order_type)
+        result = connection.execute(update(rollup_table).where(*match).values(
+            orders_count=c.orders_count + count,
+            final_total=c.final_total + final,
+            tax_total=c.tax_total + tax,
+            discount_total=c.discount_total + discount,
+            updated_at=now,
+        ))
+        if result.rowcount == 0:
+            connection.execute(insert(rollup_table).values(
+                sales_date=sales_date, jalali_date=jalali_date_string(sales_date),
+                status=status, payment_bucket=bucket, order_type=order_type,
+                orders_count=count, final_total=final, tax_total=tax, discount_total=discount,
+                updated_at=now,
+            ))
+        elif count < 0:
+            connection.execute(delete(rollup_table).where(*match, c.orders_count <= 0))
+
+
+def _order_rows(connection, where):
+    columns = [order_table.c.id] + [order_table.c[name] for name in _ORDER_FIELDS]
+    stmt = select(*columns)
+    if where is not None:
+        stmt = stmt.where(where)
+    return connection.execute(stmt).all()
+
+
+# --- rebuild / verify -----------------------------------------------------------
+
+def _date_window(column, start_date: date | None, end_date: date | None) -> list:
+    clauses = []
+    if start_date:
+        clauses.append(column >= datetime.combine(start_date, datetime.min.time()))
+    if end_date:
+        clauses.append(column < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    return clauses
+
+
+def compute_rollup_rows(connection, start_date: date | None = None, end_date: date | None = None) -> dict[tuple, list[int]]:
+    """Recompute rollup totals from ``order`` with one grouped query."""
+    o = order_table.c
+    sales_day = func.date(o.created_at)
+    stmt = (
+        select(
+            sales_day, o.status, o.payment_bucket, o.payment_method, o.type,
+            func.count(o.id), func.sum(o.final_amount), func.sum(o.tax_amount), func.sum(o.discount),
+        )
+        .where(o.created_at.isnot(None), *_date_window(o.created_at, start_date, end_date))
+        .group_by(sales_day, o.status, o.payment_bucket, o.payment_method, o.type)
+    )
+    totals: dict[tuple, list[int]] = defaultdict(lambda: [0, 0, 0, 0])
+    for day, status, bucket, method, order_type, count, final, tax, discount in connection.execute(stmt):
+        if not day:
+            continue
+        key = (_sales_date(day), status or '', bucket or categorize_payment_method(method), order_type or '')
+        row = totals[key]
+        row[0] += int(count or 0)
+        row[1] += int(final or 0)
+        row[2] += int(tax or 0)
+        row[3] += int(discount or 0)
+    return totals
+
+
+def rebuild_sales_rollup(connection, start_date: date | None = None, end_date: date | None = None) -> int:
+    """Replace rollup rows in the date range (default: everything)."""
+    totals = compute_rollup_rows(connection, start_date, end_date)
+    purge = delete(rollup_table)
+    if start_date:
+        purge = purge.where(rollup_table.c.sales_date >= start_date)
+    if end_date:
+        purge = purge.where(rollup_table.c.sales_date <= end_date)
+    connection.execute(purge)
+    if totals:
+        now = datetime.now(iran_tz)
+        connection.execute(insert(rollup_table), [
+            {
+                'sales_date': sales_date, 'jalali_date': jalali_date_string(sales_date),
+                'status': status, 'payment_bucket': bucket, 'order_type': order_type,
+                'orders_count': count, 'final_total': final, 'tax_total': tax, 'discount_total': discount,
+                'updated_at': now,
+            }
+            for (sales_date, status, bucket, order_type), (count, final, tax, discount) in totals.items()
+        ])
+    return len(totals)
+
+
+def verify_sales_rollup(connection) -> list[RollupDrift]:
+    expected = compute_rollup_rows(connection)
+    c = rollup_table.c
+    actual = {
+        (row.sales_date, row.status, row.payment_bucket, row.order_type):
+            (row.orders_count, row.final_total, row.tax_total, row.discount_total)
+        for row in connection.execute(select(rollup_table)) if row.orders_count
+    }
+    drift = []
+    for key in sorted(set(expected) | set(actual)):
+        want = tuple(expected.get(key, (0, 0, 0, 0)))
+        have = tuple(actual.get(key, (0, 0, 0, 0)))
+        if want != have:
+            drift.append(RollupDrift(key, want, have))
+    return drift
+
+
+def ensure_sales_rollup(engine) -> bool:
+    """Create and backfill the rollup on databases that predate it."""
+    tables = set(inspect(engine).get_table_names())
+    if rollup_table.name in tables:
+        return False
+    rollup_table.create(bind=engine, checkfirst=True)
+    if order_table.name in tables:
+        with engine.begin() as connection:
+            rebuild_sales_rollup(connection)
+    return True
+
+
+# --- reads -----------------------------------------------------------------------
+
+def _rollup_query(session, columns, start_date: date | None, end_date: date | None):
+    query = (session or db.session).query(*columns)
+    if start_date:
+        query = query.filter(DailySalesRollup.sales_date >= start_date)
+    if end_date:
+        query = query.filter(DailySalesRollup.sales_date <= end_date)
+    return query
+
+
+def sales_summary(start_date: date | None = None, end_date: date | None = None, session=None) -> dict:
+    """Aggregate sales between two local dates (inclusive) from the rollup.
+
+    ``order_types`` counts all orders and ``paid_channels`` sums paid orders
+    per raw ``Order.type`` (``''`` when unset); callers apply their own labels.
+    """
+    R = DailySalesRollup
+    rows = _rollup_query(session, (
+        R.status, R.payment_bucket, R.order_type,
+        func.sum(R.orders_count), func.sum(R.final_total), func.sum(R.tax_total), func.sum(R.discount_total),
+    ), start_date, end_date).group_by(R.status, R.payment_bucket, R.order_type).all()
+
+    summary = {
+        'orders_count': 0, 'total_sales': 0, 'tax_total': 0, 'discount_total': 0,
+        'paid_count': 0, 'paid_total': 0, 'unpaid_count': 0, 'unpaid_total': 0, 'open_total': 0,
+        'payment': defaultdict(int), 'payment_counts': defaultdict(int),
+        'order_types': defaultdict(int), 'paid_channels': defaultdict(lambda: {'amount': 0, 'count': 0}),
+    }
+    for status, bucket, order_type, count, final, tax, discount in rows:
+        count, final = int(count or 0), int(final or 0)
+        summary['orders_count'] += count
+        summary['total_sales'] += final
+        summary['tax_total'] += int(tax or 0)
+        summary['discount_total'] += int(discount or 0)
+        summary['order_types'][order_type] += count
+        if status == PAID_STATUS:
+            summary['paid_count'] += count
+            summary['paid_total'] += final
+            summary['payment'][bucket] += final
+            summary['payment_counts'][bucket] += count
+            summary['paid_channels'][order_type]['amount'] += final
+            summary['paid_channels'][order_type]['count'] += count
+        else:
+            summary['open_total'] += final
+            if status == UNPAID_STATUS:
+                summary['unpaid_count'] += count
+                summary['unpaid_total'] += final
+    return summary
+
+
+def daily_paid_totals(bucket: str, start_date: date | None = None, end_date: date | None = None, session=None) -> dict[date, tuple[int, int]]:
+    """``{sales_date: (count, amount)}`` of paid orders in one payment bucket."""
+    R = DailySalesRollup
+    rows = _rollup_query(session, (R.sales_date, func.sum(R.orders_count), func.sum(R.final_total)), start_date, end_date)
+    rows = rows.filter(R.status == PAID_STATUS, R.payment_bucket == bucket).group_by(R.sales_date)
+    return {sales_date: (int(count or 0), int(amount or 0)) for sales_date, count, amount in rows}
+
+
+# --- ORM hooks -------------------------------------------------------------------
+
+def _touches_rollup(target) -> bool:
+    state = inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in _ORDER_FIELDS)
+
+
+def _after_insert(mapper, connection, target):
+    _apply(connection, _accumulate(_order_rows(connection, order_table.c.id == target.id)))
+
+
+def _before_update(mapper, connection, target):
+    if _touches_rollup(target):
+        _apply(connection, _accumulate(_order_rows(connection, order_table.c.id == target.id), sign=-1))
+
+
+def _after_update(mapper, connection, target):
+    if _touches_rollup(target):
+        _apply(connection, _accumulate(_order_rows(connection, order_table.c.id == target.id)))
+
+
+def _before_delete(mapper, connection, target):
+    _apply(connection, _accumulate(_order_rows(connection, order_table.c.id == target.id), sign=-1))
+
+
+def _do_orm_execute(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    mapper = orm_execute_state.bind_arguments.get('mapper')
+    if mapper is None or mapper.class_ is not Order:
+        return None
+    session = orm_execute_state.session
+    if session.autoflush:
+        session.flush()
+    connection = session.connection(bind_arguments=orm_execute_state.bind_arguments)
+    rows = _order_rows(connection, orm_execute_state.statement.whereclause)
+    if not rows:
+        return None
+    _apply(connection, _accumulate(rows, sign=-1))
+    result = orm_execute_state.invoke_statement()
+    if orm_execute_state.is_update:
+        ids = [row.id for row in rows]
+        _apply(connection, _accumulate(_order_rows(connection, order_table.c.id.in_(ids))))
+    return result
+
+
+def register_sales_rollup_events() -> None:
+    """Attach the rollup hooks once per process."""
+    if event.contains(Order, 'after_insert', _after_insert):
+        return
+    event.listen(Order, 'after_insert', _after_insert)
+    event.listen(Order, 'before_update', _before_update)
+    event.listen(Order, 'after_update', _after_update)
+    event.listen(Order, 'before_delete', _before_delete)
+    event.listen(Session, 'do_orm_execute', _do_orm_execute)
@@ -1,17 +1,341 @@
-from sqlalchemy import inspect, text
+"""Versioned schema migrations for the default, tenant and master SQLite files.
 
+Every database file records the schema version it was brought to in
+``schema_meta``. When that version is current, :func:`migrate_operational_schema`
+costs a single primary-key lookup; otherwise the pending steps run in order
+(each one is idempotent), missing tables and indexes are created and the new
+version is recorded. Use ``migrate_all_tenants.py`` to upgrade every cafe
+ahead of a deploy so no request pays for it.
+"""
+from __future__ import annotations
 
-def migrate_operational_schema(engine) -> None:
-    """Idempotent lightweight migrations shared by default and tenant databases."""
+from sqlalchemy import Column, MetaData, String, Table, inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+from models.models import (
+    Customer, DailySalesRollup, MaterialPurchase, MaterialStockBalance, MenuItemStats, Order, OrderItem, RawMaterialUsage,
+    WarehouseTransfer, db,
+)
+from services.customer_directory import backfill_customer_keys
+from services.menu_stats import ensure_menu_item_stats
+from services.sales_rollup import ensure_sales_rollup
+from services.search_index import ensure_search_index
+from services.stock_ledger import ensure_stock_ledger, rebuild_stock_ledger
+from services.unit_factors import refresh_unit_factors
+
+
+# Bump whenever an index is added to / changed on INDEXED_TABLES in models.models;
+# databases recording an older version get the missing indexes on next touch.
+INDEX_PLAN_VERSION = 2
+INDEXED_TABLES = (
+    Customer.__table__,
+    Order.__table__,
+    OrderItem.__table__,
+    RawMaterialUsage.__table__,
+    MaterialPurchase.__table__,
+    WarehouseTransfer.__table__,
+)
+
+# Small key/value table living in every SQLite file (outside db.metadata so
+# create_all never touches it) that records which migration steps are applied.
+schema_meta = Table(
+    'schema_meta', MetaData(),
+    Column('key', String(64), primary_key=True),
+    Column('value', String(64), nullable=False),
+)
+
+
+# Columns added after the first release, per table: ``{column: DDL type}``.
+LEGACY_COLUMNS = {
+    'customer': {
+        'birth_date': 'DATE',
+        'name_key': 'VARCHAR(128)',
+        'phone_key': 'VARCHAR(20)',
+    },
+    'table': {
+        'is_reserved': 'BOOLEAN DEFAULT 0',
+        'area_id': 'INTEGER REFERENCES table_area(id)',
+        'cart_revision': 'INTEGER DEFAULT 0',
+    },
+    'menu_item_material': {
+        'raw_material_id': 'INTEGER REFERENCES raw_material(id)',
+        'unit': "VARCHAR(32) DEFAULT 'عدد'",
+        'pre_production_item_id': 'INTEGER REFERENCES pre_production_item(id)',
+    },
+    'order': {
+        'daily_sequence': 'INTEGER',
+        'invoice_uid': 'VARCHAR(64)',
+        'cart_revision': 'INTEGER DEFAULT 0',
+    },
+    'order_item': {
+        'is_deleted': 'BOOLEAN DEFAULT 0',
+        'removal_reason': 'VARCHAR(256)',
+    },
+    'raw_material': {'min_stock': 'REAL'},
+    'material_purchase': {
+        'warehouse_id': 'INTEGER REFERENCES warehouse(id)',
+        'unit_code': 'VARCHAR(16)',
+        'unit_factor': 'FLOAT',
+    },
+    'raw_material_usage': {
+        'unit_code': 'VARCHAR(16)',
+        'unit_factor': 'FLOAT',
+    },
+    'settings': {
+        'service_charge': 'FLOAT DEFAULT 0',
+        'currency': "VARCHAR(16) DEFAULT ''",
+        'card_number': 'VARCHAR(64)',
+        'instagram': 'VARCHAR(256)',
+        'telegram': 'VARCHAR(256)',
+        'website': 'VARCHAR(256)',
+    },
+    'cost_formula_settings': {
+        'personnel': 'TEXT',
+        'cost_control_percent': 'INTEGER DEFAULT 0',
+    },
+}
+
+# Derived tables are created by their ``ensure_*`` step so they get backfilled.
+DERIVED_TABLES = (DailySalesRollup.__table__, MaterialStockBalance.__table__, MenuItemStats.__table__)
+
+
+def migrate_legacy_columns(engine) -> None:
+    """Add the columns of :data:`LEGACY_COLUMNS` to tables that predate them."""
     inspector = inspect(engine)
-    if 'material_purchase' in inspector.get_table_names():
-        columns = {column['name'] for column in inspector.get_columns('material_purchase')}
-        if 'warehouse_id' not in columns:
-            with engine.begin() as connection:
-                connection.execute(text(
-                    'ALTER TABLE material_purchase ADD COLUMN warehouse_id INTEGER REFERENCES warehouse(id)'
-                ))
-                connection.execute(text(
-                    'CREATE INDEX IF NOT EXISTS ix_material_purchase_warehouse_id '
-                    'ON material_purchase (warehouse_id)'
-                ))
+    tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table, wanted in LEGACY_COLUMNS.items():
+            if table not in tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table)}
+            for column, ddl in wanted.items():
+                if column not in existing:
+                    connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+        if 'order' in tables:
+            columns = {column['name'] for column in inspector.get_columns('order')}
+            if 'payment_bucket' not in columns:
+                connection.execute(text('ALTER TABLE "order" ADD COLUMN payment_bucket VARCHAR(16)'))
+                backfill_payment_buckets(connection)
+        if 'pre_production_stock' in tables:
+            columns = {column['name'] for column in inspector.get_columns('pre_production_stock')}
+            if 'warehouse_id' not in columns:
+                migrate_pre_production_stock(connection)
+
+
+def migrate_pre_production_stock(connection) -> None:
+    """Move pre-production stock into the ``pre_production`` warehouse (NOT NULL ``warehouse_id``)."""
+    connection.execute(text('ALTER TABLE pre_production_stock ADD COLUMN warehouse_id INTEGER'))
+    warehouse_id = connection.execute(
+        text('SELECT id FROM warehouse WHERE code = :code'), {'code': 'pre_production'}
+    ).scalar()
+    if warehouse_id:
+        connection.execute(
+            text('UPDATE pre_production_stock SET warehouse_id = :wh_id WHERE warehouse_id IS NULL'),
+            {'wh_id': warehouse_id},
+        )
+    # SQLite cannot ALTER COLUMN, so the table is rebuilt with the constraint.
+    connection.execute(text('''
+        CREATE TABLE pre_production_stock_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pre_production_item_id INTEGER NOT NULL,
+            warehouse_id INTEGER NOT NULL,
+            quantity REAL NOT NULL DEFAULT 0.0,
+            unit VARCHAR(32) NOT NULL DEFAULT 'عدد',
+            created_at DATETIME,
+            updated_at DATETIME,
+            FOREIGN KEY (pre_production_item_id) REFERENCES pre_production_item(id),
+            FOREIGN KEY (warehouse_id) REFERENCES warehouse(id),
+            UNIQUE(pre_production_item_id, warehouse_id)
+        )
+    '''))
+    connection.execute(text('''
+        INSERT INTO pre_production_stock_new
+        (id, pre_production_item_id, warehouse_id, quantity, unit, created_at, updated_at)
+        SELECT id, pre_production_item_id, warehouse_id, quantity, unit, created_at, updated_at
+        FROM pre_production_stock
+    '''))
+    connection.execute(text('DROP TABLE pre_production_stock'))
+    connection.execute(text('ALTER TABLE pre_production_stock_new RENAME TO pre_production_stock'))
+
+
+def create_operational_tables(engine) -> None:
+    tables = [table for table in db.metadata.tables.values() if table not in DERIVED_TABLES]
+    db.metadata.create_all(bind=engine, tables=tables)
+
+
+def create_master_tables(engine) -> None:
+    db.metadatas['master'].create_all(bind=engine)
+
+
+def add_unit_factor_columns(engine) -> None:
+    """Add ``unit_code`` / ``unit_factor`` to purchases and usages and fill them.
+
+    The stock ledger is rebuilt from the stored factors (which refreshes them
+    first), so both agree from the start.
+    """
+    migrate_legacy_columns(engine)
+    tables = set(inspect(engine).get_table_names())
+    if not {'raw_material', 'material_purchase', 'raw_material_usage'} <= tables:
+        return
+    with engine.begin() as connection:
+        if MaterialStockBalance.__tablename__ in tables:
+            rebuild_stock_ledger(connection)
+        else:
+            refresh_unit_factors(connection)
+
+
+def add_customer_lookup_keys(engine) -> None:
+    """Add and fill ``customer.name_key`` / ``phone_key``, then index them."""
+    migrate_legacy_columns(engine)
+    if 'customer' in set(inspect(engine).get_table_names()):
+        with engine.begin() as connection:
+            backfill_customer_keys(connection)
+    apply_index_plan(engine)
+
+
+def backfill_payment_buckets(connection) -> None:
+    """Fill ``order.payment_bucket`` once per distinct payment method."""
+    from utils.helpers import categorize_payment_method
+
+    methods = connection.execute(text('SELECT DISTINCT payment_method FROM "order"')).scalars().all()
+    for method in methods:
+        bucket = categorize_payment_method(method)
+        if method is None:
+            connection.execute(text('UPDATE "order" SET payment_bucket = :bucket WHERE payment_method IS NULL'), {'bucket': bucket})
+        else:
+            connection.execute(
+                text('UPDATE "order" SET payment_bucket = :bucket WHERE payment_method = :method'),
+                {'bucket': bucket, 'method': method},
+            )
+
+
+def operational_indexes() -> list:
+    """Indexes declared on the hot order/usage/purchase/transfer tables."""
+    return sorted((index for table in INDEXED_TABLES for index in table.indexes), key=lambda index: index.name)
+
+
+def read_schema_meta(connection, key: str) -> str | None:
+    schema_meta.create(bind=connection, checkfirst=True)
+    return connection.execute(select(schema_meta.c.value).where(schema_meta.c.key == key)).scalar()
+
+
+def write_schema_meta(connection, key: str, value) -> None:
+    connection.execute(
+        text('INSERT OR REPLACE INTO schema_meta (key, value) VALUES (:key, :value)'),
+        {'key': key, 'value': str(value)},
+    )
+
+
+def apply_index_plan(engine) -> bool:
+    """Create missing report indexes once per :data:`INDEX_PLAN_VERSION`.
+
+    The version is only recorded when every indexed table and column exists,
+    so a database created before its tables (or missing a column that a later
+    startup migration adds) is retried on the next touch.
+    """
+    with engine.begin() as connection:
+        if int(read_schema_meta(connection, 'index_plan') or 0) >= INDEX_PLAN_VERSION:
+            return False
+        inspector = inspect(connection)
+        tables = set(inspector.get_table_names())
+        columns_by_table = {}
+        complete = True
+        for index in operational_indexes():
+            table_name = index.table.name
+            if table_name not in tables:
+                complete = False
+                continue
+            if table_name not in columns_by_table:
+                columns_by_table[table_name] = {column['name'] for column in inspector.get_columns(table_name)}
+            if not all(column.name in columns_by_table[table_name] for column in index.columns):
+                complete = False
+                continue
+            index.create(bind=connection, checkfirst=True)
+        if not complete:
+            return False
+        # Fresh statistics let the planner choose between the single-column and composite indexes.
+        connection.execute(text('PRAGMA analysis_limit = 1000'))
+        for table in INDEXED_TABLES:
+            connection.execute(text(f'ANALYZE "{table.name}"'))
+        write_schema_meta(connection, 'index_plan', INDEX_PLAN_VERSION)
+    return True
+
+
+# ``(version, step)`` in application order. Append new steps with a higher
+# version and raise SCHEMA_VERSION; never edit a released step.
+OPERATIONAL_MIGRATIONS = (
+    (1, migrate_legacy_columns),
+    (1, create_operational_tables),
+    (1, ensure_sales_rollup),
+    (1, ensure_stock_ledger),
+    (1, apply_index_plan),
+    (2, create_operational_tables),  # invoice_sequence
+    (3, add_unit_factor_columns),
+    (4, ensure_search_index),
+    (5, add_customer_lookup_keys),
+    (6, ensure_menu_item_stats),
+    (7, migrate_legacy_columns),  # table / order cart_revision
+    (8, create_operational_tables),  # live_event
+)
+SCHEMA_VERSION = max(version for version, _ in OPERATIONAL_MIGRATIONS)
+
+MASTER_MIGRATIONS = (
+    (1, create_master_tables),
+    (2, create_master_tables),  # cafe_metrics_snapshot
+    (3, create_master_tables),  # background_job
+)
+MASTER_SCHEMA_VERSION = max(version for version, _ in MASTER_MIGRATIONS)
+
+
+def read_schema_version(engine) -> int:
+    """Recorded schema version of a database file (0 when never migrated)."""
+    try:
+        with engine.connect() as connection:
+            value = connection.execute(
+                select(schema_meta.c.value).where(schema_meta.c.key == 'schema_version')
+            ).scalar()
+    except OperationalError:  # no schema_meta table yet
+        return 0
+    return int(value or 0)
+
+
+def _run_migrations(engine, migrations, target: int) -> bool:
+    current = read_schema_version(engine)
+    if current >= target:
+        return False
+    try:
+        for version, step in migrations:
+            if version > current:
+                step(engine)
+    except OperationalError:
+        # Another worker may have upgraded the same file concurrently.
+        if read_schema_version(engine) >= target:
+            return False
+        raise
+    with engine.begin() as connection:
+        schema_meta.create(bind=connection, checkfirst=True)
+        write_schema_meta(connection, 'schema_version', target)
+    return True
+
+
+def migrate_operational_schema(engine) -> bool:
+    """Bring a default or tenant database to :data:`SCHEMA_VERSION`.
+
+    Returns ``True`` when steps ran and ``False`` when the file was current.
+    """
+    return _run_migrations(engine, OPERATIONAL_MIGRATIONS, SCHEMA_VERSION)
+
+
+def migrate_master_schema(engine) -> bool:
+    """Bring the master database to :data:`MASTER_SCHEMA_VERSION`."""
+    return _run_migrations(engine, MASTER_MIGRATIONS, MASTER_SCHEMA_VERSION)
+
+
+def migrate_tenant_schema_once(db_path: str, engine) -> None:
+    """Check a tenant file's schema version once per process and upgrade it if needed."""
+    from flask import current_app
+
+    checked_paths = current_app.extensions.setdefault('operational_schema_checked', set())
+    if db_path not in checked_paths:
+        migrate_operational_schema(engine)
+        checked_paths.add(db_path)
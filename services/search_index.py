@@ -0,0 +1,248 @@
+"""SQLite FTS5 search over customers, orders and menu items.
+
+Each tenant database carries three FTS5 tables whose rowid is the id of the
+source row:
+
+* ``customer_search``  — customer ``name`` and ``phone``;
+* ``order_search``     — order ``invoice_uid`` and ``note``;
+* ``menu_item_search`` — menu item ``name`` and ``description``.
+
+Text is stored in a normalized form (Arabic ي/ك as Persian ی/ک, ZWNJ and
+tatweel handled, diacritics dropped, Persian and Arabic digits as ASCII) so
+``علي``, ``علی`` and ``۰۹۱۲`` / ``0912`` find the same rows. The source tables
+keep the index current through SQL triggers whose normalization is plain
+``replace()`` calls, so rows written by any process or tool are indexed.
+
+Queries are normalized the same way and every word becomes a prefix term, so
+``عل ۰۹۱`` matches "علی" with a phone starting 091; results are ordered by
+FTS5's bm25 rank. When the SQLite build lacks FTS5, callers fall back to
+``LIKE`` filters.
+"""
+from __future__ import annotations
+
+import re
+import sqlite3
+from functools import lru_cache
+from typing import NamedTuple
+
+from sqlalchemy import Column, Integer, MetaData, Table, false, inspect, or_, select, text
+
+from models.models import Customer, Order
+
+
+# Characters folded before indexing and searching; ``None`` drops the character.
+PERSIAN_FOLDING = {
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی',
+    'ك': 'ک',
+    'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',
+    'ؤ': 'و',
+    '\u200c': ' ', '\u200f': '', '\u200e': '', '\u0640': '',  # ZWNJ, RLM, LRM, tatweel
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},  # ۰-۹
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},  # ٠-٩
+}
+DIACRITICS = ''.join(chr(code) for code in range(0x064B, 0x0653))  # fathatan .. sukun
+
+_FOLD_TABLE = str.maketrans({**PERSIAN_FOLDING, **{mark: None for mark in DIACRITICS}})
+_WORD = re.compile(r'\w+')
+
+
+class SearchIndex(NamedTuple):
+    name: str
+    source: str
+    columns: tuple[str, ...]
+
+
+INDEXES = (
+    SearchIndex('customer_search', 'customer', ('name', 'phone')),
+    SearchIndex('order_search', 'order', ('invoice_uid', 'note')),
+    SearchIndex('menu_item_search', 'menu_item', ('name', 'description')),
+)
+INDEX_BY_NAME = {index.name: index for index in INDEXES}
+
+
+def _fts_table(index: SearchIndex) -> Table:
+    # Outside db.metadata so create_all/drop_all never touch the virtual tables.
+    return Table(
+        index.name, MetaData(),
+        Column('rowid', Integer, primary_key=True),
+        Column(index.name),  # FTS5 hidden column used on the left of MATCH
+        Column('rank'),
+        *(Column(column) for column in index.columns),
+    )
+
+
+SEARCH_TABLES = {index.name: _fts_table(index) for index in INDEXES}
+
+
+# --- normalization ---------------------------------------------------------------
+
+def normalize_search_text(value) -> str:
+    """Fold Persian/Arabic variants, ZWNJ, diacritics and digits; lower-case."""
+    if value is None:
+        return ''
+    return ' '.join(str(value).translate(_FOLD_TABLE).lower().split())
+
+
+# SQLite's parser limits how deeply replace() calls can nest, so the folding is
+# applied in stages of at most this many replacements.
+SQL_FOLD_STAGE_SIZE = 16
+_SQL_FOLDS = list({**PERSIAN_FOLDING, **dict.fromkeys(DIACRITICS, '')}.items())
+SQL_FOLD_STAGES = [
+    _SQL_FOLDS[start:start + SQL_FOLD_STAGE_SIZE] for start in range(0, len(_SQL_FOLDS), SQL_FOLD_STAGE_SIZE)
+]
+
+
+def _normalize_sql(expression: str, stage: int) -> str:
+    """SQL expression applying one stage of :func:`normalize_search_text`'s folding.
+
+    Case folding and whitespace are left to the FTS5 tokenizer.
+    """
+    sql = f"coalesce({expression}, '')" if stage == 0 else expression
+    for source, target in SQL_FOLD_STAGES[stage]:
+        sql = f"replace({sql}, '{source}', '{target}')"
+    return sql
+
+
+def fts_query(value) -> str | None:
+    """FTS5 query matching rows that contain a word starting with every query word."""
+    words = _WORD.findall(normalize_search_text(value))
+    if not words:
+        return None
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+# --- schema ----------------------------------------------------------------------
+
+@lru_cache(maxsize=1)
+def fts5_available() -> bool:
+    """Whether the linked SQLite library was built with FTS5."""
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE probe USING fts5(value)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+def _fold_statements(index: SearchIndex, where: str = '') -> list[str]:
+    """``UPDATE`` statements applying the later folding stages to already inserted rows."""
+    return [
+        f'UPDATE {index.name} SET '
+        + ', '.join(f'{column} = {_normalize_sql(column, stage)}' for column in index.columns)
+        + where
+        for stage in range(1, len(SQL_FOLD_STAGES))
+    ]
+
+
+def _index_statements(index: SearchIndex) -> list[str]:
+    columns = ', '.join(index.columns)
+    values = ', '.join(_normalize_sql(f'new.{column}', 0) for column in index.columns)
+    insert_new = ' '.join([
+        f'INSERT INTO {index.name}(rowid, {columns}) VALUES (new.id, {values});',
+        *(statement + ';' for statement in _fold_statements(index, ' WHERE rowid = new.id')),
+    ])
+    delete_old = f'DELETE FROM {index.name} WHERE rowid = old.id;'
+    source = f'"{index.source}"'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {index.name} USING fts5("
+        f"{columns}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+        f'CREATE TRIGGER IF NOT EXISTS {index.name}_ai AFTER INSERT ON {source} BEGIN {insert_new} END',
+        f'CREATE TRIGGER IF NOT EXISTS {index.name}_au AFTER UPDATE OF {columns} ON {source} '
+        f'BEGIN {delete_old} {insert_new} END',
+        f'CREATE TRIGGER IF NOT EXISTS {index.name}_ad AFTER DELETE ON {source} BEGIN {delete_old} END',
+    ]
+
+
+def rebuild_search_index(connection, names=None) -> None:
+    """Refill the search tables (all, or ``names``) from their source tables."""
+    for index in INDEXES:
+        if names is not None and index.name not in names:
+            continue
+        columns = ', '.join(index.columns)
+        values = ', '.join(_normalize_sql(f'src.{column}', 0) for column in index.columns)
+        connection.execute(text(f'DELETE FROM {index.name}'))
+        connection.execute(text(
+            f'INSERT INTO {index.name}(rowid, {columns}) SELECT id, {values} FROM "{index.source}" AS src'
+        ))
+        for statement in _fold_statements(index):
+            connection.execute(text(statement))
+
+
+def ensure_search_index(engine) -> bool:
+    """Create missing search tables and triggers.
+
+    An index whose table or triggers were missing (a new database, or a source
+    table recreated without its triggers) is refilled from its source table.
+    """
+    if not fts5_available():
+        return False
+    with engine.begin() as connection:
+        tables = set(inspect(connection).get_table_names())
+        triggers = set(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).scalars())
+        stale = [
+            index for index in INDEXES
+            if index.source in tables and not (
+                index.name in tables and {f'{index.name}_{kind}' for kind in ('ai', 'au', 'ad')} <= triggers
+            )
+        ]
+        for index in stale:
+            for statement in _index_statements(index):
+                connection.execute(text(statement))
+        rebuild_search_index(connection, {index.name for index in stale})
+    return bool(stale)
+
+
+# --- queries ---------------------------------------------------------------------
+
+def _matching_ids(fts: Table, query: str):
+    return select(fts.c.rowid).where(fts.c[fts.name].match(query))
+
+
+def customer_ids_matching(value):
+    """Subquery of customer ids whose name or phone matches ``value``."""
+    query = fts_query(value)
+    if query is None:
+        return select(Customer.id).where(false())
+    if not fts5_available():
+        like = f'%{value}%'
+        return select(Customer.id).where(or_(Customer.name.ilike(like), Customer.phone.ilike(like)))
+    return _matching_ids(SEARCH_TABLES['customer_search'], query)
+
+
+def order_ids_matching(value):
+    """Subquery of order ids whose invoice uid or note matches ``value``."""
+    query = fts_query(value)
+    if query is None:
+        return select(Order.id).where(false())
+    if not fts5_available():
+        like = f'%{value}%'
+        return select(Order.id).where(or_(Order.invoice_uid.ilike(like), Order.note.ilike(like)))
+    return _matching_ids(SEARCH_TABLES['order_search'], query)
+
+
+def ranked_matches(model, value, limit: int, *conditions) -> list:
+    """Rows of ``model`` matching ``value``, best bm25 rank first."""
+    index = next(index for index in INDEXES if index.source == model.__tablename__)
+    query = fts_query(value)
+    if query is None:
+        return []
+    if not fts5_available():
+        like = f'%{value}%'
+        return (
+            model.query
+            .filter(or_(*(getattr(model, column).ilike(like) for column in index.columns)), *conditions)
+            .limit(limit)
+            .all()
+        )
+    fts = SEARCH_TABLES[index.name]
+    return (
+        model.query
+        .join(fts, fts.c.rowid == model.id)
+        .filter(fts.c[index.name].match(query), *conditions)
+        .order_by(fts.c.rank)
+        .limit(limit)
+        .all()
+    )
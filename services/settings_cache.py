@@ -0,0 +1,104 @@
+"""Per-tenant cache of ``Settings`` and ``CostFormulaSettings``.
+
+Both are single-row tables read on nearly every request (tax rate for order
+totals, cafe name in every template), so they are loaded once per tenant
+database and kept as detached, read-only :class:`SettingsSnapshot` copies.
+A request checks the tenant's stamp under ``CACHE_STAMP_DIR`` once (one
+``stat``) and reuses the result for the rest of the request through ``g``.
+
+A commit that writes either table, from ``admin.settings``, the cost formula
+page or anywhere else, bumps the stamp, so every gunicorn worker reloads on
+its next request. Write paths keep using the ORM rows; the snapshots are for
+reading only.
+"""
+from __future__ import annotations
+
+import copy
+from types import SimpleNamespace
+from typing import NamedTuple
+
+from flask import g, has_app_context
+from sqlalchemy import inspect
+
+from models.models import CostFormulaSettings, Settings
+from services.tenant_cache import StampedTenantCache
+
+
+DEFAULT_TAX_PERCENT = 9.0
+SETTINGS_MODELS = (Settings, CostFormulaSettings)
+
+_REQUEST_KEY = '_tenant_settings'
+
+
+class SettingsSnapshot(SimpleNamespace):
+    """Column values of one settings row, detached from any session."""
+
+    @classmethod
+    def of(cls, row) -> 'SettingsSnapshot | None':
+        if row is None:
+            return None
+        return cls(**{
+            column.key: copy.deepcopy(getattr(row, column.key))
+            for column in inspect(type(row)).column_attrs
+        })
+
+
+class TenantSettings(NamedTuple):
+    settings: SettingsSnapshot | None
+    cost_formula: SettingsSnapshot | None
+
+    @property
+    def tax_percent(self) -> float:
+        return self.settings.tax_percent if self.settings else DEFAULT_TAX_PERCENT
+
+
+def load_tenant_settings() -> TenantSettings:
+    """Read both rows from the current tenant database (two queries)."""
+    return TenantSettings(
+        SettingsSnapshot.of(Settings.query.first()),
+        SettingsSnapshot.of(CostFormulaSettings.query.first()),
+    )
+
+
+def _forget_request_copy(key: str) -> None:
+    if has_app_context():
+        g.get(_REQUEST_KEY, {}).pop(key, None)
+
+
+_settings: StampedTenantCache[TenantSettings] = StampedTenantCache(
+    'tenant_settings', load_tenant_settings, SETTINGS_MODELS, on_forget=_forget_request_copy,
+)
+
+
+def tenant_settings() -> TenantSettings:
+    """Settings of the current tenant, reloaded only after they change."""
+    key = _settings.key()
+    memo = g.setdefault(_REQUEST_KEY, {})
+    if key not in memo:
+        memo[key] = _settings.get()
+    return memo[key]
+
+
+def current_settings() -> SettingsSnapshot | None:
+    """Cached ``Settings`` row of the current tenant (``None`` when missing)."""
+    return tenant_settings().settings
+
+
+def cost_formula_settings() -> SettingsSnapshot | None:
+    """Cached ``CostFormulaSettings`` row of the current tenant."""
+    return tenant_settings().cost_formula
+
+
+def current_tax_percent() -> float:
+    """Tax rate of the current tenant (9% when settings were never saved)."""
+    return tenant_settings().tax_percent
+
+
+def invalidate_tenant_settings(engine=None) -> None:
+    """Drop the cached settings of one database (default: current tenant)."""
+    _settings.invalidate(engine)
+
+
+def register_settings_cache_events() -> None:
+    """Attach the invalidation hooks once per process."""
+    _settings.register()
@@ -0,0 +1,489 @@
+"""Maintained per-material / per-warehouse stock balances.
+
+``MaterialStockBalance`` holds one row per ``(raw_material_id, warehouse_id)``
+with running totals in the material base unit. Purchases, order usages and
+warehouse transfers (including pre-production output) adjust it inside the
+same transaction that writes them, so reading stock is a single indexed query
+instead of a walk over the material's whole history.
+
+Bucket ``0`` (``UNASSIGNED_WAREHOUSE``) collects purchases without a warehouse
+and all order consumption; both are charged to the central warehouse, exactly
+like ``compute_warehouse_stock_for_material`` did before the ledger existed.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import date, datetime
+from typing import NamedTuple
+
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.exc import ObjectDeletedError
+
+from models.models import (
+    MaterialPurchase,
+    MaterialStockBalance,
+    RawMaterial,
+    RawMaterialUsage,
+    Warehouse,
+    WarehouseTransfer,
+    convert_unit,
+    db,
+    iran_tz,
+)
+from services.unit_factors import refresh_unit_factors
+
+
+UNASSIGNED_WAREHOUSE = 0
+LEDGER_FIELDS = ('purchased', 'consumed', 'transferred_in', 'transferred_out')
+DRIFT_TOLERANCE = 1e-6
+
+_PENDING_KEY = 'stock_ledger_pending'
+_TRACKED_FIELDS = {
+    MaterialPurchase: ('raw_material_id', 'warehouse_id', 'quantity', 'unit', 'unit_factor'),
+    RawMaterialUsage: ('raw_material_id', 'quantity', 'unit', 'unit_factor'),
+    WarehouseTransfer: ('raw_material_id', 'from_warehouse_id', 'to_warehouse_id', 'base_quantity'),
+}
+
+balance_table = MaterialStockBalance.__table__
+
+
+class LedgerDrift(NamedTuple):
+    raw_material_id: int
+    warehouse_id: int
+    expected: tuple[float, float, float, float]
+    actual: tuple[float, float, float, float]
+
+
+# --- contributions -----------------------------------------------------------
+
+def _contributions(model, values: dict) -> list[tuple[int, int, str, float, str | None]]:
+    """Ledger effect of one source row as ``(material, bucket, field, qty, unit)``.
+
+    ``unit`` is ``None`` when ``qty`` is already in the material base unit,
+    which is the case whenever the row carries its stored ``unit_factor``.
+    """
+    material_id = values.get('raw_material_id')
+    if material_id is None:
+        return []
+    if model in (MaterialPurchase, RawMaterialUsage):
+        quantity, unit = float(values.get('quantity') or 0), values.get('unit')
+        if values.get('unit_factor') is not None:
+            quantity, unit = quantity * values['unit_factor'], None
+        if model is MaterialPurchase:
+            return [(material_id, values.get('warehouse_id') or UNASSIGNED_WAREHOUSE, 'purchased', quantity, unit)]
+        return [(material_id, UNASSIGNED_WAREHOUSE, 'consumed', quantity, unit)]
+    quantity = float(values.get('base_quantity') or 0)
+    parts = []
+    if values.get('to_warehouse_id'):
+        parts.append((material_id, values['to_warehouse_id'], 'transferred_in', quantity, None))
+    if values.get('from_warehouse_id'):
+        parts.append((material_id, values['from_warehouse_id'], 'transferred_out', quantity, None))
+    return parts
+
+
+def _default_units(connection, material_ids) -> dict[int, str]:
+    if not material_ids:
+        return {}
+    rows = connection.execute(
+        select(RawMaterial.__table__.c.id, RawMaterial.__table__.c.default_unit)
+        .where(RawMaterial.__table__.c.id.in_(list(material_ids)))
+    )
+    return {row.id: row.default_unit for row in rows}
+
+
+def _apply(connection, contributions) -> None:
+    """Add signed contributions to the balance rows (one UPDATE/INSERT per key)."""
+    if not contributions:
+        return
+    units = _default_units(connection, {c[0] for c in contributions if c[4] is not None})
+    totals: dict[tuple[int, int], dict[str, float]] = defaultdict(lambda: dict.fromkeys(LEDGER_FIELDS, 0.0))
+    for material_id, bucket, field, quantity, unit in contributions:
+        if unit is not None:
+            if material_id not in units:
+                continue
+            quantity = convert_unit(quantity, unit, units[material_id])
+        totals[(material_id, bucket)][field] += quantity
+
+    now = datetime.now(iran_tz)
+    c = balance_table.c
+    for (material_id, bucket), deltas in totals.items():
+        if not any(deltas.values()):
+            continue
+        result = connection.execute(
+            update(balance_table)
+            .where(c.raw_material_id == material_id, c.warehouse_id == bucket)
+            .values(updated_at=now, **{name: c[name] + value for name, value in deltas.items()})
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(balance_table).values(
+                raw_material_id=material_id, warehouse_id=bucket, updated_at=now, **deltas
+            ))
+
+
+# --- rebuild / verify -----------------------------------------------------------
+
+def compute_ledger_rows(connection, material_ids=None, as_of: date | None = None) -> dict[tuple[int, int], list[float]]:
+    """Recompute balances from the source tables with grouped queries.
+
+    Purchases and usages are summed as ``quantity * unit_factor`` (see
+    ``services.unit_factors``), transfers by their ``base_quantity``. With
+    ``as_of`` only purchases, usages and transfers dated on or before that
+    day are counted.
+    """
+    ids = list(material_ids) if material_ids is not None else None
+    rows: dict[tuple[int, int], list[float]] = defaultdict(lambda: [0.0, 0.0, 0.0, 0.0])
+
+    def scoped(stmt, column, day_column=None):
+        if ids is not None:
+            stmt = stmt.where(column.in_(ids))
+        if as_of is not None and day_column is not None:
+            stmt = stmt.where(day_column <= as_of)
+        return stmt
+
+    material = RawMaterial.__table__.c
+    known = set(connection.execute(scoped(select(material.id), material.id)).scalars())
+
+    purchase = MaterialPurchase.__table__.c
+    for material_id, warehouse_id, quantity in connection.execute(scoped(
+        select(purchase.raw_material_id, purchase.warehouse_id, func.sum(purchase.quantity * purchase.unit_factor))
+        .group_by(purchase.raw_material_id, purchase.warehouse_id),
+        purchase.raw_material_id, purchase.purchase_date,
+    )):
+        if material_id in known:
+            rows[(material_id, warehouse_id or UNASSIGNED_WAREHOUSE)][0] += float(quantity or 0)
+
+    usage = RawMaterialUsage.__table__.c
+    for material_id, quantity in connection.execute(scoped(
+        select(usage.raw_material_id, func.sum(usage.quantity * usage.unit_factor))
+        .group_by(usage.raw_material_id),
+        usage.raw_material_id, func.date(usage.created_at),
+    )):
+        if material_id in known:
+            rows[(material_id, UNASSIGNED_WAREHOUSE)][1] += float(quantity or 0)
+
+    transfer = WarehouseTransfer.__table__.c
+    for column, slot in ((transfer.to_warehouse_id, 2), (transfer.from_warehouse_id, 3)):
+        for material_id, warehouse_id, quantity in connection.execute(scoped(
+            select(transfer.raw_material_id, column, func.sum(transfer.base_quantity))
+            .where(column.isnot(None))
+            .group_by(transfer.raw_material_id, column),
+            transfer.raw_material_id, transfer.transfer_date,
+        )):
+            if material_id in known:
+                rows[(material_id, warehouse_id)][slot] += float(quantity or 0)
+    return rows
+
+
+def rebuild_stock_ledger(connection, material_ids=None) -> int:
+    """Replace ledger rows (all, or for ``material_ids``) with recomputed totals.
+
+    The stored unit factors of those materials are refreshed first, so a
+    changed default unit is picked up.
+    """
+    ids = list(material_ids) if material_ids is not None else None
+    refresh_unit_factors(connection, ids)
+    rows = compute_ledger_rows(connection, ids)
+    purge = delete(balance_table)
+    if ids is not None:
+        purge = purge.where(balance_table.c.raw_material_id.in_(ids))
+    connection.execute(purge)
+    if rows:
+        now = datetime.now(iran_tz)
+        connection.execute(insert(balance_table), [
+            dict(zip(LEDGER_FIELDS, totals), raw_material_id=material_id, warehouse_id=bucket, updated_at=now)
+            for (material_id, bucket), totals in rows.items()
+        ])
+    return len(rows)
+
+
+def verify_stock_ledger(connection, tolerance: float = DRIFT_TOLERANCE) -> list[LedgerDrift]:
+    """Compare stored balances with a fresh recomputation."""
+    expected = compute_ledger_rows(connection)
+    c = balance_table.c
+    actual = {
+        (row.raw_material_id, row.warehouse_id): (row.purchased, row.consumed, row.transferred_in, row.transferred_out)
+        for row in connection.execute(select(
+            c.raw_material_id, c.warehouse_id, c.purchased, c.consumed, c.transferred_in, c.transferred_out
+        ))
+    }
+    drift = []
+    for key in sorted(set(expected) | set(actual)):
+        want = tuple(expected.get(key, (0.0, 0.0, 0.0, 0.0)))
+        have = tuple(float(value or 0) for value in actual.get(key, (0.0, 0.0, 0.0, 0.0)))
+        if any(abs(a - b) > tolerance for a, b in zip(want, have)):
+            drift.append(LedgerDrift(key[0], key[1], want, have))
+    return drift
+
+
+def ensure_stock_ledger(engine) -> bool:
+    """Create and backfill the ledger table on databases that predate it."""
+    tables = set(inspect(engine).get_table_names())
+    if balance_table.name in tables:
+        return False
+    balance_table.create(bind=engine, checkfirst=True)
+    if {'raw_material', 'material_purchase', 'raw_material_usage', 'warehouse_transfer'} <= tables:
+        with engine.begin() as connection:
+            rebuild_stock_ledger(connection)
+    return True
+
+
+# --- reads -----------------------------------------------------------------------
+
+def material_stock_levels(material_ids=None, session=None) -> dict[int, float]:
+    """Current stock (purchases minus usage, floored at 0) per material."""
+    query = (session if session is not None else db.session).query(
+        MaterialStockBalance.raw_material_id,
+        func.sum(MaterialStockBalance.purchased - MaterialStockBalance.consumed),
+    )
+    if material_ids is not None:
+        query = query.filter(MaterialStockBalance.raw_material_id.in_(list(material_ids)))
+    return {
+        material_id: max(0.0, float(total or 0))
+        for material_id, total in query.group_by(MaterialStockBalance.raw_material_id)
+    }
+
+
+def warehouse_stock_level(material_id: int, warehouse_id: int, is_central: bool = False) -> float:
+    """Current stock of one material in one warehouse, floored at 0."""
+    buckets = [warehouse_id, UNASSIGNED_WAREHOUSE] if is_central else [warehouse_id]
+    total = db.session.query(func.sum(
+        MaterialStockBalance.purchased - MaterialStockBalance.consumed
+        + MaterialStockBalance.transferred_in - MaterialStockBalance.transferred_out
+    )).filter(
+        MaterialStockBalance.raw_material_id == material_id,
+        MaterialStockBalance.warehouse_id.in_(buckets),
+    ).scalar()
+    return max(0.0, float(total or 0))
+
+
+def warehouse_stock_matrix(material_ids=None, warehouse_ids=None, as_of: date | None = None) -> dict[tuple[int, int], float]:
+    """Stock of every ``(material_id, warehouse_id)`` pair in the material base unit.
+
+    Without ``as_of`` this reads the maintained balances with one query; with
+    ``as_of`` it recomputes the balances at the end of that day with a few
+    grouped queries (see :func:`compute_ledger_rows`). Purchases without a
+    warehouse and order consumption are charged to the central warehouse.
+    Values are floored at 0 and pairs without any movement are omitted.
+    """
+    material_ids = list(material_ids) if material_ids is not None else None
+    central_id = db.session.query(Warehouse.id).filter(Warehouse.code == 'central').scalar()
+
+    if as_of is None:
+        B = MaterialStockBalance
+        query = db.session.query(
+            B.raw_material_id, B.warehouse_id,
+            B.purchased - B.consumed + B.transferred_in - B.transferred_out,
+        )
+        if material_ids is not None:
+            query = query.filter(B.raw_material_id.in_(material_ids))
+        if warehouse_ids is not None:
+            buckets = set(warehouse_ids)
+            if central_id in buckets:
+                buckets.add(UNASSIGNED_WAREHOUSE)
+            query = query.filter(B.warehouse_id.in_(buckets))
+        balances = ((material_id, bucket, float(total or 0)) for material_id, bucket, total in query)
+    else:
+        connection = db.session.connection(bind_arguments={'mapper': inspect(MaterialStockBalance)})
+        balances = (
+            (material_id, bucket, purchased - consumed + transferred_in - transferred_out)
+            for (material_id, bucket), (purchased, consumed, transferred_in, transferred_out)
+            in compute_ledger_rows(connection, material_ids, as_of).items()
+        )
+
+    wanted = set(warehouse_ids) if warehouse_ids is not None else None
+    totals: dict[tuple[int, int], float] = defaultdict(float)
+    for material_id, bucket, quantity in balances:
+        warehouse_id = central_id if bucket == UNASSIGNED_WAREHOUSE else bucket
+        if warehouse_id is None or (wanted is not None and warehouse_id not in wanted):
+            continue
+        totals[(material_id, warehouse_id)] += quantity
+    return {key: max(0.0, quantity) for key, quantity in totals.items()}
+
+
+# --- ORM hooks -------------------------------------------------------------------
+
+def _pending(target, connection) -> dict:
+    session = object_session(target)
+    store = session.info.setdefault(_PENDING_KEY, {}) if session is not None else {}
+    return store.setdefault(connection, {'contributions': [], 'rebuild': set(), 'purge': set()})
+
+
+def _current_values(target, fields) -> dict:
+    return {name: getattr(target, name) for name in fields}
+
+
+def _after_insert(mapper, connection, target):
+    model = mapper.class_
+    _pending(target, connection)['contributions'].extend(
+        _contributions(model, _current_values(target, _TRACKED_FIELDS[model]))
+    )
+
+
+def _after_update(mapper, connection, target):
+    model = mapper.class_
+    fields = _TRACKED_FIELDS[model]
+    current = _current_values(target, fields)
+    previous = {}
+    for name in fields:
+        history = get_history(target, name)
+        if history.deleted:
+            previous[name] = history.deleted[0]
+        elif history.added:
+            # Old value was expired before assignment; recompute the material(s).
+            pending = _pending(target, connection)
+            pending['rebuild'].add(current['raw_material_id'])
+            if name == 'raw_material_id':
+                pending['rebuild'].add(None)
+            return
+        else:
+            previous[name] = current[name]
+    if previous == current:
+        return
+    pending = _pending(target, connection)['contributions']
+    pending.extend(
+        (m, b, f, -q, u) for m, b, f, q, u in _contributions(model, previous)
+    )
+    pending.extend(_contributions(model, current))
+
+
+def _after_delete(mapper, connection, target):
+    model = mapper.class_
+    fields = _TRACKED_FIELDS[model]
+    loaded = inspect(target).dict
+    pending = _pending(target, connection)
+    if any(name not in loaded for name in fields):
+        pending['rebuild'].add(loaded.get('raw_material_id'))
+        return
+    pending['contributions'].extend(
+        (m, b, f, -q, u) for m, b, f, q, u in _contributions(model, loaded)
+    )
+
+
+def _after_material_update(mapper, connection, target):
+    if get_history(target, 'default_unit').has_changes():
+        _pending(target, connection)['rebuild'].add(target.id)
+
+
+def _after_material_delete(mapper, connection, target):
+    _pending(target, connection)['purge'].add(target.id)
+
+
+def _before_flush(session, flush_context, instances):
+    session.info[_PENDING_KEY] = {}
+    # Load the columns of rows about to be deleted while they still exist so
+    # after_delete can subtract them without another round trip.
+    for obj in session.deleted:
+        fields = _TRACKED_FIELDS.get(type(obj))
+        if not fields:
+            continue
+        state = inspect(obj)
+        unloaded = state.unloaded
+        try:
+            for name in fields:
+                if name in unloaded:
+                    getattr(obj, name)
+        except ObjectDeletedError:
+            # The row is already gone, so its contribution is unknown: recount
+            # its material (or everything, when even that was never loaded).
+            connection = session.connection(bind_arguments={'mapper': state.mapper})
+            _pending(obj, connection)['rebuild'].add(state.dict.get('raw_material_id'))
+
+
+def _after_flush(session, flush_context):
+    store = session.info.pop(_PENDING_KEY, None) or {}
+    for connection, pending in store.items():
+        _apply(connection, pending['contributions'])
+        rebuild = pending['rebuild']
+        if None in rebuild:
+            rebuild_stock_ledger(connection)
+        elif rebuild:
+            rebuild_stock_ledger(connection, rebuild)
+        if pending['purge']:
+            connection.execute(delete(balance_table).where(
+                balance_table.c.raw_material_id.in_(list(pending['purge']))
+            ))
+
+
+def _do_orm_execute(orm_execute_state):
+    """Keep the ledger in step with ``Query.delete()`` / ``Query.update()`` and bulk inserts."""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update or orm_execute_state.is_insert):
+        return None
+    mapper = orm_execute_state.bind_arguments.get('mapper')
+    model = mapper.class_ if mapper is not None else None
+    if model not in _TRACKED_FIELDS and model is not RawMaterial:
+        return None
+    if orm_execute_state.is_insert:
+        return _bulk_insert(orm_execute_state, model)
+
+    session = orm_execute_state.session
+    if session.autoflush:
+        # The statement would autoflush after this hook; do it first so the
+        # rows selected below are the rows it is about to touch.
+        session.flush()
+    statement = orm_execute_state.statement
+    table = model.__table__
+    connection = session.connection(bind_arguments=orm_execute_state.bind_arguments)
+    material_column = table.c.id if model is RawMaterial else table.c.raw_material_id
+
+    if model is RawMaterial or orm_execute_state.is_update:
+        affected = select(material_column).distinct()
+        if statement.whereclause is not None:
+            affected = affected.where(statement.whereclause)
+        material_ids = [row[0] for row in connection.execute(affected)]
+        result = orm_execute_state.invoke_statement()
+        if material_ids:
+            if orm_execute_state.is_delete:
+                connection.execute(delete(balance_table).where(balance_table.c.raw_material_id.in_(material_ids)))
+            else:
+                rebuild_stock_ledger(connection, material_ids)
+        return result
+
+    fields = _TRACKED_FIELDS[model]
+    removed = select(*(table.c[name] for name in fields))
+    if statement.whereclause is not None:
+        removed = removed.where(statement.whereclause)
+    contributions = []
+    for row in connection.execute(removed):
+        contributions.extend(
+            (m, b, f, -q, u) for m, b, f, q, u in _contributions(model, dict(row._mapping))
+        )
+    _apply(connection, contributions)
+    return None
+
+
+def _bulk_insert(orm_execute_state, model):
+    """``session.execute(insert(Model), rows)``: add the contributions of ``rows``."""
+    session = orm_execute_state.session
+    connection = session.connection(bind_arguments=orm_execute_state.bind_arguments)
+    result = orm_execute_state.invoke_statement()
+    if model is RawMaterial:
+        return result
+    rows = orm_execute_state.parameters
+    if isinstance(rows, dict):
+        rows = [rows]
+    if not rows:
+        # Values were given on the statement itself; recount from the tables.
+        rebuild_stock_ledger(connection)
+        return result
+    contributions = []
+    for row in rows:
+        contributions.extend(_contributions(model, row))
+    _apply(connection, contributions)
+    return result
+
+
+def register_stock_ledger_events() -> None:
+    """Attach the ledger hooks once per process."""
+    if event.contains(Session, 'after_flush', _after_flush):
+        return
+    for model in _TRACKED_FIELDS:
+        event.listen(model, 'after_insert', _after_insert)
+        event.listen(model, 'after_update', _after_update)
+        event.listen(model, 'after_delete', _after_delete)
+    event.listen(RawMaterial, 'after_update', _after_material_update)
+    event.listen(RawMaterial, 'after_delete', _after_material_delete)
+    event.listen(Session, 'before_flush', _before_flush)
+    event.listen(Session, 'after_flush', _after_flush)
+    event.listen(Session, 'do_orm_execute', _do_orm_execute)
@@ -0,0 +1,191 @@
+"""Per-tenant in-process caches kept consistent across workers by version stamps.
+
+Several services cache something derived from one tenant database (menu
+availability, compiled recipes, settings, recently served customers) and must
+drop it after any commit that writes the tables it was built from, in every
+gunicorn worker. :class:`StampedTenantCache` is that protocol in one place:
+
+* values live in a bounded LRU keyed by :func:`database_key`, each tagged with
+  the version read from the tenant's stamp under ``CACHE_STAMP_DIR``; a lookup
+  costs one ``stat`` and reloads when the version moved;
+* session hooks mark the database dirty when a flush or an ORM bulk statement
+  touches a watched model, and after the commit drop the local entry and bump
+  the stamp so the other workers reload too. A rollback clears the mark.
+
+Without ``CACHE_STAMP_DIR`` (or outside an app context) nothing is cached and
+every lookup calls the loader.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, TypeVar
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models.models import db
+from services.cache_stamps import bump_stamp, read_stamp, stamp_path
+from services.tenant_engines import tenant_registry_key
+
+
+MAX_CACHED_TENANTS = 128
+
+T = TypeVar('T')
+
+
+def database_key(engine) -> str:
+    database = engine.url.database
+    if database and database != ':memory:':
+        return tenant_registry_key(database)
+    return str(engine.url)
+
+
+class StampedTenantCache(Generic[T]):
+    """One cached value per tenant database, invalidated by commits to ``watched_models``.
+
+    ``loader()`` builds the value for the current tenant. ``is_change(session,
+    obj)`` can narrow which flushed objects count (default: any new, dirty or
+    deleted instance); ``watch_inserts=False`` ignores inserts altogether.
+    ``on_forget(key)`` runs whenever this worker drops a key, for callers that
+    keep derived copies (e.g. per-request memos).
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        loader: Callable[[], T],
+        watched_models: tuple[type, ...],
+        *,
+        is_change: Callable[[Session, object], bool] | None = None,
+        watch_inserts: bool = True,
+        on_forget: Callable[[str], None] | None = None,
+        max_tenants: int = MAX_CACHED_TENANTS,
+    ) -> None:
+        self.namespace = namespace
+        self.loader = loader
+        self.watched_models = tuple(watched_models)
+        self.is_change = is_change
+        self.watch_inserts = watch_inserts
+        self.on_forget = on_forget
+        self.max_tenants = max_tenants
+        self._dirty_key = f'{namespace}_dirty'
+        self._entries: OrderedDict[str, tuple[int, T]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- lookups -------------------------------------------------------------
+
+    def engine(self):
+        """Engine of the current tenant (where the first watched model lives)."""
+        return db.session.get_bind(mapper=inspect(self.watched_models[0]))
+
+    def key(self, engine=None) -> str:
+        return database_key(engine if engine is not None else self.engine())
+
+    def stamp_path(self, key: str) -> str | None:
+        if not has_app_context():
+            return None
+        return stamp_path(current_app.config.get('CACHE_STAMP_DIR'), self.namespace, key)
+
+    def enabled(self, engine=None) -> bool:
+        """Whether values of this tenant are cached at all (stamps configured)."""
+        return self.stamp_path(self.key(engine)) is not None
+
+    def version(self, engine=None) -> int | None:
+        """Current version of the tenant's stamp; ``None`` when stamps are off."""
+        stamp = self.stamp_path(self.key(engine))
+        return read_stamp(stamp) if stamp else None
+
+    def get(self) -> T:
+        """The current tenant's value, reloaded only after its version changed."""
+        key = self.key()
+        stamp = self.stamp_path(key)
+        if stamp is None:
+            return self.loader()
+        version = read_stamp(stamp)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = self.loader()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_tenants:
+                self._entries.popitem(last=False)
+        return value
+
+    def peek(self, engine=None) -> T | None:
+        """The cached value if it is still current, without loading it."""
+        key = self.key(engine)
+        stamp = self.stamp_path(key)
+        if stamp is None:
+            return None
+        version = read_stamp(stamp)
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[1] if entry is not None and entry[0] == version else None
+
+    def forget(self, key: str) -> None:
+        """Drop this worker's copy of one database's value."""
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.on_forget is not None:
+            self.on_forget(key)
+
+    def invalidate(self, engine=None) -> None:
+        """Drop the value of one database (default: current tenant) in every worker."""
+        key = self.key(engine)
+        self.forget(key)
+        stamp = self.stamp_path(key)
+        if stamp:
+            bump_stamp(stamp)
+
+    # --- invalidation hooks --------------------------------------------------
+
+    def _mark(self, session, mapper) -> None:
+        session.info.setdefault(self._dirty_key, set()).add(database_key(session.get_bind(mapper=mapper)))
+
+    def _after_flush(self, session, flush_context):
+        objects = (*session.new, *session.dirty, *session.deleted) if self.watch_inserts else (
+            *session.dirty, *session.deleted
+        )
+        for obj in objects:
+            if isinstance(obj, self.watched_models) and (self.is_change is None or self.is_change(session, obj)):
+                self._mark(session, inspect(obj).mapper)
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not (
+            orm_execute_state.is_delete
+            or orm_execute_state.is_update
+            or (self.watch_inserts and orm_execute_state.is_insert)
+        ):
+            return
+        mapper = orm_execute_state.bind_arguments.get('mapper')
+        if mapper is not None and issubclass(mapper.class_, self.watched_models):
+            self._mark(orm_execute_state.session, mapper)
+
+    def _after_commit(self, session):
+        keys = session.info.pop(self._dirty_key, None)
+        if not keys:
+            return
+        for key in keys:
+            self.forget(key)
+        for key in keys:
+            stamp = self.stamp_path(key)
+            if stamp:
+                bump_stamp(stamp)
+
+    def _after_rollback(self, session):
+        session.info.pop(self._dirty_key, None)
+
+    def register(self) -> None:
+        """Attach the invalidation hooks once per process."""
+        if event.contains(Session, 'after_commit', self._after_commit):
+            return
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'do_orm_execute', self._do_orm_execute)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
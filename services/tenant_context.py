@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from flask import current_app, g, has_app_context, has_request_context
+
+from services.cache_stamps import bump_stamp, read_stamp
+
+
+DEFAULT_TTL_SECONDS = 30
+
+
+@dataclass(frozen=True)
+class TenantContext:
+    """Master-database facts about one cafe needed by the request pipeline."""
+    cafe_id: int
+    slug: str
+    name: str
+    db_path: str
+    is_active: bool
+    enabled_modules: frozenset[str]
+    has_module_rows: bool
+    warehouse_mode: str
+    warehouse_enabled: bool
+
+
+class TenantContextCache:
+    """TTL cache of :class:`TenantContext` guarded by a cross-worker stamp."""
+
+    def __init__(self, stamp_path: str | None, ttl_seconds: float = DEFAULT_TTL_SECONDS) -> None:
+        self.stamp_path = stamp_path
+        self.ttl_seconds = ttl_seconds
+        self._entries: dict[str, tuple[float, int, TenantContext | None]] = {}
+        self._lock = threading.Lock()
+
+    def current_version(self) -> int:
+        return read_stamp(self.stamp_path) if self.stamp_path else 0
+
+    def get(self, slug: str, version: int) -> tuple[bool, TenantContext | None]:
+        with self._lock:
+            entry = self._entries.get(slug)
+        if entry is None:
+            return False, None
+        loaded_at, loaded_version, context = entry
+        if loaded_version != version or time.monotonic() - loaded_at > self.ttl_seconds:
+            return False, None
+        return True, context
+
+    def put(self, slug: str, version: int, context: TenantContext | None) -> None:
+        with self._lock:
+            self._entries[slug] = (time.monotonic(), version, context)
+
+    def invalidate(self, slug: str | None = None) -> None:
+        with self._lock:
+            if slug is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(slug, None)
+        if self.stamp_path:
+            bump_stamp(self.stamp_path)
+
+
+def _cache() -> TenantContextCache:
+    cache = current_app.extensions.get('tenant_context_cache')
+    if cache is None:
+        stamp_dir = current_app.config.get('CACHE_STAMP_DIR')
+        cache = TenantContextCache(
+            os.path.join(stamp_dir, 'tenant_context.stamp') if stamp_dir else None,
+            float(current_app.config.get('TENANT_CONTEXT_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+        )
+        current_app.extensions['tenant_context_cache'] = cache
+    return cache
+
+
+def load_tenant_context(slug: str) -> TenantContext | None:
+    """Read one cafe's context from the master database (uncached)."""
+    from models.master_models import CafeModule, CafeTenant, CafeWarehouseProfile
+
+    cafe = CafeTenant.query.filter_by(slug=slug).first()
+    if cafe is None:
+        return None
+    module_rows = CafeModule.query.filter_by(cafe_id=cafe.id).all()
+    profile = CafeWarehouseProfile.query.filter_by(cafe_id=cafe.id).first()
+    return TenantContext(
+        cafe_id=cafe.id,
+        slug=cafe.slug,
+        name=cafe.name,
+        db_path=cafe.db_path,
+        is_active=bool(cafe.is_active),
+        enabled_modules=frozenset(row.module_code for row in module_rows if row.is_enabled),
+        has_module_rows=bool(module_rows),
+        warehouse_mode=profile.mode if profile else 'none',
+        warehouse_enabled=bool(profile and profile.is_enabled),
+    )
+
+
+def resolve_tenant_context(slug: str | None) -> TenantContext | None:
+    """Resolve ``slug`` once per request, backed by the process-wide cache."""
+    if not slug:
+        return None
+    memo = None
+    if has_request_context():
+        memo = g.setdefault('_tenant_contexts', {})
+        if slug in memo:
+            return memo[slug]
+
+    cache = _cache()
+    version = cache.current_version()
+    hit, context = cache.get(slug, version)
+    if not hit:
+        context = load_tenant_context(slug)
+        cache.put(slug, version, context)
+    if memo is not None:
+        memo[slug] = context
+    return context
+
+
+def invalidate_tenant_context(slug: str | None = None) -> None:
+    """Drop cached context for ``slug`` (or all cafes) in every worker.
+
+    Called from the master write paths. The drop is repeated after the current
+    master transaction commits so a request that re-reads the cafe between the
+    change and the commit cannot pin the old values.
+    """
+    if not has_app_context():
+        return
+    cache = _cache()
+    cache.invalidate(slug)
+    if has_request_context():
+        g.pop('_tenant_contexts', None)
+
+    from sqlalchemy import event
+    from models.models import db
+
+    session = db.session()
+    if session.in_transaction():
+        event.listen(session, 'after_commit', lambda _session: cache.invalidate(slug), once=True)
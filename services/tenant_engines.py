@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+
+DEFAULT_MAX_ENGINES = 64
+DEFAULT_IDLE_SECONDS = 15 * 60
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
+
+def tenant_registry_key(db_path: str) -> str:
+    """Canonical registry key for a tenant SQLite file."""
+    return os.path.normcase(os.path.abspath(db_path))
+
+
+@dataclass
+class _RegistryEntry:
+    engine: Engine
+    session_factory: sessionmaker
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class TenantEngineRegistry:
+    """Process-wide, bounded LRU of pooled engines for tenant databases.
+
+    Creating an engine per request repeats dialect initialisation and opens a
+    new SQLite handle on every POS call. Engines are kept per ``db_path``, each
+    with a real connection pool and per-connection PRAGMAs, and are disposed
+    when they fall out of the LRU, sit idle for too long, or the cafe is
+    deactivated/deleted in the master portal.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_engines: int = DEFAULT_MAX_ENGINES,
+        idle_seconds: float = DEFAULT_IDLE_SECONDS,
+        busy_timeout_ms: int = DEFAULT_BUSY_TIMEOUT_MS,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        max_overflow: int = DEFAULT_MAX_OVERFLOW,
+    ) -> None:
+        self._entries: OrderedDict[str, _RegistryEntry] = OrderedDict()
+        self._lock = threading.RLock()
+        self.configure(
+            max_engines=max_engines,
+            idle_seconds=idle_seconds,
+            busy_timeout_ms=busy_timeout_ms,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+        )
+
+    def configure(
+        self,
+        *,
+        max_engines: int | None = None,
+        idle_seconds: float | None = None,
+        busy_timeout_ms: int | None = None,
+        pool_size: int | None = None,
+        max_overflow: int | None = None,
+    ) -> None:
+        """Update limits; already-open engines keep their pool settings."""
+        with self._lock:
+            if max_engines is not None:
+                self.max_engines = max(1, int(max_engines))
+            if idle_seconds is not None:
+                self.idle_seconds = max(0.0, float(idle_seconds))
+            if busy_timeout_ms is not None:
+                self.busy_timeout_ms = max(0, int(busy_timeout_ms))
+            if pool_size is not None:
+                self.pool_size = max(1, int(pool_size))
+            if max_overflow is not None:
+                self.max_overflow = max(0, int(max_overflow))
+            self._trim()
+
+    def _create_engine(self, db_path: str) -> Engine:
+        engine = create_engine(
+            f"sqlite:///{db_path}",
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            connect_args={'timeout': self.busy_timeout_ms / 1000.0},
+        )
+        busy_timeout_ms = self.busy_timeout_ms
+
+        @event.listens_for(engine, 'connect')
+        def _apply_pragmas(dbapi_connection, _connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('PRAGMA journal_mode=WAL')
+                cursor.execute('PRAGMA synchronous=NORMAL')
+                cursor.execute(f'PRAGMA busy_timeout={busy_timeout_ms}')
+            finally:
+                cursor.close()
+
+        return engine
+
+    def _entry(self, db_path: str) -> _RegistryEntry:
+        key = tenant_registry_key(db_path)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now, keep=key)
+            entry = self._entries.get(key)
+            if entry is None:
+                engine = self._create_engine(key)
+                entry = _RegistryEntry(engine=engine, session_factory=sessionmaker(bind=engine))
+                self._entries[key] = entry
+                self._trim()
+            else:
+                self._entries.move_to_end(key)
+            entry.last_used = now
+            return entry
+
+    def get_engine(self, db_path: str) -> Engine:
+        """Return the shared pooled engine for ``db_path``, creating it if needed."""
+        return self._entry(db_path).engine
+
+    def get_sessionmaker(self, db_path: str) -> sessionmaker:
+        """Return a session factory bound to the shared engine for ``db_path``."""
+        return self._entry(db_path).session_factory
+
+    def invalidate(self, db_path: str | None) -> bool:
+        """Dispose and forget the engine of one tenant database."""
+        if not db_path:
+            return False
+        with self._lock:
+            entry = self._entries.pop(tenant_registry_key(db_path), None)
+        if entry is None:
+            return False
+        entry.engine.dispose()
+        return True
+
+    def evict_idle(self) -> int:
+        """Dispose engines that were not used within ``idle_seconds``."""
+        with self._lock:
+            return self._evict_idle(time.monotonic())
+
+    def dispose_all(self) -> None:
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.engine.dispose()
+
+    def _evict_idle(self, now: float, keep: str | None = None) -> int:
+        if not self.idle_seconds:
+            return 0
+        expired = [
+            key for key, entry in self._entries.items()
+            if key != keep and now - entry.last_used > self.idle_seconds
+        ]
+        for key in expired:
+            self._entries.pop(key).engine.dispose()
+        return len(expired)
+
+    def _trim(self) -> None:
+        while len(self._entries) > self.max_engines:
+            _, entry = self._entries.popitem(last=False)
+            entry.engine.dispose()
+
+    def __contains__(self, db_path: str) -> bool:
+        return tenant_registry_key(db_path) in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+tenant_engines = TenantEngineRegistry()
+
+
+def configure_tenant_engines(config) -> None:
+    """Apply ``TENANT_ENGINE_*`` settings from a Flask config mapping."""
+    tenant_engines.configure(
+        max_engines=config.get('TENANT_ENGINE_CACHE_SIZE'),
+        idle_seconds=config.get('TENANT_ENGINE_IDLE_SECONDS'),
+        busy_timeout_ms=config.get('TENANT_DB_BUSY_TIMEOUT_MS'),
+        pool_size=config.get('TENANT_ENGINE_POOL_SIZE'),
+        max_overflow=config.get('TENANT_ENGINE_MAX_OVERFLOW'),
+    )
+
+
+def get_tenant_engine(db_path: str) -> Engine:
+    return tenant_engines.get_engine(db_path)
+
+
+def tenant_sessionmaker(db_path: str) -> sessionmaker:
+    return tenant_engines.get_sessionmaker(db_path)
+
+
+def invalidate_tenant_engine(db_path: str | None) -> bool:
+    return tenant_engines.invalidate(db_path)
+
+
+def dispose_tenant_engines() -> None:
+    tenant_engines.dispose_all()
@@ -6,11 +6,11 @@ from dataclasses import dataclass
 from datetime import datetime
 
 import pytz
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from werkzeug.security import generate_password_hash
 
 from models.models import InventoryConfiguration, Settings, User, Warehouse, db
+from services.schema_migrations import migrate_operational_schema
+from services.tenant_engines import get_tenant_engine, tenant_sessionmaker
 
 
 _SLUG_RE = re.compile(r"^[a-z0-9]+(?:-[a-z0-9]+)*$")
@@ -136,35 +136,30 @@ def provision_tenant(
     instance_dir = os.path.join(root_dir, "instance")
     os.makedirs(instance_dir, exist_ok=False)
     db_path = os.path.join(instance_dir, "cafe.db")
-    engine = create_engine(f"sqlite:///{db_path}", future=True)
-
-    try:
-        db.metadata.create_all(bind=engine)
-        Session = sessionmaker(bind=engine, future=True)
-        iran_tz = pytz.timezone("Asia/Tehran")
-        with Session.begin() as tenant_session:
-            tenant_session.add(Settings(cafe_name=name))
-            tenant_session.add(
-                InventoryConfiguration(
-                    is_enabled=warehouse_mode != 'none',
-                    warehouse_mode=warehouse_mode,
-                    managed_by_master=True,
-                )
+    migrate_operational_schema(get_tenant_engine(db_path))
+    Session = tenant_sessionmaker(db_path)
+    iran_tz = pytz.timezone("Asia/Tehran")
+    with Session.begin() as tenant_session:
+        tenant_session.add(Settings(cafe_name=name))
+        tenant_session.add(
+            InventoryConfiguration(
+                is_enabled=warehouse_mode != 'none',
+                warehouse_mode=warehouse_mode,
+                managed_by_master=True,
             )
-            for code, warehouse_name in warehouses:
-                tenant_session.add(Warehouse(code=code, name=warehouse_name, is_active=True))
-            tenant_session.add(
-                User(
-                    username=admin_username,
-                    password_hash=generate_password_hash(admin_password),
-                    name=admin_name,
-                    role=admin_role,
-                    is_active=True,
-                    created_at=datetime.now(iran_tz),
-                )
+        )
+        for code, warehouse_name in warehouses:
+            tenant_session.add(Warehouse(code=code, name=warehouse_name, is_active=True))
+        tenant_session.add(
+            User(
+                username=admin_username,
+                password_hash=generate_password_hash(admin_password),
+                name=admin_name,
+                role=admin_role,
+                is_active=True,
+                created_at=datetime.now(iran_tz),
             )
-    finally:
-        engine.dispose()
+        )
 
     return ProvisionedTenant(
         name=name,
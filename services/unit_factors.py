@@ -0,0 +1,91 @@
+"""Unit conversion factors stored on purchase and usage rows.
+
+Every ``MaterialPurchase`` and ``RawMaterialUsage`` row carries the canonical
+code of its unit (``unit_code``, see ``models.normalize_unit``) and the
+multiplier converting its quantity into the material base unit
+(``unit_factor``). Both are filled when the row is written, so stock, cost and
+usage aggregates are plain ``SUM(quantity * unit_factor)`` queries instead of
+Python loops calling ``convert_unit`` per row.
+
+Factors depend on ``RawMaterial.default_unit``; :func:`refresh_unit_factors`
+recomputes them for whole materials with one ``UPDATE`` per distinct
+``(default unit, unit)`` pair and is run by every stock ledger rebuild, which is
+what a default-unit change triggers. ``WarehouseTransfer`` rows already store
+their ``base_quantity`` and need no factor.
+"""
+from __future__ import annotations
+
+from sqlalchemy import event, inspect, select, update
+
+from models.models import MaterialPurchase, RawMaterial, RawMaterialUsage, normalize_unit, unit_factor
+
+
+FACTOR_MODELS = (MaterialPurchase, RawMaterialUsage)
+
+material_table = RawMaterial.__table__
+
+
+# --- bulk refresh ----------------------------------------------------------------
+
+def refresh_unit_factors(connection, material_ids=None) -> int:
+    """Recompute ``unit_code`` / ``unit_factor`` of all rows (or of ``material_ids``).
+
+    Returns the number of ``(default unit, unit)`` groups updated.
+    """
+    ids = list(material_ids) if material_ids is not None else None
+    m = material_table.c
+    updated = 0
+    for model in FACTOR_MODELS:
+        table = model.__table__
+        t = table.c
+        pairs = select(m.default_unit, t.unit).distinct().join_from(table, material_table, t.raw_material_id == m.id)
+        if ids is not None:
+            pairs = pairs.where(m.id.in_(ids))
+        for default_unit, unit in connection.execute(pairs).all():
+            materials = select(m.id).where(m.default_unit == default_unit)
+            if ids is not None:
+                materials = materials.where(m.id.in_(ids))
+            connection.execute(
+                update(table)
+                .where(t.unit == unit, t.raw_material_id.in_(materials.scalar_subquery()))
+                .values(unit_code=normalize_unit(unit), unit_factor=unit_factor(unit, default_unit))
+            )
+            updated += 1
+    return updated
+
+
+# --- ORM hooks -------------------------------------------------------------------
+
+def _material_unit(connection, target) -> str | None:
+    material = inspect(target).dict.get('raw_material')
+    if material is not None and material.id == target.raw_material_id:
+        return material.default_unit
+    if target.raw_material_id is None:
+        return None
+    return connection.execute(
+        select(material_table.c.default_unit).where(material_table.c.id == target.raw_material_id)
+    ).scalar()
+
+
+def _set_factor(connection, target) -> None:
+    target.unit_code = normalize_unit(target.unit)
+    target.unit_factor = unit_factor(target.unit, _material_unit(connection, target))
+
+
+def _before_insert(mapper, connection, target):
+    _set_factor(connection, target)
+
+
+def _before_update(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.unit.history.has_changes() or state.attrs.raw_material_id.history.has_changes():
+        _set_factor(connection, target)
+
+
+def register_unit_factor_events() -> None:
+    """Attach the write-time factor hooks once per process."""
+    if event.contains(MaterialPurchase, 'before_insert', _before_insert):
+        return
+    for model in FACTOR_MODELS:
+        event.listen(model, 'before_insert', _before_insert)
+        event.listen(model, 'before_update', _before_update)
@@ -0,0 +1,108 @@
+// صف تغییرات سبد میز/بیرون‌بر
+// هر ضربه (افزودن، + و -) فوراً روی صفحه اعمال می‌شود و در صف می‌ماند؛ بعد از چند صد میلی‌ثانیه
+// بدون ضربه جدید، کل صف با یک درخواست به /table/<id>/cart یا /takeaway/<id>/cart فرستاده می‌شود
+// و سرور همه را در یک تراکنش اعمال می‌کند و وضعیت جدید سبد را برمی‌گرداند.
+
+// اطلاعات آیتم منو از روی کارت‌های منوی داشبورد (برای نمایش فوری آیتم تازه اضافه شده)
+function menuItemInfo(menuItemId) {
+    const element = document.querySelector(`.menu-item-selectable[data-item-id="${menuItemId}"]`);
+    if (!element) return null;
+    return {
+        name: element.getAttribute('data-item-name') || '',
+        price: parseInt(element.getAttribute('data-item-price')) || 0
+    };
+}
+
+// url: تابعی که آدرس endpoint سبد را برمی‌گرداند
+// getRevision: آخرین revision سبد که کلاینت دیده است
+// onState(cart, settled): وضعیت سبد از سرور؛ settled یعنی تغییر دیگری در صف نیست
+// onError(data): پاسخ ناموفق (data.cart در صورت وجود، وضعیت فعلی سرور است)
+function createCartQueue({ url, getRevision, onState, onError, delay = 250 }) {
+    let operations = [];
+    let timer = null;
+    let inFlight = null;
+
+    function schedule() {
+        clearTimeout(timer);
+        timer = setTimeout(flush, delay);
+    }
+
+    // افزودن‌های پشت سر هم یک آیتم منو در یک عملیات جمع می‌شوند
+    function add(menuItemId, quantity = 1) {
+        const existing = operations.find(op => op.op === 'add' && op.menu_item_id === menuItemId);
+        if (existing) {
+            existing.quantity += quantity;
+            if (existing.quantity <= 0) {
+                operations.splice(operations.indexOf(existing), 1);
+            }
+        } else if (quantity > 0) {
+            operations.push({ op: 'add', menu_item_id: menuItemId, quantity });
+        }
+        schedule();
+    }
+
+    // برای هر آیتم فقط آخرین تعداد فرستاده می‌شود
+    function update(itemId, quantity) {
+        const existing = operations.find(op => op.op === 'update' && op.item_id === itemId);
+        if (existing) {
+            existing.quantity = quantity;
+        } else {
+            operations.push({ op: 'update', item_id: itemId, quantity });
+        }
+        schedule();
+    }
+
+    function remove(itemId, removalReason) {
+        operations = operations.filter(op => !(op.op === 'update' && op.item_id === itemId));
+        operations.push({ op: 'remove', item_id: itemId, removal_reason: removalReason || null });
+        schedule();
+    }
+
+    async function send(batch) {
+        try {
+            const response = await fetch(url(), {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ revision: getRevision(), operations: batch })
+            });
+            const data = await response.json();
+            if (data.success) {
+                await onState(data.cart, operations.length === 0);
+            } else {
+                // تغییرات صف بر پایه سبدی بودند که دیگر معتبر نیست
+                operations = [];
+                if (data.cart) await onState(data.cart, true);
+                onError(data);
+            }
+        } catch (error) {
+            operations = [];
+            onError({ success: false, message: error.message });
+        }
+    }
+
+    // ارسال فوری صف (مثلاً قبل از حذف با دلیل، ثبت سفارش یا بستن پاپ‌آپ)
+    async function flush() {
+        clearTimeout(timer);
+        timer = null;
+        while (inFlight) {
+            await inFlight;
+        }
+        if (operations.length === 0) return;
+        const batch = operations;
+        operations = [];
+        inFlight = send(batch);
+        try {
+            await inFlight;
+        } finally {
+            inFlight = null;
+        }
+    }
+
+    function clear() {
+        clearTimeout(timer);
+        timer = null;
+        operations = [];
+    }
+
+    return { add, update, remove, flush, clear, pending: () => operations.length > 0 || inFlight !== null };
+}
@@ -0,0 +1,74 @@
+// به‌روزرسانی زنده داشبورد
+// سرور تغییر وضعیت میزها، ثبت/تسویه/حذف سفارش‌ها و تغییر موجودی قابل تولید منو را از
+// /dashboard/events (Server-Sent Events) می‌فرستد و صفحه به جای reload فقط همان کارت‌ها را
+// از نو می‌گیرد. هر اتصال بعد از چند ثانیه بسته می‌شود و مرورگر با Last-Event-ID خودکار
+// دوباره وصل می‌شود، پس رویدادی از دست نمی‌رود.
+
+const LIVE_REFRESH_DELAY = 150;
+// وقتی سقف اتصال‌های زنده سرور پر است (503) مرورگر خودش دوباره وصل نمی‌شود
+const LIVE_RECONNECT_DELAY = 10000;
+
+// چند رویداد پشت سر هم برای یک کارت فقط یک درخواست می‌سازند
+const liveRefreshTimers = new Map();
+
+function scheduleLiveRefresh(key, refresh) {
+    clearTimeout(liveRefreshTimers.get(key));
+    liveRefreshTimers.set(key, setTimeout(() => {
+        liveRefreshTimers.delete(key);
+        refresh();
+    }, LIVE_REFRESH_DELAY));
+}
+
+function parseLiveEvent(event) {
+    try {
+        return JSON.parse(event.data);
+    } catch (error) {
+        console.error('رویداد زنده نامعتبر:', event.data);
+        return null;
+    }
+}
+
+function handleTableEvent(event) {
+    const data = parseLiveEvent(event);
+    if (!data || typeof updateTableCard !== 'function') return;
+    scheduleLiveRefresh(`table-${data.table_id}`, () => updateTableCard(data.table_id));
+}
+
+function handleOrderEvent(event) {
+    const data = parseLiveEvent(event);
+    if (!data || data.type !== 'بیرون‌بر') return;
+    if (data.action === 'paid' || data.action === 'deleted') {
+        const card = document.querySelector(`.takeaway-order-card[data-order-id="${data.order_id}"]`);
+        if (card) card.remove();
+        return;
+    }
+    if (typeof updateTakeawayCard !== 'function') return;
+    scheduleLiveRefresh(`order-${data.order_id}`, () => updateTakeawayCard(data.order_id));
+}
+
+// موجودی قابل تولید آیتم‌های تغییرکرده در همه فهرست‌های منوی صفحه
+function handleStockEvent(event) {
+    const data = parseLiveEvent(event);
+    if (!data || !data.items) return;
+    Object.entries(data.items).forEach(([menuItemId, quantity]) => {
+        document.querySelectorAll(`.menu-item-selectable[data-item-id="${menuItemId}"] .item-stock`).forEach(element => {
+            element.textContent = `قابل تولید: ${quantity}`;
+        });
+    });
+}
+
+function startLiveUpdates() {
+    if (!window.EventSource) return null;
+    const source = new EventSource('/dashboard/events');
+    source.addEventListener('table', handleTableEvent);
+    source.addEventListener('order', handleOrderEvent);
+    source.addEventListener('stock', handleStockEvent);
+    source.addEventListener('error', () => {
+        if (source.readyState !== EventSource.CLOSED) return;
+        // کمی پراکنده تا همه صفحه‌ها با هم برنگردند
+        setTimeout(startLiveUpdates, LIVE_RECONNECT_DELAY + Math.random() * LIVE_RECONNECT_DELAY);
+    });
+    return source;
+}
+
+document.addEventListener('DOMContentLoaded', startLiveUpdates);
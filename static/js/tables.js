@@ -1,6 +1,29 @@
 let currentTableId = null;
 let currentTableNumber = null;
 let tableItems = [];
+let tableCartQueue = null; // صف تغییرات سبد میز باز (cart_queue.js)
+
+// صف سبد یک میز؛ شناسه میز در خود صف نگه داشته می‌شود تا بعد از بستن پاپ‌آپ هم درست ارسال شود
+function createTableCartQueue(tableId) {
+    return createCartQueue({
+        url: () => `/table/${tableId}/cart`,
+        getRevision: () => (currentTableData && currentTableData.id === tableId ? currentTableData.cart_revision : null),
+        onState: async (cart, settled) => {
+            if (currentTableId === tableId && currentTableData) {
+                currentTableData.cart_revision = cart.cart_revision;
+                if (settled) await loadTableData(tableId, cart);
+            }
+            if (settled) updateTableCard(tableId);
+        },
+        onError: (data) => {
+            if (data.requires_reason && currentTableId === tableId) {
+                showRemoveReasonField(data.item_id);
+            } else if (data.message) {
+                alert(data.message);
+            }
+        }
+    });
+}
 
 // باز کردن پاپ‌آپ میز
 function openTableModal(tableId, tableNumber) {
@@ -24,6 +47,8 @@ function openTableModal(tableId, tableNumber) {
     modal.style.display = 'flex';
     console.log('Modal display set to flex');
     
+    if (tableCartQueue) tableCartQueue.flush();
+    tableCartQueue = createTableCartQueue(tableId);
     loadTableData(tableId);
     
     // تنظیم event listener برای دکمه‌های ثبت و تسویه (باید هر بار که modal باز می‌شود تنظیم شود)
@@ -114,6 +139,8 @@ function openTableModal(tableId, tableNumber) {
 async function closeTableModal() {
     const tableIdToUpdate = currentTableId; // ذخیره tableId قبل از پاک کردن
     document.getElementById('table-modal').style.display = 'none';
+    // تغییرات در صف قبل از بستن ارسال می‌شوند
+    if (tableCartQueue) await tableCartQueue.flush();
     currentTableId = null;
     currentTableNumber = null;
     tableItems = [];
@@ -128,10 +155,10 @@ async function closeTableModal() {
 // بارگذاری اطلاعات میز
 let currentTableData = null; // ذخیره داده‌های میز برای استفاده در updateTableTotals
 
-async function loadTableData(tableId) {
+// preloaded: وضعیت سبدی که endpoint /cart برگردانده است (بدون درخواست دوباره)
+async function loadTableData(tableId, preloaded = null) {
     try {
-        const response = await fetch(`/table/${tableId}`);
-        const data = await response.json();
+        const data = preloaded || await (await fetch(`/table/${tableId}`)).json();
         
         // ذخیره داده‌های میز
         currentTableData = data;
@@ -300,7 +327,8 @@ function renderTableItems() {
 }
 
 // افزودن آیتم به میز
-async function addItemToTable(menuItemId) {
+// آیتم فوراً در لیست دیده می‌شود و افزودن در صف سبد می‌ماند تا با ضربه‌های بعدی یک‌جا ارسال شود
+function addItemToTable(menuItemId) {
     if (!currentTableId) {
         console.error('currentTableId is null');
         alert('لطفاً ابتدا یک میز را انتخاب کنید');
@@ -312,43 +340,52 @@ async function addItemToTable(menuItemId) {
         return;
     }
     
-    console.log('Adding item to table:', currentTableId, 'item:', menuItemId);
-    
-    try {
-        const response = await fetch(`/table/${currentTableId}/add_item`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                menu_item_id: menuItemId,
-                quantity: 1
-            })
-        });
-        
-        if (!response.ok) {
-            const errorText = await response.text();
-            console.error('HTTP error:', response.status, errorText);
-            throw new Error(`خطای سرور: ${response.status}`);
-        }
-        
-        const data = await response.json();
-        if (data.success) {
-            console.log('Item added successfully');
-            await loadTableData(currentTableId);
-            updateTableCard(currentTableId);
+    const existing = tableItems.find(i => i.menu_item_id === menuItemId);
+    if (existing && existing.id > 0) {
+        // آیتم ذخیره شده: فقط تعداد نهایی آن فرستاده می‌شود
+        setTableItemQuantity(existing, existing.quantity + 1);
+        tableCartQueue.update(existing.id, existing.quantity);
+    } else {
+        if (existing) {
+            setTableItemQuantity(existing, existing.quantity + 1);
         } else {
-            console.error('Server error:', data.message);
-            alert(data.message || 'خطا در افزودن آیتم');
+            // آیتم هنوز ذخیره نشده؛ تا پاسخ سرور با شناسه منفی نگه داشته می‌شود
+            const info = menuItemInfo(menuItemId) || { name: '', price: 0 };
+            tableItems.push({
+                id: -menuItemId,
+                menu_item_id: menuItemId,
+                menu_item_name: info.name,
+                quantity: 1,
+                unit_price: info.price,
+                total_price: info.price,
+                is_order_item: !!currentTableOrderId
+            });
         }
-    } catch (error) {
-        console.error('خطا در افزودن آیتم:', error);
-        alert('خطا در افزودن آیتم به میز: ' + error.message);
+        tableCartQueue.add(menuItemId, 1);
     }
+    renderTableItems();
+    updateTableTotals();
+}
+
+// تغییر تعداد یک ردیف در لیست محلی
+function setTableItemQuantity(item, quantity) {
+    item.quantity = quantity;
+    item.total_price = quantity * item.unit_price;
 }
 
 // نمایش فیلد دلیل حذف
 function showRemoveReasonField(itemId) {
+    // آیتمی که هنوز ذخیره نشده فقط از صف و لیست حذف می‌شود
+    if (itemId < 0) {
+        const pending = tableItems.find(i => i.id === itemId);
+        if (pending) {
+            tableCartQueue.add(pending.menu_item_id, -pending.quantity);
+            tableItems = tableItems.filter(i => i !== pending);
+            renderTableItems();
+            updateTableTotals();
+        }
+        return;
+    }
     // همیشه دلیل بپرسیم
     const reasonRow = document.querySelector(`tr.removal-reason-row[data-item-id="${itemId}"]`);
     if (reasonRow) {
@@ -391,6 +428,7 @@ async function confirmRemoveTableItem(itemId) {
     }
     
     try {
+        await tableCartQueue.flush();
         const response = await fetch(`/table/${currentTableId}/remove_item/${itemId}`, {
             method: 'DELETE',
             headers: {
@@ -417,6 +455,7 @@ async function removeTableItemDirectly(itemId) {
     if (!currentTableId) return;
     
     try {
+        await tableCartQueue.flush();
         const response = await fetch(`/table/${currentTableId}/remove_item/${itemId}`, {
             method: 'DELETE'
         });
@@ -448,11 +487,11 @@ async function removeTableItem(itemId) {
 }
 
 // افزایش تعداد آیتم
-async function increaseItemQuantity(itemId) {
+function increaseItemQuantity(itemId) {
     const item = tableItems.find(i => i.id === itemId);
     if (!item) return;
     
-    await updateItemQuantity(itemId, item.quantity + 1);
+    updateItemQuantity(itemId, item.quantity + 1);
 }
 
 // کاهش تعداد آیتم
@@ -460,37 +499,31 @@ async function decreaseItemQuantity(itemId) {
     const item = tableItems.find(i => i.id === itemId);
     if (!item) return;
     
-    if (item.quantity > 1) {
-        await updateItemQuantity(itemId, item.quantity - 1);
+    if (item.quantity > 1 || itemId < 0) {
+        updateItemQuantity(itemId, item.quantity - 1);
     } else {
         await removeTableItem(itemId);
     }
 }
 
-// به‌روزرسانی تعداد آیتم
-async function updateItemQuantity(itemId, quantity) {
+// به‌روزرسانی تعداد آیتم (فوراً روی صفحه، ارسال از طریق صف سبد)
+function updateItemQuantity(itemId, quantity) {
     if (!currentTableId) return;
+    const item = tableItems.find(i => i.id === itemId);
+    if (!item) return;
     
-    try {
-        const response = await fetch(`/table/${currentTableId}/update_item/${itemId}`, {
-            method: 'PUT',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ quantity })
-        });
-        
-        const data = await response.json();
-        if (data.success) {
-            await loadTableData(currentTableId);
-            updateTableCard(currentTableId);
-        } else {
-            alert(data.message || 'خطا در به‌روزرسانی تعداد');
+    if (itemId < 0) {
+        // آیتم ذخیره نشده: تفاوت تعداد به افزودن در صف اضافه می‌شود
+        tableCartQueue.add(item.menu_item_id, quantity - item.quantity);
+        if (quantity <= 0) {
+            tableItems = tableItems.filter(i => i !== item);
         }
-    } catch (error) {
-        console.error('خطا در به‌روزرسانی تعداد:', error);
-        alert('خطا در به‌روزرسانی تعداد آیتم');
+    } else {
+        tableCartQueue.update(itemId, quantity);
     }
+    setTableItemQuantity(item, Math.max(quantity, 0));
+    renderTableItems();
+    updateTableTotals();
 }
 
 // به‌روزرسانی اطلاعات مشتری
@@ -561,6 +594,7 @@ async function submitTableOrder() {
         alert('لطفاً ابتدا یک میز را انتخاب کنید');
         return;
     }
+    await tableCartQueue.flush();
     
     // اگر سفارش ثبت شده باشد، نیازی به بررسی tableItems نیست
     // چون آیتم‌ها در OrderItem هستند
@@ -597,6 +631,7 @@ async function submitTableOrder() {
         console.log('Response data:', data);
         
         if (data.success) {
+            const submittedTableId = currentTableId;
             // بستن modal فوراً
             closeTableModal();
             if (currentTableOrderId) {
@@ -604,8 +639,8 @@ async function submitTableOrder() {
             } else {
                 alert(`سفارش با شماره فاکتور ${data.invoice_number} با موفقیت ثبت شد`);
             }
-            // به‌روزرسانی صفحه برای نمایش تغییرات
-            location.reload();
+            // فقط کارت همین میز به‌روزرسانی می‌شود (صفحه‌های دیگر از /dashboard/events باخبر می‌شوند)
+            updateTableCard(submittedTableId);
         } else {
             alert(data.message || 'خطا در ثبت سفارش');
         }
@@ -622,6 +657,7 @@ async function checkoutTable() {
         alert('لطفاً ابتدا یک میز را انتخاب کنید');
         return;
     }
+    await tableCartQueue.flush();
     
     try {
         console.log('Checking out table:', currentTableId);
@@ -645,10 +681,10 @@ async function checkoutTable() {
         console.log('Checkout response:', data);
         
         if (data.success) {
+            const settledTableId = currentTableId;
             alert(`میز با موفقیت تسویه شد. شماره فاکتور: ${data.invoice_number}`);
             closeTableModal();
-            // به‌روزرسانی صفحه برای نمایش تغییرات
-            location.reload();
+            updateTableCard(settledTableId);
         } else {
             alert(data.message || 'خطا در تسویه میز');
         }
@@ -762,95 +798,27 @@ function updateTableTotals() {
     }
 }
 
-// به‌روزرسانی کارت میز
+// به‌روزرسانی کارت میز با HTML تازه از سرور (همان قالب dashboard/table_card.html)
 async function updateTableCard(tableId) {
     try {
-        const response = await fetch(`/table/${tableId}`);
+        const response = await fetch(`/dashboard/cards/table/${tableId}`);
         if (!response.ok) {
-            console.error('خطا در دریافت اطلاعات میز');
+            console.error('خطا در دریافت کارت میز');
             return;
         }
         
-        const data = await response.json();
-        
-        const tableCard = document.querySelector(`[data-table-id="${tableId}"]`);
+        const tableCard = document.querySelector(`.table-card[data-table-id="${tableId}"]`);
         if (!tableCard) {
             console.log('کارت میز یافت نشد:', tableId);
             return;
         }
         
-        // به‌روزرسانی badge وضعیت
-        const badge = tableCard.querySelector('.table-card__badge');
-        if (badge) {
-            badge.textContent = data.status || 'خالی';
-            badge.className = `table-card__badge ${data.status === 'اشغال شده' ? 'occupied' : 'empty'}`;
+        const template = document.createElement('template');
+        template.innerHTML = (await response.text()).trim();
+        const freshCard = template.content.querySelector('.table-card');
+        if (freshCard) {
+            tableCard.replaceWith(freshCard);
         }
-        
-        // به‌روزرسانی بخش مشتری و مبلغ
-        const customerSection = tableCard.querySelector('.table-card__customer');
-        const emptySection = tableCard.querySelector('.table-card__empty');
-        const orderSection = tableCard.querySelector('.table-card__order');
-        const actionsSection = tableCard.querySelector('.table-card__actions');
-        
-        if (data.status === 'اشغال شده' && (data.items && data.items.length > 0)) {
-            // اگر میز اشغال شده و آیتم دارد
-            if (emptySection) {
-                emptySection.remove();
-            }
-            
-            if (!customerSection) {
-                // ساخت بخش مشتری اگر وجود ندارد
-                const newCustomerSection = document.createElement('div');
-                newCustomerSection.className = 'table-card__customer';
-                newCustomerSection.innerHTML = `
-                    <div>
-                        <span>مشتری</span>
-                        <strong>${data.customer_name || 'بدون نام'}</strong>
-                    </div>
-                    <div>
-                        <span>مبلغ با تخفیف</span>
-                        <strong>${(data.final_amount || 0).toLocaleString('fa-IR')}</strong>
-                    </div>
-                `;
-                // قرار دادن قبل از بخش order یا actions
-                const insertBefore = orderSection || actionsSection || emptySection;
-                if (insertBefore) {
-                    tableCard.insertBefore(newCustomerSection, insertBefore);
-                } else {
-                    tableCard.appendChild(newCustomerSection);
-                }
-            } else {
-                // به‌روزرسانی بخش مشتری موجود
-                const customerName = customerSection.querySelector('strong');
-                const amount = customerSection.querySelectorAll('strong')[1];
-                if (customerName) {
-                    customerName.textContent = data.customer_name || 'بدون نام';
-                }
-                if (amount) {
-                    amount.textContent = `${(data.final_amount || 0).toLocaleString('fa-IR')}`;
-                }
-            }
-        } else {
-            // اگر میز خالی است
-            if (customerSection) {
-                customerSection.remove();
-            }
-            if (orderSection) {
-                orderSection.remove();
-            }
-            if (actionsSection) {
-                actionsSection.remove();
-            }
-            
-            if (!emptySection) {
-                const newEmptySection = document.createElement('div');
-                newEmptySection.className = 'table-card__empty';
-                newEmptySection.textContent = 'میز آماده پذیرش';
-                tableCard.appendChild(newEmptySection);
-            }
-        }
-        
-        console.log('کارت میز به‌روزرسانی شد:', tableId, data.status);
     } catch (error) {
         console.error('خطا در به‌روزرسانی کارت میز:', error);
     }
@@ -1143,10 +1111,8 @@ async function settleTableFromDashboard(tableId, event, paymentMethod = 'کار
             
             alert(`میز با موفقیت تسویه شد. شماره فاکتور: ${data.invoice_number}`);
             
-            // به‌روزرسانی صفحه برای به‌روزرسانی آمار و اطمینان از همگام‌سازی
-            setTimeout(() => {
-            location.reload();
-            }, 500);
+            // همگام‌سازی کارت با وضعیت سرور
+            updateTableCard(tableId);
         } else {
             alert(data.message || 'خطا در تسویه میز');
         }
@@ -1824,11 +1790,13 @@ async function confirmTransferTable() {
         const data = await response.json();
         
         if (data.success) {
+            const sourceTableId = currentTableId;
             alert(data.message);
             closeTransferTableModal();
             closeTableModal();
-            // به‌روزرسانی صفحه برای نمایش تغییرات
-            location.reload();
+            // کارت میز مبدأ و مقصد به‌روزرسانی می‌شوند
+            updateTableCard(sourceTableId);
+            updateTableCard(parseInt(targetTableId));
         } else {
             alert(data.message || 'خطا در انتقال میز');
         }
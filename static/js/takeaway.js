@@ -2,6 +2,44 @@ let currentTakeawayId = null;
 let currentTakeawayStatus = null;
 let takeawayItems = [];
 let isNewTakeawayCustomer = false; // متغیر global برای نگه‌داری وضعیت مشتری جدید
+let takeawayCartQueue = null; // صف تغییرات سبد سفارش باز (cart_queue.js)
+
+// صف سبد یک سفارش بیرون‌بر؛ شناسه سفارش و آخرین revision در خود صف نگه داشته می‌شوند
+function createTakeawayCartQueue(orderId) {
+    let revision = null;
+    return {
+        orderId,
+        setRevision: (value) => { revision = value; },
+        queue: createCartQueue({
+            url: () => `/takeaway/${orderId}/cart`,
+            getRevision: () => revision,
+            onState: async (cart, settled) => {
+                revision = cart.cart_revision;
+                if (settled && currentTakeawayId === orderId) await loadTakeawayData(orderId, cart);
+                if (settled) updateTakeawayCard(orderId);
+            },
+            onError: (data) => {
+                if (data.requires_reason && currentTakeawayId === orderId) {
+                    showTakeawayRemoveReasonField(data.item_id);
+                } else if (data.message) {
+                    alert(data.message);
+                }
+            }
+        })
+    };
+}
+
+// صف سبد سفارش جاری را (در صورت نیاز) بساز
+function useTakeawayCartQueue(orderId) {
+    if (takeawayCartQueue && takeawayCartQueue.orderId === orderId) return;
+    if (takeawayCartQueue) takeawayCartQueue.queue.flush();
+    takeawayCartQueue = createTakeawayCartQueue(orderId);
+}
+
+// ارسال فوری تغییرات در صف سفارش جاری
+async function flushTakeawayCart() {
+    if (takeawayCartQueue) await takeawayCartQueue.queue.flush();
+}
 
 // باز کردن پاپ‌آپ سفارش بیرون‌بر جدید
 // اطمینان از اینکه تابع در scope global است
@@ -470,6 +508,8 @@ window.openTakeawayModal = async function openTakeawayModal(orderId, event) {
 
 // بستن پاپ‌آپ
 window.closeTakeawayModal = function closeTakeawayModal() {
+    // تغییرات در صف قبل از بستن ارسال می‌شوند (صف شناسه سفارش خودش را دارد)
+    flushTakeawayCart();
     const modal = document.getElementById('takeaway-modal');
     if (modal) {
         modal.style.display = 'none';
@@ -512,22 +552,29 @@ window.cancelCurrentTakeawayOrder = async function cancelCurrentTakeawayOrder(ev
 }
 
 // بارگذاری اطلاعات سفارش بیرون‌بر
-async function loadTakeawayData(orderId) {
+// preloaded: وضعیت سبدی که endpoint /cart برگردانده است (بدون درخواست دوباره)
+async function loadTakeawayData(orderId, preloaded = null) {
     try {
-        const response = await fetch(`/takeaway/${orderId}`);
-        
-        if (!response.ok) {
-            const errorText = await response.text();
-            console.error('خطای HTTP:', response.status, errorText);
-            throw new Error(`خطای سرور: ${response.status}`);
+        let data = preloaded;
+        if (!data) {
+            const response = await fetch(`/takeaway/${orderId}`);
+            
+            if (!response.ok) {
+                const errorText = await response.text();
+                console.error('خطای HTTP:', response.status, errorText);
+                throw new Error(`خطای سرور: ${response.status}`);
+            }
+            
+            data = await response.json();
         }
         
-        const data = await response.json();
-        
         if (!data.id) {
             throw new Error('سفارش یافت نشد');
         }
         
+        useTakeawayCartQueue(data.id);
+        takeawayCartQueue.setRevision(data.cart_revision);
+        
         document.getElementById('takeaway-modal-invoice').textContent = `#${data.invoice_number}`;
         // اگر customer_name خالی یا "مشتری ناشناس" یا "عمومی" است، فیلد را خالی نگه دار
         const customerName = data.customer_name || '';
@@ -712,7 +759,8 @@ function renderTakeawayItems() {
 }
 
 // افزودن آیتم به سفارش
-async function addItemToTakeaway(menuItemId) {
+// آیتم فوراً در لیست دیده می‌شود و افزودن در صف سبد می‌ماند تا با ضربه‌های بعدی یک‌جا ارسال شود
+function addItemToTakeaway(menuItemId) {
     if (!currentTakeawayId) {
         console.error('currentTakeawayId is null');
         alert('لطفاً ابتدا یک سفارش ایجاد کنید');
@@ -724,49 +772,67 @@ async function addItemToTakeaway(menuItemId) {
         return;
     }
     
-    console.log('Adding item to takeaway order:', currentTakeawayId, 'item:', menuItemId);
-    
-    try {
-        const response = await fetch(`/takeaway/${currentTakeawayId}/add_item`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                menu_item_id: menuItemId,
-                quantity: 1
-            })
-        });
-        
-        if (!response.ok) {
-            const errorText = await response.text();
-            console.error('HTTP error:', response.status, errorText);
-            throw new Error(`خطای سرور: ${response.status}`);
-        }
-        
-        const data = await response.json();
-        if (data.success) {
-            console.log('Item added successfully');
-            await loadTakeawayData(currentTakeawayId);
-            updateTakeawayCard(currentTakeawayId);
-            
-            // تغییر دکمه به "اصلاح سفارش" بعد از افزودن آیتم
-            const submitBtn = document.getElementById('submit-takeaway-order');
-            if (submitBtn && currentTakeawayStatus && currentTakeawayStatus !== 'پرداخت شده') {
-                submitBtn.textContent = 'اصلاح سفارش';
-            }
+    useTakeawayCartQueue(currentTakeawayId);
+    const existing = takeawayItems.find(i => i.menu_item_id === menuItemId);
+    if (existing && existing.id > 0) {
+        // آیتم ذخیره شده: فقط تعداد نهایی آن فرستاده می‌شود
+        setTakeawayItemQuantity(existing, existing.quantity + 1);
+        takeawayCartQueue.queue.update(existing.id, existing.quantity);
+    } else {
+        if (existing) {
+            setTakeawayItemQuantity(existing, existing.quantity + 1);
         } else {
-            console.error('Server error:', data.message);
-            alert(data.message || 'خطا در افزودن آیتم');
+            // آیتم هنوز ذخیره نشده؛ تا پاسخ سرور با شناسه منفی نگه داشته می‌شود
+            const info = menuItemInfo(menuItemId) || { name: '', price: 0 };
+            takeawayItems.push({
+                id: -menuItemId,
+                menu_item_id: menuItemId,
+                menu_item_name: info.name,
+                quantity: 1,
+                unit_price: info.price,
+                total_price: info.price
+            });
         }
-    } catch (error) {
-        console.error('خطا در افزودن آیتم:', error);
-        alert('خطا در افزودن آیتم به سفارش: ' + error.message);
+        takeawayCartQueue.queue.add(menuItemId, 1);
+    }
+    refreshTakeawayItems();
+}
+
+// تغییر تعداد یک ردیف در لیست محلی
+function setTakeawayItemQuantity(item, quantity) {
+    item.quantity = quantity;
+    item.total_price = quantity * item.unit_price;
+}
+
+// نمایش دوباره لیست و مبالغ محلی تا پاسخ سرور برسد
+function refreshTakeawayItems() {
+    renderTakeawayItems();
+    if (takeawayItems.length === 0) {
+        ['takeaway-total-amount', 'takeaway-tax-amount', 'takeaway-final-amount'].forEach(id => {
+            document.getElementById(id).textContent = '0';
+        });
+    }
+    updateTakeawayTotals();
+    
+    const submitBtn = document.getElementById('submit-takeaway-order');
+    if (submitBtn && currentTakeawayStatus && currentTakeawayStatus !== 'پرداخت شده') {
+        submitBtn.textContent = 'اصلاح سفارش';
     }
 }
 
 // نمایش فیلد دلیل حذف برای سفارش بیرون‌بر
 async function showTakeawayRemoveReasonField(itemId) {
+    // آیتمی که هنوز ذخیره نشده فقط از صف و لیست حذف می‌شود
+    if (itemId < 0) {
+        const pending = takeawayItems.find(i => i.id === itemId);
+        if (pending) {
+            takeawayCartQueue.queue.add(pending.menu_item_id, -pending.quantity);
+            takeawayItems = takeawayItems.filter(i => i !== pending);
+            refreshTakeawayItems();
+        }
+        return;
+    }
+    
     // اگر وضعیت تنظیم نشده، ابتدا بارگذاری کن
     if (currentTakeawayId && !currentTakeawayStatus) {
         await loadTakeawayData(currentTakeawayId);
@@ -830,6 +896,7 @@ async function confirmRemoveTakeawayItem(itemId) {
     }
     
     try {
+        await flushTakeawayCart();
         const url = `/takeaway/${currentTakeawayId}/remove_item/${itemId}`;
         console.log('Sending DELETE request to:', url, 'with reason:', removalReason);
         
@@ -875,6 +942,7 @@ async function removeTakeawayItem(itemId) {
     if (!currentTakeawayId) return;
     
     try {
+        await flushTakeawayCart();
         const response = await fetch(`/takeaway/${currentTakeawayId}/remove_item/${itemId}`, {
             method: 'DELETE'
         });
@@ -904,11 +972,11 @@ async function removeTakeawayItem(itemId) {
 }
 
 // افزایش تعداد
-async function increaseTakeawayItemQuantity(itemId) {
+function increaseTakeawayItemQuantity(itemId) {
     const item = takeawayItems.find(i => i.id === itemId);
     if (!item) return;
     
-    await updateTakeawayItemQuantity(itemId, item.quantity + 1);
+    updateTakeawayItemQuantity(itemId, item.quantity + 1);
 }
 
 // کاهش تعداد
@@ -916,43 +984,31 @@ async function decreaseTakeawayItemQuantity(itemId) {
     const item = takeawayItems.find(i => i.id === itemId);
     if (!item) return;
     
-    if (item.quantity > 1) {
-        await updateTakeawayItemQuantity(itemId, item.quantity - 1);
+    if (item.quantity > 1 || itemId < 0) {
+        updateTakeawayItemQuantity(itemId, item.quantity - 1);
     } else {
         await removeTakeawayItem(itemId);
     }
 }
 
-// به‌روزرسانی تعداد
-async function updateTakeawayItemQuantity(itemId, quantity) {
+// به‌روزرسانی تعداد (فوراً روی صفحه، ارسال از طریق صف سبد)
+function updateTakeawayItemQuantity(itemId, quantity) {
     if (!currentTakeawayId) return;
+    const item = takeawayItems.find(i => i.id === itemId);
+    if (!item) return;
     
-    try {
-        const response = await fetch(`/takeaway/${currentTakeawayId}/update_item/${itemId}`, {
-            method: 'PUT',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ quantity })
-        });
-        
-        const data = await response.json();
-        if (data.success) {
-            await loadTakeawayData(currentTakeawayId);
-            updateTakeawayCard(currentTakeawayId);
-            
-            // تغییر دکمه به "اصلاح سفارش" بعد از تغییر تعداد
-            const submitBtn = document.getElementById('submit-takeaway-order');
-            if (submitBtn && currentTakeawayStatus && currentTakeawayStatus !== 'پرداخت شده') {
-                submitBtn.textContent = 'اصلاح سفارش';
-            }
-        } else {
-            alert(data.message || 'خطا در به‌روزرسانی تعداد');
+    useTakeawayCartQueue(currentTakeawayId);
+    if (itemId < 0) {
+        // آیتم ذخیره نشده: تفاوت تعداد به افزودن در صف اضافه می‌شود
+        takeawayCartQueue.queue.add(item.menu_item_id, quantity - item.quantity);
+        if (quantity <= 0) {
+            takeawayItems = takeawayItems.filter(i => i !== item);
         }
-    } catch (error) {
-        console.error('خطا در به‌روزرسانی تعداد:', error);
-        alert('خطا در به‌روزرسانی تعداد آیتم');
+    } else {
+        takeawayCartQueue.queue.update(itemId, quantity);
     }
+    setTakeawayItemQuantity(item, Math.max(quantity, 0));
+    refreshTakeawayItems();
 }
 
 // به‌روزرسانی اطلاعات مشتری
@@ -1008,6 +1064,7 @@ async function updateTakeawayCustomer() {
 
 // ثبت یا به‌روزرسانی سفارش
 async function submitTakeawayOrder(orderId) {
+    await flushTakeawayCart();
     // بررسی اینکه آیا آیتمی در سفارش وجود دارد
     if (takeawayItems.length === 0) {
         alert('لطفاً حداقل یک آیتم انتخاب کنید');
@@ -1058,12 +1115,10 @@ async function submitTakeawayOrder(orderId) {
                 : `سفارش با شماره فاکتور ${data.invoice_number} با موفقیت ثبت شد`;
             alert(message);
             
-            // به‌روزرسانی کارت سفارش
+            // به‌روزرسانی کارت سفارش (برای سفارش تازه، کارت به فهرست اضافه می‌شود)
             await updateTakeawayCard(orderId);
             
-            // بستن modal و reload صفحه
             closeTakeawayModal();
-            location.reload();
         } else {
             alert(data.message || 'خطا در ثبت/به‌روزرسانی سفارش');
         }
@@ -1126,6 +1181,7 @@ window.checkoutTakeawayOrder = async function checkoutTakeawayOrder(orderId, eve
     try {
         // تسویه نباید اطلاعاتی را که کاربر همین حالا در مودال وارد کرده از دست بدهد.
         if (currentTakeawayId === orderId) {
+            await flushTakeawayCart();
             await updateTakeawayCustomer();
         }
         const response = await fetch(`/takeaway/${orderId}/checkout`, {
@@ -1144,7 +1200,7 @@ window.checkoutTakeawayOrder = async function checkoutTakeawayOrder(orderId, eve
             if (currentTakeawayId === orderId) {
                 closeTakeawayModal();
             }
-            location.reload();
+            updateTakeawayCard(orderId);
         } else {
             alert(data.message || 'خطا در تسویه سفارش');
         }
@@ -1162,6 +1218,10 @@ window.deleteTakeawayOrder = async function deleteTakeawayOrder(orderId, event)
     }
     
     try {
+        // تغییرات در صف سفارشی که حذف می‌شود دیگر لازم نیست
+        if (takeawayCartQueue && takeawayCartQueue.orderId === orderId) {
+            takeawayCartQueue.queue.clear();
+        }
         console.log('Deleting takeaway order:', orderId);
         const response = await fetch(`/takeaway/${orderId}/delete`, {
             method: 'DELETE',
@@ -1191,7 +1251,7 @@ window.deleteTakeawayOrder = async function deleteTakeawayOrder(orderId, event)
         console.log('Delete response:', data);
         
         if (data.success) {
-            // ریست کردن متغیرهای global قبل از reload
+            // ریست کردن متغیرهای global
             currentTakeawayId = null;
             currentTakeawayStatus = null;
             takeawayItems = [];
@@ -1208,8 +1268,6 @@ window.deleteTakeawayOrder = async function deleteTakeawayOrder(orderId, event)
             if (modal) {
                 modal.style.display = 'none';
             }
-            // برای هماهنگی خلاصه‌های مالی، صفحه را تازه‌سازی می‌کنیم
-            window.location.reload();
         } else {
             alert(data.message || 'خطا در حذف سفارش');
         }
@@ -1335,57 +1393,35 @@ function updateTakeawayTotals() {
     }
 }
 
-// به‌روزرسانی کارت سفارش
+// به‌روزرسانی کارت سفارش با HTML تازه از سرور (همان قالب dashboard/takeaway_card.html)
+// سفارشی که دیگر پرداخت نشده نیست (تسویه یا حذف شده) از داشبورد برداشته می‌شود
 async function updateTakeawayCard(orderId) {
     try {
-        // دریافت اطلاعات به‌روزرسانی شده سفارش از سرور
-        const response = await fetch(`/takeaway/${orderId}`);
+        const response = await fetch(`/dashboard/cards/takeaway/${orderId}`);
         if (!response.ok) {
-            console.error('خطا در دریافت اطلاعات سفارش');
-            return;
-        }
-        
-        const data = await response.json();
-        if (!data.id) {
-            console.error('سفارش یافت نشد');
+            console.error('خطا در دریافت کارت سفارش');
             return;
         }
         
-        // پیدا کردن کارت سفارش در DOM
         const card = document.querySelector(`.takeaway-order-card[data-order-id="${orderId}"]`);
-        if (!card) {
-            console.warn('کارت سفارش در داشبورد یافت نشد؛ برای دیدن وضعیت جدید صفحه را دستی تازه کنید.');
+        if (response.status === 204) {
+            if (card) card.remove();
             return;
         }
         
-        // به‌روزرسانی مبلغ
-        const amountElement = card.querySelector('.takeaway-amount');
-        if (amountElement) {
-            const finalAmount = data.final_amount || 0;
-            amountElement.textContent = `${finalAmount.toLocaleString('fa-IR')}`;
-        }
-        
-        // به‌روزرسانی نام مشتری
-        const customerElement = card.querySelector('.takeaway-customer');
-        if (customerElement) {
-            customerElement.textContent = data.customer_name || 'مشتری ناشناس';
-        }
-        
-        // به‌روزرسانی وضعیت (اگر تغییر کرده باشد)
-        const statusElement = card.querySelector('.takeaway-status');
-        if (statusElement) {
-            statusElement.textContent = data.status || 'پرداخت نشده';
-            statusElement.className = `takeaway-status ${data.status === 'پرداخت شده' ? 'paid' : 'unpaid'}`;
+        const template = document.createElement('template');
+        template.innerHTML = (await response.text()).trim();
+        const freshCard = template.content.querySelector('.takeaway-order-card');
+        if (!freshCard) return;
+        if (card) {
+            card.replaceWith(freshCard);
+            return;
         }
-        
-        // اگر سفارش پرداخت شده، دکمه‌های ثبت و تسویه را حذف کن
-        if (data.status === 'پرداخت شده') {
-            const actionsDiv = card.querySelector('.takeaway-order-actions');
-            if (actionsDiv) {
-                actionsDiv.innerHTML = '<button class="btn-edit-takeaway" onclick="openTakeawayModal(' + orderId + ', event)">ویرایش</button>';
-            }
+        // سفارش تازه فقط در داشبوردی اضافه می‌شود که فهرست بیرون‌برها را نشان می‌دهد (نه گارسون)
+        const grid = document.querySelector('.takeaway-orders-grid[data-live-orders]');
+        if (grid) {
+            grid.prepend(freshCard);
         }
-        
     } catch (error) {
         console.error('خطا در به‌روزرسانی کارت سفارش:', error);
     }
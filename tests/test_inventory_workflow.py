@@ -1,14 +1,47 @@
-from datetime import date
+from datetime import date, datetime, timedelta
+import json
 import tempfile
 import unittest
+from unittest import mock
+import warnings
 
 from config import Config
 from app import create_app
+from models.master_models import BackgroundJob
 from models.models import (
-    db, Category, Customer, MaterialPurchase, MenuItem, MenuItemMaterial, Order, OrderItem,
-    RawMaterial, RawMaterialUsage, Warehouse, convert_unit,
-    sync_order_item_material_usage,
+    db, Category, CostFormulaSettings, Customer, MaterialPurchase, MenuItem, MenuItemMaterial, Order, OrderItem,
+    PreProductionItem, PreProductionItemMaterial, RawMaterial, RawMaterialUsage, Settings, Table, TableItem, User,
+    Warehouse, WarehouseTransfer, InvoiceSequence, calculate_order_amount, convert_unit, convert_units,
+    generate_invoice_number, iran_tz,
 )
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from services.background_jobs import DONE, run_pending_jobs
+from services.cache_stamps import bump_stamp, stamp_path
+from services.cart_operations import (
+    CartError, CartOperation, StaleCartRevision, apply_order_operations, apply_table_operations, parse_cart_request,
+)
+from services.compiled_recipes import (
+    compiled_recipes, record_order_material_usage, sync_order_item_material_usage,
+)
+from services.customer_directory import (
+    backfill_customer_keys, customer_typeahead, find_customer, find_or_create_customer, normalize_phone,
+)
+from services.dashboard_summary import summarize_period
+from services.financial_report import financial_orders_page, financial_range_totals, order_range_filters
+from services.schema_migrations import add_unit_factor_columns, apply_index_plan, operational_indexes
+from services.sales_rollup import rebuild_sales_rollup, sales_summary, verify_sales_rollup
+from services.inventory_service import calculate_material_stock_for_period, menu_stock_map, period_stock
+from services.invoice_sequence import discard_reserved_blocks
+from services.live_events import live_event_hub, live_events_engine, stream_live_events
+from services.menu_availability import database_key
+from services.menu_stats import menu_item_costs, menu_popularity, verify_menu_item_stats
+from services.order_pages import OrderFilter, order_count, orders_page
+from services.order_writer import InvalidOrderLines, OrderLine, place_order
+from services.search_index import customer_ids_matching, ensure_search_index, normalize_search_text, ranked_matches
+from services.settings_cache import cost_formula_settings, current_settings, current_tax_percent
+from services.stock_ledger import rebuild_stock_ledger, verify_stock_ledger, warehouse_stock_level, warehouse_stock_matrix
 
 
 class InventoryWorkflowTest(unittest.TestCase):
@@ -21,6 +54,7 @@ class InventoryWorkflowTest(unittest.TestCase):
             TESTING = True
             SECRET_KEY = 'workflow-test'
             TENANTS_DIR = f"{self.tmp.name}/tenants"
+            CACHE_STAMP_DIR = f"{self.tmp.name}/stamps"
             MASTER_BOOTSTRAP_USERNAME = 'admin'
             MASTER_BOOTSTRAP_PASSWORD = 'admin'
 
@@ -31,6 +65,17 @@ class InventoryWorkflowTest(unittest.TestCase):
         db.drop_all(bind_key='master')
         db.create_all()
         db.create_all(bind_key='master')
+        ensure_search_index(db.engine)  # create_all recreated the source tables without their triggers
+
+    def waiter_client(self):
+        waiter = User(username='garson', password_hash='-', role='waiter')
+        db.session.add(waiter)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(waiter.id)
+            session['_fresh'] = True
+        return client
 
     def tearDown(self):
         db.session.remove()
@@ -80,5 +125,961 @@ class InventoryWorkflowTest(unittest.TestCase):
         self.assertEqual(RawMaterialUsage.query.filter_by(order_item_id=item.id).count(), 0)
 
 
+    def test_stock_ledger_follows_purchases_usage_and_transfers(self):
+        material = RawMaterial(name='شیر', default_unit='gr')
+        category = Category(name='بار سرد', is_active=True)
+        central = Warehouse(code='central', name='انبار مرکزی')
+        kitchen = Warehouse(code='kitchen', name='آشپزخانه')
+        customer = Customer(name='مشتری انبار', phone='09120000001')
+        db.session.add_all([material, category, central, kitchen, customer])
+        db.session.flush()
+        menu_item = MenuItem(name='لاته', price=120_000, is_active=True, category_id=category.id)
+        db.session.add(menu_item)
+        db.session.flush()
+        db.session.add(MenuItemMaterial(menu_item_id=menu_item.id, raw_material_id=material.id, name='شیر', quantity='200', unit='gr'))
+        purchase = MaterialPurchase(raw_material_id=material.id, purchase_date=date.today(), quantity=2, unit='kg', total_price=400_000, warehouse_id=central.id)
+        db.session.add_all([
+            purchase,
+            MaterialPurchase(raw_material_id=material.id, purchase_date=date.today(), quantity=500, unit='gr', total_price=100_000),
+        ])
+        db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 2500)
+        self.assertEqual(menu_stock_map()[menu_item.id], 12)
+
+        order = Order(invoice_number=9998, customer_id=customer.id, type='بیرون‌بر', status='پرداخت نشده', total_amount=0, final_amount=0)
+        db.session.add(order)
+        db.session.flush()
+        item = OrderItem(order_id=order.id, menu_item_id=menu_item.id, quantity=3, unit_price=120_000, total_price=360_000)
+        db.session.add(item)
+        db.session.flush()
+        sync_order_item_material_usage(item)
+        db.session.add(WarehouseTransfer(raw_material_id=material.id, from_warehouse_id=central.id, to_warehouse_id=kitchen.id, quantity=1, unit='kg', base_quantity=1000))
+        db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 1900)
+        self.assertEqual(menu_stock_map()[menu_item.id], 9)
+        self.assertAlmostEqual(warehouse_stock_level(material.id, central.id, is_central=True), 900)
+        self.assertAlmostEqual(warehouse_stock_level(material.id, kitchen.id), 1000)
+
+        purchase.quantity = 3
+        item.quantity = 1
+        sync_order_item_material_usage(item)
+        db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 3300)
+
+        material.default_unit = 'kg'
+        db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 3.3)
+
+        db.session.delete(purchase)
+        db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 0.3)
+        with db.engine.begin() as connection:
+            self.assertEqual(verify_stock_ledger(connection), [])
+            rebuild_stock_ledger(connection)
+        self.assertAlmostEqual(material.current_stock, 0.3)
+
+
+    def test_stock_ledger_recounts_a_deleted_row_that_was_already_gone(self):
+        material = RawMaterial(name='شکر', default_unit='gr')
+        db.session.add(material)
+        db.session.flush()
+        stale = MaterialPurchase(raw_material_id=material.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=50_000)
+        db.session.add_all([
+            stale,
+            MaterialPurchase(raw_material_id=material.id, purchase_date=date.today(), quantity=500, unit='gr', total_price=25_000),
+        ])
+        db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 1500)
+
+        # Removed behind the ledger (e.g. by another tool) before this session deletes it.
+        with db.engine.begin() as connection:
+            connection.execute(text('DELETE FROM material_purchase WHERE id = :id'), {'id': stale.id})
+        db.session.expire(stale, ['quantity', 'unit'])
+        db.session.delete(stale)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # "expected to delete 1 row(s); 0 were matched"
+            db.session.commit()
+        self.assertAlmostEqual(material.current_stock, 500)
+        self.assertEqual(verify_stock_ledger(db.session.connection()), [])
+
+    def test_warehouse_stock_matrix_covers_all_materials_and_as_of_dates(self):
+        milk = RawMaterial(name='شیر', default_unit='gr')
+        sugar = RawMaterial(name='شکر', default_unit='gr')
+        central = Warehouse(code='central', name='انبار مرکزی')
+        kitchen = Warehouse(code='kitchen', name='آشپزخانه')
+        db.session.add_all([milk, sugar, central, kitchen])
+        db.session.flush()
+        # The usage row's default created_at is Tehran time, which can be a day ahead of the host.
+        today = datetime.now(iran_tz).date()
+        yesterday = today - timedelta(days=1)
+        db.session.add_all([
+            MaterialPurchase(raw_material_id=milk.id, purchase_date=today - timedelta(days=2), quantity=2, unit='kg', total_price=1, warehouse_id=central.id),
+            MaterialPurchase(raw_material_id=milk.id, purchase_date=today, quantity=500, unit='gr', total_price=1),
+            MaterialPurchase(raw_material_id=sugar.id, purchase_date=yesterday, quantity=1, unit='kg', total_price=1, warehouse_id=kitchen.id),
+            WarehouseTransfer(raw_material_id=milk.id, from_warehouse_id=central.id, to_warehouse_id=kitchen.id, quantity=1, unit='kg', base_quantity=1000, transfer_date=yesterday),
+            RawMaterialUsage(raw_material_id=milk.id, quantity=100, unit='gr'),
+        ])
+        db.session.commit()
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        current = warehouse_stock_matrix()
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(current, {(milk.id, central.id): 1400, (milk.id, kitchen.id): 1000, (sugar.id, kitchen.id): 1000})
+        self.assertEqual(warehouse_stock_matrix(warehouse_ids=[central.id]), {(milk.id, central.id): 1400})
+        self.assertAlmostEqual(current[(milk.id, central.id)], warehouse_stock_level(milk.id, central.id, is_central=True))
+
+        self.assertEqual(
+            warehouse_stock_matrix(as_of=yesterday),
+            {(milk.id, central.id): 1000, (milk.id, kitchen.id): 1000, (sugar.id, kitchen.id): 1000},
+        )
+        self.assertEqual(warehouse_stock_matrix([milk.id], as_of=today - timedelta(days=2)), {(milk.id, central.id): 2000})
+        self.assertEqual(warehouse_stock_matrix(as_of=today), current)
+
+    def test_period_stock_uses_grouped_queries_and_is_cached_until_stock_changes(self):
+        milk = RawMaterial(name='شیر', default_unit='gr')
+        db.session.add(milk)
+        db.session.flush()
+        # The last usage row defaults to a Tehran created_at, which can be a day ahead of the host.
+        today = datetime.now(iran_tz).date()
+        days_ago = lambda n: today - timedelta(days=n)  # noqa: E731
+        db.session.add_all([
+            MaterialPurchase(raw_material_id=milk.id, purchase_date=days_ago(10), quantity=2, unit='kg', total_price=1),
+            MaterialPurchase(raw_material_id=milk.id, purchase_date=days_ago(3), quantity=500, unit='gr', total_price=1),
+            RawMaterialUsage(raw_material_id=milk.id, quantity=100, unit='gr', created_at=datetime.combine(days_ago(5), datetime.min.time())),
+            RawMaterialUsage(raw_material_id=milk.id, quantity=0.05, unit='kg', created_at=datetime.combine(days_ago(1), datetime.min.time())),
+        ])
+        db.session.commit()
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        period = period_stock(days_ago(4), today)
+        self.assertEqual(len(statements), 4)
+        self.assertAlmostEqual(period.opening[milk.id], 1900)
+        self.assertAlmostEqual(period.purchased[milk.id], 500)
+        self.assertAlmostEqual(period.used[milk.id], 50)
+        self.assertAlmostEqual(period.closing[milk.id], 2350)
+        self.assertAlmostEqual(period_stock(days_ago(4), days_ago(2)).closing[milk.id], 2400)
+        self.assertAlmostEqual(calculate_material_stock_for_period([milk], None, None)[milk.id], 2350)
+
+        statements.clear()
+        self.assertIs(period_stock(days_ago(4), today), period)
+        self.assertEqual(statements, [])
+
+        db.session.add(RawMaterialUsage(raw_material_id=milk.id, quantity=350, unit='gr'))
+        db.session.commit()
+        self.assertAlmostEqual(period_stock(days_ago(4), today).closing[milk.id], 2000)
+
+    def test_unit_factors_are_stored_at_write_time_and_follow_default_unit(self):
+        self.assertEqual(convert_units([2, 500, 3, 4], ['kg', 'گرم', 'l', 'kg'], 'gr'), [2000, 500, 3, 4000])
+        self.assertEqual(convert_units([1500, 2], ['ml', 'pack'], ['لیتر', 'بسته']), [1.5, 2])
+        sugar = RawMaterial(name='شکر', default_unit='gr')
+        db.session.add(sugar)
+        db.session.flush()
+        purchase = MaterialPurchase(raw_material_id=sugar.id, quantity=2, unit='کیلوگرم', total_price=400_000)
+        usage = RawMaterialUsage(raw_material_id=sugar.id, quantity=250, unit='گرم')
+        db.session.add_all([purchase, usage])
+        db.session.commit()
+        self.assertEqual((purchase.unit_code, purchase.unit_factor), ('kg', 1000.0))
+        self.assertEqual((usage.unit_code, usage.unit_factor), ('g', 1.0))
+        self.assertAlmostEqual(sugar.current_stock, 1750)
+
+        sugar.default_unit = 'kg'
+        db.session.commit()
+        db.session.refresh(usage)
+        self.assertAlmostEqual(usage.unit_factor, 0.001)
+        self.assertAlmostEqual(sugar.current_stock, 1.75)
+        self.assertAlmostEqual(sugar.weighted_average_unit_price, 200_000)
+
+        # Rows written before the columns existed are filled by the migration step.
+        db.session.execute(text('UPDATE material_purchase SET unit_code = NULL, unit_factor = NULL'))
+        db.session.commit()
+        add_unit_factor_columns(db.engine)
+        db.session.expire_all()
+        self.assertAlmostEqual(purchase.unit_factor, 1.0)
+        self.assertEqual(verify_stock_ledger(db.session.connection()), [])
+
+    def test_menu_availability_is_batched_and_invalidated_by_recipe_edits(self):
+        sugar = RawMaterial(name='شکر', default_unit='gr')
+        cream = RawMaterial(name='خامه', default_unit='gr')
+        category = Category(name='کیک', is_active=True)
+        syrup = PreProductionItem(name='سیروپ', unit='kg')
+        db.session.add_all([sugar, cream, category, syrup])
+        db.session.flush()
+        db.session.add(PreProductionItemMaterial(pre_production_item_id=syrup.id, raw_material_id=sugar.id, quantity=500, unit='gr'))
+        items = []
+        for index in range(5):
+            item = MenuItem(name=f'کیک {index}', price=90_000, is_active=True, category_id=category.id)
+            db.session.add(item)
+            db.session.flush()
+            db.session.add_all([
+                MenuItemMaterial(menu_item_id=item.id, pre_production_item_id=syrup.id, name='سیروپ', quantity='100', unit='gr'),
+                MenuItemMaterial(menu_item_id=item.id, raw_material_id=cream.id, name='خامه', quantity='50', unit='gr'),
+            ])
+            items.append(item)
+        db.session.add_all([
+            MaterialPurchase(raw_material_id=sugar.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=1),
+            MaterialPurchase(raw_material_id=cream.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=1),
+        ])
+        db.session.commit()
+        items = MenuItem.query.filter_by(category_id=category.id).all()
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            stocks = menu_stock_map(items)
+            self.assertEqual(len(statements), 6)
+            statements.clear()
+            self.assertEqual(menu_stock_map(items), stocks)
+            self.assertEqual(statements, [])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        # 1000gr sugar / (0.1kg syrup * 500gr) = 20; 1000gr cream / 50gr = 20
+        self.assertEqual(set(stocks.values()), {20})
+
+        part = MenuItemMaterial.query.filter_by(menu_item_id=items[0].id, raw_material_id=cream.id).one()
+        part.quantity = '400'
+        db.session.commit()
+        self.assertEqual(menu_stock_map(items)[items[0].id], 2)
+
+
+    def test_dashboard_period_summary_groups_by_stored_payment_bucket(self):
+        customer = Customer(name='مشتری گزارش', phone='09120000002')
+        db.session.add(customer)
+        db.session.flush()
+        now = datetime.now()
+        db.session.add_all([
+            Order(invoice_number=1, customer_id=customer.id, created_at=now, type='حضوری', status='پرداخت شده',
+                  payment_method='انتقال', total_amount=100, tax_amount=9, final_amount=109),
+            Order(invoice_number=2, customer_id=customer.id, created_at=now, type='بیرون‌بر', status='پرداخت شده',
+                  payment_method='اسنپ', total_amount=200, discount=10, final_amount=190),
+            Order(invoice_number=3, customer_id=customer.id, created_at=now, type='بیرون‌بر', status='پرداخت نشده',
+                  total_amount=50, final_amount=50),
+            Order(invoice_number=4, customer_id=customer.id, created_at=now - timedelta(days=3), type='حضوری',
+                  status='پرداخت شده', payment_method='نقدی', total_amount=70, final_amount=70),
+        ])
+        db.session.commit()
+        self.assertEqual(Order.query.filter_by(invoice_number=2).one().payment_bucket, 'snap')
+
+        summary = summarize_period('day', 'امروز', now.replace(hour=0, minute=0, second=0, microsecond=0))
+        self.assertEqual(summary['orders_count'], 3)
+        self.assertEqual(summary['total_sales'], 349)
+        self.assertEqual(summary['paid_count'], 2)
+        self.assertEqual(summary['paid_total'], 299)
+        self.assertEqual(summary['unpaid_total'], 50)
+        self.assertEqual(summary['tax_total'], 9)
+        self.assertEqual(summary['discount_total'], 10)
+        self.assertEqual(summary['order_types'], {'حضوری': 1, 'بیرون‌بر': 2, 'سایر': 0})
+        self.assertEqual(summary['payment'], {'pos': 0, 'card_to_card': 109, 'snap': 190})
+        self.assertEqual(summary['payment_counts'], {'pos': 0, 'card_to_card': 1, 'snap': 1})
+
+
+    def test_daily_sales_rollup_tracks_order_lifecycle(self):
+        customer = Customer(name='مشتری رول‌آپ', phone='09120000003')
+        db.session.add(customer)
+        db.session.flush()
+        # Orders are stamped and bucketed in Tehran time, which can be a day ahead of the host.
+        today = datetime.now(iran_tz).date()
+        first = Order(invoice_number=11, customer_id=customer.id, type='حضوری', status='پرداخت نشده',
+                      total_amount=100, final_amount=100)
+        second = Order(invoice_number=12, customer_id=customer.id, type='بیرون‌بر', status='پرداخت نشده',
+                       total_amount=40, final_amount=40)
+        db.session.add_all([first, second])
+        db.session.commit()
+        self.assertEqual(sales_summary(today, today)['unpaid_total'], 140)
+
+        first.status = 'پرداخت شده'
+        first.payment_method = 'اسنپ'
+        db.session.commit()
+        summary = sales_summary(today, today)
+        self.assertEqual((summary['paid_count'], summary['paid_total']), (1, 100))
+        self.assertEqual(summary['payment']['snap'], 100)
+        self.assertEqual(summary['unpaid_total'], 40)
+
+        Order.query.filter_by(id=second.id).update({'final_amount': 60})
+        db.session.commit()
+        self.assertEqual(sales_summary(today, today)['total_sales'], 160)
+
+        db.session.delete(first)
+        db.session.commit()
+        Order.query.filter(Order.status == 'پرداخت نشده').delete()
+        db.session.commit()
+        self.assertEqual(sales_summary(today, today)['orders_count'], 0)
+        with db.engine.begin() as connection:
+            self.assertEqual(verify_sales_rollup(connection), [])
+            self.assertEqual(rebuild_sales_rollup(connection), 0)
+
+
+    def test_financial_report_line_stats_use_grouped_queries(self):
+        customer = Customer(name='مشتری مالی', phone='09120000004')
+        category = Category(name='نوشیدنی', is_active=True)
+        db.session.add_all([customer, category])
+        db.session.flush()
+        menu_item = MenuItem(name='چای', price=1000, is_active=True, category_id=category.id)
+        db.session.add(menu_item)
+        db.session.flush()
+        orders = []
+        for index in range(3):
+            order = Order(invoice_number=100 + index, customer_id=customer.id, status='پرداخت نشده',
+                          total_amount=0, tax_amount=7, final_amount=0)
+            db.session.add(order)
+            db.session.flush()
+            orders.append(order)
+        db.session.add_all([
+            OrderItem(order_id=orders[0].id, menu_item_id=menu_item.id, quantity=2, unit_price=1000, total_price=2000),
+            OrderItem(order_id=orders[0].id, menu_item_id=menu_item.id, quantity=1, unit_price=500, total_price=500, is_deleted=True),
+            OrderItem(order_id=orders[1].id, menu_item_id=menu_item.id, quantity=3, unit_price=1000, total_price=3000),
+        ])
+        db.session.commit()
+
+        # Orders are stamped with Tehran time, which can be a day ahead of the host.
+        start = datetime.combine(datetime.now(iran_tz).date(), datetime.min.time())
+        filters = order_range_filters(start, start + timedelta(days=1))
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            totals = financial_range_totals(filters, 9.0)
+            rows = financial_orders_page(filters, 9.0, page=1, per_page=2)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(statements), 3)
+        # 180 + 270 recomputed from live items, 7 stored on the order without items
+        self.assertEqual(totals, {
+            'orders_count': 3, 'total_tax': 457, 'total_deleted_items_count': 1,
+            'total_deleted_items_amount': 500, 'orders_with_deleted': 1,
+        })
+        self.assertEqual([row['order'].id for row in rows], [orders[2].id, orders[1].id])
+        self.assertEqual([row['tax_amount'] for row in rows], [7, 270])
+        self.assertEqual(financial_orders_page(filters, 9.0, page=2, per_page=2)[0]['deleted_items_total'], 500)
+
+    def test_order_pages_use_keyset_cursors_and_bounded_counts(self):
+        alice = Customer(name='آلیس', phone='09120000010')
+        bob = Customer(name='باب', phone='09120000011')
+        db.session.add_all([alice, bob])
+        db.session.flush()
+        base = datetime(2025, 3, 1, 12, 0)
+        orders = [
+            Order(invoice_number=100 + i, customer_id=(alice if i % 2 else bob).id, status='پرداخت شده',
+                  created_at=base - timedelta(hours=i // 2), total_amount=10, final_amount=10)
+            for i in range(7)
+        ]
+        db.session.add_all(orders)
+        db.session.commit()
+
+        seen, cursor = [], None
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        while True:
+            page = orders_page(OrderFilter(), cursor, limit=3)
+            seen += [order.id for order in page.orders]
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        expected = [o.id for o in sorted(orders, key=lambda o: (o.created_at, o.id), reverse=True)]
+        self.assertEqual(seen, expected)
+        self.assertEqual((page.total, page.total_is_exact), (7, True))
+        self.assertFalse(any('count(' in sql.lower() and 'FROM "order"' in sql for sql in statements))
+
+        by_name = orders_page(OrderFilter(q='آلیس'), limit=2)
+        self.assertEqual([o.customer_id for o in by_name.orders], [alice.id, alice.id])
+        self.assertEqual((by_name.total, by_name.total_is_exact), (3, True))
+        self.assertEqual(order_count(OrderFilter(q='آلیس'), cap=2), (2, False))
+        self.assertEqual([o.id for o in orders_page(OrderFilter(q='103')).orders], [orders[3].id])
+        self.assertEqual(orders_page(OrderFilter(), cursor='not-a-cursor', limit=1).orders[0].id, expected[0])
+
+    def test_search_index_normalizes_persian_text_and_follows_writes(self):
+        self.assertEqual(normalize_search_text('علي\u200cرضا كريمي ۰۹۱۲ ٣'), 'علی رضا کریمی 0912 3')
+        ali = Customer(name='علي كريمي', phone='۰۹۱۲۱۱۱۲۲۳۳')
+        alireza = Customer(name='علیرضا محمدی', phone='09351112233')
+        other = Customer(name='مریم', phone='09120000000')
+        category = Category(name='نوشیدنی')
+        db.session.add_all([ali, alireza, other, category])
+        db.session.flush()
+        db.session.add_all([
+            MenuItem(name='کیک شکلاتی', price=10, category_id=category.id, description='با کاکائوی تلخ'),
+            MenuItem(name='کـــیک هویج', price=10, category_id=category.id, is_active=False),
+        ])
+        db.session.commit()
+
+        self.assertEqual([c.id for c in ranked_matches(Customer, 'علی', 10)][:2], [ali.id, alireza.id])
+        self.assertEqual([c.id for c in ranked_matches(Customer, 'كريمی 0912', 10)], [ali.id])
+        self.assertEqual([m.name for m in ranked_matches(MenuItem, 'کیك', 10, MenuItem.is_active == True)], ['کیک شکلاتی'])  # noqa: E712
+        self.assertEqual(len(ranked_matches(MenuItem, 'کیک', 10)), 2)
+        self.assertEqual(len(ranked_matches(MenuItem, 'کاکائو', 10)), 1)
+
+        other.name = 'مریم رضایی'
+        db.session.delete(alireza)
+        db.session.commit()
+        matches = set(db.session.execute(customer_ids_matching('رضا')).scalars())
+        self.assertEqual(matches, {other.id})
+        ensure_search_index(db.engine)
+        self.assertEqual(db.session.execute(text('SELECT count(*) FROM customer_search')).scalar(), 2)
+
+    def test_customer_directory_matches_normalized_keys_and_remembers_recent_customers(self):
+        self.assertEqual(normalize_phone('+98 912 111 2233'), '09121112233')
+        self.assertEqual(normalize_phone('۰۹۱۲-۱۱۱-۲۲۳۳'), '09121112233')
+        ali = Customer(name='علي كريمي', phone='+989121112233')
+        namesake = Customer(name='علی کریمی', phone='09350000000')
+        db.session.add_all([ali, namesake])
+        db.session.commit()
+        self.assertEqual((ali.phone_key, ali.name_key), ('09121112233', 'علی کریمی'))
+        ali_id, namesake_id = ali.id, namesake.id
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        self.assertEqual(find_customer('هر نامی', '۰۹۱۲۱۱۱۲۲۳۳').id, ali_id)
+        self.assertEqual(find_customer('علی کریمی').id, ali_id)  # oldest customer with the name
+        db.session.expunge_all()
+        statements.clear()
+        self.assertEqual(find_customer(phone='09121112233').id, ali_id)
+        self.assertEqual(find_customer('علي  كريمي').id, ali_id)
+        self.assertFalse(any('phone_key =' in statement or 'name_key =' in statement for statement in statements))
+
+        new = find_or_create_customer('مریم', '0912 000 0001')
+        self.assertEqual(find_or_create_customer('مريم', None).id, new.id)
+        self.assertEqual([row['id'] for row in customer_typeahead(None, 2)], [new.id, ali_id])
+        self.assertEqual([row['id'] for row in customer_typeahead('كريمی', 5)], [ali_id, namesake_id])
+
+        db.session.get(Customer, ali_id).phone = '09129999999'
+        db.session.commit()  # the change drops the tenant's remembered customers
+        self.assertEqual(customer_typeahead('', 5), [])
+        self.assertIsNone(find_customer(phone='09121112233'))
+
+        db.session.execute(text("UPDATE customer SET name_key = NULL, phone_key = NULL"))
+        db.session.commit()
+        with db.engine.begin() as connection:
+            self.assertEqual(backfill_customer_keys(connection, chunk_size=2), 3)
+        self.assertEqual(find_customer(phone='989129999999').id, ali_id)
+
+    def test_menu_stats_follow_payments_and_recipe_cost_changes(self):
+        coffee = RawMaterial(name='قهوه دمی', default_unit='gr')
+        milk = RawMaterial(name='شیر پرچرب', default_unit='ml')
+        category = Category(name='کافه', is_active=True)
+        customer = Customer(name='مشتری منو', phone='09120000020')
+        foam = PreProductionItem(name='فوم شیر', unit='عدد')
+        db.session.add_all([coffee, milk, category, customer, foam])
+        db.session.flush()
+        latte = MenuItem(name='لاته دمی', price=150_000, is_active=True, category_id=category.id)
+        mocha = MenuItem(name='موکا دمی', price=170_000, is_active=True, category_id=category.id)
+        db.session.add_all([latte, mocha])
+        db.session.flush()
+        db.session.add_all([
+            PreProductionItemMaterial(pre_production_item_id=foam.id, raw_material_id=milk.id, quantity=0.2, unit='l'),
+            MenuItemMaterial(menu_item_id=latte.id, raw_material_id=coffee.id, name='قهوه', quantity='18', unit='gr'),
+            MenuItemMaterial(menu_item_id=latte.id, pre_production_item_id=foam.id, name='فوم', quantity='1', unit='عدد'),
+            MaterialPurchase(raw_material_id=coffee.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=2_000_000),
+            MaterialPurchase(raw_material_id=milk.id, purchase_date=date.today(), quantity=1, unit='l', total_price=100_000),
+        ])
+        orders = []
+        for number, quantities in enumerate(((2, 1), (1, 0), (3, 2))):
+            order = Order(invoice_number=8000 + number, customer_id=customer.id, status='پرداخت نشده', total_amount=0, final_amount=0)
+            order.order_items = [
+                OrderItem(menu_item_id=item.id, quantity=quantity, unit_price=0, total_price=0)
+                for item, quantity in ((latte, quantities[0]), (mocha, quantities[1])) if quantity
+            ]
+            orders.append(order)
+        db.session.add_all(orders)
+        db.session.commit()
+        latte_id, mocha_id = latte.id, mocha.id
+        self.assertEqual(menu_popularity(), {})
+
+        orders[0].status = 'پرداخت شده'
+        db.session.commit()
+        self.assertEqual(menu_popularity(), {latte_id: {'orders_count': 1, 'quantity_sold': 2}, mocha_id: {'orders_count': 1, 'quantity_sold': 1}})
+        orders[0].order_items.append(OrderItem(menu_item_id=latte_id, quantity=1, unit_price=0, total_price=0))
+        orders[0].order_items[1].is_deleted = True  # the mocha
+        db.session.commit()
+        Order.query.filter(Order.invoice_number.in_([8001, 8002])).update({'status': 'پرداخت شده'}, synchronize_session=False)
+        OrderItem.query.filter_by(order_id=orders[2].id, menu_item_id=mocha_id).delete(synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(menu_popularity()[latte_id], {'orders_count': 3, 'quantity_sold': 7})
+        self.assertNotIn(mocha_id, menu_popularity())
+        with db.engine.connect() as connection:
+            self.assertEqual(verify_menu_item_stats(connection), [])
+
+        expected = sum(line.estimated_cost for line in MenuItemMaterial.query.filter_by(menu_item_id=latte_id))
+        cost = menu_item_costs([latte_id, mocha_id])
+        self.assertAlmostEqual(cost[latte_id].cost_price, 36_000 + 20_000)
+        self.assertAlmostEqual(cost[latte_id].cost_price, expected)
+        self.assertEqual([line['name'] for line in cost[latte_id].materials], ['قهوه', 'فوم'])
+        self.assertEqual(cost[mocha_id].cost_price, 0)
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        menu_item_costs([latte_id, mocha_id])
+        self.assertEqual(len(statements), 1)  # snapshot read only
+
+        db.session.add(MaterialPurchase(raw_material_id=coffee.id, purchase_date=date.today() + timedelta(days=1), quantity=500, unit='gr', total_price=1_500_000))
+        db.session.commit()
+        self.assertAlmostEqual(menu_item_costs([latte_id])[latte_id].cost_price, 18 * 3_000 + 20_000)
+        db.session.add(PreProductionItemMaterial(pre_production_item_id=foam.id, raw_material_id=coffee.id, quantity=1, unit='gr'))
+        db.session.commit()
+        self.assertAlmostEqual(menu_item_costs([latte_id])[latte_id].cost_price, 18 * 3_000 + 20_000 + int(3_500_000 / 1_500))
+
+    def test_order_material_usage_comes_from_compiled_recipes_in_one_insert(self):
+        sugar = RawMaterial(name='شکر', default_unit='gr')
+        coffee = RawMaterial(name='قهوه', default_unit='gr')
+        category = Category(name='بار گرم', is_active=True)
+        syrup = PreProductionItem(name='سیروپ', unit='kg')
+        customer = Customer(name='مشتری دستور', phone='09120000009')
+        db.session.add_all([sugar, coffee, category, syrup, customer])
+        db.session.flush()
+        db.session.add(PreProductionItemMaterial(pre_production_item_id=syrup.id, raw_material_id=sugar.id, quantity=500, unit='gr'))
+        latte = MenuItem(name='لاته', price=120_000, is_active=True, category_id=category.id)
+        water = MenuItem(name='آب', price=10_000, is_active=True, category_id=category.id)
+        db.session.add_all([latte, water])
+        db.session.flush()
+        db.session.add_all([
+            MenuItemMaterial(menu_item_id=latte.id, raw_material_id=coffee.id, name='قهوه', quantity='0.018', unit='kg'),
+            MenuItemMaterial(menu_item_id=latte.id, pre_production_item_id=syrup.id, name='سیروپ', quantity='50', unit='gr'),
+            MaterialPurchase(raw_material_id=coffee.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=1),
+            MaterialPurchase(raw_material_id=sugar.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=1),
+        ])
+        order = Order(invoice_number=9997, customer_id=customer.id, type='بیرون‌بر', status='پرداخت نشده', total_amount=0, final_amount=0)
+        db.session.add(order)
+        db.session.commit()
+        lines = compiled_recipes([latte.id, water.id])
+        self.assertEqual(list(lines), [latte.id])
+        self.assertEqual([(line.raw_material_id, line.unit, line.note) for line in lines[latte.id]], [
+            (coffee.id, 'kg', 'مصرف مستقیم BOM'), (sugar.id, 'gr', 'مصرف از پیش‌تولید: سیروپ'),
+        ])
+        self.assertAlmostEqual(lines[latte.id][0].base_quantity, 18)
+        self.assertAlmostEqual(lines[latte.id][1].base_quantity, 25)  # 0.05kg syrup * 500gr
+
+        db.session.add_all([
+            OrderItem(order_id=order.id, menu_item_id=latte.id, quantity=quantity, unit_price=120_000, total_price=0)
+            for quantity in (2, 1)
+        ] + [OrderItem(order_id=order.id, menu_item_id=water.id, quantity=1, unit_price=10_000, total_price=0)])
+        db.session.flush()
+        statements = []
+        listener = lambda conn, cursor, statement, parameters, context, executemany: statements.append((statement, executemany))
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(record_order_material_usage(order), 2)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        db.session.commit()
+        inserts = [executemany for statement, executemany in statements if statement.startswith('INSERT INTO raw_material_usage')]
+        self.assertEqual(inserts, [True])
+        self.assertFalse(any('menu_item_material' in statement or 'pre_production' in statement for statement, _ in statements))
+        self.assertAlmostEqual(coffee.current_stock, 1000 - 3 * 18)
+        self.assertAlmostEqual(sugar.current_stock, 1000 - 3 * 25)
+        self.assertEqual(verify_stock_ledger(db.session.connection()), [])
+        self.assertEqual(record_order_material_usage(order), 0)  # rows already match
+
+        part = MenuItemMaterial.query.filter_by(menu_item_id=latte.id, raw_material_id=coffee.id).one()
+        part.quantity = '20'
+        part.unit = 'gr'
+        db.session.commit()
+        self.assertEqual(record_order_material_usage(order, replace_existing=True), 2)
+        db.session.commit()
+        self.assertAlmostEqual(coffee.current_stock, 1000 - 3 * 20)
+        self.assertEqual(RawMaterialUsage.query.filter_by(order_id=order.id, raw_material_id=coffee.id, unit='gr').count(), 2)
+        self.assertEqual(verify_stock_ledger(db.session.connection()), [])
+
+    def test_place_order_writes_items_usage_and_stock_in_fixed_statements(self):
+        coffee = RawMaterial(name='قهوه', default_unit='gr')
+        category = Category(name='بار گرم', is_active=True)
+        customer = Customer(name='مشتری سفارش', phone='09120000010')
+        db.session.add_all([coffee, category, customer])
+        db.session.flush()
+        espresso = MenuItem(name='اسپرسو', price=80_000, stock=5, is_active=True, category_id=category.id)
+        retired = MenuItem(name='قدیمی', price=50_000, is_active=False, category_id=category.id)
+        db.session.add_all([espresso, retired])
+        db.session.flush()
+        db.session.add_all([
+            MenuItemMaterial(menu_item_id=espresso.id, raw_material_id=coffee.id, name='قهوه', quantity='18', unit='gr'),
+            MaterialPurchase(raw_material_id=coffee.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=1),
+        ])
+        db.session.commit()
+        espresso_id, retired_id, customer_id = espresso.id, retired.id, customer.id
+
+        with self.assertRaises(InvalidOrderLines) as caught:
+            place_order([OrderLine(espresso_id, 1), OrderLine(retired_id, 1)], customer_id=customer_id, active_only=True)
+        self.assertEqual([line.menu_item_id for line in caught.exception.lines], [retired_id])
+        self.assertEqual(Order.query.count(), 0)
+
+        compiled_recipes([espresso_id])  # warm the recipe cache
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            placed = place_order(
+                [OrderLine(espresso_id, 2), OrderLine(espresso_id, 1, 70_000), OrderLine(retired_id, 0)],
+                customer_id=customer_id, status='پرداخت شده', skip_invalid=True,
+            )
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        db.session.commit()
+        self.assertEqual(len([s for s in statements if s.startswith('SELECT menu_item.id, menu_item.price')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO order_item')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO raw_material_usage')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE menu_item')]), 1)
+
+        order = placed.order
+        self.assertEqual([line.menu_item_id for line in placed.rejected], [retired_id])
+        self.assertEqual(placed.stocks, {espresso_id: 2})
+        self.assertEqual(db.session.get(MenuItem, espresso_id).stock, 2)
+        self.assertEqual(order.total_amount, 2 * 80_000 + 70_000)
+        self.assertEqual(sorted(item.id for item in order.order_items), sorted(placed.order_item_ids))
+        self.assertEqual(order.invoice_uid, placed.identifiers.invoice_uid)
+        self.assertAlmostEqual(coffee.current_stock, 1000 - 3 * 18)
+        self.assertEqual(verify_stock_ledger(db.session.connection()), [])
+        self.assertEqual(menu_popularity()[espresso_id], {'orders_count': 1, 'quantity_sold': 3})
+        self.assertEqual(verify_menu_item_stats(db.session.connection()), [])
+
+    def test_cart_batches_apply_in_order_and_reject_stale_revisions(self):
+        coffee = RawMaterial(name='قهوه', default_unit='gr')
+        category = Category(name='بار گرم', is_active=True)
+        customer = Customer(name='مشتری بیرون‌بر', phone='09120000011')
+        db.session.add_all([coffee, category, customer])
+        db.session.flush()
+        espresso = MenuItem(name='اسپرسو', price=80_000, stock=10, is_active=True, category_id=category.id)
+        latte = MenuItem(name='لاته', price=120_000, is_active=True, category_id=category.id)
+        table = Table(number=7)
+        db.session.add_all([espresso, latte, table])
+        db.session.flush()
+        db.session.add_all([
+            MenuItemMaterial(menu_item_id=espresso.id, raw_material_id=coffee.id, name='قهوه', quantity='18', unit='gr'),
+            MaterialPurchase(raw_material_id=coffee.id, purchase_date=date.today(), quantity=1, unit='kg', total_price=1),
+        ])
+        db.session.commit()
+        espresso_id, latte_id = espresso.id, latte.id
+
+        revision, operations = parse_cart_request({'revision': 0, 'operations': [
+            {'op': 'add', 'menu_item_id': espresso_id},
+            {'op': 'add', 'menu_item_id': latte_id, 'quantity': 2},
+            {'op': 'add', 'menu_item_id': espresso_id, 'quantity': '2'},
+        ]})
+        self.assertEqual(apply_table_operations(table, operations, revision), 1)
+        db.session.commit()
+        items = {item.menu_item_id: item for item in TableItem.query.filter_by(table_id=table.id)}
+        self.assertEqual({item_id: item.quantity for item_id, item in items.items()}, {espresso_id: 3, latte_id: 2})
+        self.assertEqual(table.status, 'اشغال شده')
+        self.assertEqual(table.final_amount, calculate_order_amount([{'quantity': 3, 'unit_price': 80_000}, {'quantity': 2, 'unit_price': 120_000}])[2])
+
+        with self.assertRaises(StaleCartRevision):
+            apply_table_operations(table, [CartOperation('remove', item_id=items[latte_id].id)], revision=0)
+        db.session.rollback()
+        self.assertEqual(TableItem.query.filter_by(table_id=table.id).count(), 2)
+        apply_table_operations(table, [
+            CartOperation('update', item_id=items[espresso_id].id, quantity=0),
+            CartOperation('remove', item_id=items[latte_id].id),
+        ], revision=1)
+        db.session.commit()
+        self.assertEqual((table.status, table.final_amount, table.cart_revision), ('خالی', 0, 2))
+
+        identifiers = generate_invoice_number()
+        order = Order(
+            invoice_number=identifiers.unique_number, daily_sequence=identifiers.daily_sequence,
+            invoice_uid=identifiers.invoice_uid, customer_id=customer.id, total_amount=0, final_amount=0,
+            type='بیرون‌بر',
+        )
+        db.session.add(order)
+        db.session.commit()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            apply_order_operations(order, [CartOperation('add', menu_item_id=espresso_id, quantity=1)] * 4, revision=0)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        db.session.commit()
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE "order" SET cart_revision')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO raw_material_usage')]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE menu_item')]), 1)
+        item = OrderItem.query.filter_by(order_id=order.id).one()
+        self.assertEqual((item.quantity, db.session.get(MenuItem, espresso_id).stock), (4, 6))
+        self.assertAlmostEqual(coffee.current_stock, 1000 - 4 * 18)
+
+        with self.assertRaises(CartError) as caught:
+            apply_order_operations(order, [
+                CartOperation('update', item_id=item.id, quantity=2),
+                CartOperation('remove', item_id=item.id),
+            ], revision=1)
+        self.assertEqual((caught.exception.index, caught.exception.details['requires_reason']), (1, True))
+        db.session.rollback()
+        self.assertEqual((item.quantity, order.cart_revision), (4, 1))
+        apply_order_operations(order, [
+            CartOperation('update', item_id=item.id, quantity=2),
+            CartOperation('remove', item_id=item.id, removal_reason='اشتباه ثبت شد'),
+        ], revision=1)
+        db.session.commit()
+        self.assertTrue(item.is_deleted)
+        self.assertEqual((order.final_amount, order.cart_revision), (0, 2))
+        self.assertEqual(RawMaterialUsage.query.filter_by(order_id=order.id).count(), 0)
+        self.assertEqual(verify_stock_ledger(db.session.connection()), [])
+
+    def test_waiters_can_edit_table_and_takeaway_carts(self):
+        category = Category(name='نوشیدنی سرد', is_active=True)
+        customer = Customer(name='مشتری گارسون', phone='09120000099')
+        table = Table(number=9)
+        db.session.add_all([category, customer, table])
+        db.session.flush()
+        item = MenuItem(name='لیموناد', price=60_000, stock=10, is_active=True, category_id=category.id)
+        order = Order(invoice_number=7201, customer_id=customer.id, type='بیرون‌بر', status='پرداخت نشده', total_amount=0, final_amount=0)
+        db.session.add_all([item, order])
+        db.session.commit()
+        client = self.waiter_client()
+        body = {'revision': 0, 'operations': [{'op': 'add', 'menu_item_id': item.id, 'quantity': 1}]}
+
+        for url in (f'/table/{table.id}/cart', f'/takeaway/{order.id}/cart'):
+            response = client.post(url, json=body)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertTrue(response.get_json()['success'], url)
+
+    def test_cart_endpoints_answer_unexpected_failures_with_json(self):
+        customer = Customer(name='مشتری خطا', phone='09120000012')
+        table = Table(number=8)
+        db.session.add_all([customer, table])
+        db.session.flush()
+        order = Order(invoice_number=7101, customer_id=customer.id, type='بیرون‌بر', status='پرداخت نشده', total_amount=0, final_amount=0)
+        db.session.add(order)
+        db.session.commit()
+        self.app.config['LOGIN_DISABLED'] = True
+        client = self.app.test_client()
+        body = {'operations': [{'op': 'add', 'menu_item_id': 1, 'quantity': 1}]}
+
+        failure = IntegrityError('INSERT', {}, Exception('constraint failed'))
+        for url, target in ((f'/table/{table.id}/cart', 'routes.table.apply_table_operations'),
+                            (f'/takeaway/{order.id}/cart', 'routes.takeaway.apply_order_operations')):
+            with mock.patch(target, side_effect=failure):
+                response = client.post(url, json=body)
+            self.assertEqual(response.status_code, 500)
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertFalse(response.get_json()['success'])
+
+    def test_settings_cache_loads_once_per_version_and_follows_commits(self):
+        db.session.add_all([Settings(tax_percent=10, cafe_name='مادلین'), CostFormulaSettings(staff_count=3)])
+        db.session.commit()
+
+        def read_in_new_request():
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            with self.app.app_context():
+                event.listen(db.engine, 'before_cursor_execute', listener)
+                try:
+                    values = (current_tax_percent(), current_settings().cafe_name, cost_formula_settings().staff_count)
+                    self.assertEqual(current_tax_percent(), values[0])  # memoized for the request
+                finally:
+                    event.remove(db.engine, 'before_cursor_execute', listener)
+                db.session.remove()
+            return values, len([s for s in statements if s.startswith('SELECT')])
+
+        self.assertEqual(read_in_new_request(), ((10, 'مادلین', 3), 2))
+        self.assertEqual(read_in_new_request(), ((10, 'مادلین', 3), 0))
+
+        settings = Settings.query.first()
+        settings.tax_percent = 12
+        db.session.commit()
+        self.assertEqual(read_in_new_request(), ((12, 'مادلین', 3), 2))
+
+        # Another worker's commit reaches this one only through the stamp.
+        with db.engine.begin() as connection:
+            connection.execute(text('UPDATE cost_formula_settings SET staff_count = 5'))
+        self.assertEqual(read_in_new_request()[0][2], 3)
+        bump_stamp(stamp_path(self.app.config['CACHE_STAMP_DIR'], 'tenant_settings', database_key(db.engine)))
+        self.assertEqual(read_in_new_request()[0][2], 5)
+
+    def test_live_events_publish_committed_changes_once_per_worker(self):
+        category = Category(name='نوشیدنی زنده', is_active=True)
+        customer = Customer(name='مهمان زنده', phone='09120000077')
+        table = Table(number=1, status='خالی')
+        db.session.add_all([category, customer, table])
+        db.session.flush()
+        item = MenuItem(name='چای', price=50_000, stock=10, is_active=True, category_id=category.id)
+        db.session.add(item)
+        db.session.commit()
+
+        engine = live_events_engine()
+        stream = stream_live_events(engine, seconds=0.3)  # a screen is listening from here on
+        hub = live_event_hub(engine)
+        start = hub.last_id
+
+        order = Order(
+            invoice_number=7001, daily_sequence=1, invoice_uid='20250301-0001', customer_id=customer.id,
+            total_amount=0, final_amount=0, status='پرداخت نشده', type='حضوری', table_id=table.id,
+        )
+        db.session.add(order)
+        db.session.flush()
+        table.status, table.order_id = 'اشغال شده', order.id
+        item.stock = 7
+        db.session.commit()
+
+        table.customer_name = 'برگشت خورده'
+        db.session.flush()
+        db.session.rollback()
+
+        # The availability pass runs after the commit, not under its write lock.
+        trace = []
+        on_statement = lambda conn, cursor, statement, *args: trace.append(  # noqa: E731
+            'availability' if 'FROM menu_item_material' in statement else 'sql'
+        )
+        on_commit = lambda conn: trace.append('commit')  # noqa: E731
+        event.listen(engine, 'before_cursor_execute', on_statement)
+        event.listen(engine, 'commit', on_commit)
+        try:
+            order.status = 'پرداخت شده'
+            item.stock = 5
+            db.session.commit()
+        finally:
+            event.remove(engine, 'before_cursor_execute', on_statement)
+            event.remove(engine, 'commit', on_commit)
+        self.assertLess(trace.index('commit'), trace.index('availability'))
+
+        events =[(kind, json.loads(payload)) for _, kind, payload in hub.events_after(start, timeout=2)]
+        self.assertEqual(events, [
+            ('order', {'order_id': order.id, 'action': 'created', 'type': 'حضوری', 'table_id': table.id}),
+            ('table', {'table_id': table.id}),
+            ('stock', {'items': {str(item.id): 7}, 'full': True}),
+            ('order', {'order_id': order.id, 'action': 'paid', 'type': 'حضوری', 'table_id': table.id}),
+            ('stock', {'items': {str(item.id): 5}, 'full': False}),
+        ])
+        # Buffered in the hub: a second screen reads them without another query.
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(len(hub.events_after(start, timeout=0)), 5)
+        finally:
+            event.remove(engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+
+        body = ''.join(stream)
+        self.assertTrue(body.startswith('retry: 1000\n\n'))
+        self.assertIn(f'event: table\ndata: {{"table_id": {table.id}}}\n\n', body)
+        self.assertEqual(body.count('event: '), 5)
+
+    def test_live_event_streams_are_capped_per_worker(self):
+        self.app.config.update(LOGIN_DISABLED=True, LIVE_STREAMS_PER_WORKER=1)
+        client = self.app.test_client()
+
+        first = client.get('/dashboard/events', buffered=False)
+        self.assertEqual(first.status_code, 200)
+        busy = client.get('/dashboard/events')
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(busy.headers['Retry-After'], '10')
+        self.assertEqual(busy.get_data(as_text=True), 'retry: 10000\n\n')
+
+        first.close()  # the screen went away: its slot is free again
+        second = client.get('/dashboard/events', buffered=False)
+        self.assertEqual(second.status_code, 200)
+        second.close()
+
+    def test_waiters_receive_live_events_and_refreshed_cards(self):
+        customer = Customer(name='مشتری زنده', phone='09120000088')
+        table = Table(number=4, status='خالی')
+        db.session.add_all([customer, table])
+        db.session.flush()
+        order = Order(invoice_number=7301, customer_id=customer.id, type='بیرون‌بر', status='پرداخت نشده', total_amount=0, final_amount=0)
+        db.session.add(order)
+        db.session.commit()
+        table_id, order_id = table.id, order.id
+        client = self.waiter_client()
+
+        stream = client.get('/dashboard/events', buffered=False)
+        self.assertEqual((stream.status_code, stream.mimetype), (200, 'text/event-stream'))
+        stream.close()
+        table_card = client.get(f'/dashboard/cards/table/{table_id}')
+        self.assertEqual(table_card.status_code, 200)
+        self.assertTrue(table_card.get_data(as_text=True).lstrip().startswith(f'<div class="table-card" data-table-id="{table_id}"'))
+        takeaway_card = client.get(f'/dashboard/cards/takeaway/{order_id}')
+        self.assertEqual(takeaway_card.status_code, 200)
+        self.assertTrue(takeaway_card.get_data(as_text=True).lstrip().startswith(f'<div class="takeaway-order-card" data-order-id="{order_id}"'))
+
+    def test_index_plan_is_applied_once_per_version(self):
+        engine = db.engine
+
+        def index_names():
+            inspector = inspect(engine)
+            return {index['name'] for table in ('order', 'order_item', 'raw_material_usage') for index in inspector.get_indexes(table)}
+
+        with engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_order_status_created_at'))
+            connection.execute(text('DROP INDEX ix_raw_material_usage_order_item_id'))
+            connection.execute(text("DELETE FROM schema_meta WHERE key = 'index_plan'"))
+        self.assertTrue(apply_index_plan(engine))
+        self.assertTrue({'ix_order_status_created_at', 'ix_raw_material_usage_order_item_id'} <= index_names())
+        self.assertTrue(all(index.name in index_names() for index in operational_indexes() if index.table.name in ('order', 'order_item', 'raw_material_usage')))
+
+        with engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_order_status_created_at'))
+        self.assertFalse(apply_index_plan(engine))
+        self.assertNotIn('ix_order_status_created_at', index_names())
+
+    def test_invoice_numbers_come_from_the_sequence_table(self):
+        customer = Customer(name='مشتری فاکتور', phone='09120000009')
+        db.session.add(customer)
+        db.session.flush()
+        now = datetime(2025, 3, 1, 12, 0)
+        db.session.add(Order(
+            invoice_number=5000, daily_sequence=104, invoice_uid='20250301-0104', customer_id=customer.id,
+            total_amount=0, final_amount=0, created_at=now,
+        ))
+        db.session.commit()
+
+        first = generate_invoice_number(now)
+        self.assertEqual((first.unique_number, first.daily_sequence, first.invoice_uid), (5001, 105, '20250301-0105'))
+        db.session.commit()
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        second = generate_invoice_number(now)
+        db.session.rollback()  # the order was never saved: its numbers are handed out again
+        third = generate_invoice_number(now)
+        self.assertEqual((second.unique_number, second.daily_sequence), (5002, 106))
+        self.assertEqual((third.unique_number, third.daily_sequence), (5002, 106))
+        self.assertFalse(any('max(' in statement for statement in statements))
+        self.assertEqual(generate_invoice_number(now + timedelta(days=1)).daily_sequence, 100)
+        db.session.commit()
+
+        self.app.config['INVOICE_NUMBER_BLOCK_SIZE'] = 10
+        try:
+            numbers = [generate_invoice_number(now).unique_number for _ in range(3)]
+            db.session.rollback()
+            self.assertEqual(numbers, [5004, 5005, 5006])
+            self.assertEqual(db.session.get(InvoiceSequence, 'invoice').value, 5013)
+        finally:
+            discard_reserved_blocks()
+
+
+    def test_startup_backfills_run_as_resumable_chunked_jobs(self):
+        regular = Customer(name='مشتری قدیمی', phone='09120000010')
+        browsing = Customer(name='بدون سفارش', phone='09120000011')
+        db.session.add_all([regular, browsing])
+        db.session.flush()
+        day = datetime(2025, 3, 1, 9, 0)
+        db.session.add_all([
+            Order(invoice_number=1, total_amount=0, final_amount=0, created_at=day, customer_id=regular.id),
+            Order(invoice_number=2, total_amount=0, final_amount=0, created_at=day + timedelta(hours=1), daily_sequence=103, customer_id=regular.id),
+            Order(invoice_number=3, total_amount=0, final_amount=0, created_at=day + timedelta(hours=2), customer_id=regular.id),
+            Order(invoice_number=4, total_amount=0, final_amount=0, created_at=day + timedelta(days=1), customer_id=regular.id),
+        ])
+        db.session.commit()
+        # Orders created before the identifiers existed; bypass the model defaults.
+        db.session.execute(text('UPDATE "order" SET invoice_uid = NULL'))
+        db.session.execute(text('UPDATE "order" SET daily_sequence = NULL WHERE invoice_number != 2'))
+        db.session.commit()
+
+        jobs = run_pending_jobs(chunk_size=2)
+        self.assertEqual(sorted(job.name for job in jobs), ['customer_birth_dates', 'invoice_identifiers'])
+        self.assertTrue(all(job.status == DONE and job.progress == 100 for job in jobs))
+        invoice_job = next(job for job in jobs if job.name == 'invoice_identifiers')
+        self.assertEqual((invoice_job.processed, invoice_job.total), (4, 4))
+
+        db.session.expire_all()
+        identifiers = [(order.daily_sequence, order.invoice_uid) for order in Order.query.order_by(Order.invoice_number)]
+        self.assertEqual(identifiers, [
+            (100, '20250301-0100'), (103, '20250301-0103'), (104, '20250301-0104'), (100, '20250302-0100'),
+        ])
+        self.assertIsNotNone(db.session.get(Customer, regular.id).birth_date)
+        self.assertIsNone(db.session.get(Customer, browsing.id).birth_date)
+
+        # Once per database: a second pass finds nothing left to do.
+        self.assertEqual(run_pending_jobs(chunk_size=2), [])
+        self.assertEqual(BackgroundJob.query.filter_by(status=DONE).count(), 2)
+
 if __name__ == '__main__':
     unittest.main()
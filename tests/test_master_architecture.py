@@ -5,9 +5,16 @@ import unittest
 
 from app import create_app
 from config import Config
-from models.master_models import CafeEventLog, CafeModule, CafeTenant, CafeWarehouseDefinition, CafeWarehouseProfile, MasterUser
-from models.models import db
-from services.master_service import create_managed_cafe, seed_demo_cafes
+from models.master_models import CafeEventLog, CafeMetricsSnapshot, CafeModule, CafeTenant, CafeWarehouseDefinition, CafeWarehouseProfile, MasterUser
+from models.models import Customer, db
+from services.schema_migrations import SCHEMA_VERSION, migrate_operational_schema, read_schema_version
+from services.fleet_metrics import latest_cafe_metrics, metrics_refresher, refresh_dirty_cafe_metrics
+from services.fleet_query import invalidate_fleet_results, run_fleet_query
+from services.fleet_reports import cafe_overview
+from services.master_service import create_managed_cafe, seed_demo_cafes, set_cafe_modules
+from services.tenant_context import resolve_tenant_context
+from services.tenant_engines import dispose_tenant_engines, get_tenant_engine, tenant_engines, tenant_sessionmaker
+from sqlalchemy import event, inspect, text
 
 
 class MasterArchitectureTest(unittest.TestCase):
@@ -21,6 +28,7 @@ class MasterArchitectureTest(unittest.TestCase):
             TESTING = True
             SECRET_KEY = "test-secret"
             TENANTS_DIR = os.path.join(root, "tenants")
+            CACHE_STAMP_DIR = os.path.join(root, "stamps")
             SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(instance_dir, 'cafe.db')}"
             MASTER_DB_URI = f"sqlite:///{os.path.join(instance_dir, 'master.db')}"
             SQLALCHEMY_BINDS = {"master": MASTER_DB_URI}
@@ -35,6 +43,7 @@ class MasterArchitectureTest(unittest.TestCase):
             db.session.remove()
             for engine in db.engines.values():
                 engine.dispose()
+        dispose_tenant_engines()
         self.temp_dir.cleanup()
 
     def test_master_login_is_hashed_and_requires_correct_password(self):
@@ -142,6 +151,125 @@ class MasterArchitectureTest(unittest.TestCase):
         self.assertIn("انبار بار و سرویس", body)
         self.assertNotIn("انبار قلیان", body)
 
+    def test_tenant_engine_is_pooled_and_dropped_when_cafe_is_deactivated(self):
+        with self.app.app_context():
+            seed_demo_cafes(self.app.config["TENANTS_DIR"])
+            db_path = CafeTenant.query.filter_by(slug="madeline").one().db_path
+
+        self.client.post("/cafe/madeline/login", data={"username": "admin", "password": "admin123"})
+        first = tenant_engines.get_engine(db_path)
+        self.assertEqual(self.client.get("/admin/warehouses").status_code, 200)
+        self.assertIs(tenant_engines.get_engine(db_path), first)
+        with first.connect() as connection:
+            journal_mode = connection.exec_driver_sql("pragma journal_mode").scalar()
+        self.assertEqual(journal_mode, "wal")
+
+        self.client.post("/master/login", data={"username": "admin", "password": "admin"})
+        self.client.post("/master/cafes/madeline/toggle-active")
+        self.assertNotIn(db_path, tenant_engines)
+
+    def test_legacy_tenant_file_is_migrated_once_and_then_skipped(self):
+        legacy_path = os.path.join(self.temp_dir.name, "legacy.db")
+        with sqlite3.connect(legacy_path) as connection:
+            connection.execute("CREATE TABLE customer (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, phone VARCHAR(20))")
+            connection.execute("CREATE TABLE settings (id INTEGER PRIMARY KEY, tax_percent FLOAT)")
+        engine = get_tenant_engine(legacy_path)
+
+        with self.app.app_context():
+            self.assertEqual(read_schema_version(engine), 0)
+            self.assertTrue(migrate_operational_schema(engine))
+        inspector = inspect(engine)
+        self.assertIn("birth_date", {column["name"] for column in inspector.get_columns("customer")})
+        self.assertIn("website", {column["name"] for column in inspector.get_columns("settings")})
+        self.assertTrue({"order", "daily_sales_rollup", "material_stock_balance"} <= set(inspector.get_table_names()))
+        self.assertEqual(read_schema_version(engine), SCHEMA_VERSION)
+
+        statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        with self.app.app_context():
+            self.assertFalse(migrate_operational_schema(engine))
+        self.assertEqual(len(statements), 1)
+
+    def test_fleet_query_returns_partial_results_and_memoizes(self):
+        with self.app.app_context():
+            seed_demo_cafes(self.app.config["TENANTS_DIR"])
+            cafes = CafeTenant.query.order_by(CafeTenant.id).all()
+            broken = cafes[-1]
+            invalidate_fleet_results()
+            dispose_tenant_engines()
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(broken.db_path + suffix):
+                    os.remove(broken.db_path + suffix)
+            with open(broken.db_path, "wb") as handle:
+                handle.write(b"this is not a sqlite database" * 100)
+
+            results = run_fleet_query("test_overview", cafes, cafe_overview)
+            self.assertEqual(list(results), [cafe.slug for cafe in cafes])
+            self.assertFalse(results[broken.slug].ok)
+            healthy = [results[cafe.slug] for cafe in cafes[:-1]]
+            self.assertTrue(all(result.ok for result in healthy))
+            self.assertTrue(all(result.value["users_count"] >= 1 for result in healthy))
+
+            calls = []
+            cached = run_fleet_query("test_overview", cafes[:-1], lambda s: calls.append(1))
+            self.assertEqual(calls, [])
+            self.assertEqual(cached[cafes[0].slug], results[cafes[0].slug])
+
+            def write(session):
+                session.execute(text("DELETE FROM user"))
+
+            denied = run_fleet_query("test_write", cafes[:1], write)[cafes[0].slug]
+            self.assertIn("readonly", denied.error.replace(" ", "").lower())
+            with get_tenant_engine(cafes[0].db_path).connect() as connection:
+                self.assertEqual(connection.exec_driver_sql("PRAGMA query_only").scalar(), 0)
+
+    def test_dashboard_renders_from_metrics_snapshots_refreshed_on_tenant_writes(self):
+        with self.app.app_context():
+            seed_demo_cafes(self.app.config["TENANTS_DIR"])
+            active_ids = [cafe.id for cafe in CafeTenant.query.filter_by(is_active=True)]
+
+        self.client.post("/master/login", data={"username": "admin", "password": "admin"})
+        self.assertEqual(self.client.get("/master/").status_code, 200)
+
+        with self.app.app_context():
+            snapshots = latest_cafe_metrics()
+            self.assertEqual(sorted(snapshots), sorted(active_ids))
+            cafe = CafeTenant.query.filter_by(slug="madeline").one()
+            before = snapshots[cafe.id].customers_count
+
+            metrics_refresher.enabled = True
+            try:
+                with tenant_sessionmaker(cafe.db_path)() as tenant_session:
+                    tenant_session.add(Customer(name="مشتری تازه", phone="09120000999"))
+                    tenant_session.commit()
+                dirty = set(metrics_refresher._dirty)
+            finally:
+                metrics_refresher.enabled = False
+                metrics_refresher._dirty.clear()
+            self.assertEqual(len(dirty), 1)
+
+            refresh_dirty_cafe_metrics(dirty)
+            db.session.expire_all()
+            self.assertEqual(latest_cafe_metrics([cafe.id])[cafe.id].customers_count, before + 1)
+            self.assertEqual(CafeMetricsSnapshot.query.filter_by(cafe_id=cafe.id).count(), 1)
+
+        trend = self.client.get("/master/metrics/trend?days=7").get_json()
+        self.assertEqual(len(trend["points"]), 1)
+        self.assertEqual(trend["points"][0]["cafes"], len(active_ids))
+
+    def test_tenant_context_is_cached_until_master_changes_modules(self):
+        with self.app.app_context():
+            seed_demo_cafes(self.app.config["TENANTS_DIR"])
+            cached = resolve_tenant_context("kiosk")
+            self.assertIs(resolve_tenant_context("kiosk"), cached)
+            self.assertNotIn("inventory", cached.enabled_modules)
+
+            kiosk = CafeTenant.query.filter_by(slug="kiosk").one()
+            set_cafe_modules(kiosk, ["orders", "inventory"])
+            db.session.commit()
+            refreshed = resolve_tenant_context("kiosk")
+            self.assertEqual(refreshed.enabled_modules, frozenset({"orders", "inventory"}))
+
     def test_master_access_view_exposes_the_canonical_warehouse_profile(self):
         with self.app.app_context():
             seed_demo_cafes(self.app.config["TENANTS_DIR"])
@@ -5,9 +5,9 @@ from datetime import datetime
 from typing import Optional, ContextManager
 from contextlib import contextmanager
 from flask import session, current_app
-from sqlalchemy import create_engine
-from models.master_models import CafeTenant
 from models.models import db
+from services.tenant_context import resolve_tenant_context
+from services.tenant_engines import get_tenant_engine
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -200,16 +200,15 @@ def tenant_db_context(slug: Optional[str] = None):
         return
     
     # Get tenant database path
-    with current_app.app_context():
-        cafe = CafeTenant.query.filter_by(slug=slug).first()
+    cafe = resolve_tenant_context(slug)
     
     if not cafe or not os.path.exists(cafe.db_path):
         # Tenant not found or database doesn't exist, use default
         yield
         return
     
-    # Create engine for tenant database
-    tenant_engine = create_engine(f"sqlite:///{cafe.db_path}")
+    # Shared pooled engine for tenant database
+    tenant_engine = get_tenant_engine(cafe.db_path)
     
     # Store original bind
     original_bind = db.session.bind